@@ -0,0 +1,80 @@
+'''
+Memory benchmark of CompactListing against lists of the FileObject classes.
+
+Usage:
+    python Benchmarks/bench_compact_listing.py [--count N]
+'''
+import os
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from Util.Repository import FileObject, S3FileObject, CompactListing
+from Util.S3Listing import ListedObject
+import Util.S3Repository
+
+
+def synthetic_versions(count):
+    '''
+    Generate listing entries for synthetic object versions spread over 1000 folders.
+    :param count: (int) Number of versions
+    :return: (iterator) ListedObjects
+    '''
+    start = datetime(2019, 1, 1, tzinfo=timezone.utc)
+    for n in range(count):
+        yield ListedObject({'Key': f'folder{n % 1000}/sub{n % 7}/file{n}.dat', 'VersionId': f'{n:032x}',
+                            'LastModified': start + timedelta(seconds=n), 'Size': n * 17, 'IsLatest': True,
+                            'StorageClass': 'STANDARD', 'ETag': f'"{n:032x}"'})
+
+
+def measure(label, build, count):
+    '''
+    Build a container twice: once to time it, and once under tracemalloc to measure its memory.
+    '''
+    start = time.perf_counter()
+    build(count)
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    result = build(count)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f'{label:<34} {current / 2 ** 20:9.1f} MB {peak / 2 ** 20:9.1f} MB {elapsed:8.1f} s')
+    return result
+
+
+def build_file_objects(count):
+    return [FileObject(full_name=o.key + '$' + o.id, size=o.size, timestamp=o.last_modified)
+            for o in synthetic_versions(count)]
+
+
+def build_s3_file_objects(count):
+    return [S3FileObject(o) for o in synthetic_versions(count)]
+
+
+def build_s3_repository_objects(count):
+    return dict((o.key, Util.S3Repository.S3FileObject(o.key, bucket_object_version=o))
+                for o in synthetic_versions(count))
+
+
+def build_compact_listing(count):
+    listing = CompactListing()
+    for o in synthetic_versions(count):
+        listing.append(o.key + '$' + o.id, o.size, o.last_modified)
+    return listing
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Memory use of file object containers')
+    parser.add_argument('--count', type=int, default=1000000, help='Number of synthetic objects')
+    args = parser.parse_args()
+
+    print(f'{"objects: " + format(args.count, ","):<34} {"retained":>12} {"peak":>12} {"build":>10}')
+    measure('list of FileObject', build_file_objects, args.count)
+    measure('list of S3FileObject', build_s3_file_objects, args.count)
+    measure('dict of S3Repository.S3FileObject', build_s3_repository_objects, args.count)
+    measure('CompactListing', build_compact_listing, args.count)
@@ -0,0 +1,64 @@
+'''
+Benchmark of the cost analytics over a listing cache: reading the versions into NumPy columns and
+rolling them up by class, version state and folder, and simulating a transition.
+
+Usage:
+    python Benchmarks/bench_cost_analysis.py [--count N] [--folder FOLDER]
+'''
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from Util.CostAnalysis import CostAnalysis
+from Util.ListingCache import ListingCache
+from Util.Repository import S3StorageClass
+
+START = 1546300800 * 10 ** 6
+
+
+def synthetic_rows(count):
+    '''
+    Generate cache rows for synthetic versions spread over 1000 folders, with mixed classes, noncurrent
+    versions and delete markers.
+    :param count: (int) Number of versions
+    :return: (iterator) Rows for ListingCache.add_rows
+    '''
+    classes = (S3StorageClass.STANDARD, S3StorageClass.STANDARD, S3StorageClass.STANDARD_IA, S3StorageClass.GLACIER)
+    for n in range(count):
+        yield (f'folder{n % 1000}/sub{n % 7}/file{n // 2}.dat', f'v{n % 2}', (n * 7919) % 10 ** 7,
+               START + n * 10 ** 6, None, classes[n % 4].value, n % 2 == 0, n % 50 == 1)
+
+
+def timed(label, function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    print(f'{label:<40} {time.perf_counter() - start:8.2f} s')
+    return result
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Times of the cost analytics over a listing cache')
+    parser.add_argument('--count', type=int, default=1000000, help='Number of synthetic object versions')
+    parser.add_argument('--folder', help='Folder for the cache database (default: a temporary folder)')
+    args = parser.parse_args()
+
+    database_name = os.path.join(args.folder or tempfile.mkdtemp(), 'cost.db')
+    if not os.path.exists(database_name):
+        with ListingCache(database_name) as cache:
+            timed('build cache', cache.add_rows, synthetic_rows(args.count))
+    print(f'versions: {args.count:,}')
+    analysis = timed('read versions into columns', CostAnalysis, database_name)
+    timed('by class', analysis.by_class)
+    timed('by version state', analysis.by_version_state)
+    folders = timed('by folder, recursive', analysis.by_folder)
+    timed('early deletion cost', analysis.early_deletion_cost)
+    estimate = timed('simulate transition of folder2/', analysis.simulate_transition, 'folder2/',
+                     S3StorageClass.DEEP_ARCHIVE, True)
+    print(f'folders: {len(folders):,}, monthly cost: ${analysis.monthly_cost():,.2f}, '
+          f'transition saves ${estimate.monthly_savings:,.4f} a month')
+    analysis.close()
@@ -0,0 +1,93 @@
+'''
+Build and load benchmark of the listing cache: the normalized, indexed schema written with executemany
+and read with fetchmany, against the single FileObjects table written and read one row at a time.
+
+Usage:
+    python Benchmarks/bench_listing_cache.py [--count N] [--folder FOLDER]
+'''
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from Util.ListingCache import ListingCache
+from Util.Repository import S3FileObject, CachedRepository, CompactListing
+from Util.S3Listing import ListedObject
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+
+def synthetic_versions(count):
+    '''
+    Generate S3FileObjects for synthetic object versions spread over 1000 folders.
+    :param count: (int) Number of versions
+    :return: (list) S3FileObjects
+    '''
+    start = datetime(2019, 1, 1, tzinfo=timezone.utc)
+    return [S3FileObject(ListedObject({'Key': f'folder{n % 1000}/sub{n % 7}/file{n}.dat', 'VersionId': f'{n:032x}',
+                                       'LastModified': start + timedelta(seconds=n), 'Size': n * 17,
+                                       'IsLatest': True, 'StorageClass': 'STANDARD', 'ETag': f'"{n:032x}"'}))
+            for n in range(count)]
+
+
+def build_row_at_a_time(database_name, file_objects):
+    '''
+    Write the cache the way it was written before the normalized schema.
+    '''
+    with sqlite3.connect(database_name) as db:
+        cursor = db.cursor()
+        cursor.execute('CREATE TABLE "FileObjects" ("Name" TEXT, "Size" INTEGER, "Time" TEXT)')
+        cursor.execute('CREATE UNIQUE INDEX "FileObjectsName" ON "FileObjects" ("Name")')
+        for obj in file_objects:
+            cursor.execute('INSERT INTO FileObjects(Name,Size,Time) VALUES(?,?,?)',
+                           (obj.full_name, obj.size, obj.timestamp.strftime(TIME_FORMAT)))
+
+
+def load_row_at_a_time(database_name):
+    objects = CompactListing()
+    with sqlite3.connect(database_name) as db:
+        cursor = db.cursor()
+        cursor.execute('SELECT Name, Size, Time FROM FileObjects')
+        for row in cursor:
+            objects.append(row[0], row[1], datetime.strptime(row[2], TIME_FORMAT))
+    return objects
+
+
+def build_normalized(database_name, file_objects):
+    ListingCache.build(database_name, file_objects).close()
+
+
+def timed(label, function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    print(f'{label:<40} {time.perf_counter() - start:8.2f} s')
+    return result
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Build and load times of the listing cache')
+    parser.add_argument('--count', type=int, default=1000000, help='Number of synthetic object versions')
+    parser.add_argument('--folder', help='Folder for the cache databases (default: a temporary folder)')
+    args = parser.parse_args()
+
+    folder = args.folder or tempfile.mkdtemp()
+    file_objects = synthetic_versions(args.count)
+    print(f'versions: {args.count:,}')
+    old_name = os.path.join(folder, 'row_at_a_time.db')
+    new_name = os.path.join(folder, 'normalized.db')
+    for name in (old_name, new_name):
+        if os.path.exists(name):
+            os.remove(name)
+    timed('build, FileObjects row at a time', build_row_at_a_time, old_name, file_objects)
+    timed('build, normalized with executemany', build_normalized, new_name, file_objects)
+    timed('load, FileObjects with strptime', load_row_at_a_time, old_name)
+    timed('load, normalized with fetchmany', CachedRepository, new_name)
+    timed('migrate FileObjects to normalized', ListingCache, old_name)
+    for name in (old_name, new_name):
+        print(f'{os.path.basename(name):<40} {os.path.getsize(name) / 2 ** 20:8.1f} MB')
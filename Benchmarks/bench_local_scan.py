@@ -0,0 +1,85 @@
+'''
+Benchmark of local tree scanning: the previous os.walk scan (with two stat calls per file)
+against LocalScanner, serially and on a thread pool.
+
+Usage:
+    python Benchmarks/bench_local_scan.py [--count N] [--root DIR] [--workers N]
+
+The tree is generated under DIR (default: a temporary directory) unless it already exists there.
+'''
+import os
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from Util.Repository import LocalRepository
+
+FILES_PER_FOLDER = 100
+FOLDERS_PER_FOLDER = 10
+
+
+def generate_tree(root, count):
+    '''
+    Generate a tree of empty files, FILES_PER_FOLDER per folder, FOLDERS_PER_FOLDER sub-folders per folder.
+    :param root: (string) Root folder of tree
+    :param count: (int) Number of files
+    '''
+    folders = count // FILES_PER_FOLDER + 1
+    for n in range(folders):
+        # folder n is sub-folder n % FOLDERS_PER_FOLDER of folder n // FOLDERS_PER_FOLDER
+        parts = []
+        parent = n
+        while parent:
+            parts.append(f'd{parent % FOLDERS_PER_FOLDER}')
+            parent //= FOLDERS_PER_FOLDER
+        folder = os.path.join(root, *reversed(parts))
+        os.makedirs(folder, exist_ok=True)
+        for i in range(min(FILES_PER_FOLDER, count - n * FILES_PER_FOLDER)):
+            with open(os.path.join(folder, f'file{i}.dat'), 'w') as f:
+                f.write('x' * (i % 10))
+
+
+def legacy_scan(root):
+    count = 0
+    for dir_path, dir_names, file_names in os.walk(root):
+        for filename in file_names:
+            full_path = dir_path + os.sep + filename
+            size = os.path.getsize(full_path)
+            timestamp = datetime.fromtimestamp(os.stat(full_path).st_mtime)
+            count += 1
+    return count
+
+
+def timed(label, scan):
+    start = time.perf_counter()
+    count = scan()
+    elapsed = time.perf_counter() - start
+    print(f'{label:<28} {count:>10,} files {elapsed:8.2f} s')
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Local tree scan benchmark')
+    parser.add_argument('--count', type=int, default=1000000, help='Number of files in generated tree')
+    parser.add_argument('--root', help='Folder for generated tree (kept after benchmark)')
+    parser.add_argument('--workers', type=int, default=8, help='Threads for parallel scan')
+    args = parser.parse_args()
+
+    root = args.root or tempfile.mkdtemp(prefix='cloudsync-scan-')
+    try:
+        if not os.path.exists(os.path.join(root, 'file0.dat')):
+            start = time.perf_counter()
+            generate_tree(root, args.count)
+            print(f'generated {args.count:,} files in {time.perf_counter() - start:.1f} s')
+        timed('os.walk + getsize + stat', lambda: legacy_scan(root))
+        timed('LocalScanner, 1 thread', lambda: sum(1 for o in LocalRepository.scan(root, max_workers=1)))
+        timed(f'LocalScanner, {args.workers} threads',
+              lambda: sum(1 for o in LocalRepository.scan(root, max_workers=args.workers)))
+    finally:
+        if not args.root:
+            shutil.rmtree(root)
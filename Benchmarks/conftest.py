@@ -0,0 +1,162 @@
+'''
+Fixtures of the pytest-benchmark suite: synthetic buckets, listing caches and local trees of 10k, 1M
+and 10M objects, generated once per run for each size.
+
+Usage:
+    python -m pytest Benchmarks [--bench-size 10k,1m] [--bench-root DIR] [--benchmark-autosave]
+
+Only 10k is run unless --bench-size asks for more; 10M needs several GB of memory for the fake bucket.
+Trees and caches generated under DIR are kept for the next run.  --benchmark-autosave stores the
+results as JSON under .benchmarks, named after the commit, and "pytest-benchmark compare" compares them;
+the peak memory of each benchmark is in its extra_info.
+'''
+import os
+import sys
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from Util.FakeS3 import FakeS3Client
+from Util.Repository import CachedRepository
+from bench_local_scan import generate_tree
+import pytest
+
+SIZES = {'10k': 10000, '1m': 1000000, '10m': 10000000}
+BUCKET_NAME = 'bench'
+MB = 2 ** 20
+# seconds each request of latent_bucket takes, and keys in each of its pages
+LISTING_LATENCY = 0.005
+LISTING_PAGE_SIZE = 100
+
+
+def pytest_addoption(parser):
+    parser.addoption('--bench-size', default='10k',
+                     help=f'Comma-separated sizes of the synthetic repositories (of: {", ".join(SIZES)}; default: 10k)')
+    parser.addoption('--bench-root', help='Folder to keep generated trees and caches in (default: a temporary folder)')
+
+
+def pytest_generate_tests(metafunc):
+    if 'size' in metafunc.fixturenames:
+        names = [name.strip().lower() for name in metafunc.config.getoption('--bench-size', '10k').split(',')]
+        unknown = [name for name in names if name not in SIZES]
+        if unknown:
+            raise Exception(f'--bench-size must be some of {", ".join(SIZES)}, not {", ".join(unknown)}')
+        metafunc.parametrize('size', [SIZES[name] for name in names], ids=names, scope='session')
+
+
+def synthetic_entries(count, folders=1000, sub_folders=7):
+    '''
+    Generate listing entries for synthetic object versions spread over 1000 folders, like the entries of
+    bench_compact_listing.  Every tenth object has an older version, and every hundredth is deleted.
+    :param count: (int) Number of versions
+    :param folders: (int) Number of top-level folders
+    :param sub_folders: (int) Number of sub-folders of each folder
+    :return: (iterator) Version dicts, the versions of a key newest first
+    '''
+    start = datetime(2019, 1, 1, tzinfo=timezone.utc)
+    n = 0
+    while n < count:
+        key = f'folder{n % folders}/sub{n % sub_folders}/file{n}.dat'
+        versions = 2 if n % 10 == 0 and n + 1 < count else 1
+        for v in range(versions):
+            entry = {'Key': key, 'VersionId': f'{n + v:032x}', 'LastModified': start + timedelta(seconds=n - v),
+                     'IsLatest': v == 0}
+            if n % 100 != 0 or v > 0:
+                entry.update({'Size': n * 17, 'ETag': f'"{n + v:032x}"', 'StorageClass': 'STANDARD'})
+            yield entry
+        n += versions
+
+
+@pytest.fixture(scope='session')
+def bench_root(tmp_path_factory, request):
+    root = request.config.getoption('--bench-root', None)
+    if root:
+        os.makedirs(root, exist_ok=True)
+        return root
+    return str(tmp_path_factory.mktemp('bench'))
+
+
+@pytest.fixture(scope='session')
+def fake_bucket(size):
+    '''
+    Versioned fake bucket of size object versions, without request latency, so listings measure the
+    processing of the pages.
+    '''
+    client = FakeS3Client()
+    client.create_bucket(Bucket=BUCKET_NAME)
+    client.add_listing(BUCKET_NAME, synthetic_entries(size))
+    client.list_entries(BUCKET_NAME, '', None)
+    return client
+
+
+@pytest.fixture(scope='session')
+def latent_bucket(size):
+    '''
+    Versioned fake bucket of size object versions in 64 folders, whose requests take LISTING_LATENCY, so
+    listings are dominated by round trips, as they are with S3.  Pages are small so that the 10k bucket
+    takes as many requests as a bucket ten times larger listed in full pages.
+    '''
+    client = FakeS3Client(latency=LISTING_LATENCY, page_size=LISTING_PAGE_SIZE)
+    client.create_bucket(Bucket=BUCKET_NAME)
+    client.add_listing(BUCKET_NAME, synthetic_entries(size, folders=8, sub_folders=8))
+    client.list_entries(BUCKET_NAME, '', None)
+    return client
+
+
+@pytest.fixture(scope='session')
+def cache_database(fake_bucket, bench_root, size):
+    '''
+    Listing cache of the fake bucket, built once and only read by the benchmarks.
+    '''
+    database_name = os.path.join(bench_root, f'cache-{size}.db')
+    if not os.path.exists(database_name):
+        CachedRepository.create_local_cached_database(BUCKET_NAME, database_name, client=fake_bucket)
+    return database_name
+
+
+@pytest.fixture(scope='session')
+def local_tree(bench_root, size):
+    '''
+    Tree of size small files, 100 per folder, generated by bench_local_scan.
+    '''
+    root = os.path.join(bench_root, f'tree-{size}')
+    if not os.path.exists(os.path.join(root, 'file0.dat')):
+        generate_tree(root, size)
+    return root
+
+
+def rounds_for(size):
+    '''
+    Rounds of a benchmark: several for small repositories, one for large ones, which take seconds each.
+    '''
+    return max(1, min(5, 100000 // size))
+
+
+@pytest.fixture
+def measure(benchmark, size):
+    '''
+    Run a function once under tracemalloc to record its peak memory, then benchmark it.  tracemalloc only
+    counts memory allocated by Python, including numpy arrays, not memory allocated by SQLite.
+    :return: (function) Called with the function, its arguments, and a setup function called before each run
+    '''
+    def run(function, *args, setup=None):
+        if setup is not None:
+            setup()
+        tracemalloc.start()
+        try:
+            function(*args)
+            current, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        benchmark.extra_info['objects'] = size
+        benchmark.extra_info['peak_memory_mb'] = round(peak / MB, 1)
+
+        def setup_round():
+            if setup is not None:
+                setup()
+            return args, {}
+
+        return benchmark.pedantic(function, setup=setup_round, rounds=rounds_for(size), iterations=1)
+
+    return run
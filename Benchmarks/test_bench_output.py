@@ -0,0 +1,51 @@
+'''
+Benchmarks of BucketList.output_file_objects writing a listed bucket to each of its sinks.
+'''
+import contextlib
+import os
+
+import pytest
+
+pytest.importorskip('pytest_benchmark')
+pytest.importorskip('openpyxl')
+
+from conftest import BUCKET_NAME
+from BucketList import BucketOutput, OutputType, output_file_objects
+from Util.S3Repository import Repository
+
+
+@pytest.fixture(scope='session')
+def bucket_objects(fake_bucket):
+    return list(Repository.stream(BUCKET_NAME, client=fake_bucket))
+
+
+@pytest.mark.benchmark(group='output')
+@pytest.mark.parametrize('show_versions', [False, True], ids=['latest', 'versions'])
+def test_output_stdout(measure, bucket_objects, show_versions):
+    def output():
+        with open(os.devnull, 'w') as f, contextlib.redirect_stdout(f):
+            output_file_objects(bucket_objects, BucketOutput(OutputType.StandardOutput, True, show_versions))
+
+    measure(output)
+
+
+@pytest.mark.benchmark(group='output')
+@pytest.mark.parametrize('show_versions', [False, True], ids=['latest', 'versions'])
+def test_output_text_file(measure, bucket_objects, bench_root, show_versions):
+    output = BucketOutput(OutputType.TextFile, True, show_versions, filename=os.path.join(bench_root, 'list.csv'))
+    measure(output_file_objects, bucket_objects, output)
+
+
+@pytest.mark.benchmark(group='output')
+def test_output_excel(measure, bucket_objects, bench_root):
+    output = BucketOutput(OutputType.Excel, True, False, filename=os.path.join(bench_root, 'list.xlsx'))
+    measure(output_file_objects, bucket_objects, output)
+
+
+@pytest.mark.benchmark(group='output')
+def test_output_stream(measure, fake_bucket, bench_root):
+    '''
+    List and write at the same time, as BucketList does: memory does not depend on the size of the bucket
+    '''
+    output = BucketOutput(OutputType.TextFile, True, False, filename=os.path.join(bench_root, 'stream.csv'))
+    measure(lambda: output_file_objects(Repository.stream(BUCKET_NAME, client=fake_bucket), output))
@@ -0,0 +1,89 @@
+'''
+Benchmarks of building repositories: listing a fake bucket, creating and loading the listing cache,
+scanning a local tree, and diffing a bucket listing against the cache.
+'''
+import os
+from datetime import datetime, timezone
+
+import pytest
+
+pytest.importorskip('pytest_benchmark')
+
+from conftest import BUCKET_NAME
+from Util.Diff import diff, s3_entries, cache_snapshot_entries, entries_identical_at_time
+from Util.ListingCache import ListingCache
+from Util.Repository import S3Repository, CachedRepository, LocalRepository
+from Util.S3Listing import ShardedLister
+import Util.S3Repository
+
+# listing calls made at the same time by the sharded listing
+LISTING_WORKERS = 8
+
+
+@pytest.mark.benchmark(group='s3-listing')
+def test_s3_repository(measure, fake_bucket):
+    measure(lambda: Util.S3Repository.Repository(BUCKET_NAME, client=fake_bucket))
+
+
+@pytest.mark.benchmark(group='s3-listing')
+def test_s3_repository_serial(measure, fake_bucket):
+    measure(lambda: Util.S3Repository.Repository(BUCKET_NAME, max_workers=1, client=fake_bucket))
+
+
+@pytest.mark.benchmark(group='s3-listing')
+def test_s3_file_objects(measure, fake_bucket):
+    measure(lambda: S3Repository(BUCKET_NAME, client=fake_bucket))
+
+
+@pytest.mark.benchmark(group='s3-listing-latency')
+def test_sharded_listing(measure, latent_bucket):
+    '''
+    List a bucket whose requests have latency by shards at the same time; compare with test_serial_listing
+    '''
+    lister = ShardedLister(latent_bucket, BUCKET_NAME, max_workers=LISTING_WORKERS)
+    measure(lambda: sum(1 for o in lister.list()))
+
+
+@pytest.mark.benchmark(group='s3-listing-latency')
+def test_serial_listing(measure, latent_bucket):
+    lister = ShardedLister(latent_bucket, BUCKET_NAME, max_workers=LISTING_WORKERS)
+    measure(lambda: sum(1 for o in lister.list_serial()))
+
+
+@pytest.mark.benchmark(group='cache')
+def test_cache_create(measure, fake_bucket, bench_root, size):
+    database_name = os.path.join(bench_root, f'create-{size}.db')
+
+    def remove():
+        if os.path.exists(database_name):
+            os.remove(database_name)
+
+    measure(CachedRepository.create_local_cached_database, BUCKET_NAME, database_name, fake_bucket, setup=remove)
+    remove()
+
+
+@pytest.mark.benchmark(group='cache')
+def test_cache_load(measure, cache_database):
+    measure(CachedRepository, cache_database)
+
+
+@pytest.mark.benchmark(group='local-scan')
+def test_local_scan(measure, local_tree):
+    measure(LocalRepository, local_tree)
+
+
+@pytest.mark.benchmark(group='local-scan')
+def test_local_scan_serial(measure, local_tree):
+    measure(LocalRepository, local_tree, 1)
+
+
+@pytest.mark.benchmark(group='diff')
+def test_diff_bucket_to_cache(measure, fake_bucket, cache_database):
+    now = datetime.now(timezone.utc)
+
+    def compare():
+        with ListingCache(cache_database) as cache:
+            return sum(1 for action in diff(s3_entries(fake_bucket, BUCKET_NAME),
+                                            cache_snapshot_entries(cache, '', now), entries_identical_at_time))
+
+    measure(compare)
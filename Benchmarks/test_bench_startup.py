@@ -0,0 +1,39 @@
+'''
+Startup time of the command line tools, measured with python -X importtime in a new interpreter.  Timing
+depends on the machine, so it is checked here rather than in UnitTests, which only check that the heavy
+modules are not imported (see UnitTests/test_Startup.py).
+'''
+import os
+import subprocess
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# cumulative import time of a tool, in seconds: about 50 ms here, with room for slow machines
+IMPORT_BUDGET = 0.25
+
+
+def import_times(module):
+    '''
+    Import a module in a new interpreter and get the cumulative import time of each module it imported.
+    :param module: (string) Name of module
+    :return: (dict) Seconds by module name
+    '''
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([ROOT, os.path.join(ROOT, 'S3List')]))
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    command = [sys.executable, '-X', 'importtime', '-c', f'import {module}']
+    # the first run compiles the modules, so the second one measures a normal start
+    subprocess.run(command, env=env, cwd=ROOT, check=True, capture_output=True)
+    result = subprocess.run(command, env=env, cwd=ROOT, check=True, capture_output=True, text=True)
+    times = dict()
+    for line in result.stderr.splitlines():
+        if line.startswith('import time:') and '[us]' not in line:
+            self_time, cumulative, name = line[len('import time:'):].split('|')
+            times[name.strip()] = int(cumulative) / 1e6
+    return times
+
+
+@pytest.mark.parametrize('module', ['CloudSync', 'BucketList', 'S3List'])
+def test_import_budget(module):
+    assert import_times(module)[module] < IMPORT_BUDGET
@@ -1,7 +1,11 @@
+import csv
+import sys
+from datetime import timezone
 from enum import Enum
-from openpyxl import Workbook
 from Util.S3Repository import Repository, S3FileObject, S3FileVersion
-from datetime import datetime
+from Util import Metrics
+
+TEXT_BUFFER_SIZE = 1024 * 1024
 
 class OutputType(Enum):
     StandardOutput = 1
@@ -33,51 +37,91 @@ class BucketOutput:
         return self._show_versions
 
 
+def file_object_rows(file_objects, show_versions):
+    """
+    Format file objects as output rows, one at a time.
+
+    :param file_objects: (iterator) S3FileObjects
+    :param show_versions: (bool) Add a row for every version after the row of each object
+    :return: (iterator) Rows, as lists of values (None for empty cells)
+    """
+    if show_versions:
+        for o in file_objects:
+            yield [o.key, None, o.time_stamp, o.size, o.storage_class.name, o.is_deleted, o.num_versions]
+            for v in o.versions:
+                yield [None, v.version_id, v.time_stamp, v.size, v.storage_class.name, v.is_delete_marker, None]
+    else:
+        for o in file_objects:
+            yield [o.key, o.time_stamp, o.size, o.storage_class.name, o.is_deleted]
+
+
+def output_header(show_versions):
+    if show_versions:
+        return ['key', 'version_id', 'time_stamp', 'size', 'storage_class', 'deleted', 'num_versions']
+    return ['key', 'time_stamp', 'size', 'storage_class', 'deleted']
+
+
+def excel_value(value):
+    """
+    Convert a value for a write-only worksheet, which does not accept timezone-aware datetimes.
+
+    :param value: Value of cell
+    :return: Value with datetimes converted to naive UTC
+    """
+    if getattr(value, 'tzinfo', None) is not None:
+        return value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
 def output_file_objects(repository, output):
-    items = list()
-    if output.show_versions:
-        header = 'key,version_id,time_stamp,size,storage_class,deleted,num_versions'
-        for key, o in repository.file_objects.items():
-            k = key.replace(',', ' ')
-            line = f'{k},,{o.time_stamp},{o.size},{o.storage_class.name},{o.is_deleted},{o.num_versions}'
-            items.append(line)
-            for v in sorted(o.versions, reverse=True):
-                line = f',{v.version_id},{v.time_stamp},{v.size},{o.storage_class.name},{v.is_delete_marker},'
-                items.append(line)
+    """
+    Write file objects to the output.  Rows are written as they are produced, so when given a stream
+    of objects (see Repository.stream) memory use does not depend on the size of the bucket.
+
+    :param repository: (Repository) Repository, or iterator of S3FileObjects
+    :param output: (BucketOutput) Where and how to write the objects
+    """
+    if isinstance(repository, Repository):
+        file_objects = repository.file_objects.values()
     else:
-        header = 'key,time_stamp,size,storage_class,deleted'
-        for key, o in repository.file_objects.items():
-            k = key.replace(',', ' ')
-            line = f'{k},{o.time_stamp},{o.size},{o.storage_class.name},{o.is_deleted}'
-            items.append(line)
+        file_objects = repository
+    rows = file_object_rows(file_objects, output.show_versions)
+    header = output_header(output.show_versions)
+    # rows are produced as they are written, so the time of the listing is part of the render phase
+    with Metrics.timer('render', output=output.type.name):
+        write_rows(rows, header, output)
+
+
+def write_rows(rows, header, output):
+    """
+    Write rows to the output.
+
+    :param rows: (iterator) Rows of file_object_rows
+    :param header: (list) Header row, written if the output asks for it
+    :param output: (BucketOutput) Where and how to write the rows
+    """
     if output.type == OutputType.StandardOutput:
+        writer = csv.writer(sys.stdout)
         if output.output_header:
-            print(header)
-        for o in items:
-            print(o)
+            writer.writerow(header)
+        writer.writerows(rows)
 
     if output.type == OutputType.TextFile:
-        with open(output.filename, mode='w') as f:
+        with open(output.filename, mode='w', newline='', buffering=TEXT_BUFFER_SIZE) as f:
+            writer = csv.writer(f)
             if output.output_header:
-                f.write(header + '\n')
-            for o in items:
-                f.write(o)
+                writer.writerow(header)
+            writer.writerows(rows)
 
     if output.type == OutputType.Excel:
-        wb = Workbook()
-        ws = wb.active
+        # openpyxl takes longer to import than listing a small bucket, so only Excel output imports it
+        from openpyxl import Workbook
+        wb = Workbook(write_only=True)
+        ws = wb.create_sheet()
         if output.output_header:
-            header_items = header.split(sep=',')
-            for n in range(len(header_items)):
-                ws.cell(column=n + 1, row=1, value=header_items[n])
-        row = 2
-        for o in items:
-            col = 1
-            line_items = o.split(sep=',')
-            for x in line_items:
-                ws.cell(row=row, column=col, value=x)
-                col += 1
-            row += 1
+            ws.append(header)
+        for row in rows:
+            ws.append([excel_value(x) for x in row])
         wb.save(output.filename)
 
 
@@ -92,7 +136,9 @@ if __name__ == '__main__':
     output_group.add_argument('-e', help='Excel file for output', metavar='Excel-file')
     parser.add_argument('--header', help='Output header line', action='store_true')
     parser.add_argument('--versions', help='Output information about all versions', action='store_true')
+    Metrics.add_arguments(parser)
     args = parser.parse_args()
+    Metrics.enable_from_arguments(args)
 
     bucket_output = None
     if args.o:
@@ -106,5 +152,4 @@ if __name__ == '__main__':
     # selected_bucket = s3.Bucket(args.bucket)
     # output_file_objects(selected_bucket, bucket_output)
 
-    repository = Repository(args.bucket)
-    output_file_objects(repository, bucket_output)
+    output_file_objects(Repository.stream(args.bucket), bucket_output)
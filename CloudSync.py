@@ -1,6 +1,23 @@
-from Util.Repository import Repository
+from Util.Diff import DiffActionType, diff, local_entries, s3_entries, s3_snapshot_entries, cache_snapshot_entries, \
+    entries_identical, entries_identical_at_time
+from Util.ListingCache import ListingCache
+from Util.SyncState import SyncStateIndex
+from Util.Sync import SyncActionType, ConflictPolicy, sync_diff, conflict_path
+from Util.Watch import ChangeQueue, SqsPoller, ListingPoller, RESCAN, DEFAULT_DEBOUNCE, DEFAULT_MAX_DELAY, \
+    DEFAULT_POLL_INTERVAL, DEFAULT_REMOTE_POLL_INTERVAL, local_event_source, expand_keys, local_key_entries, \
+    remote_key_entries
+from Util.Dedup import RemoteFingerprints, local_fingerprint
+from Util.Transfer import TransferEngine, TransferConfig, TransferItem, CopyItem, UploadJournal, MB
+from Util.S3Client import S3ClientConfig, configure, get_client
+from Util.Plan import Planner, PlanStep, PlanActionType, ThroughputHistory, read_plan, plan_steps
+from Util.Delete import BulkDeleter
+from Util.Backend import S3Backend, LocalBackend, CacheBackend
+from Util import Metrics
+from datetime import datetime, timezone
 from enum import Enum
+import os
 import sys
+import time
 
 class OperationType(Enum):
     '''
@@ -26,6 +43,587 @@ class OperationType(Enum):
             return 'List objects in target'
 
 
+def parse_target(target):
+    '''
+    Parse a target given on the command line.
+    :param target: (string) "s3:<bucketname>[/<prefix>]" or "dir:<directory>"
+    :return: (tuple) type ('s3' or 'dir'), bucket name or directory, key prefix ('' or ending with '/')
+    '''
+    kind, delimiter, location = target.partition(':')
+    bucket_name, slash, prefix = location.partition('/')
+    if not delimiter or kind not in ('s3', 'dir') or not location or (kind == 's3' and not bucket_name):
+        raise Exception(f'Target must be "s3:<bucketname>" or "dir:<directory>", not "{target}"')
+    if kind == 'dir':
+        return kind, location, ''
+    if prefix and not prefix.endswith('/'):
+        prefix += '/'
+    return kind, bucket_name, prefix
+
+
+def local_path(root, key):
+    return os.path.join(root, *key.split('/'))
+
+
+def record_state(index, config, key, full_path, content_hash=None, e_tag=None, remote_e_tag=None, version_id=None):
+    '''
+    Record a local file in the sync-state index after it was synchronized, with the ETag and version of
+    its object if they are known.
+    '''
+    stat_result = os.stat(full_path)
+    if content_hash is None:
+        content_hash, e_tag = index.file_hashes(full_path, config.part_size_for(stat_result.st_size))
+    index.record(key, stat_result, content_hash, e_tag, remote_e_tag, version_id)
+
+
+def upload_step(entry, key):
+    return PlanStep(PlanActionType.Upload, entry.key, key, entry.file_object, entry.size, entry.timestamp.timestamp(),
+                    content_hash=entry.content_hash)
+
+
+def delete_keys(client, bucket_name, keys):
+    '''
+    Delete the latest versions of objects, in batches sent in parallel by a BulkDeleter.
+    :return: (list) keys that could not be deleted
+    '''
+    return [key for key, version_id, e in BulkDeleter(client, bucket_name).delete((key, None) for key in keys)]
+
+
+def update(client, bucket_name, prefix, source, index, engine, show_only, replicate=False, planner=None,
+           purge=False):
+    '''
+    Upload new and changed files of the source folder.  New files whose contents already exist in the
+    bucket under another key (renamed or moved files) are copied on the server instead of uploaded.
+    With replicate, objects missing from the source folder are deleted, after the copies.  With purge as
+    well, their older versions go too: noncurrent versions and delete markers are deleted as the listing
+    streams them in, alongside the uploads, and objects of missing files are deleted with every version
+    instead of getting a delete marker.
+    With show_only, nothing is changed and the steps are added to the planner instead.
+    :return: (list) Tuples of key and exception for files that failed
+    '''
+    config = engine.config
+    if show_only and planner is None:
+        planner = Planner(config)
+    keys = dict()
+    deletes = []
+    new_files = []
+    fingerprints = RemoteFingerprints(client, bucket_name, prefix, min_size=max(config.small_file_size, 1))
+    # rate limits apply per prefix, and S3 splits busy prefixes, so limit each folder of the target separately
+    deleter = BulkDeleter(client, bucket_name, prefix_depth=prefix.count('/') + 1)
+    deleting = dict()
+
+    def deleted(targets):
+        for target in targets:
+            name = deleting.pop(target, None)
+            if name is not None:
+                index.remove(name)
+
+    def purge_version(key, version_id):
+        if show_only:
+            planner.add(PlanStep(PlanActionType.DeleteVersion, key[len(prefix):], key, version_id=version_id))
+        else:
+            deleter.add(key, version_id)
+
+    if replicate and not show_only:
+        deleter.start(on_deleted=deleted)
+
+    def uploads():
+        target = fingerprints.collect(s3_entries(client, bucket_name, prefix,
+                                                 purge_version if replicate and purge else None))
+        for action in Metrics.timed('diff', diff(local_entries(source, index), target)):
+            if action.action == DiffActionType.Copy and action.source.size >= fingerprints.min_size:
+                # the same contents may be listed under a later key, so match once the listing is done
+                new_files.append(action.source)
+            elif show_only:
+                if action.action == DiffActionType.Delete:
+                    if replicate:
+                        deletes.append(action.target)
+                elif action.action != DiffActionType.Skip:
+                    planner.add(upload_step(action.source, prefix + action.key))
+            elif action.action == DiffActionType.Skip:
+                if action.source.content_hash is None:
+                    record_state(index, config, action.key, action.source.file_object)
+            elif action.action == DiffActionType.Delete:
+                if replicate:
+                    deletes.append(action.target)
+            else:
+                if action.action == DiffActionType.Overwrite:
+                    fingerprints.exclude(action.key)
+                keys[prefix + action.key] = action.key
+                yield TransferItem(action.source.file_object, prefix + action.key, action.source.size,
+                                   content_hash=action.source.content_hash)
+
+    def uploaded(item):
+        record_state(index, config, keys.pop(item.key), item.local_path, remote_e_tag=item.e_tag,
+                     version_id=item.version_id)
+
+    failures = [(item.key, e) for item, e in engine.upload(uploads(), on_complete=uploaded)]
+
+    copies = []
+    unmatched = []
+    hashes = dict()
+    for entry in new_files:
+        key = prefix + entry.key
+        try:
+            stat_result = os.stat(entry.file_object)
+            content_hash, e_tag = local_fingerprint(index, entry.key, entry.file_object, stat_result,
+                                                    config.part_size_for(entry.size))
+        except OSError as e:
+            failures.append((key, e))
+            continue
+        keys[key] = entry.key
+        hashes[key] = (content_hash, e_tag)
+        location = fingerprints.find(entry.size, content_hash, e_tag)
+        if show_only:
+            if location is None:
+                planner.add(PlanStep(PlanActionType.Upload, entry.key, key, entry.file_object, entry.size,
+                                     stat_result.st_mtime, content_hash=content_hash))
+            else:
+                planner.add(PlanStep(PlanActionType.Copy, entry.key, key, entry.file_object, entry.size,
+                                     stat_result.st_mtime, source_key=location[0], source_version_id=location[1],
+                                     content_hash=content_hash))
+        elif location is None:
+            unmatched.append(TransferItem(entry.file_object, key, entry.size, content_hash=content_hash))
+        else:
+            copies.append(CopyItem(entry.file_object, key, entry.size, location[0], location[1], content_hash))
+    if not show_only:
+        def copied(item):
+            record_state(index, config, keys.pop(item.key), item.local_path, *hashes.pop(item.key), item.e_tag,
+                         item.version_id)
+
+        failures.extend((item.key, e) for item, e in engine.copy(copies, on_complete=copied))
+        failures.extend((item.key, e) for item, e in engine.upload(unmatched, on_complete=copied))
+
+    if replicate and not show_only:
+        for entry in deletes:
+            target = (entry.file_object, entry.version_id if purge else None)
+            deleting[target] = entry.key
+            deleter.add(*target)
+        failures.extend((key, e) for key, version_id, e in deleter.finish())
+    elif replicate:
+        for entry in deletes:
+            planner.add(PlanStep(PlanActionType.Delete, entry.key, entry.file_object,
+                                 version_id=entry.version_id if purge else None))
+    return failures
+
+
+def restore(client, bucket_name, prefix, source, index, engine, show_only, timestamp=None, cache=None,
+            planner=None):
+    '''
+    Make the source folder match the repository, downloading new and changed files and deleting local
+    files that don't exist in the repository.  With a timestamp, the repository is taken as it was at
+    that time: the newest version of each key not newer than the time is downloaded, read from the
+    listing cache if one is given, otherwise from a listing of all versions.
+    With show_only, nothing is changed and the steps are added to the planner instead.
+    :return: (list) Tuples of key and exception for files that failed
+    '''
+    versions = dict()
+    deletes = []
+    if show_only and planner is None:
+        planner = Planner(engine.config)
+    if timestamp is None:
+        entries = s3_entries(client, bucket_name, prefix)
+        compare = entries_identical
+    elif cache is not None:
+        entries = cache_snapshot_entries(cache, prefix, timestamp)
+        compare = entries_identical_at_time
+    else:
+        entries = s3_snapshot_entries(client, bucket_name, prefix, timestamp)
+        compare = entries_identical_at_time
+
+    def downloads():
+        for action in Metrics.timed('diff', diff(entries, local_entries(source, index), compare)):
+            if action.action == DiffActionType.Skip:
+                continue
+            if show_only:
+                planner.add(restore_step(action, source))
+            elif action.action == DiffActionType.Delete:
+                deletes.append(action.target)
+            else:
+                entry = action.source
+                versions[entry.file_object] = entry
+                yield TransferItem(local_path(source, entry.key), entry.file_object, entry.size, entry.version_id,
+                                   entry.timestamp)
+
+    def downloaded(item):
+        entry = versions.pop(item.key)
+        # a restore to a point in time doesn't make the restored versions current
+        remote_e_tag = entry.e_tag if timestamp is None else None
+        record_state(index, engine.config, item.key[len(prefix):], item.local_path, entry.content_hash,
+                     remote_e_tag=remote_e_tag, version_id=item.version_id if timestamp is None else None)
+
+    failures = [(item.key, e) for item, e in engine.download(downloads(), on_complete=downloaded)]
+    for entry in deletes:
+        try:
+            os.remove(entry.file_object)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            failures.append((entry.key, e))
+            continue
+        index.remove(entry.key)
+    return failures
+
+
+def synchronize(client, bucket_name, prefix, source, index, engine, show_only, policy=ConflictPolicy.Newer,
+                planner=None):
+    '''
+    Make the source folder and the repository match in both directions, with a three-way merge of the
+    folder, the bucket listing and the sync-state index of the last sync (see sync_diff).
+    With show_only, nothing is changed and the steps are added to the planner instead.
+    :return: (list) Tuples of key and exception for files that failed
+    '''
+    actions = sync_diff(local_entries(source), s3_entries(client, bucket_name, prefix), index.states(),
+                        sync_hashes(index, engine.config), policy)
+    actions = Metrics.timed('diff', actions)
+    return apply_sync(client, bucket_name, prefix, source, index, engine, actions, show_only, planner)
+
+
+def sync_hashes(index, config):
+    '''
+    Get the function sync_diff hashes local files with.
+    '''
+    def local_hashes(entry):
+        return index.file_hashes(entry.file_object, config.part_size_for(entry.size))
+    return local_hashes
+
+
+def apply_sync(client, bucket_name, prefix, source, index, engine, actions, show_only=False, planner=None):
+    '''
+    Carry out the actions of a three-way sync.  Uploads start as the actions are read; downloads, then
+    deletes in the bucket, then local deletes of files unchanged since the scan are made after them.  When
+    a conflict is resolved by downloading, the local file is kept as a conflict copy; when it is resolved by
+    uploading, the object is overwritten, and its previous contents are kept by bucket versioning.
+    :return: (list) Tuples of key and exception for files that failed
+    '''
+    config = engine.config
+    if show_only and planner is None:
+        planner = Planner(config)
+    uploading = dict()
+    downloads = []
+    deletes = []
+    local_deletes = []
+
+    def uploads():
+        for action in actions:
+            effective_action = action.effective_action
+            if show_only:
+                step = sync_step(action, prefix, source)
+                if step is not None:
+                    planner.add(step)
+            elif effective_action == SyncActionType.Record:
+                record_state(index, config, action.key, action.local.file_object, *(action.hashes or (None, None)),
+                             action.remote.e_tag, action.remote.version_id)
+            elif effective_action == SyncActionType.Forget:
+                index.remove(action.key)
+            elif effective_action == SyncActionType.Download:
+                downloads.append(action)
+            elif effective_action == SyncActionType.DeleteRemote:
+                deletes.append(action.key)
+            elif effective_action == SyncActionType.DeleteLocal:
+                local_deletes.append(action)
+            elif effective_action == SyncActionType.Upload:
+                entry = action.local
+                uploading[prefix + action.key] = action
+                content_hash = action.hashes[0] if action.hashes else None
+                yield TransferItem(entry.file_object, prefix + action.key, entry.size, content_hash=content_hash)
+
+    def uploaded(item):
+        action = uploading.pop(item.key)
+        record_state(index, config, action.key, item.local_path, *(action.hashes or (None, None)), item.e_tag,
+                     item.version_id)
+
+    failures = [(item.key, e) for item, e in engine.upload(uploads(), on_complete=uploaded)]
+    if show_only:
+        return failures
+
+    downloading = dict()
+
+    def download_items():
+        now = datetime.now(timezone.utc)
+        for action in downloads:
+            full_path = local_path(source, action.key)
+            if action.action == SyncActionType.Conflict:
+                os.replace(full_path, conflict_path(full_path, now))
+            entry = action.remote
+            downloading[entry.file_object] = action
+            yield TransferItem(full_path, entry.file_object, entry.size, entry.version_id, entry.timestamp)
+
+    def downloaded(item):
+        action = downloading.pop(item.key)
+        record_state(index, config, action.key, item.local_path, action.remote.content_hash,
+                     remote_e_tag=action.remote.e_tag, version_id=action.remote.version_id)
+
+    failures.extend((item.key, e) for item, e in engine.download(download_items(), on_complete=downloaded))
+    failed = set(delete_keys(client, bucket_name, [prefix + k for k in deletes]))
+    for key in deletes:
+        if prefix + key not in failed:
+            index.remove(key)
+    failures.extend((key, Exception('Delete failed')) for key in failed)
+    # the transfers may take long after the scan: a file modified since is kept, as a modification wins over
+    # a delete.  A file whose stat changed but not its contents was judged unchanged by its scanned stat.
+    changed = Exception('File changed since it was scanned')
+    for action in local_deletes:
+        full_path = action.local.file_object
+        scanned = action.local.stat_result
+        try:
+            stat_result = os.stat(full_path)
+            unchanged = action.base.matches(stat_result) or (
+                scanned is not None and stat_signature(scanned) == stat_signature(stat_result))
+            if not unchanged:
+                failures.append((action.key, changed))
+                continue
+            os.remove(full_path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            failures.append((action.key, e))
+            continue
+        index.remove(action.key)
+    return failures
+
+
+def sync_step(action, prefix, source):
+    '''
+    Get the plan step of a sync action, or None if nothing would be transferred or deleted.
+    '''
+    effective_action = action.effective_action
+    if effective_action == SyncActionType.Upload:
+        return upload_step(action.local, prefix + action.key)
+    elif effective_action == SyncActionType.Download:
+        entry = action.remote
+        return PlanStep(PlanActionType.Download, action.key, entry.file_object, local_path(source, action.key),
+                        entry.size, entry.timestamp.timestamp(), entry.version_id, content_hash=entry.content_hash)
+    elif effective_action == SyncActionType.DeleteRemote:
+        return PlanStep(PlanActionType.Delete, action.key, prefix + action.key)
+    elif effective_action == SyncActionType.DeleteLocal:
+        entry = action.local
+        return PlanStep(PlanActionType.DeleteLocal, action.key, local_path=entry.file_object, size=entry.size,
+                        mtime=entry.timestamp.timestamp())
+    return None
+
+
+def sync_keys(client, bucket_name, prefix, source, index, engine, keys, operation_type=None,
+              policy=ConflictPolicy.Newer):
+    '''
+    Synchronize only the files of some keys, after they changed: the three-way merge of sync_diff is made
+    from a stat and a HEAD request per key, and the states of the keys in the sync-state index, so the
+    cost depends on the number of changed keys, not on the size of the tree.  Folder keys ending with '/'
+    stand for the files under the folder; RESCAN stands for the whole tree, which is compared by a full
+    run instead.  Update only applies local changes, and Replicate also deletes objects of deleted files.
+    :return: (list) Tuples of key and exception for files that failed
+    '''
+    if operation_type is None:
+        operation_type = OperationType.Synchronize
+    if RESCAN in keys:
+        if operation_type == OperationType.Synchronize:
+            return synchronize(client, bucket_name, prefix, source, index, engine, False, policy)
+        return update(client, bucket_name, prefix, source, index, engine, False,
+                      replicate=operation_type == OperationType.Replicate)
+    keys = expand_keys(source, index, keys)
+    if operation_type != OperationType.Synchronize:
+        policy = ConflictPolicy.Local
+    base = (state for state in map(index.get, keys) if state is not None)
+    actions = sync_diff(local_key_entries(source, keys), remote_key_entries(client, bucket_name, prefix, keys), base,
+                        sync_hashes(index, engine.config), policy)
+    if operation_type != OperationType.Synchronize:
+        allowed = {SyncActionType.Upload, SyncActionType.Record, SyncActionType.Forget}
+        if operation_type == OperationType.Replicate:
+            allowed.add(SyncActionType.DeleteRemote)
+        actions = (action for action in actions if action.effective_action in allowed)
+    return apply_sync(client, bucket_name, prefix, source, index, engine, actions)
+
+
+def watch(client, bucket_name, prefix, source, index, engine, events, operation_type=None, remote=None,
+          policy=ConflictPolicy.Newer, debounce=DEFAULT_DEBOUNCE, max_delay=DEFAULT_MAX_DELAY, idle_timeout=1.0,
+          report=print):
+    '''
+    Keep synchronizing the keys that change until the event source is closed.  Local change events, and
+    remote changes from the poller if one is given, go into a debounced queue, and the keys that are due
+    are synchronized with sync_keys.  Keys still waiting when the source is closed are synchronized before
+    returning.  A batch that fails as a whole, such as on a transient S3 error, is put back in the queue to
+    be retried, so the watch goes on.
+    :param events: Source of local change events (InotifySource, PollingSource or SimulatedSource)
+    :param remote: Source of remote changes (SqsPoller or ListingPoller), or None
+    :param report: (function) Called with a line of text for every batch synchronized (None for silence)
+    :return: (list) Tuples of key and exception for files that failed
+    '''
+    queue = ChangeQueue(debounce, max_delay)
+    failures = []
+    while True:
+        closed = events.closed
+        for key in events.events(queue.timeout(idle_timeout)):
+            queue.add(key)
+        if remote is not None:
+            for key in remote.changes():
+                queue.add(key)
+        keys = queue.pop_all() if closed else queue.pop_due()
+        if keys:
+            try:
+                failed = sync_keys(client, bucket_name, prefix, source, index, engine, keys, operation_type, policy)
+            except Exception as e:
+                index.commit()
+                if report is not None:
+                    report(f'{datetime.now().isoformat(timespec="seconds")} Synchronizing {len(keys):,} changed keys '
+                           f'failed: {e}')
+                if closed:
+                    failures.extend((key, e) for key in keys)
+                    return failures
+                for key in keys:
+                    queue.add(key)
+                continue
+            index.commit()
+            failures.extend(failed)
+            if report is not None:
+                report(f'{datetime.now().isoformat(timespec="seconds")} Synchronized {len(keys):,} changed keys, '
+                       f'{len(failed):,} failed')
+                for key, e in failed:
+                    report(f'Failed: {key}: {e}')
+        if closed:
+            return failures
+
+
+def restore_step(action, source):
+    if action.action == DiffActionType.Delete:
+        entry = action.target
+        return PlanStep(PlanActionType.DeleteLocal, entry.key, local_path=entry.file_object, size=entry.size,
+                        mtime=entry.timestamp.timestamp())
+    entry = action.source
+    return PlanStep(PlanActionType.Download, entry.key, entry.file_object, local_path(source, entry.key), entry.size,
+                    entry.timestamp.timestamp(), entry.version_id, content_hash=entry.content_hash)
+
+
+def stat_signature(stat_result):
+    return stat_result.st_size, stat_result.st_mtime_ns, stat_result.st_ino
+
+
+def local_file_unchanged(step):
+    '''
+    Check that a local file still has the size and modification time it had when a plan was made.
+    '''
+    try:
+        stat_result = os.stat(step.local_path)
+    except OSError:
+        return False
+    # times are planned to the microsecond
+    return stat_result.st_size == step.size and abs(stat_result.st_mtime - step.mtime) < 2e-6
+
+
+def execute_plan(client, bucket_name, plan_file, index, engine):
+    '''
+    Carry out the steps of a plan file written by --showonly, exactly as planned: the planned versions
+    are downloaded, and local files are only uploaded or deleted if they haven't changed since the plan
+    was made.  Copies and uploads are made before deletes, like update does.  The plan file is read once
+    for each type of step, so steps are not kept in memory.
+    :return: (list) Tuples of key and exception for steps that failed
+    '''
+    config = engine.config
+    failures = []
+    names = dict()
+    hashes = dict()
+    changed = Exception('File changed since the plan was made')
+
+    def items(actions):
+        for step in plan_steps(plan_file, actions):
+            if step.action in (PlanActionType.Upload, PlanActionType.Copy) and not local_file_unchanged(step):
+                failures.append((step.key, changed))
+                continue
+            names[step.key] = step.name
+            hashes[step.key] = step.content_hash
+            if step.action == PlanActionType.Copy:
+                yield CopyItem(step.local_path, step.key, step.size, step.source_key, step.source_version_id,
+                               step.content_hash)
+            elif step.action == PlanActionType.Upload:
+                yield TransferItem(step.local_path, step.key, step.size, content_hash=step.content_hash)
+            else:
+                yield TransferItem(step.local_path, step.key, step.size, step.version_id, step.timestamp)
+
+    def completed(item):
+        record_state(index, config, names.pop(item.key), item.local_path, hashes.pop(item.key))
+
+    failures.extend((item.key, e) for item, e in engine.copy(items((PlanActionType.Copy,)), on_complete=completed))
+    failures.extend((item.key, e) for item, e in engine.upload(items((PlanActionType.Upload,)), on_complete=completed))
+    failures.extend((item.key, e) for item, e in engine.download(items((PlanActionType.Download,)),
+                                                                   on_complete=completed))
+    deleting = dict()
+
+    def deleted(targets):
+        for target in targets:
+            name = deleting.pop(target, None)
+            if name is not None:
+                index.remove(name)
+
+    deleter = BulkDeleter(client, bucket_name)
+    deleter.start(on_deleted=deleted)
+    for step in plan_steps(plan_file, (PlanActionType.Delete, PlanActionType.DeleteVersion)):
+        # noncurrent versions have no local file, so only deleted objects leave the index
+        if step.action == PlanActionType.Delete:
+            deleting[(step.key, step.version_id)] = step.name
+        deleter.add(step.key, step.version_id)
+    failures.extend((key, e) for key, version_id, e in deleter.finish())
+    for step in plan_steps(plan_file, (PlanActionType.DeleteLocal,)):
+        if not local_file_unchanged(step):
+            failures.append((step.local_path, changed))
+            continue
+        os.remove(step.local_path)
+        index.remove(step.name)
+    return failures
+
+
+def parse_time(text):
+    '''
+    Parse a time given on the command line.
+    :param text: (string) ISO 8601 date/time, local time unless it has a UTC offset
+    :return: (datetime) Timezone-aware date/time
+    '''
+    try:
+        timestamp = datetime.fromisoformat(text)
+    except ValueError:
+        raise Exception(f'Time must be an ISO 8601 date/time such as 2019-08-19T12:00:00, not "{text}"')
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.astimezone()
+    return timestamp
+
+
+def mirror(source, target, show_only, replicate=False):
+    '''
+    Make a target backend match a source backend, for targets without sync state such as dir: targets.
+    New and changed objects are stored in the target, natively copied between local folders (see
+    LocalBackend.put_file), and with replicate, objects missing from the source are deleted.
+    :param source: (Backend) Source
+    :param target: (Backend) Target
+    :param show_only: (bool) Only show the changes that would be made
+    :param replicate: (bool) Delete objects of the target missing from the source
+    :return: (list) Tuples of key and exception for objects that failed
+    '''
+    failures = []
+    deletes = []
+    for action in Metrics.timed('diff', diff(source.list(), target.list())):
+        if action.action == DiffActionType.Skip or (action.action == DiffActionType.Delete and not replicate):
+            continue
+        print(f'{action.action.Description}: {action.key}')
+        if show_only:
+            continue
+        if action.action == DiffActionType.Delete:
+            deletes.append(action.key)
+            continue
+        try:
+            target.put_from(source, action.source)
+        except Exception as e:
+            failures.append((action.key, e))
+    if deletes:
+        failures.extend(target.delete(deletes))
+    return failures
+
+
+def list_only(backend):
+    '''
+    Print the latest version of each object of a backend.
+    :param backend: (Backend) Bucket, listing cache of a bucket, or local folder
+    '''
+    for entry in backend.list():
+        print(f'{entry.timestamp.isoformat()} {entry.size:>14,} {entry.key}')
+
+
 '''
 Command line:
 CloudSync --source <src> --target <trg> --op {Update | Replicate | Synchronize | Restore}
@@ -42,10 +640,38 @@ if __name__ == "__main__":
     parser.add_argument('--source', help='Source', required=False)
     parser.add_argument('--target', help='Target', required=True)
     parser.add_argument('--op', help='Operation type (one of: Update, Replicate, Synchronize, Restore or ListOnly', required=True)
-    parser.add_argument('--showonly', help='No changes, only show chnages that would be made', required=False)
+    parser.add_argument('--showonly', help='No changes, only show chnages that would be made', action='store_true')
     parser.add_argument('--refresh', help='Refresh local database for remote repository (S3 only)')
+    parser.add_argument('--state', help='Sync-state database (default: one per source and target in ~/.cloudsync)')
+    parser.add_argument('--part-size', help='Part size of multipart transfers, in MB (default: 8)', type=int, default=8)
+    parser.add_argument('--concurrency', help='Number of S3 requests at the same time, and size of the connection pool '
+                                              '(default: 10)', type=int, default=10)
+    parser.add_argument('--max-in-flight', help='Maximum MB of transfer requests in flight (default: 256)', type=int,
+                        default=256)
+    parser.add_argument('--time', help='Restore the versions current at this ISO 8601 time (local time unless it has '
+                                       'a UTC offset)')
+    parser.add_argument('--cache', help='Listing cache of the bucket (see S3Browser) to find the versions of --time in, '
+                                        'or to list with ListOnly without connecting to S3')
+    parser.add_argument('--conflict', help='How Synchronize resolves files changed on both sides (default: Newer)',
+                        choices=[p.name for p in ConflictPolicy], default='Newer')
+    parser.add_argument('--watch', help='After the operation, keep watching for changes and synchronize them '
+                                        '(Update, Replicate or Synchronize)', action='store_true')
+    parser.add_argument('--poll', help='With --watch, seconds between scans of the source where inotify is not '
+                                       f'available (default: {DEFAULT_POLL_INTERVAL:g})', type=float,
+                        default=DEFAULT_POLL_INTERVAL)
+    parser.add_argument('--remote-poll', help='With --watch and Synchronize, seconds between listings of the target '
+                                              f'(default: {DEFAULT_REMOTE_POLL_INTERVAL:g}, 0 for none)', type=float,
+                        default=DEFAULT_REMOTE_POLL_INTERVAL)
+    parser.add_argument('--sqs', help='With --watch and Synchronize, URL of an SQS queue that receives the S3 event '
+                                      'notifications of the bucket, read instead of listing the target')
+    parser.add_argument('--purge', help='With Replicate, also delete noncurrent versions and delete markers, and '
+                                        'delete objects of missing files with every version', action='store_true')
+    parser.add_argument('--plan', help='With --showonly, write the plan to this file; otherwise carry out the plan '
+                                       'in this file exactly as planned')
+    Metrics.add_arguments(parser)
 
     args = parser.parse_args()
+    Metrics.enable_from_arguments(args)
     opType = args.op
     operation_type = OperationType[opType]
     if operation_type != OperationType.ListOnly and args.source == None:
@@ -53,11 +679,122 @@ if __name__ == "__main__":
         parser.print_help()
         sys.exit(1)
 
+    if args.watch and (args.showonly or args.plan or operation_type not in (
+            OperationType.Update, OperationType.Replicate, OperationType.Synchronize)):
+        print('--watch can only be used with Update, Replicate or Synchronize, without --showonly or --plan')
+        sys.exit(1)
+
+    if args.purge and operation_type != OperationType.Replicate:
+        print('--purge can only be used with Replicate')
+        sys.exit(1)
+
+    timestamp = None
+    if args.time:
+        if operation_type != OperationType.Restore:
+            print('--time can only be used with Restore')
+            sys.exit(1)
+        timestamp = parse_time(args.time)
+
     print(f'{operation_type.Description}: {args.source} -> {args.target}')
+    if timestamp is not None:
+        print(f'As of {timestamp.isoformat()}')
 
-'''
-s3.list_object_versions(
-    Bucket='jea-scratch',
-    Prefix='<key>'
+    target_type, bucket_name, prefix = parse_target(args.target)
+    if target_type == 'dir':
+        # a local folder or NAS share is compared with the source directly, without sync state
+        target = LocalBackend(bucket_name)
+        if operation_type == OperationType.ListOnly:
+            list_only(target)
+            sys.exit(0)
+        if operation_type == OperationType.Synchronize or args.watch or args.plan or args.purge or \
+                timestamp is not None:
+            print('dir: targets support Update, Replicate and Restore, without --watch, --plan, --purge or --time')
+            sys.exit(1)
+        source = LocalBackend(args.source)
+        if operation_type == OperationType.Restore:
+            # like a restore from S3, local files that aren't in the target are deleted
+            failures = mirror(target, source, args.showonly, replicate=True)
+        else:
+            failures = mirror(source, target, args.showonly, replicate=operation_type == OperationType.Replicate)
+        for key, e in failures:
+            print(f'Failed: {key}: {e}')
+        sys.exit(1 if failures else 0)
+    if operation_type == OperationType.ListOnly and args.cache:
+        # read from the cache alone: no client or session is made, so boto3 is never imported
+        with CacheBackend(args.cache, prefix) as backend:
+            list_only(backend)
+        sys.exit(0)
+    # one client, connection pool and concurrency for every listing, HEAD and transfer request
+    configure(S3ClientConfig(max_concurrency=args.concurrency))
+    client = get_client()
+    if operation_type == OperationType.ListOnly:
+        list_only(S3Backend(bucket_name, prefix, client))
+        sys.exit(0)
 
-'''
+    state_database = args.state or SyncStateIndex.default_database_name(args.source, args.target)
+    config = TransferConfig(part_size=args.part_size * MB, max_concurrency=args.concurrency,
+                            max_bytes_in_flight=args.max_in_flight * MB)
+    engine = TransferEngine(client, bucket_name, config, UploadJournal(state_database))
+    history = ThroughputHistory(state_database)
+    header = {'operation': operation_type.name, 'source': args.source, 'target': args.target}
+    planner = None
+    if args.showonly:
+        planner = Planner(config, args.plan, header)
+    elif args.plan:
+        planned = read_plan(args.plan)
+        if any(planned.get(name) != value for name, value in header.items()):
+            print(f'Plan {args.plan} is for {planned.get("operation")}: {planned.get("source")} -> '
+                  f'{planned.get("target")}')
+            sys.exit(1)
+    start = time.perf_counter()
+    with SyncStateIndex(state_database) as index:
+        if args.plan and not args.showonly:
+            failures = execute_plan(client, bucket_name, args.plan, index, engine)
+        elif operation_type == OperationType.Restore:
+            cache = ListingCache(args.cache) if args.cache and timestamp is not None else None
+            failures = restore(client, bucket_name, prefix, args.source, index, engine, args.showonly, timestamp,
+                               cache, planner)
+            if cache is not None:
+                cache.close()
+        elif operation_type == OperationType.Synchronize:
+            failures = synchronize(client, bucket_name, prefix, args.source, index, engine, args.showonly,
+                                   ConflictPolicy[args.conflict], planner)
+        else:
+            failures = update(client, bucket_name, prefix, args.source, index, engine, args.showonly,
+                              replicate=operation_type == OperationType.Replicate, planner=planner,
+                              purge=args.purge)
+        # the transfers of Synchronize go both ways, so they don't give the rate of either direction; the
+        # run is recorded before any watch, whose time is mostly spent waiting for changes
+        if not args.showonly and operation_type != OperationType.Synchronize:
+            direction = 'download' if operation_type == OperationType.Restore else 'upload'
+            history.record(direction, engine.stats.bytes, engine.stats.requests, time.perf_counter() - start)
+        if args.watch:
+            for key, e in failures:
+                print(f'Failed: {key}: {e}')
+            events = local_event_source(args.source, args.poll)
+            remote = None
+            if operation_type == OperationType.Synchronize and args.sqs:
+                remote = SqsPoller(get_client('sqs'), args.sqs, bucket_name, prefix)
+            elif operation_type == OperationType.Synchronize and args.remote_poll > 0:
+                remote = ListingPoller(client, bucket_name, prefix, index, args.remote_poll)
+            print(f'Watching {args.source} ({type(events).__name__}), press Ctrl+C to stop')
+            try:
+                watch(client, bucket_name, prefix, args.source, index, engine, events, operation_type, remote,
+                      ConflictPolicy[args.conflict])
+            except KeyboardInterrupt:
+                pass
+            events.close()
+            # failures were shown as they happened
+            failures = []
+    if args.showonly:
+        planner.close()
+        for line in planner.summary.report(history):
+            print(line)
+    else:
+        for line in engine.stats.report():
+            print(line)
+    history.close()
+    for key, e in failures:
+        print(f'Failed: {key}: {e}')
+    if failures:
+        sys.exit(1)
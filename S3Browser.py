@@ -1,7 +1,81 @@
-import wx, os, boto3, time
+import wx, os
 import sys
-import sqlite3
-from Util.Repository import CachedRepository, S3Repository, S3FileObject, LocalRepository
+from Util.Repository import LocalRepository
+from Util.ListingView import ListingView
+from Util.ListingCache import FolderTotals
+from Util.CacheRefresh import CacheRefresh, RefreshCancelled
+from Util import Metrics
+
+class ObjectListCtrl(wx.ListCtrl):
+    '''
+    Virtual list control showing the rows of a ListingView.  Only the rows on screen are read, when
+    they are painted, so the list appears at once however many objects there are.
+    '''
+    def __init__(self, parent):
+        super().__init__(
+            parent, size=(-1,-1),
+            style=wx.LC_REPORT | wx.LC_VIRTUAL | wx.BORDER_SUNKEN | wx.EXPAND
+        )
+        self._view = None
+        for column, name in enumerate(ListingView.COLUMNS):
+            self.InsertColumn(column, name, width=140 if column == 0 else 80)
+        self.Bind(wx.EVT_LIST_COL_CLICK, self.OnColumnClick)
+
+    @property
+    def View(self):
+        return self._view
+
+    def SetView(self, view):
+        self._view = view
+        self.SetItemCount(view.count)
+        self.Refresh()
+
+    def OnGetItemText(self, item, column):
+        if self._view is None:
+            return ''
+        return self._view.item_text(item, column)
+
+    def OnColumnClick(self, event):
+        if self._view is not None and self._view.sort(event.GetColumn()):
+            self.Refresh()
+
+class FolderTreeCtrl(wx.TreeCtrl):
+    '''
+    Tree of the folders of a ListingView's cache, with the totals of each folder's sub-tree.  The
+    sub-folders of a folder are read when it is first expanded, and the totals come from the folder's
+    row in the cache, so large buckets show at once.
+    '''
+    def __init__(self, parent):
+        super().__init__(parent, size=(240,-1), style=wx.TR_DEFAULT_STYLE | wx.BORDER_SUNKEN)
+        self._view = None
+        self.Bind(wx.EVT_TREE_ITEM_EXPANDING, self.OnExpanding)
+
+    def SetView(self, view):
+        self._view = view
+        self.DeleteAllItems()
+        root = self.AddRoot(self.FolderLabel(view.cache.folder_totals('') or FolderTotals('')), data='')
+        self.SetItemHasChildren(root, True)
+        self.Expand(root)
+
+    def UpdateRootLabel(self):
+        root = self.GetRootItem()
+        if self._view is not None and root.IsOk():
+            self.SetItemText(root, self.FolderLabel(self._view.cache.folder_totals('') or FolderTotals('')))
+
+    @staticmethod
+    def FolderLabel(totals):
+        name = totals.prefix.rstrip('/').rpartition('/')[2] or '/'
+        return f'{name}  ({totals.objects:,} objects, {GetSize(totals.size)})'
+
+    def OnExpanding(self, event):
+        item = event.GetItem()
+        if self._view is None or self.GetChildrenCount(item, recursively=False) > 0:
+            return
+        for totals in self._view.cache.sub_folder_totals(self.GetItemData(item)):
+            child = self.AppendItem(item, self.FolderLabel(totals), data=totals.prefix)
+            self.SetItemHasChildren(child, True)
+        if self.GetChildrenCount(item, recursively=False) == 0:
+            self.SetItemHasChildren(item, False)
 
 class ObjectListPanel(wx.Panel):
     def __init__(self, parent):
@@ -14,20 +88,24 @@ class ObjectListPanel(wx.Panel):
         self.horizontal = wx.BoxSizer(wx.HORIZONTAL)
         self.RowObjDict = {}
 
-        self._listControl = wx.ListCtrl(
-            self, size=(-1,-1),
-            style=wx.LC_REPORT | wx.BORDER_SUNKEN | wx.EXPAND
-        )
-        self._listControl.InsertColumn(0, 'Key', width=140)
-        self._listControl.InsertColumn(1, 'Size', width=40)
-        self._listControl.InsertColumn(2, 'Timestamp', width=80)
-        self._listControl.InsertColumn(3, 'Class', width=80)
-        self._listControl.InsertColumn(4, 'BillableSize', width=80)
+        self._search = wx.SearchCtrl(self, style=wx.TE_PROCESS_ENTER)
+        self._search.ShowCancelButton(True)
+        self._search.SetDescriptiveText('Search keys')
+        self._gauge = wx.Gauge(self, range=100)
+        self._gauge.Hide()
+        self.top = wx.BoxSizer(wx.HORIZONTAL)
+        self.top.Add(self._search, proportion=1, flag=wx.EXPAND)
+        self.top.Add(self._gauge, proportion=1, flag=wx.EXPAND | wx.LEFT, border=10)
+
+        self._treeControl = FolderTreeCtrl(self)
+        self._listControl = ObjectListCtrl(self)
 
         #self.horizontal.Add(self.ListControl, 0, wx.ALL | wx.EXPAND, 10)
+        self.horizontal.Add(self._treeControl, flag=wx.EXPAND)
         self.horizontal.Add(self._listControl, proportion=1, flag=wx.EXPAND)
 
         self.vertical = wx.BoxSizer(wx.VERTICAL)
+        self.vertical.Add(self.top, flag=wx.EXPAND)
         self.vertical.Add(self.horizontal, proportion=1, flag=wx.EXPAND)
 
         self._label = wx.StaticText(self, label='Label here')
@@ -40,16 +118,142 @@ class ObjectListFrame(wx.Frame):
         super().__init__(parent=None,
                          title='S3 Object Browser')
         self.panel = ObjectListPanel(self)
+        self._refresh = None
+        self._databaseName = None
+        self.panel._search.Bind(wx.EVT_SEARCHCTRL_SEARCH_BTN, self.OnSearch)
+        self.panel._search.Bind(wx.EVT_SEARCHCTRL_CANCEL_BTN, self.OnSearchCancel)
+        self.panel._search.Bind(wx.EVT_TEXT_ENTER, self.OnSearch)
+        self.TreeControl.Bind(wx.EVT_TREE_SEL_CHANGED, self.OnFolderSelected)
+        self.Bind(wx.EVT_CLOSE, self.OnClose)
         self.Show()
 
     @property
     def ListControl(self):
         return self.panel._listControl
 
+    @property
+    def TreeControl(self):
+        return self.panel._treeControl
+
     @property
     def Label(self):
         return self.panel._label
 
+    @property
+    def Gauge(self):
+        return self.panel._gauge
+
+    def ShowView(self, view):
+        '''
+        Show a view in the list and its folders in the tree, keeping the current search.
+        '''
+        old = self.ListControl.View
+        if old is not None and old is not view:
+            view.search(old.search_text)
+            old.close()
+        self.ListControl.SetView(view)
+        self.TreeControl.SetView(view)
+        self.UpdateLabel()
+
+    def UpdateLabel(self):
+        '''
+        Show the totals of the selected folder, read from its row in the cache instead of added up.
+        '''
+        view = self.ListControl.View
+        totals = view.folder_totals
+        label = (f'{view.prefix or "/"}: {totals.objects:,} objects, {totals.versions:,} versions, '
+                 f'total size: {totals.size:,} ({GetSize(totals.size)}), billable: {GetSize(totals.billable_size)}')
+        if totals.newest is not None:
+            label += f', newest: {totals.newest.isoformat(" ", "seconds")}'
+        if view.search_text:
+            totalSize = view.total_size
+            label = f'{view.count:,} versions matching "{view.search_text}" ({GetSize(totalSize)}) in ' + label
+        self.Label.SetLabel(label)
+
+    def OnFolderSelected(self, event):
+        view = self.ListControl.View
+        item = event.GetItem()
+        if view is not None and item.IsOk():
+            view.show_folder(self.TreeControl.GetItemData(item))
+            self.ListControl.SetView(view)
+            self.UpdateLabel()
+
+    def OnSearch(self, event):
+        view = self.ListControl.View
+        if view is not None:
+            view.search(self.panel._search.GetValue())
+            self.ListControl.SetView(view)
+            self.UpdateLabel()
+
+    def OnSearchCancel(self, event):
+        self.panel._search.SetValue('')
+        self.OnSearch(event)
+
+    def StartRefresh(self, bucketName, databaseName, incremental):
+        '''
+        Refresh the cache of a bucket on a worker thread, showing its progress in the gauge.  A cache
+        refreshed in place is shown as it is written; otherwise the old cache is shown until the new
+        one replaces it.
+        '''
+        self._databaseName = databaseName
+        self._refresh = CacheRefresh(bucketName, databaseName, incremental,
+                                     on_progress=lambda done, total: wx.CallAfter(self.OnRefreshProgress, done, total),
+                                     on_done=lambda refresh: wx.CallAfter(self.OnRefreshDone, refresh))
+        self._refresh.start()
+        self.ShowView(ListingView(databaseName))
+        self.Gauge.Show()
+        self.Gauge.Pulse()
+        self.panel.Layout()
+
+    def OnRefreshProgress(self, done, total):
+        if self._refresh is None:
+            return
+        if total:
+            self.Gauge.SetRange(total)
+            self.Gauge.SetValue(min(done, total))
+        else:
+            self.Gauge.Pulse()
+        if self._refresh.in_place:
+            view = self.ListControl.View
+            view.reload()
+            self.ListControl.SetView(view)
+            self.TreeControl.UpdateRootLabel()
+            self.UpdateLabel()
+
+    def OnRefreshDone(self, refresh):
+        if refresh is not self._refresh:
+            return
+        self._refresh = None
+        self.Gauge.Hide()
+        self.panel.Layout()
+        if refresh.error is not None and not isinstance(refresh.error, RefreshCancelled):
+            wx.MessageBox(f'Refresh failed: {refresh.error}', 'S3 Object Browser', wx.OK | wx.ICON_ERROR, self)
+        view = self.ListControl.View
+        if not refresh.in_place and refresh.error is None:
+            # the files of the cache are replaced, so it is closed first
+            searchText = view.search_text
+            view.close()
+            self.ListControl._view = None
+            refresh.install()
+            view = ListingView(self._databaseName)
+            view.search(searchText)
+        else:
+            refresh.install()
+            view.reload()
+        # folders may have been added or removed
+        view.show_folder('')
+        self.ListControl.SetView(view)
+        self.TreeControl.SetView(view)
+        self.UpdateLabel()
+
+    def OnClose(self, event):
+        if self._refresh is not None:
+            self._refresh.cancel()
+            self._refresh.join()
+            self._refresh.install()
+            self._refresh = None
+        event.Skip()
+
 def GetSize(value):
     KB = 1024
     MB = KB * KB
@@ -71,38 +275,30 @@ if __name__ == '__main__':
     group.add_argument('--bucket', help='Name of bucket to browse', nargs='?')
     group.add_argument('--folder', help='Name of folder to browse', nargs='?')
     parser.add_argument('--refresh', action='store_true', default=False, help='Refresh local cached database from S3 storage')
+    parser.add_argument('--incremental', action='store_true', default=False,
+                        help='With --refresh, only re-read prefixes that changed since the last refresh')
+    Metrics.add_arguments(parser)
     args = parser.parse_args()
+    Metrics.enable_from_arguments(args)
 
-    repository = None
-    if args.bucket:
-        bucketName = args.bucket
-        dbName = bucketName + '.db'
-        if (not os.path.exists(dbName)) or args.refresh:
-            repository = CachedRepository.create_local_cached_database(bucketName)
-        else:
-            repository = CachedRepository.load_from_cache(bucketName)
-
-    elif args.folder:
-        folder = args.folder
-        repository = LocalRepository(folder)
-
-    else:
+    if not (args.bucket or args.folder):
         parser.print_help()
         sys.exit(1)
 
     app = wx.App(False)
     frame = ObjectListFrame()
-
-    index = 0
-    totalSize = 0
-    for fileObj in repository.file_objects:
-        if type(fileObj) is S3FileObject:
-            frame.ListControl.Append([fileObj.full_name, fileObj.size, fileObj.timestamp.isoformat(), fileObj.storage_class.name, fileObj.billable_size])
+    if args.bucket:
+        bucketName = args.bucket
+        dbName = bucketName + '.db'
+        if (not os.path.exists(dbName)) or args.refresh:
+            # the bucket is listed on a worker thread while the window shows the cache as it fills
+            frame.StartRefresh(bucketName, dbName, args.incremental)
         else:
-            frame.ListControl.Append([fileObj.full_name, fileObj.size, fileObj.timestamp.isoformat()])
-        totalSize += fileObj.size
-        index = index + 1
-    totalSizeInMb = totalSize / (1024 * 1024)
-    frame.Label.SetLabel(f'Total size: {totalSize:,} ({GetSize(totalSize)})')
+            # rows are read from the cache as they are shown, instead of loading the whole repository
+            frame.ShowView(ListingView(dbName))
+    else:
+        frame.ShowView(ListingView.from_file_objects(LocalRepository(args.folder).file_objects))
 
-    app.MainLoop()
\ No newline at end of file
+    app.MainLoop()
+    if frame.ListControl.View is not None:
+        frame.ListControl.View.close()
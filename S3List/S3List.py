@@ -1,5 +1,33 @@
 import os
-from Util.Repository import CachedRepository
+from Util.ListingCache import ListingCache, VERSION_DELIMITER
+from Util import Metrics
+
+
+def print_cached_names(cache):
+    '''
+    Print the full name of each version in the cache, read straight from its rows, so listing a cache
+    builds no repository and doesn't import the S3 client.
+    :param cache: (ListingCache) Cache of bucket
+    '''
+    for key, version_id, *rest in cache.versions():
+        print('/' + key + VERSION_DELIMITER + version_id)
+
+
+def print_folder_tree(cache, prefix='', depth=0):
+    '''
+    Print a folder and its sub-folders, indented, with the totals of each sub-tree read from the cache.
+    :param cache: (ListingCache) Cache of bucket
+    :param prefix: (string) Prefix of folder
+    :param depth: (int) Depth of folder, for indenting
+    '''
+    totals = cache.folder_totals(prefix)
+    if totals is None:
+        return
+    print(f'{"  " * depth}/{prefix}\t{totals.objects}\t{totals.versions}\t{totals.size}\t{totals.billable_size}\t'
+          f'{totals.newest.isoformat() if totals.newest else ""}')
+    for sub_folder in cache.sub_folder_totals(prefix):
+        print_folder_tree(cache, sub_folder.prefix, depth + 1)
+
 
 if __name__ == '__main__':
     import argparse
@@ -8,18 +36,29 @@ if __name__ == '__main__':
     parser.add_argument('--bucket', help='Name of bucket browse')
     parser.add_argument('--refresh', action='store_true', default=False,
                         help='Refresh local cached database from S3 storage')
+    parser.add_argument('--incremental', action='store_true', default=False,
+                        help='With --refresh, only re-read prefixes that changed since the last refresh')
+    parser.add_argument('--folders', action='store_true', default=False,
+                        help='List folders with their objects, versions, size, billable size and newest time '
+                             'instead of keys')
+    Metrics.add_arguments(parser)
     args = parser.parse_args()
+    Metrics.enable_from_arguments(args)
 
     bucketName = args.bucket
     dbName = bucketName + '.db'
-    bucket = None
     if (not os.path.exists(dbName)) or args.refresh:
-        bucket = CachedRepository.create_local_cached_database(bucketName)
-    else:
-        bucket = CachedRepository.load_from_cache(bucketName)
-
-    allNames = ['/' + o.full_name for o in bucket.file_objects]
+        # only listing the bucket needs the S3 client
+        from Util.Repository import CachedRepository
+        if args.refresh and args.incremental:
+            CachedRepository.refresh_local_cached_database(bucketName)
+        else:
+            CachedRepository.create_local_cached_database(bucketName)
 
-    for name in allNames:
-        print(name)
+    with ListingCache(dbName) as cache:
+        if args.folders:
+            # totals are read from the folder rows of the cache, without loading its objects
+            print_folder_tree(cache)
+        else:
+            print_cached_names(cache)
 
@@ -0,0 +1,16 @@
+'''
+Fixtures shared by the unit tests
+'''
+from Util.FakeS3 import FakeS3Client
+import pytest
+
+
+@pytest.fixture
+def client():
+    '''
+    Get a fake client with an empty versioned bucket
+    :return: (FakeS3Client) client with bucket 'test'
+    '''
+    client = FakeS3Client()
+    client.create_bucket(Bucket='test')
+    return client
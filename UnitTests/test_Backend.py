@@ -0,0 +1,203 @@
+from CloudSync import mirror, parse_target
+from Util import Backend as BackendModule
+from Util.Backend import S3Backend, LocalBackend, CacheBackend, copy_file
+from Util.Diff import diff, DiffActionType
+from Util.Repository import CachedRepository
+from Util.Transfer import TransferConfig, MB
+import errno
+import os
+import pytest
+
+
+@pytest.fixture(params=['s3', 'dir'])
+def backend(request, client, tmp_path):
+    if request.param == 's3':
+        # a small part size so put_file uploads in parts
+        return S3Backend('test', 'root/', client, TransferConfig(part_size=5 * MB))
+    return LocalBackend(str(tmp_path / 'root'))
+
+
+def test_operations(backend, tmp_path):
+    assert list(backend.list()) == []
+    assert backend.stat('a/b.txt') is None
+    stored = backend.put('a/b.txt', b'0123456789')
+    assert stored.key == 'a/b.txt' and stored.size == 10
+    backend.put('a/c/d.txt', b'd')
+    backend.put('ab.txt', b'ab')
+    entry = backend.stat('a/b.txt')
+    assert entry.size == 10
+    assert backend.read('a/b.txt') == b'0123456789'
+    assert backend.read('a/b.txt', 2, 3) == b'234'
+    assert backend.read('a/b.txt', 8) == b'89'
+
+    path = str(tmp_path / 'large.bin')
+    data = os.urandom(11 * MB)
+    with open(path, 'wb') as f:
+        f.write(data)
+    assert backend.put_file('large.bin', path).size == len(data)
+    assert backend.copy('large.bin', 'a/copy.bin').size == len(data)
+    assert backend.read('a/copy.bin', 6 * MB, 100) == data[6 * MB:6 * MB + 100]
+
+    assert [e.key for e in backend.list()] == ['a/b.txt', 'a/c/d.txt', 'a/copy.bin', 'ab.txt', 'large.bin']
+    assert [e.key for e in backend.list('a/')] == ['a/b.txt', 'a/c/d.txt', 'a/copy.bin']
+    assert [e.key for e in backend.list('a/c/')] == ['a/c/d.txt']
+    assert backend.delete(['a/c/d.txt', 'large.bin', 'missing.txt']) == []
+    assert [e.key for e in backend.list()] == ['a/b.txt', 'a/copy.bin', 'ab.txt']
+    assert backend.stat('a/c/d.txt') is None
+
+
+def test_versions(client):
+    backend = S3Backend('test', client=client)
+    first = backend.put('k.txt', b'first')
+    second = backend.put('k.txt', b'second!')
+    assert first.version_id != second.version_id
+    assert backend.stat('k.txt').size == 7
+    assert backend.stat('k.txt', first.version_id).size == 5
+    assert backend.read('k.txt', version_id=first.version_id) == b'first'
+    assert [(e.key, e.version_id) for e in backend.list()] == [('k.txt', second.version_id)]
+
+
+def test_cache_backend(client, tmp_path):
+    bucket = S3Backend('test', client=client)
+    for n in range(10):
+        bucket.put(f'{n % 3}/{n}.txt', bytes(n))
+    bucket.put('1/4.txt', b'new')
+    bucket.delete(['2/5.txt'])
+    database_name = str(tmp_path / 'test.db')
+    CachedRepository.create_local_cached_database('test', database_name, client=client)
+
+    prefixed = S3Backend('test', '1/', client)
+    with CacheBackend(database_name, '1/', prefixed) as cache:
+        # the same listing as the bucket, read from the cache
+        assert [(e.key, e.size, e.version_id) for e in cache.list()] == \
+               [(e.key, e.size, e.version_id) for e in prefixed.list()]
+        assert cache.stat('4.txt').size == 3
+        assert cache.stat('missing.txt') is None
+        assert cache.read('4.txt') == b'new'
+        with pytest.raises(Exception):
+            cache.put('x.txt', b'x')
+    with CacheBackend(database_name, '2/') as cache:
+        assert [e.key for e in cache.list()] == ['2.txt', '8.txt']
+        assert cache.stat('5.txt') is None
+        with pytest.raises(Exception):
+            cache.read('2.txt')
+
+
+def test_parse_target():
+    assert parse_target('s3:bucket') == ('s3', 'bucket', '')
+    assert parse_target('s3:bucket/data') == ('s3', 'bucket', 'data/')
+    assert parse_target('dir:/mnt/nas/data') == ('dir', '/mnt/nas/data', '')
+    for target in ('bucket', 'ftp:host', 's3:', 'dir:', 's3:/data', 's3://bucket'):
+        with pytest.raises(Exception, match='Target must be'):
+            parse_target(target)
+
+
+@pytest.fixture
+def folders(tmp_path):
+    '''
+    Make a source folder of 5 files, and a target folder with an older copy of one of them, a copy of
+    another and a file the source doesn't have
+    :return: (tuple) Source and target LocalBackends
+    '''
+    source = LocalBackend(str(tmp_path / 'source'))
+    target = LocalBackend(str(tmp_path / 'target'))
+    for n in range(5):
+        source.put(f'{n % 2}/{n}.txt', bytes(n))
+    target.put('0/0.txt', b'old')
+    target.put_from(source, source.stat('1/1.txt'))
+    target.put('extra.txt', b'extra')
+    return source, target
+
+
+def contents(backend):
+    return dict((e.key, backend.read(e.key)) for e in backend.list())
+
+
+@pytest.mark.parametrize('replicate', [False, True])
+def test_mirror(folders, replicate):
+    source, target = folders
+    assert mirror(source, target, False, replicate) == []
+    expected = contents(source)
+    if not replicate:
+        expected['extra.txt'] = b'extra'
+    assert contents(target) == expected
+    # files copied between folders keep their time, so they compare equal afterwards
+    assert [a.action for a in diff(source.list(), target.list())] == \
+        [DiffActionType.Skip] * 5 + ([] if replicate else [DiffActionType.Delete])
+
+
+def test_mirror_restore(folders):
+    source, target = folders
+    # a restore mirrors the target back to the source, deleting the files the target doesn't have
+    assert mirror(target, source, False, replicate=True) == []
+    assert contents(source) == {'0/0.txt': b'old', '1/1.txt': bytes(1), 'extra.txt': b'extra'}
+
+
+def test_mirror_show_only(folders, capsys):
+    source, target = folders
+    before = contents(target)
+    assert mirror(source, target, True, replicate=True) == []
+    assert contents(target) == before
+    shown = capsys.readouterr().out.splitlines()
+    assert len(shown) == 5 and shown[-1].endswith(': extra.txt')
+
+
+def test_mirror_failures(folders, monkeypatch):
+    source, target = folders
+    put_from = target.put_from
+
+    def failing_put_from(backend, entry):
+        if entry.key == '0/2.txt':
+            raise OSError(errno.ENOSPC, 'No space left on device')
+        return put_from(backend, entry)
+
+    def failing_delete(keys):
+        return [(key, OSError(errno.EACCES, 'Permission denied')) for key in keys]
+
+    monkeypatch.setattr(target, 'put_from', failing_put_from)
+    monkeypatch.setattr(target, 'delete', failing_delete)
+    failures = mirror(source, target, False, replicate=True)
+    assert [(key, e.errno) for key, e in failures] == [('0/2.txt', errno.ENOSPC), ('extra.txt', errno.EACCES)]
+    # the other files are copied all the same
+    assert sorted(contents(target)) == ['0/0.txt', '0/4.txt', '1/1.txt', '1/3.txt', 'extra.txt']
+
+
+def test_copy_file(tmp_path, monkeypatch):
+    source = str(tmp_path / 'source.bin')
+    data = os.urandom(3 * MB + 5)
+    with open(source, 'wb') as f:
+        f.write(data)
+
+    def read(path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    monkeypatch.setattr(BackendModule, 'COPY_CHUNK_SIZE', MB)
+    assert copy_file(source, str(tmp_path / 'native.bin')) == len(data)
+    assert read(str(tmp_path / 'native.bin')) == data
+
+    # a copy the file system doesn't support is carried on by the next way of copying
+    calls = []
+
+    def unsupported(source_fd, target_fd, offset):
+        calls.append(offset)
+        if offset >= MB:
+            raise OSError(errno.EXDEV, 'Cross-device link')
+        return BackendModule._sendfile(source_fd, target_fd, offset)
+
+    monkeypatch.setattr(BackendModule, 'NATIVE_COPIES', (unsupported,))
+    assert copy_file(source, str(tmp_path / 'buffered.bin')) == len(data)
+    assert calls == [0, MB]
+    assert read(str(tmp_path / 'buffered.bin')) == data
+
+    # a native copy that returns 0 before the end of the file, as some mounts do, is not taken for the end
+    def short(source_fd, target_fd, offset):
+        return 0 if offset >= 2 * MB else BackendModule._sendfile(source_fd, target_fd, offset)
+
+    def nothing(source_fd, target_fd, offset):
+        return 0
+
+    for copies in [(short,), (nothing,), (nothing, short)]:
+        monkeypatch.setattr(BackendModule, 'NATIVE_COPIES', copies)
+        assert copy_file(source, str(tmp_path / 'short.bin')) == len(data)
+        assert read(str(tmp_path / 'short.bin')) == data
@@ -0,0 +1,79 @@
+from BucketList import BucketOutput, OutputType, output_file_objects, output_header
+from Util.S3Repository import Repository
+import csv
+import pytest
+
+
+@pytest.fixture
+def bucket(client):
+    '''
+    Fill the bucket with 10 objects listed 3 entries per page: 0/0.txt has a second version and 1/1.txt a
+    delete marker
+    :return: (FakeS3Client) client with bucket 'test'
+    '''
+    client.page_size = 3
+    for n in range(10):
+        client.add_version('test', f'{n % 3}/{n}.txt', size=n)
+    client.add_version('test', '0/0.txt', size=100)
+    client.add_version('test', '1/1.txt', is_delete_marker=True)
+    return client
+
+
+def expected_rows(client, show_versions):
+    rows = []
+    for o in Repository('test', client=client).file_objects.values():
+        if show_versions:
+            rows.append([o.key, '', str(o.time_stamp), str(o.size), o.storage_class.name, str(o.is_deleted),
+                         str(o.num_versions)])
+            rows.extend(['', v.version_id, str(v.time_stamp), str(v.size), v.storage_class.name,
+                         str(v.is_delete_marker), ''] for v in o.versions)
+        else:
+            rows.append([o.key, str(o.time_stamp), str(o.size), o.storage_class.name, str(o.is_deleted)])
+    return rows
+
+
+def test_stream(bucket):
+    stream = Repository.stream('test', client=bucket)
+    first = next(stream)
+    # objects are produced as the pages of the listing arrive
+    assert bucket.calls['list_object_versions'] == 1
+    assert (first.key, first.size, first.num_versions) == ('0/0.txt', 100, 2)
+    objects = [first] + list(stream)
+    assert bucket.calls['list_object_versions'] == 4
+    assert [o.key for o in objects] == sorted(f'{n % 3}/{n}.txt' for n in range(10))
+    deleted = [o for o in objects if o.is_deleted]
+    assert [(o.key, o.num_versions) for o in deleted] == [('1/1.txt', 2)]
+
+
+@pytest.mark.parametrize('show_versions', [False, True])
+def test_text_file(bucket, tmp_path, show_versions):
+    filename = str(tmp_path / 'bucket.csv')
+    output_file_objects(Repository.stream('test', client=bucket),
+                        BucketOutput(OutputType.TextFile, True, show_versions, filename=filename))
+    with open(filename, newline='') as f:
+        rows = list(csv.reader(f))
+    assert rows[0] == output_header(show_versions)
+    assert rows[1:] == expected_rows(bucket, show_versions)
+    assert len(rows) == 1 + (22 if show_versions else 10)
+
+
+def test_standard_output(bucket, capsys):
+    output_file_objects(Repository.stream('test', client=bucket),
+                        BucketOutput(OutputType.StandardOutput, False, False))
+    rows = list(csv.reader(capsys.readouterr().out.splitlines()))
+    assert rows == expected_rows(bucket, False)
+
+
+def test_excel(bucket, tmp_path):
+    load_workbook = getattr(pytest.importorskip('openpyxl'), 'load_workbook', None)
+    if load_workbook is None:
+        pytest.skip('openpyxl is a stand-in without load_workbook')
+    filename = str(tmp_path / 'bucket.xlsx')
+    output_file_objects(Repository.stream('test', client=bucket),
+                        BucketOutput(OutputType.Excel, True, True, filename=filename))
+    rows = list(load_workbook(filename, read_only=True).worksheets[0].values)
+    assert list(rows[0]) == output_header(True)
+    objects = list(Repository('test', client=bucket).file_objects.values())
+    assert [row[0] for row in rows[1:] if row[0] is not None] == [o.key for o in objects]
+    assert rows[1][2:7] == (objects[0].time_stamp.replace(tzinfo=None), 100, 'STANDARD', False, 2)
+    assert len(rows) == 23
@@ -0,0 +1,90 @@
+from Util.CacheRefresh import CacheRefresh, RefreshCancelled, REFRESH_SUFFIX
+from Util.ListingCache import ListingCache
+from Util.Repository import CachedRepository
+from Util.FakeS3 import FakeS3Client
+import os
+import threading
+import pytest
+
+
+@pytest.fixture
+def client():
+    client = FakeS3Client(page_size=100)
+    client.create_bucket(Bucket='test')
+    for n in range(1000):
+        client.add_version('test', f'folder{n % 4}/file{n:04}.dat', size=n)
+    client.add_version('test', 'root.txt', size=1)
+    return client
+
+
+def versions(database_name):
+    with ListingCache(database_name) as cache:
+        return sorted(row[0:3] for row in cache.versions())
+
+
+def run(refresh):
+    done = threading.Event()
+    refresh._on_done = lambda r: done.set()
+    refresh.start()
+    assert done.wait(10)
+    refresh.join()
+    return refresh
+
+
+def test_stream_new_cache(client, tmp_path):
+    database_name = str(tmp_path / 'test.db')
+    progress = []
+    refresh = CacheRefresh('test', database_name, client=client, on_progress=lambda *p: progress.append(p),
+                           batch_size=500)
+    assert refresh.in_place
+    run(refresh)
+    assert refresh.error is None
+    # each batch is committed and reported, and the total once the listing ends
+    assert progress[-1] == (1001, 1001)
+    assert progress[0:2] == [(500, None), (1000, None)]
+    assert not refresh.install()
+    assert len(versions(database_name)) == 1001
+    with ListingCache(database_name) as cache:
+        assert cache.search_keys('file0999') == ['folder3/file0999.dat']
+        assert cache.db.execute('SELECT COUNT(*) FROM PrefixCheckpoints').fetchone()[0] == 5
+
+    # a streamed cache is refreshed incrementally like one created at once
+    client.add_version('test', 'folder2/new.dat', size=5)
+    progress.clear()
+    refresh = run(CacheRefresh('test', database_name, incremental=True, client=client,
+                               on_progress=lambda *p: progress.append(p)))
+    assert refresh.incremental and refresh.in_place and refresh.error is None
+    assert progress == [(n, 5) for n in range(1, 6)]
+    assert len(versions(database_name)) == 1002
+    CachedRepository.create_local_cached_database('test', str(tmp_path / 'full.db'), client=client)
+    assert versions(database_name) == versions(str(tmp_path / 'full.db'))
+
+
+def test_full_refresh_replaces_cache(client, tmp_path):
+    database_name = str(tmp_path / 'test.db')
+    CachedRepository.create_local_cached_database('test', database_name, client=client)
+    client.add_version('test', 'folder1/new.dat', size=5)
+    progress = []
+    refresh = CacheRefresh('test', database_name, client=client, on_progress=lambda *p: progress.append(p),
+                           batch_size=500)
+    assert refresh.building_name == database_name + REFRESH_SUFFIX
+    run(refresh)
+    # the old cache's count is the estimated total until the listing ends
+    assert progress[0:2] == [(500, 1001), (1000, 1001)]
+    assert progress[-1] == (1002, 1002)
+    assert len(versions(database_name)) == 1001
+    assert refresh.install()
+    assert len(versions(database_name)) == 1002
+    assert not os.path.exists(database_name + REFRESH_SUFFIX)
+
+
+def test_cancel(client, tmp_path):
+    database_name = str(tmp_path / 'test.db')
+    CachedRepository.create_local_cached_database('test', database_name, client=client)
+    refresh = CacheRefresh('test', database_name, client=client, on_progress=lambda *p: refresh.cancel(),
+                           batch_size=500)
+    run(refresh)
+    assert isinstance(refresh.error, RefreshCancelled)
+    assert not refresh.install()
+    assert not os.path.exists(database_name + REFRESH_SUFFIX)
+    assert len(versions(database_name)) == 1001
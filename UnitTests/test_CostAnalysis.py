@@ -0,0 +1,98 @@
+from Util.CostAnalysis import CostAnalysis, VersionState, GIGABYTE, STORAGE_PRICES
+from Util.ListingCache import ListingCache, epoch_microseconds
+from Util.Repository import S3FileObject, S3StorageClass
+from Util.S3Listing import ListedObject
+from datetime import datetime, timedelta, timezone
+import pytest
+
+NOW = datetime(2020, 7, 1, tzinfo=timezone.utc)
+MB = 2 ** 20
+
+
+@pytest.fixture
+def analysis(tmp_path):
+    '''
+    Get an analysis of a cache with objects of several classes, noncurrent versions and a delete marker
+    '''
+    def mtime(days):
+        return epoch_microseconds(NOW - timedelta(days=days))
+
+    rows = [
+        ('logs/2020/a.log', 'v2', 10 * MB, mtime(10), None, S3StorageClass.STANDARD, True, False),
+        ('logs/2020/a.log', 'v1', 10 * MB, mtime(100), None, S3StorageClass.STANDARD, False, False),
+        ('logs/2020/small.log', 'v1', 1000, mtime(100), None, S3StorageClass.STANDARD, True, False),
+        ('logs/old.log', 'v1', 1000, mtime(10), None, S3StorageClass.STANDARD_IA, True, False),
+        ('photos/p.jpg', 'v1', 2 * MB, mtime(60), None, S3StorageClass.GLACIER, True, False),
+        ('photos/q.jpg', 'v2', 0, mtime(1), None, None, True, True),
+        ('photos/q.jpg', 'v1', 1 * MB, mtime(200), None, S3StorageClass.STANDARD, False, False),
+    ]
+    database_name = str(tmp_path / 'bucket.db')
+    with ListingCache(database_name) as cache:
+        cache.add_rows(rows)
+    analysis = CostAnalysis(database_name, now=NOW)
+    yield analysis
+    analysis.close()
+
+
+def test_storage_class_rules():
+    assert S3StorageClass.STANDARD_IA.billable_size(1000) == 128 * 1024
+    assert S3StorageClass.GLACIER.billable_size(1000) == 1000 + 40 * 1024
+    assert S3StorageClass.STANDARD.billable_size(1000) == 1000
+    assert S3StorageClass.from_name(None) == S3StorageClass.STANDARD
+    assert S3StorageClass.from_name('OUTPOSTS') == S3StorageClass.STANDARD
+    version = S3FileObject(ListedObject({'Key': 'a', 'VersionId': 'v1', 'LastModified': NOW, 'Size': 10,
+                                         'StorageClass': 'ONEZONE_IA'}))
+    assert version.storage_class == S3StorageClass.ONEZONE_IA
+    assert version.billable_size == 128 * 1024
+    marker = S3FileObject(ListedObject({'Key': 'a', 'VersionId': 'v2', 'LastModified': NOW}, is_delete_marker=True))
+    assert marker.billable_size == 0
+
+
+def test_rollups(analysis):
+    assert analysis.count == 7
+    total = analysis.total()
+    assert total.size == 23 * MB + 2000
+    assert total.billable_size == 23 * MB + 1000 + 128 * 1024 + 40 * 1024
+
+    by_class = analysis.by_class()
+    assert set(by_class) == {S3StorageClass.STANDARD, S3StorageClass.STANDARD_IA, S3StorageClass.GLACIER}
+    assert by_class[S3StorageClass.STANDARD].count == 4
+    assert by_class[S3StorageClass.STANDARD].monthly_cost == pytest.approx((21 * MB + 1000) / GIGABYTE * 0.023)
+
+    by_state = analysis.by_version_state()
+    assert by_state[VersionState.Noncurrent].size == 11 * MB
+    assert by_state[VersionState.DeleteMarker].count == 1
+    assert by_state[VersionState.DeleteMarker].billable_size == 0
+
+    by_folder = analysis.by_folder()
+    assert by_folder[''].count == 7
+    assert by_folder['logs/'].size == 20 * MB + 2000
+    assert by_folder['logs/2020/'].count == 3
+    assert list(analysis.by_folder(depth=1)) == ['logs/', 'photos/']
+    assert by_folder['logs/'].monthly_cost + by_folder['photos/'].monthly_cost == pytest.approx(analysis.monthly_cost())
+    assert analysis.by_folder(recursive=False)['logs/'].count == 1
+
+    # 20 days left of STANDARD_IA, 30 days left of GLACIER
+    expected = (128 * 1024 * 0.0125 * 20 / 30 + (2 * MB + 32 * 1024) * STORAGE_PRICES[S3StorageClass.GLACIER]
+                + 8 * 1024 * 0.023) / GIGABYTE
+    assert analysis.early_deletion_cost() == pytest.approx(expected)
+
+
+def test_simulate_transition(analysis):
+    estimate = analysis.simulate_transition('logs/', S3StorageClass.GLACIER)
+    # small objects, noncurrent versions and objects already in a colder class are not transitioned
+    assert (estimate.count, estimate.size) == (1, 10 * MB)
+    assert estimate.monthly_savings > 0
+    assert estimate.transition_cost == pytest.approx(0.03 / 1000)
+    assert estimate.early_deletion_cost == 0
+    assert estimate.break_even_months > 0
+
+    estimate = analysis.simulate_transition('logs/', S3StorageClass.GLACIER, include_noncurrent=True,
+                                            min_age_days=30)
+    assert (estimate.count, estimate.size) == (1, 10 * MB)
+    assert analysis.simulate_transition('logs/2020/a', S3StorageClass.STANDARD_IA, include_noncurrent=True).count == 2
+    assert analysis.simulate_transition('photos/', S3StorageClass.STANDARD_IA).count == 0
+
+    subset = CostAnalysis(analysis._cache, prefix='photos/', now=NOW)
+    assert subset.count == 3
+    assert list(subset.by_folder(depth=1)) == ['photos/']
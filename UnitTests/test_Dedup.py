@@ -0,0 +1,50 @@
+from Util.Dedup import RemoteFingerprints
+from Util.Diff import s3_entries
+from Util.SyncState import SyncStateIndex
+from Util.Transfer import TransferEngine, TransferConfig, MB
+from CloudSync import update
+import os
+import pytest
+
+
+@pytest.fixture
+def local_folder(tmp_path):
+    '''
+    Get a local folder with one small file and two large files, one of them uploaded in parts
+    :return: (string) root of folder
+    '''
+    root = tmp_path / 'local'
+    (root / 'photos').mkdir(parents=True)
+    (root / 'photos' / 'small.txt').write_text('small file')
+    (root / 'photos' / 'large.jpg').write_bytes(os.urandom(2 * MB))
+    (root / 'photos' / 'huge.jpg').write_bytes(os.urandom(11 * MB))
+    return str(root)
+
+
+def test_renamed_folder_is_copied(client, local_folder, tmp_path):
+    config = TransferConfig(part_size=5 * MB, small_file_size=MB)
+    engine = TransferEngine(client, 'test', config)
+    with SyncStateIndex(str(tmp_path / 'state.db')) as index:
+        assert update(client, 'test', 'backup/', local_folder, index, engine, False) == []
+        uploaded = client.bytes_sent
+
+        os.rename(os.path.join(local_folder, 'photos'), os.path.join(local_folder, 'pictures'))
+        client.calls.clear()
+        assert update(client, 'test', 'backup/', local_folder, index, engine, False, replicate=True) == []
+
+    assert client.calls['copy_object'] == 2
+    assert client.calls['put_object'] == 1
+    assert 'upload_part' not in client.calls
+    assert client.bytes_sent - uploaded == len('small file')
+    keys = [e['Key'] for e in client.list_entries('test', 'backup/', None, versions=False)]
+    assert keys == ['backup/pictures/huge.jpg', 'backup/pictures/large.jpg', 'backup/pictures/small.txt']
+
+
+def test_stored_hash_matches_other_part_size(client):
+    data = os.urandom(11 * MB)
+    client.add_version('test', 'old.bin', data=data, e_tag='"0123-3"', metadata={'cloudsync-md5': 'abc'})
+    fingerprints = RemoteFingerprints(client, 'test')
+    assert len(list(fingerprints.collect(s3_entries(client, 'test')))) == 1
+    assert fingerprints.find(len(data), 'abc', '4567-2') == ('old.bin', 'old.bin-v1')
+    assert fingerprints.find(len(data), 'def', '4567-2') is None
+    assert client.calls['head_object'] == 1
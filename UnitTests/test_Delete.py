@@ -0,0 +1,84 @@
+from Util.Delete import BulkDeleter, PrefixRateLimiter
+from Util.Plan import Planner, PlanActionType
+from Util.SyncState import SyncStateIndex
+from Util.Transfer import TransferEngine, TransferConfig
+from CloudSync import update, execute_plan
+import pytest
+
+
+def versions(client, prefix='sync/'):
+    return [(e['Key'], e['VersionId']) for e in client.list_entries('test', prefix, None)]
+
+
+def test_rate_limiter():
+    now = [0.0]
+    waits = []
+
+    def sleep(seconds):
+        waits.append(seconds)
+        now[0] += seconds
+
+    limiter = PrefixRateLimiter(rate=100, prefix_depth=2, clock=lambda: now[0], sleep=sleep)
+    assert limiter.prefix('a/b/c.txt') == 'a/b'
+    assert limiter.prefix('a/c.txt') == 'a'
+    assert limiter.prefix('c.txt') == ''
+    # a burst of up to one second of requests goes straight away
+    assert limiter.acquire(['a/b/1'] * 100) == 0.0
+    assert limiter.acquire(['a/c/1'] * 100) == 0.0
+    # then each prefix is held to its rate
+    assert limiter.acquire(['a/b/2'] * 50 + ['a/c/2'] * 10) == pytest.approx(0.5)
+    assert limiter.acquire(['a/b/3'] * 50) == pytest.approx(0.5)
+    assert waits == [pytest.approx(0.5), pytest.approx(0.5)]
+
+
+def test_bulk_delete(client):
+    for n in range(2500):
+        client.add_version('test', f'sync/{n % 3}/{n:04}.txt', size=1)
+        client.add_version('test', f'sync/{n % 3}/{n:04}.txt', size=2)
+    targets = versions(client)
+    # errors are taken in turn by both versions of a key
+    client.delete_errors = {'sync/0/0000.txt': ['SlowDown', 'InternalError'],
+                            'sync/1/0001.txt': ['AccessDenied'] * 2, 'sync/2/0002.txt': ['SlowDown'] * 10}
+    deleted = []
+    deleter = BulkDeleter(client, 'test', max_concurrency=4, backoff=0.001)
+    failures = deleter.delete(targets, on_deleted=deleted.extend)
+    assert sorted((key, e.args[0]) for key, version_id, e in failures) == [
+        ('sync/1/0001.txt', 'AccessDenied: Injected error'), ('sync/1/0001.txt', 'AccessDenied: Injected error'),
+        ('sync/2/0002.txt', 'SlowDown: Injected error'), ('sync/2/0002.txt', 'SlowDown: Injected error')]
+    assert sorted(versions(client)) == sorted(set(targets) - set(deleted))
+    assert len(deleted) == 5000 - 4
+    # 5 batches, then requests with only the keys that failed with SlowDown and InternalError, up to 5 attempts
+    assert client.calls['delete_objects'] == 5 + 1 + 4
+    assert deleter.stats.deleted == 4996
+    assert deleter.stats.failed == 4
+
+
+def test_replicate_purge(client, tmp_path):
+    root = tmp_path / 'local'
+    root.mkdir()
+    (root / 'a.txt').write_bytes(b'a')
+    for data in (b'old a', b'older a'):
+        client.add_version('test', 'sync/a.txt', data=data)
+    client.add_version('test', 'sync/b.txt', data=b'b')
+    client.add_version('test', 'sync/b.txt', data=b'newer b')
+    client.add_version('test', 'sync/c.txt', data=b'c')
+    client.delete_objects(Bucket='test', Delete={'Objects': [{'Key': 'sync/c.txt'}]})
+    engine = TransferEngine(client, 'test', TransferConfig())
+    with SyncStateIndex(str(tmp_path / 'state.db')) as index:
+        planner = Planner(engine.config, str(tmp_path / 'plan.jsonl'), show=None)
+        assert update(client, 'test', 'sync/', str(root), index, engine, True, replicate=True, planner=planner,
+                      purge=True) == []
+        planner.close()
+        # the noncurrent versions of a.txt and b.txt, b.txt itself, and c.txt with its delete marker
+        assert planner.summary.count(PlanActionType.DeleteVersion) == 1 + 1 + 2
+        assert planner.summary.count(PlanActionType.Delete) == 1
+        assert len(versions(client)) == 6
+
+        # the version of a.txt replaced by the upload only becomes noncurrent now
+        assert execute_plan(client, 'test', str(tmp_path / 'plan.jsonl'), index, engine) == []
+        assert [key for key, version_id in versions(client)] == ['sync/a.txt', 'sync/a.txt']
+
+        client.add_version('test', 'sync/d.txt', data=b'd')
+        assert update(client, 'test', 'sync/', str(root), index, engine, False, replicate=True, purge=True) == []
+        assert [key for key, version_id in versions(client)] == ['sync/a.txt']
+        assert client.get_object(Bucket='test', Key='sync/a.txt')['Body'].read() == b'a'
@@ -0,0 +1,157 @@
+from Util.Diff import DiffEntry, DiffActionType, diff, local_entries, s3_entries, s3_snapshot_entries, \
+    cache_snapshot_entries
+from Util.ListingCache import ListingCache, epoch_microseconds
+from Util.SyncState import SyncStateIndex
+from Util.Transfer import TransferEngine, TransferConfig
+from Util.FakeS3 import FakeS3Client
+from CloudSync import restore
+from datetime import datetime, timezone
+import os
+import pytest
+
+T1 = datetime(2019, 8, 19, 12, 35, 22, tzinfo=timezone.utc)
+T2 = datetime(2019, 8, 20, tzinfo=timezone.utc)
+
+
+def actions(source, target):
+    return [(a.action, a.key) for a in diff(iter(source), iter(target))]
+
+
+def test_diff_actions():
+    source = [DiffEntry('a', 10, T1), DiffEntry('b', 10, T2), DiffEntry('c', 5, T1),
+              DiffEntry('d', 7, T1, content_hash='x'), DiffEntry('f', 1, T1)]
+    target = [DiffEntry('b', 10, T1), DiffEntry('c', 5, T2), DiffEntry('d', 7, T2, content_hash='y'),
+              DiffEntry('e', 3, T1)]
+    assert actions(source, target) == [
+        (DiffActionType.Copy, 'a'),
+        (DiffActionType.Overwrite, 'b'),
+        (DiffActionType.Skip, 'c'),
+        (DiffActionType.Overwrite, 'd'),
+        (DiffActionType.Delete, 'e'),
+        (DiffActionType.Copy, 'f'),
+    ]
+
+
+def test_diff_unsorted():
+    with pytest.raises(Exception):
+        actions([DiffEntry('b', 1, T1), DiffEntry('a', 1, T1)], [])
+
+
+def test_local_entries_in_key_order(tmp_path):
+    for name in ['a-b', 'a/x', 'a.txt', 'a/b/c', 'b', 'a0']:
+        path = tmp_path / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(name)
+    keys = [e.key for e in local_entries(str(tmp_path))]
+    assert keys == sorted(keys)
+    assert len(keys) == 6
+
+
+def test_diff_local_to_s3(tmp_path):
+    (tmp_path / 'same.txt').write_text('same')
+    (tmp_path / 'new.txt').write_text('new')
+    (tmp_path / 'dir').mkdir()
+    (tmp_path / 'dir' / 'changed.txt').write_text('changed locally')
+    client = FakeS3Client()
+    client.create_bucket(Bucket='test')
+    client.add_version('test', 'root/same.txt', size=4, last_modified=datetime.now(timezone.utc))
+    client.add_version('test', 'root/dir/changed.txt', size=3)
+    client.add_version('test', 'root/gone.txt', size=3)
+    client.add_version('test', 'root/deleted.txt', size=3)
+    client.add_version('test', 'root/deleted.txt', is_delete_marker=True)
+    result = [(a.action, a.key) for a in diff(local_entries(str(tmp_path)), s3_entries(client, 'test', 'root/'))]
+    assert result == [
+        (DiffActionType.Overwrite, 'dir/changed.txt'),
+        (DiffActionType.Delete, 'gone.txt'),
+        (DiffActionType.Copy, 'new.txt'),
+        (DiffActionType.Skip, 'same.txt'),
+    ]
+
+
+@pytest.fixture
+def history():
+    '''
+    Get a fake client for a bucket whose objects were changed at noon on three days of 2019-08
+    '''
+    def day(n):
+        return datetime(2019, 8, n, 12, tzinfo=timezone.utc)
+
+    client = FakeS3Client()
+    client.create_bucket(Bucket='test')
+    client.add_version('test', 'root/a.txt', data=b'a, first', last_modified=day(1))
+    client.add_version('test', 'root/b.txt', data=b'b', last_modified=day(1))
+    client.add_version('test', 'root/a.txt', data=b'a, second version', last_modified=day(2))
+    client.add_version('test', 'root/c.txt', data=b'c', last_modified=day(2))
+    client.add_version('test', 'root/b.txt', is_delete_marker=True, last_modified=day(3))
+    client.add_version('test', 'root/a.txt', data=b'a, third', last_modified=day(3))
+    return client
+
+
+def snapshot(entries):
+    return [(e.key, e.size) for e in entries]
+
+
+def test_snapshot_entries(history, tmp_path):
+    assert snapshot(s3_snapshot_entries(history, 'test', 'root/', datetime(2019, 8, 1, tzinfo=timezone.utc))) == []
+    assert snapshot(s3_snapshot_entries(history, 'test', 'root/', datetime(2019, 8, 2, 12, tzinfo=timezone.utc))) == \
+        [('a.txt', 17), ('b.txt', 1), ('c.txt', 1)]
+    assert snapshot(s3_snapshot_entries(history, 'test', 'root/', datetime(2019, 8, 3, tzinfo=timezone.utc))) == \
+        [('a.txt', 17), ('b.txt', 1), ('c.txt', 1)]
+    assert snapshot(s3_snapshot_entries(history, 'test', 'root/', datetime(2019, 8, 4, tzinfo=timezone.utc))) == \
+        [('a.txt', 8), ('c.txt', 1)]
+
+    rows = []
+    for key, versions in history._buckets['test']['objects'].items():
+        for v in versions:
+            rows.append((key, v['VersionId'], v.get('Size', 0), epoch_microseconds(v['LastModified']), v.get('ETag'),
+                         None, v['IsLatest'], 'Size' not in v))
+    with ListingCache(str(tmp_path / 'bucket.db')) as cache:
+        cache.add_rows(rows)
+        for day in (1, 2, 3, 4):
+            timestamp = datetime(2019, 8, day, 6, tzinfo=timezone.utc)
+            cached = list(cache_snapshot_entries(cache, 'root/', timestamp))
+            listed = list(s3_snapshot_entries(history, 'test', 'root/', timestamp))
+            assert [(e.key, e.size, e.version_id, e.content_hash, e.timestamp) for e in cached] == \
+                [(e.key, e.size, e.version_id, e.content_hash, e.timestamp) for e in listed]
+
+
+def test_restore_to_time(history, tmp_path):
+    source = tmp_path / 'local'
+    source.mkdir()
+    (source / 'a.txt').write_bytes(b'a, local edit')
+    (source / 'new.txt').write_bytes(b'new')
+    engine = TransferEngine(history, 'test', TransferConfig())
+    with SyncStateIndex(str(tmp_path / 'state.db')) as index:
+        timestamp = datetime(2019, 8, 2, 18, tzinfo=timezone.utc)
+        assert restore(history, 'test', 'root/', str(source), index, engine, False, timestamp) == []
+        assert sorted(os.listdir(source)) == ['a.txt', 'b.txt', 'c.txt']
+        assert (source / 'a.txt').read_bytes() == b'a, second version'
+        history.calls.clear()
+        assert restore(history, 'test', 'root/', str(source), index, engine, False, timestamp) == []
+        assert 'get_object' not in history.calls
+
+
+def test_restore_delete_failures(history, tmp_path, monkeypatch):
+    '''
+    A local file that can't be deleted is a failure that doesn't stop the other deletes
+    '''
+    source = tmp_path / 'local'
+    source.mkdir()
+    for name in ('gone.txt', 'locked.txt', 'new.txt'):
+        (source / name).write_bytes(name.encode())
+    remove = os.remove
+
+    def failing_remove(path):
+        if path.endswith('gone.txt'):
+            # deleted since the folder was scanned
+            remove(path)
+        elif path.endswith('locked.txt'):
+            raise PermissionError(13, 'Permission denied', path)
+        remove(path)
+    monkeypatch.setattr(os, 'remove', failing_remove)
+    engine = TransferEngine(history, 'test', TransferConfig())
+    with SyncStateIndex(str(tmp_path / 'state.db')) as index:
+        failures = restore(history, 'test', 'root/', str(source), index, engine, False)
+        assert [(key, type(e)) for key, e in failures] == [('locked.txt', PermissionError)]
+        assert sorted(os.listdir(source)) == ['a.txt', 'c.txt', 'locked.txt']
+        assert index.get('a.txt') is not None
@@ -0,0 +1,137 @@
+from Util.ListingCache import ListingCache, SCHEMA_VERSION
+from Util.Repository import CachedRepository, S3FileObject, S3StorageClass
+from Util.S3Listing import ListedObject
+from datetime import datetime, timedelta, timezone
+import sqlite3
+
+
+def listed_versions(count, start=datetime(2019, 1, 1, tzinfo=timezone.utc)):
+    '''
+    Get S3FileObjects for two versions each of count // 2 keys in three folders
+    '''
+    for n in range(count):
+        yield S3FileObject(ListedObject({'Key': f'folder{n // 2 % 3}/sub/file{n // 2}.dat', 'VersionId': f'v{n % 2}',
+                                         'LastModified': start + timedelta(seconds=n), 'Size': n,
+                                         'IsLatest': n % 2 == 0, 'ETag': f'"{n:032x}"'}))
+
+
+def test_build_and_load(tmp_path):
+    database_name = str(tmp_path / 'bucket.db')
+    ListingCache.build(database_name, listed_versions(100)).close()
+    with ListingCache(database_name) as cache:
+        assert cache.db.execute('PRAGMA user_version').fetchone()[0] == SCHEMA_VERSION
+        assert cache.db.execute('SELECT COUNT(*) FROM Objects').fetchone()[0] == 50
+        prefixes = [row[0] for row in cache.db.execute('SELECT Prefix FROM Folders ORDER BY Prefix')]
+        assert prefixes == ['', 'folder0/', 'folder0/sub/', 'folder1/', 'folder1/sub/', 'folder2/', 'folder2/sub/']
+        rows = list(cache.versions('o.Key = ?', ('folder2/sub/file2.dat',), 'ORDER BY v.VersionId'))
+        assert [row[0:4] for row in rows] == [
+            ('folder2/sub/file2.dat', 'v0', 4, 1546300804000000), ('folder2/sub/file2.dat', 'v1', 5, 1546300805000000)]
+        assert rows[0][4:8] == ('"00000000000000000000000000000004"', S3StorageClass.STANDARD.value, 1, 0)
+
+    repository = CachedRepository(database_name)
+    assert len(repository.file_objects) == 100
+    first = repository.file_objects[0]
+    assert (first.full_name, first.size) == ('folder0/sub/file0.dat$v0', 0)
+    assert first.timestamp == datetime(2019, 1, 1)
+
+
+def test_migrate_file_objects(tmp_path):
+    '''
+    Open a cache written with the single FileObjects table and expect the same file objects
+    '''
+    database_name = str(tmp_path / 'old.db')
+    with sqlite3.connect(database_name) as db:
+        db.execute('CREATE TABLE "FileObjects" ("Name" TEXT, "Size" INTEGER, "Time" TEXT)')
+        db.executemany('INSERT INTO FileObjects(Name,Size,Time) VALUES(?,?,?)', [
+            ('a.txt$1', 10, '2019-08-19 12:35:22.000000'),
+            ('dir/b.txt$2', 20, '2019-06-30 06:30:00.500000'),
+            ('dir/b.txt$1', 30, '2019-06-29 06:30:00.000000')])
+    repository = CachedRepository(database_name)
+    assert [(o.full_name, o.size, o.timestamp) for o in repository.file_objects] == [
+        ('a.txt$1', 10, datetime(2019, 8, 19, 12, 35, 22)),
+        ('dir/b.txt$2', 20, datetime(2019, 6, 30, 6, 30, 0, 500000)),
+        ('dir/b.txt$1', 30, datetime(2019, 6, 29, 6, 30))]
+    with sqlite3.connect(database_name) as db:
+        tables = [row[0] for row in db.execute("SELECT name FROM sqlite_master WHERE type='table'")]
+        assert 'FileObjects' not in tables
+        assert db.execute('SELECT COUNT(*) FROM Objects').fetchone()[0] == 2
+
+
+def test_update_prefix_rows(tmp_path):
+    database_name = str(tmp_path / 'bucket.db')
+    versions = list(listed_versions(12))
+    ListingCache.build(database_name, versions).close()
+    start = datetime(2019, 1, 1, tzinfo=timezone.utc)
+    # folder0: one version removed, one added
+    listed = [o for o in versions if o.full_name.startswith('folder0/') and o.full_name != 'folder0/sub/file0.dat$v0']
+    listed.append(S3FileObject(ListedObject({'Key': 'folder0/new.dat', 'VersionId': 'v9', 'LastModified': start,
+                                             'Size': 99, 'IsLatest': True, 'ETag': '"new"'})))
+    with ListingCache(database_name) as cache:
+        CachedRepository._update_prefix_rows(cache, 'folder0/', listed)
+        keys = sorted(row[0] + '$' + row[1] for row in cache.versions())
+    expected = [o.full_name for o in versions if o.full_name != 'folder0/sub/file0.dat$v0']
+    assert keys == sorted(expected + ['folder0/new.dat$v9'])
+
+
+def test_snapshot(tmp_path):
+    database_name = str(tmp_path / 'bucket.db')
+    ListingCache.build(database_name, listed_versions(12)).close()
+    start = datetime(2019, 1, 1)
+    with ListingCache(database_name) as cache:
+        indexes = [row[0] for row in cache.db.execute("SELECT name FROM sqlite_master WHERE type='index'")]
+        assert 'VersionsTimeline' in indexes and 'VersionsObject' not in indexes
+        assert [row[1] for row in cache.timeline('folder1/sub/file1.dat')] == ['v0', 'v1']
+        # at 5 seconds, file0..file1 have both versions and file2 only its first
+        rows = list(cache.snapshot(start + timedelta(seconds=4)))
+        assert [(row[0], row[1]) for row in rows] == [
+            ('folder0/sub/file0.dat', 'v1'), ('folder1/sub/file1.dat', 'v1'), ('folder2/sub/file2.dat', 'v0')]
+        assert [row[0] for row in cache.snapshot(start + timedelta(hours=1), 'folder0/')] == \
+            ['folder0/sub/file0.dat', 'folder0/sub/file3.dat']
+
+
+def test_search_keys(tmp_path):
+    database_name = str(tmp_path / 'bucket.db')
+    with ListingCache.build(database_name, listed_versions(100)) as cache:
+        assert cache.has_key_search
+        assert cache.search_keys('file4') == [f'folder{n % 3}/sub/file{n}.dat' for n in [4] + list(range(40, 50))]
+        # words are matched anywhere in a key, ignoring case; short words without the index
+        assert cache.search_keys('FOLDER1 e4') == ['folder1/sub/file4.dat', 'folder1/sub/file40.dat', 'folder1/sub/file43.dat',
+                                                   'folder1/sub/file46.dat', 'folder1/sub/file49.dat']
+        assert cache.search_keys('file_') == []
+        assert cache.search_keys('') == []
+        # the index follows objects added and deleted
+        cache.add_rows([('new/file4x.dat', 'v0', 1, 0, None, None, True, False)])
+        assert cache.search_keys('4x') == cache.search_keys('file4x') == ['new/file4x.dat']
+        cache.delete_versions(row[8] for row in cache.versions('o.Key = ?', ('new/file4x.dat',)))
+        assert cache.search_keys('file4x') == []
+
+
+def test_folder_totals(tmp_path):
+    database_name = str(tmp_path / 'bucket.db')
+    file_objects = list(listed_versions(100))
+    with ListingCache.build(database_name, file_objects) as cache:
+        totals = cache.folder_totals('folder2/')
+        assert (totals.prefix, totals.objects, totals.versions) == ('folder2/', 16, 32)
+        assert totals.size == sum(n for n in range(100) if n // 2 % 3 == 2)
+        assert totals.newest == datetime(2019, 1, 1, 0, 1, 35)
+        root = cache.folder_totals('')
+        assert (root.objects, root.versions, root.size) == (50, 100, sum(range(100)))
+        assert [t.prefix for t in cache.sub_folder_totals('')] == ['folder0/', 'folder1/', 'folder2/']
+        assert cache.folder_totals('folder3/') is None
+        built = list(cache.db.execute('SELECT * FROM Folders ORDER BY Prefix'))
+
+    # totals kept up to date by changes match totals built from scratch
+    with ListingCache(str(tmp_path / 'changed.db')) as cache:
+        cache.add_file_objects(file_objects[0:30])
+        cache.add_file_objects(file_objects[30:])
+        assert list(cache.db.execute('SELECT * FROM Folders ORDER BY Prefix')) == built
+        # deleting the newest version of folder2 makes an older one its newest
+        cache.delete_versions(row[8] for row in cache.versions("o.Key LIKE 'folder1/%' OR o.Key = ?",
+                                                               ('folder2/sub/file47.dat',)))
+        cache.add_rows([('folder0/glacier.dat', 'v0', 10, 0, None, S3StorageClass.GLACIER, True, False)])
+        changed = list(cache.db.execute('SELECT * FROM Folders ORDER BY Prefix'))
+        cache.build_folder_totals()
+        assert list(cache.db.execute('SELECT * FROM Folders ORDER BY Prefix')) == changed
+        assert cache.folder_totals('folder2/').newest == datetime(2019, 1, 1, 0, 1, 29)
+        assert cache.folder_totals('folder0/').billable_size == cache.folder_totals('folder0/').size + 40 * 1024
+        assert cache.folder_totals('folder1/') is None
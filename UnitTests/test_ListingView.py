@@ -0,0 +1,90 @@
+from Util.ListingCache import ListingCache, epoch_microseconds
+from Util.ListingView import ListingView
+from Util.Repository import CachedRepository, S3StorageClass, MIN_BILLABLE_SIZE
+from datetime import datetime, timedelta
+import pytest
+
+
+@pytest.fixture
+def cache_database(tmp_path):
+    '''
+    Get a cache database of 1000 objects, with sizes and times in a different order than names
+    :return: (string) name of database
+    '''
+    database_name = str(tmp_path / 'bucket.db')
+    start = datetime(2020, 1, 1)
+    with ListingCache(database_name) as cache:
+        cache.add_rows((f'folder/file{n:04}.dat', 'v1', (n * 7919) % 1000,
+                        epoch_microseconds(start + timedelta(minutes=(n * 31) % 1000)), None, None, True, False)
+                       for n in range(1000))
+    return database_name
+
+
+def test_rows_in_sort_order(cache_database):
+    view = ListingView(cache_database, page_size=30, cache_rows=60)
+    assert view.count == 1000
+    assert view.total_size == sum(range(1000))
+    names = [view.item_text(n, 0) for n in range(view.count)]
+    assert names == sorted(names)
+    assert view.row(0) == ('folder/file0000.dat$v1', '0', '2020-01-01T00:00:00', 'STANDARD', '0')
+
+    assert view.sort(1)
+    sizes = [int(view.item_text(n, 1)) for n in range(view.count)]
+    assert sizes == list(range(1000))
+    # clicking the same column again reverses the order; a distant row is read by offset
+    assert view.sort(1)
+    assert view.item_text(990, 1) == '9'
+    assert [int(view.item_text(n, 1)) for n in range(view.count)] == list(reversed(range(1000)))
+    assert not view.sort(3)
+    with pytest.raises(IndexError):
+        view.row(1000)
+
+
+def test_from_file_objects(cache_database):
+    view = ListingView.from_file_objects(CachedRepository(cache_database).file_objects)
+    assert view.count == 1000
+    view.sort(2)
+    assert view.item_text(0, 2) == '2020-01-01T00:00:00'
+    assert view.item_text(999, 2) == '2020-01-01T16:39:00'
+
+
+def test_search(cache_database):
+    view = ListingView(cache_database, page_size=3)
+    view.search('file099')
+    assert view.count == 10
+    assert view.total_size == sum((n * 7919) % 1000 for n in range(990, 1000))
+    assert [view.item_text(n, 0) for n in range(view.count)] == [f'folder/file{n:04}.dat$v1' for n in range(990, 1000)]
+    view.sort(1)
+    assert [int(view.item_text(n, 1)) for n in range(view.count)] == sorted((n * 7919) % 1000 for n in range(990, 1000))
+    view.search('')
+    assert view.count == 1000
+
+
+def test_show_folder(cache_database):
+    with ListingCache(cache_database) as cache:
+        cache.add_rows([('other/file.dat', 'v1', 5, 0, None, None, True, False)])
+    view = ListingView(cache_database)
+    assert view.count == 1001
+    view.show_folder('other/')
+    assert (view.count, view.total_size) == (1, 5)
+    assert view.row(0)[0] == 'other/file.dat$v1'
+    view.search('file0')
+    assert view.count == 0
+    view.show_folder('folder/')
+    assert view.count == 1000
+
+
+def test_billable_size(tmp_path):
+    '''
+    The billable size has the minimum size and archive overhead of the storage class, and is 0 for delete markers
+    '''
+    database_name = str(tmp_path / 'bucket.db')
+    with ListingCache(database_name) as cache:
+        cache.add_rows([('a.txt', 'v1', 100, 0, None, S3StorageClass.STANDARD_IA, False, False),
+                        ('a.txt', 'v2', 0, 1, None, None, True, True),
+                        ('b.txt', 'v1', 100, 2, None, S3StorageClass.DEEP_ARCHIVE, True, False),
+                        ('c.txt', 'v1', 100, 3, None, S3StorageClass.STANDARD, True, False)])
+    view = ListingView(database_name)
+    assert [view.item_text(n, 4) for n in range(view.count)] == \
+        [str(MIN_BILLABLE_SIZE), '0', str(100 + 40 * 1024), '100']
+    assert not view.sort(4)
@@ -0,0 +1,65 @@
+from Util.LocalScanner import LocalScanner
+import os
+import pytest
+
+
+@pytest.fixture
+def tree(tmp_path):
+    '''
+    Make a tree whose names sort differently as paths and as keys: as keys 'a-b' and 'a.txt' sort before
+    'a/b' and 'a0' after it ('-' < '.' < '/' < '0')
+    :return: (string) Root of tree
+    '''
+    for name in ('a.txt', 'a-b', 'a0', 'a/b', 'a/c/d.txt', 'a/c.txt', 'b/e/f/g.txt', 'z.txt'):
+        path = tmp_path / 'root' / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(name.encode())
+    root = tmp_path / 'root'
+    # links to folders are not followed; links to files are files
+    os.symlink(str(root / 'b'), str(root / 'link-to-b'))
+    os.symlink(str(root / 'z.txt'), str(root / 'link-to-z.txt'))
+    return str(root)
+
+
+def keys(root, results):
+    return [os.path.relpath(path, root).replace(os.sep, '/') for path, stat_result in results]
+
+
+def walk_keys(root):
+    return sorted(os.path.relpath(os.path.join(folder, name), root).replace(os.sep, '/')
+                  for folder, folders, names in os.walk(root) for name in names)
+
+
+@pytest.mark.parametrize('max_workers', [1, 8])
+def test_scan(tree, max_workers):
+    results = list(LocalScanner(max_workers).scan(tree))
+    assert sorted(keys(tree, results)) == walk_keys(tree)
+    assert 'link-to-b/e/f/g.txt' not in keys(tree, results)
+    for path, stat_result in results:
+        assert stat_result.st_size == os.stat(path).st_size
+
+
+def test_scan_sorted(tree):
+    found = keys(tree, LocalScanner().scan_sorted(tree))
+    assert found == ['a-b', 'a.txt', 'a/b', 'a/c.txt', 'a/c/d.txt', 'a0', 'b/e/f/g.txt', 'link-to-z.txt', 'z.txt']
+    # the order of an S3 listing of the same keys
+    assert found == sorted(found) == walk_keys(tree)
+
+
+def test_unreadable_directory(tree, monkeypatch):
+    # permissions don't stop root, so the directory fails to open instead
+    scandir = os.scandir
+
+    def failing_scandir(path):
+        if os.path.basename(path) == 'c':
+            raise PermissionError(13, 'Permission denied', path)
+        return scandir(path)
+    monkeypatch.setattr(os, 'scandir', failing_scandir)
+    expected = [key for key in walk_keys(tree) if not key.startswith('a/c/')]
+    assert sorted(keys(tree, LocalScanner().scan(tree))) == expected
+    assert keys(tree, LocalScanner().scan_sorted(tree)) == expected
+
+
+def test_max_workers():
+    with pytest.raises(Exception):
+        LocalScanner(0)
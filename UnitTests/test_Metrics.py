@@ -0,0 +1,107 @@
+from Util import Metrics
+from Util.Metrics import Histogram, instrument_client
+from Util.Repository import CachedRepository
+from Util.FakeS3 import FakeS3Client
+import io
+import json
+import pytest
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def metrics():
+    log = io.StringIO()
+    metrics = Metrics.enable(log)
+    metrics._clock = FakeClock()
+    yield metrics
+    Metrics.disable()
+
+
+def lines(metrics):
+    return [json.loads(line) for line in metrics._log.getvalue().splitlines()]
+
+
+def test_histogram():
+    histogram = Histogram((1, 10, 100))
+    for value in (0.5, 1, 5, 50, 500, 5000):
+        histogram.observe(value)
+    assert histogram.counts == [2, 1, 1, 2]
+    assert histogram.count == 6
+    assert histogram.sum == 5556.5
+    assert histogram.cumulative_counts() == [(1, 2), (10, 3), (100, 4), (float('inf'), 6)]
+
+
+def test_disabled():
+    assert Metrics.get_metrics() is None
+    pages = iter([1, 2])
+    # nothing is wrapped while instrumentation is off
+    assert Metrics.timed('list_page', pages) is pages
+    assert Metrics.timer('diff') is Metrics.timer('delete')
+    with Metrics.timer('diff'):
+        Metrics.record('transfer', 1.0, 10)
+    assert Metrics.disable() is None
+
+
+def test_phases(metrics):
+    clock = metrics._clock
+    with Metrics.timer('delete', keys=10):
+        clock.now += 0.5
+
+    def pages():
+        for page in range(3):
+            clock.now += 0.25
+            yield page
+    assert list(Metrics.timed('list_page', pages(), each=True)) == [0, 1, 2]
+    assert list(Metrics.timed('diff', pages())) == [0, 1, 2]
+    Metrics.record('transfer', 2.0, 3 * Metrics.MB, files=3)
+
+    logged = lines(metrics)
+    assert [(line['phase'], line['seconds']) for line in logged] == \
+           [('delete', 0.5)] + [('list_page', 0.25)] * 3 + [('diff', 0.75), ('transfer', 2.0)]
+    assert logged[0]['keys'] == 10 and logged[4]['items'] == 3
+    assert logged[5]['bytes'] == 3 * Metrics.MB and logged[5]['files'] == 3
+    summary = metrics.summary()
+    assert summary['phases']['list_page'] == {'seconds': 0.75, 'count': 3}
+    assert summary['bytes'] == {'transfer': 3 * Metrics.MB}
+
+
+def test_requests(metrics, tmp_path):
+    client = FakeS3Client(page_size=10)
+    client.create_bucket(Bucket='test')
+    for n in range(25):
+        client.add_version('test', f'{n % 2}/{n:02}.txt', size=n)
+    instrument_client(client)
+    CachedRepository.create_local_cached_database('test', str(tmp_path / 'test.db'), client=client)
+    client.put_object(Bucket='test', Key='new.txt', Body=b'x' * 2000)
+    metrics.request('HeadObject', 0.01, error='404')
+
+    summary = metrics.summary()
+    assert summary['requests']['PutObject'] == 1
+    assert summary['requests']['ListObjectVersions'] >= 3
+    assert summary['errors'] == {'HeadObject:404': 1}
+    assert summary['bytes']['PutObject'] == 2000
+    assert summary['phases']['list_page']['count'] == summary['requests']['ListObjectVersions']
+    assert summary['phases']['object_build']['count'] >= 3
+    assert summary['phases']['cache_write']['count'] >= 2
+
+    text = metrics.prometheus_text()
+    assert 'cloudsync_s3_requests_total{operation="PutObject"} 1\n' in text
+    assert 'cloudsync_s3_errors_total{operation="HeadObject",code="404"} 1\n' in text
+    assert 'cloudsync_bytes_bucket{name="PutObject",le="4096"} 1\n' in text
+    assert '# TYPE cloudsync_phase_seconds histogram\n' in text
+
+    metrics._prometheus_file = str(tmp_path / 'cloudsync.prom')
+    assert Metrics.disable() is metrics
+    with open(tmp_path / 'cloudsync.prom') as f:
+        assert f.read() == text
+    assert lines(metrics)[-1]['event'] == 'summary'
+    # hooks registered on the client do nothing once instrumentation is off
+    client.put_object(Bucket='test', Key='other.txt', Body=b'x')
+    assert metrics.summary()['requests']['PutObject'] == 1
@@ -0,0 +1,88 @@
+from Util.Plan import Planner, PlanActionType, PlanSummary, PlanStep, ThroughputHistory, read_plan, plan_steps
+from Util.SyncState import SyncStateIndex
+from Util.Transfer import TransferEngine, TransferConfig, MB
+from CloudSync import update, restore, execute_plan
+from datetime import datetime, timezone
+import os
+import pytest
+
+
+@pytest.fixture
+def local_folder(tmp_path):
+    root = tmp_path / 'local'
+    (root / 'dir').mkdir(parents=True)
+    (root / 'a.txt').write_bytes(b'a' * 100)
+    (root / 'dir' / 'b.txt').write_bytes(b'b' * 200)
+    (root / 'big.bin').write_bytes(os.urandom(12 * MB))
+    return str(root)
+
+
+def test_summary_requests():
+    summary = PlanSummary(TransferConfig(part_size=5 * MB))
+    summary.add(PlanStep(PlanActionType.Upload, 'a', size=MB))
+    summary.add(PlanStep(PlanActionType.Upload, 'b', size=12 * MB))
+    summary.add(PlanStep(PlanActionType.Download, 'c', size=12 * MB))
+    for n in range(1001):
+        summary.add(PlanStep(PlanActionType.Delete, f'd{n}'))
+    assert summary.requests(PlanActionType.Upload) == 1 + 3 + 2
+    assert summary.requests(PlanActionType.Download) == 3
+    assert summary.requests(PlanActionType.Delete) == 2
+    assert summary.bytes(PlanActionType.Upload) == 13 * MB
+    assert summary.estimate_seconds() == (13 * MB / (10 * MB) + 3 * MB * 4 / (10 * MB), False)
+
+
+def test_throughput_history(tmp_path):
+    history = ThroughputHistory(str(tmp_path / 'state.db'))
+    assert history.rates('upload') is None
+    history.record('upload', 100 * MB, 100, 10.0)
+    history.record('upload', 300 * MB, 100, 10.0)
+    assert history.rates('upload') == (20 * MB, 10.0)
+    summary = PlanSummary(TransferConfig())
+    summary.add(PlanStep(PlanActionType.Upload, 'a', size=40 * MB))
+    assert summary.estimate_seconds(history) == (2.0, True)
+    history.close()
+
+
+def test_plan_then_execute(client, local_folder, tmp_path):
+    config = TransferConfig(part_size=5 * MB)
+    engine = TransferEngine(client, 'test', config)
+    plan_file = str(tmp_path / 'plan.jsonl')
+    lines = []
+    with SyncStateIndex(str(tmp_path / 'state.db')) as index:
+        planner = Planner(config, plan_file, {'operation': 'Update'}, show=lines.append)
+        assert update(client, 'test', 'backup/', local_folder, index, engine, True, planner=planner) == []
+        planner.close()
+        assert client.calls.get('put_object', 0) == 0
+        # large new files are matched against the bucket after the listing, so they come last
+        assert lines == ['Upload      a.txt', 'Upload      dir/b.txt', 'Upload      big.bin']
+        assert planner.summary.count(PlanActionType.Upload) == 3
+        assert planner.summary.bytes(PlanActionType.Upload) == 12 * MB + 300
+        assert planner.summary.requests(PlanActionType.Upload) == 2 + 3 + 2
+        assert read_plan(plan_file)['operation'] == 'Update'
+
+        # a file changed after the plan was made is not uploaded
+        with open(os.path.join(local_folder, 'a.txt'), 'ab') as f:
+            f.write(b'changed')
+        failures = execute_plan(client, 'test', plan_file, index, engine)
+        assert [key for key, e in failures] == ['backup/a.txt']
+    keys = [e['Key'] for e in client.list_entries('test', 'backup/', None, versions=False)]
+    assert keys == ['backup/big.bin', 'backup/dir/b.txt']
+
+
+def test_planned_restore_downloads_planned_version(client, tmp_path):
+    client.add_version('test', 'backup/a.txt', data=b'planned', last_modified=datetime(2019, 8, 1, tzinfo=timezone.utc))
+    source = tmp_path / 'restored'
+    source.mkdir()
+    (source / 'extra.txt').write_bytes(b'extra')
+    config = TransferConfig()
+    engine = TransferEngine(client, 'test', config)
+    plan_file = str(tmp_path / 'plan.jsonl')
+    with SyncStateIndex(str(tmp_path / 'state.db')) as index:
+        planner = Planner(config, plan_file, show=None)
+        assert restore(client, 'test', 'backup/', str(source), index, engine, True, planner=planner) == []
+        planner.close()
+        assert [step.action for step in plan_steps(plan_file)] == [PlanActionType.Download, PlanActionType.DeleteLocal]
+        client.add_version('test', 'backup/a.txt', data=b'newer version')
+        assert execute_plan(client, 'test', plan_file, index, engine) == []
+    assert os.listdir(source) == ['a.txt']
+    assert (source / 'a.txt').read_bytes() == b'planned'
@@ -1,7 +1,9 @@
 
-from Util.Repository import FileObject
+from Util.Repository import FileObject, CompactListing, LocalRepository, CachedRepository, S3Repository
+from Util.ListingCache import ListingCache
+from Util.Diff import repository_entries
 import pytest
-from datetime import datetime
+from datetime import datetime, timezone
 
 @pytest.fixture
 def test_data():
@@ -57,3 +59,161 @@ def test_constructor_exceptions(constructor_exception_args):
         with pytest.raises(Exception):
             f = FileObject(**case)
 
+
+def test_compact_listing(test_data):
+    '''
+    Store FileObjects in a CompactListing and expect views with the same properties
+    '''
+    listing = CompactListing()
+    listing.extend(data[0] for data in test_data)
+    assert len(listing) == len(test_data)
+    for f, data in zip(listing, test_data):
+        assert f.size == data[1]
+        assert f.timestamp == data[2]
+        assert f.full_name == data[3]
+        assert f.folder == data[4]
+        assert f.name == data[5]
+    assert listing[-1].full_name == test_data[-1][3]
+    with pytest.raises(IndexError):
+        f = listing[len(test_data)]
+
+
+@pytest.fixture
+def local_tree(tmp_path):
+    '''
+    Get a local folder with files in two levels of sub-folders
+    '''
+    for name in ('a.txt', 'photos/b.jpg', 'photos/2024/c.jpg', 'photos/2024/d.jpg', 'docs/e.txt'):
+        path = tmp_path.joinpath(*name.split('/'))
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(b'x' * len(name))
+    return tmp_path
+
+
+def test_local_list_folder(local_tree):
+    repository = LocalRepository(str(local_tree), lazy=True)
+    file_objects, folders = repository.list_folder()
+    assert [o.name for o in file_objects] == ['a.txt']
+    assert folders == ['docs/', 'photos/']
+    file_objects, folders = repository.list_folder('photos/')
+    assert [o.name for o in file_objects] == ['b.jpg']
+    assert folders == ['photos/2024/']
+
+    repository = LocalRepository(str(local_tree), prefix='photos/', lazy=True)
+    assert sorted(o.name for o in repository.walk()) == ['b.jpg', 'c.jpg', 'd.jpg']
+    assert sorted(o.name for o in repository.file_objects) == ['b.jpg', 'c.jpg', 'd.jpg']
+    assert sorted(o.name for o in LocalRepository(str(local_tree), prefix='photos/2024/').file_objects) == \
+        ['c.jpg', 'd.jpg']
+
+
+def test_cached_list_folder(tmp_path):
+    database_name = str(tmp_path / 'bucket.db')
+    with ListingCache(database_name) as cache:
+        cache.add_rows((key, 'v1', 10, 0, None, None, True, False)
+                       for key in ('a.txt', 'photos/b.jpg', 'photos/2024/c.jpg', 'photos/2024/d.jpg', 'docs/e.txt'))
+    repository = CachedRepository(database_name, prefix='photos/')
+    assert sorted(o.full_name for o in repository.file_objects) == \
+        ['photos/2024/c.jpg$v1', 'photos/2024/d.jpg$v1', 'photos/b.jpg$v1']
+
+    repository = CachedRepository(database_name, lazy=True)
+    file_objects, folders = repository.list_folder()
+    assert [o.full_name for o in file_objects] == ['a.txt$v1']
+    assert folders == ['docs/', 'photos/']
+    assert [o.full_name for o in repository.walk('photos/')] == \
+        ['photos/b.jpg$v1', 'photos/2024/c.jpg$v1', 'photos/2024/d.jpg$v1']
+    file_objects, folders = repository.list_folder('missing/')
+    assert (len(file_objects), folders) == (0, [])
+    repository.close()
+
+
+def test_cached_version_flags(client, tmp_path):
+    '''
+    Expect deleted keys to be left out of the entries of a cached repository, and the latest version to be
+    the one S3 flagged, even if a noncurrent version has a later timestamp
+    '''
+    client.add_version('test', 'gone.txt', size=5)
+    client.add_version('test', 'gone.txt', is_delete_marker=True)
+    client.add_version('test', 'kept.txt', size=3, last_modified=datetime(2020, 1, 1, tzinfo=timezone.utc))
+    latest = client.add_version('test', 'kept.txt', size=4, last_modified=datetime(2019, 1, 1, tzinfo=timezone.utc))
+    database_name = str(tmp_path / 'test.db')
+    CachedRepository.create_local_cached_database('test', database_name, client=client)
+
+    repository = CachedRepository(database_name)
+    flags = sorted((o.full_name, o.is_latest, o.is_delete_marker) for o in repository.file_objects)
+    assert [f[1:] for f in flags] == [(False, False), (True, True), (False, False), (True, False)]
+    assert [o.billable_size for o in repository.file_objects if o.is_delete_marker] == [0]
+    assert [(e.key, e.size, e.file_object.full_name) for e in repository_entries(repository)] == \
+        [('kept.txt', 4, 'kept.txt$' + latest['VersionId'])]
+
+    file_objects, folders = CachedRepository(database_name, lazy=True).list_folder()
+    assert sorted((o.full_name, o.is_latest, o.is_delete_marker) for o in file_objects) == flags
+
+
+def cached_versions(database_name):
+    with ListingCache(database_name) as cache:
+        return dict((row[0:2], row) for row in cache.versions())
+
+
+def checkpoints(database_name):
+    with ListingCache(database_name) as cache:
+        return sorted(cache.db.execute('SELECT Prefix, Count, Newest, Digest FROM PrefixCheckpoints').fetchall())
+
+
+@pytest.fixture
+def refreshed_bucket(client, tmp_path):
+    """
+    Cache a bucket with four top-level prefixes and an object at its root, then change it: p0 gains a
+    version and a key, p1 loses a version and gets a delete marker, p2 is unchanged, p3 is removed and
+    p4 is new.
+    """
+    added = dict()
+    for n in range(40):
+        added[n] = client.add_version('test', f'p{n % 4}/file{n:02}.txt', size=n)
+    client.add_version('test', 'root.txt', size=1)
+    database_name = str(tmp_path / 'test.db')
+    CachedRepository.create_local_cached_database('test', database_name, client=client)
+
+    client.add_version('test', 'p0/file00.txt', size=100)
+    client.add_version('test', 'p0/new.txt', size=5)
+    client.delete_objects(Bucket='test', Delete={'Objects': [{'Key': 'p1/file01.txt',
+                                                              'VersionId': added[1]['VersionId']}]})
+    client.delete_objects(Bucket='test', Delete={'Objects': [{'Key': 'p1/file05.txt'}]})
+    client.delete_objects(Bucket='test', Delete={'Objects': [{'Key': added[n]['Key'],
+                                                              'VersionId': added[n]['VersionId']}
+                                                             for n in range(3, 40, 4)]})
+    client.add_version('test', 'p4/file.txt', size=4)
+    return database_name
+
+
+def test_incremental_refresh(client, tmp_path, refreshed_bucket):
+    database_name = refreshed_bucket
+    before = cached_versions(database_name)
+    CachedRepository.refresh_local_cached_database('test', database_name, client=client)
+    after = cached_versions(database_name)
+
+    full_name = str(tmp_path / 'full.db')
+    CachedRepository.create_local_cached_database('test', full_name, client=client)
+    full = cached_versions(full_name)
+    assert dict((k, row[0:8]) for k, row in after.items()) == dict((k, row[0:8]) for k, row in full.items())
+    assert checkpoints(database_name) == checkpoints(full_name)
+    assert any(k[0] == 'p0/new.txt' for k in after) and not any(k[0].startswith('p3/') for k in after)
+    # rows of prefixes whose checkpoint didn't change are not rewritten
+    assert all(after[k][8] == row[8] for k, row in before.items() if k[0].startswith('p2/') or k[0] == 'root.txt')
+
+
+def test_refresh_failure(client, monkeypatch, refreshed_bucket):
+    database_name = refreshed_bucket
+    before = cached_versions(database_name)
+    before_checkpoints = checkpoints(database_name)
+    list_prefix_versions = S3Repository.list_prefix_versions
+
+    def failing(cls, client, bucket_name, prefix):
+        if prefix == 'p2/':
+            raise Exception('Listing failed')
+        return list_prefix_versions(client, bucket_name, prefix)
+    monkeypatch.setattr(S3Repository, 'list_prefix_versions', classmethod(failing))
+    with pytest.raises(Exception, match='Listing failed'):
+        CachedRepository.refresh_local_cached_database('test', database_name, client=client)
+    # the prefixes refreshed before the failure are rolled back with it
+    assert cached_versions(database_name) == before
+    assert checkpoints(database_name) == before_checkpoints
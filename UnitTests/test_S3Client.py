@@ -0,0 +1,62 @@
+from Util import S3Client
+from Util.S3Client import S3ClientConfig, AsyncS3Client, configure, get_client, set_client, max_concurrency, run_all
+from Util.S3Listing import ShardedLister
+from Util.S3Repository import Repository
+from Util.Transfer import TransferConfig
+from Util.FakeS3 import FakeS3Client
+import time
+import pytest
+
+
+@pytest.fixture
+def shared_client():
+    '''
+    Share a fake client with a 20 ms round trip and at most 4 requests at the same time
+    '''
+    configure(S3ClientConfig(max_concurrency=4))
+    client = FakeS3Client(latency=0.02, jitter=0.005, seed=1)
+    client.create_bucket(Bucket='test')
+    for n in range(20):
+        client.add_version('test', f'{n // 5}/{n:02}.txt', size=n)
+    set_client(client)
+    yield client
+    configure(S3ClientConfig())
+
+
+def test_concurrency_knob(shared_client):
+    assert get_client() is shared_client
+    assert max_concurrency() == 4
+    assert TransferConfig().max_concurrency == 4
+    assert ShardedLister(shared_client, 'test').max_workers == 4
+    repository = Repository('test')
+    assert len(repository.file_objects) == 20
+    assert shared_client.max_in_flight <= 4
+
+
+def test_async_client(shared_client):
+    s3 = AsyncS3Client()
+    start = time.perf_counter()
+    responses = run_all([s3.head_object(Bucket='test', Key=f'{n // 5}/{n:02}.txt') for n in range(20)] +
+                        [s3.head_object(Bucket='test', Key='missing')])
+    elapsed = time.perf_counter() - start
+    assert [r['ContentLength'] for r in responses[0:20]] == list(range(20))
+    assert responses[20].response['Error']['Code'] == 'NoSuchKey'
+    # 21 requests, 4 at a time
+    assert shared_client.max_in_flight == 4
+    assert elapsed < 21 * 0.02 / 2
+
+    async def pages():
+        return [page async for page in s3.paginate('list_object_versions', Bucket='test', Prefix='1/')]
+
+    shared_client.page_size = 2
+    assert [len(page['Versions']) for page in run_all([pages()])[0]] == [2, 2, 1]
+
+
+def test_botocore_config():
+    pytest.importorskip('botocore')
+    config = S3ClientConfig(max_concurrency=32, max_attempts=5).botocore_config()
+    assert config.max_pool_connections == 32
+    assert config.retries == {'max_attempts': 5, 'mode': 'adaptive'}
+    with pytest.raises(Exception):
+        S3ClientConfig(max_concurrency=0)
+    assert S3Client.get_config().max_concurrency == S3Client.DEFAULT_MAX_CONCURRENCY
@@ -0,0 +1,69 @@
+from Util.S3Listing import ShardedLister
+from Util.S3Repository import Repository
+from Util.FakeS3 import FakeS3Client
+import pytest
+from datetime import timedelta
+
+
+@pytest.fixture
+def client():
+    '''
+    Get a fake client for a versioned bucket with a two level prefix tree, objects at every level
+    and a request latency large enough to dominate listing time
+    :return: (FakeS3Client) client with bucket 'test'
+    '''
+    client = FakeS3Client(latency=0.005, page_size=50)
+    client.create_bucket(Bucket='test')
+    client.add_version('test', 'root.txt', size=10)
+    for a in range(8):
+        client.add_version('test', f'dir{a}.txt', size=20)
+        for b in range(4):
+            for n in range(40):
+                key = f'dir{a}/sub{b}/file{n}.dat'
+                client.add_version('test', key, size=n)
+                if n % 3 == 0:
+                    client.add_version('test', key, size=n + 1)
+                if n % 7 == 0:
+                    client.add_version('test', key, is_delete_marker=True)
+        client.add_version('test', f'dir{a}/top.txt', size=30)
+    return client
+
+
+def listing(objects):
+    return [(o.key, o.id, o.size, o.is_latest) for o in objects]
+
+
+def test_sharded_matches_serial(client):
+    lister = ShardedLister(client, 'test', max_workers=8)
+    assert listing(lister.list()) == listing(lister.list_serial())
+
+
+def test_repository_merge(client):
+    repository = Repository('test', max_workers=8, client=client)
+    serial = listing(ShardedLister(client, 'test').list_serial())
+    assert list(repository.file_objects) == sorted(set(o[0] for o in serial))
+    assert sum(o.num_versions for o in repository.file_objects.values()) == len(serial)
+    deleted = repository.file_objects['dir0/sub0/file7.dat']
+    assert deleted.is_deleted
+    assert deleted.num_versions == 2
+
+
+def test_prefix(client):
+    lister = ShardedLister(client, 'test', max_workers=1)
+    objects, folders = lister.list_level('dir3/')
+    assert [o.key for o in objects] == ['dir3/top.txt']
+    assert folders == [f'dir3/sub{b}/' for b in range(4)]
+    repository = Repository('test', max_workers=4, client=client, prefix='dir3/')
+    assert repository.prefix == 'dir3/'
+    assert len(repository.file_objects) == 4 * 40 + 1
+    assert all(key.startswith('dir3/') for key in repository.file_objects)
+
+
+def test_version_timeline(client):
+    repository = Repository('test', max_workers=8, client=client)
+    versions = repository.file_objects['dir0/sub0/file0.dat'].versions
+    assert [v.time_stamp for v in versions] == sorted((v.time_stamp for v in versions), reverse=True)
+    deleted = repository.file_objects['dir0/sub0/file0.dat']
+    assert deleted.version_at(versions[0].time_stamp).is_delete_marker
+    assert deleted.version_at(versions[1].time_stamp) is versions[1]
+    assert deleted.version_at(versions[-1].time_stamp - timedelta(seconds=1)) is None
@@ -0,0 +1,31 @@
+'''
+Modules imported by the command line tools when they start, checked in a new interpreter (the import
+time budget is in Benchmarks/test_bench_startup.py)
+'''
+import os
+import subprocess
+import sys
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# imported only on the paths that use them: S3 requests, Excel output, cost analysis and the asyncio interface
+HEAVY_MODULES = ('boto3', 'botocore', 'openpyxl', 'numpy', 'asyncio')
+
+
+def imported_modules(module):
+    '''
+    Import a module in a new interpreter and get the names of all the modules it imported.
+    :param module: (string) Name of module
+    :return: (list) Module names
+    '''
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([ROOT, os.path.join(ROOT, 'S3List')]))
+    command = [sys.executable, '-c', f'import sys, {module}; print("\\n".join(sys.modules))']
+    result = subprocess.run(command, env=env, cwd=ROOT, check=True, capture_output=True, text=True)
+    return result.stdout.split()
+
+
+@pytest.mark.parametrize('module', ['CloudSync', 'BucketList', 'S3List'])
+def test_heavy_modules_not_imported(module):
+    modules = imported_modules(module)
+    assert module in modules
+    assert [name for name in modules if name.split('.')[0] in HEAVY_MODULES] == []
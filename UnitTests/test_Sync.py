@@ -0,0 +1,159 @@
+from Util.Sync import SyncActionType, ConflictPolicy, sync_diff
+from Util.SyncState import SyncStateIndex
+from Util.Diff import local_entries, s3_entries
+from Util.Transfer import TransferEngine, TransferConfig
+from CloudSync import synchronize, update, apply_sync
+from datetime import datetime, timezone
+import os
+import pytest
+
+
+@pytest.fixture
+def local_folder(tmp_path):
+    root = tmp_path / 'local'
+    (root / 'dir').mkdir(parents=True)
+    (root / 'a.txt').write_bytes(b'a' * 100)
+    (root / 'dir' / 'b.txt').write_bytes(b'b' * 200)
+    (root / 'e.txt').write_bytes(b'e')
+    return root
+
+
+def keys(client):
+    return dict((e['Key'], e) for e in client.list_entries('test', 'sync/', None, versions=False))
+
+
+def test_synchronize(client, local_folder, tmp_path, monkeypatch):
+    client.add_version('test', 'sync/c.txt', data=b'remote c')
+    client.add_version('test', 'sync/e.txt', data=b'e')
+    engine = TransferEngine(client, 'test', TransferConfig())
+    with SyncStateIndex(str(tmp_path / 'state.db')) as index:
+        # first sync: identical files are only recorded
+        assert synchronize(client, 'test', 'sync/', str(local_folder), index, engine, False) == []
+        assert set(keys(client)) == {'sync/a.txt', 'sync/c.txt', 'sync/dir/b.txt', 'sync/e.txt'}
+        assert (local_folder / 'c.txt').read_bytes() == b'remote c'
+        assert client.calls['put_object'] == 2
+        assert index.get('e.txt').version_id == keys(client)['sync/e.txt']['VersionId']
+
+        # nothing changed: no transfers, and the files are only stat'ed by the scan
+        stat = os.stat
+        stats = []
+
+        def counted_stat(path, *args, **kwargs):
+            stats.append(path)
+            return stat(path, *args, **kwargs)
+        with monkeypatch.context() as m:
+            m.setattr(os, 'stat', counted_stat)
+            actions = list(sync_diff(local_entries(str(local_folder)), s3_entries(client, 'test', 'sync/'),
+                                     index.states(), lambda entry: index.file_hashes(entry.file_object)))
+        assert [action.action for action in actions] == [SyncActionType.Skip] * 4
+        assert stats == []
+        calls = dict(client.calls)
+        assert synchronize(client, 'test', 'sync/', str(local_folder), index, engine, False) == []
+        assert client.calls.get('put_object') == calls.get('put_object')
+        assert client.calls.get('get_object') == calls.get('get_object')
+
+        # a change and a delete on each side, and a conflict
+        (local_folder / 'a.txt').write_bytes(b'changed locally')
+        os.remove(local_folder / 'dir' / 'b.txt')
+        client.add_version('test', 'sync/c.txt', data=b'changed remotely')
+        client.delete_objects(Bucket='test', Delete={'Objects': [{'Key': 'sync/e.txt'}]})
+        (local_folder / 'd.txt').write_bytes(b'new local')
+        client.add_version('test', 'sync/f.txt', data=b'new remote')
+        actions = dict((action.key, action) for action in
+                       sync_diff(local_entries(str(local_folder)), s3_entries(client, 'test', 'sync/'), index.states(),
+                                 lambda entry: index.file_hashes(entry.file_object)))
+        assert dict((key, action.action) for key, action in actions.items()) == {
+            'a.txt': SyncActionType.Upload, 'c.txt': SyncActionType.Download, 'd.txt': SyncActionType.Upload,
+            'dir/b.txt': SyncActionType.DeleteRemote, 'e.txt': SyncActionType.DeleteLocal,
+            'f.txt': SyncActionType.Download}
+        assert synchronize(client, 'test', 'sync/', str(local_folder), index, engine, False) == []
+        assert set(keys(client)) == {'sync/a.txt', 'sync/c.txt', 'sync/d.txt', 'sync/f.txt'}
+        assert sorted(os.listdir(local_folder)) == ['a.txt', 'c.txt', 'd.txt', 'dir', 'f.txt']
+        assert (local_folder / 'c.txt').read_bytes() == b'changed remotely'
+        assert index.get('e.txt') is None and index.get('dir/b.txt') is None
+
+
+def test_conflict(client, local_folder, tmp_path):
+    engine = TransferEngine(client, 'test', TransferConfig())
+    with SyncStateIndex(str(tmp_path / 'state.db')) as index:
+        synchronize(client, 'test', 'sync/', str(local_folder), index, engine, False)
+        (local_folder / 'a.txt').write_bytes(b'local edit')
+        os.utime(local_folder / 'a.txt', (0, datetime(2019, 1, 1, tzinfo=timezone.utc).timestamp()))
+        client.add_version('test', 'sync/a.txt', data=b'remote edit', last_modified=datetime.now(timezone.utc))
+        (local_folder / 'e.txt').write_bytes(b'same edit')
+        client.add_version('test', 'sync/e.txt', data=b'same edit')
+        actions = dict((action.key, action) for action in
+                       sync_diff(local_entries(str(local_folder)), s3_entries(client, 'test', 'sync/'), index.states(),
+                                 lambda entry: index.file_hashes(entry.file_object), ConflictPolicy.Local))
+        assert actions['a.txt'].action == SyncActionType.Conflict
+        assert actions['a.txt'].resolution == SyncActionType.Upload
+        assert actions['e.txt'].action == SyncActionType.Record
+
+        # the remote edit is newer, and the local edit is kept as a conflict copy
+        assert synchronize(client, 'test', 'sync/', str(local_folder), index, engine, False) == []
+        assert (local_folder / 'a.txt').read_bytes() == b'remote edit'
+        copies = [name for name in os.listdir(local_folder) if name.startswith('a.conflict-')]
+        assert len(copies) == 1 and copies[0].endswith('.txt')
+        assert (local_folder / copies[0]).read_bytes() == b'local edit'
+
+
+def test_local_deletes(client, local_folder, tmp_path, monkeypatch):
+    '''
+    Local files are only deleted if they are unchanged since the scan, and a file that can't be deleted is a
+    failure that doesn't stop the others
+    '''
+    engine = TransferEngine(client, 'test', TransferConfig())
+    with SyncStateIndex(str(tmp_path / 'state.db')) as index:
+        synchronize(client, 'test', 'sync/', str(local_folder), index, engine, False)
+        client.add_version('test', 'sync/new.txt', data=b'new')
+        client.delete_objects(Bucket='test', Delete={'Objects': [{'Key': 'sync/a.txt'}, {'Key': 'sync/dir/b.txt'},
+                                                                 {'Key': 'sync/e.txt'}]})
+        actions = list(sync_diff(local_entries(str(local_folder)), s3_entries(client, 'test', 'sync/'),
+                                 index.states(), lambda entry: index.file_hashes(entry.file_object)))
+        assert [action.action for action in actions] == [SyncActionType.DeleteLocal] * 3 + [SyncActionType.Download]
+
+        # edited and deleted after the scan
+        (local_folder / 'a.txt').write_bytes(b'edited after the scan')
+        os.remove(local_folder / 'dir' / 'b.txt')
+        remove = os.remove
+
+        def failing_remove(path):
+            if path.endswith('e.txt'):
+                raise PermissionError(13, 'Permission denied', path)
+            remove(path)
+        monkeypatch.setattr(os, 'remove', failing_remove)
+        failures = apply_sync(client, 'test', 'sync/', str(local_folder), index, engine, iter(actions))
+        assert [(key, type(e)) for key, e in failures] == [('a.txt', Exception), ('e.txt', PermissionError)]
+        assert (local_folder / 'a.txt').read_bytes() == b'edited after the scan'
+        assert (local_folder / 'new.txt').read_bytes() == b'new'
+        assert index.get('a.txt') is not None and index.get('e.txt') is not None
+        assert index.get('dir/b.txt') is None
+
+
+def test_update_state_is_base(client, local_folder, tmp_path):
+    '''
+    Files recorded by Update, without the versions of their objects, are not transferred again
+    '''
+    engine = TransferEngine(client, 'test', TransferConfig())
+    with SyncStateIndex(str(tmp_path / 'state.db')) as index:
+        assert update(client, 'test', 'sync/', str(local_folder), index, engine, False) == []
+        for key in ('a.txt', 'dir/b.txt', 'e.txt'):
+            state = index.get(key)
+            index.record(key, os.stat(local_folder / key), state.content_hash, state.e_tag)
+        calls = dict(client.calls)
+        assert synchronize(client, 'test', 'sync/', str(local_folder), index, engine, False) == []
+        assert client.calls['put_object'] == calls['put_object']
+        assert client.calls.get('get_object') == calls.get('get_object')
+        assert index.get('a.txt').version_id == keys(client)['sync/a.txt']['VersionId']
+
+
+def test_states_snapshot(tmp_path):
+    with SyncStateIndex(str(tmp_path / 'state.db'), batch_size=1) as index:
+        stat_result = os.stat(tmp_path)
+        for path in ('a', 'b', 'c'):
+            index.record(path, stat_result, 'hash')
+        states = index.states(batch_size=1)
+        assert next(states).path == 'a'
+        index.remove('b')
+        index.record('bb', stat_result, 'hash')
+        assert [state.path for state in states] == ['b', 'c']
@@ -0,0 +1,55 @@
+from Util.SyncState import SyncStateIndex
+import os
+import pytest
+
+
+@pytest.fixture
+def local_folder(tmp_path):
+    '''
+    Get a local folder with three files in two folders
+    :return: (string) root of folder
+    '''
+    root = tmp_path / 'local'
+    (root / 'dir1').mkdir(parents=True)
+    (root / 'a.txt').write_text('first file')
+    (root / 'dir1' / 'b.txt').write_text('second file')
+    (root / 'dir1' / 'c.txt').write_text('third file')
+    return str(root)
+
+
+def sync_all(index, root):
+    '''
+    Record every changed file, as if each one had been synchronized
+    :return: (list) sorted relative paths of the changed files
+    '''
+    changed = []
+    for path, full_path, stat_result, content_hash in index.changed_files(root):
+        index.record(path, stat_result, content_hash)
+        changed.append(path)
+    index.commit()
+    return sorted(changed)
+
+
+def test_changed_files(local_folder, tmp_path):
+    with SyncStateIndex(str(tmp_path / 'state.db')) as index:
+        assert sync_all(index, local_folder) == ['a.txt', 'dir1/b.txt', 'dir1/c.txt']
+        assert sync_all(index, local_folder) == []
+        # new modification time, same contents
+        os.utime(os.path.join(local_folder, 'a.txt'), ns=(0, 10 ** 18))
+        with open(os.path.join(local_folder, 'dir1', 'b.txt'), 'w') as f:
+            f.write('second file, changed')
+        assert sync_all(index, local_folder) == ['dir1/b.txt']
+        assert index.get('a.txt').mtime_ns == 10 ** 18
+
+
+def test_resume_after_interrupt(local_folder, tmp_path):
+    database_name = str(tmp_path / 'state.db')
+    index = SyncStateIndex(database_name, batch_size=1)
+    changed = index.changed_files(local_folder)
+    path, full_path, stat_result, content_hash = next(changed)
+    index.record(path, stat_result, content_hash)
+    # interrupted: index never closed
+    with SyncStateIndex(database_name) as index:
+        remaining = sync_all(index, local_folder)
+    assert len(remaining) == 2
+    assert path not in remaining
@@ -0,0 +1,69 @@
+from Util.Transfer import TransferEngine, TransferConfig, TransferItem, UploadJournal, MB
+from Util.FakeS3 import FakeS3Client, FakeClientError
+import os
+import pytest
+
+
+@pytest.fixture
+def client():
+    client = FakeS3Client(latency=0.001, bandwidth=500 * MB)
+    client.create_bucket(Bucket='test')
+    return client
+
+
+@pytest.fixture
+def local_files(tmp_path):
+    '''
+    Get local files of every transfer size: small (batched), single request and multipart
+    :return: (list) TransferItems for uploading the files
+    '''
+    sizes = [0, 100, 2000, 300 * 1024, 2 * MB, 6 * MB, 12 * MB + 5]
+    items = []
+    for n, size in enumerate(sizes):
+        path = tmp_path / 'upload' / f'file{n}.dat'
+        path.parent.mkdir(exist_ok=True)
+        path.write_bytes(os.urandom(size))
+        items.append(TransferItem(str(path), f'data/file{n}.dat', size))
+    return items
+
+
+def test_upload_and_download(client, local_files, tmp_path):
+    config = TransferConfig(part_size=5 * MB, max_concurrency=4, max_bytes_in_flight=16 * MB,
+                            small_file_size=MB, batch_files=2)
+    engine = TransferEngine(client, 'test', config)
+    uploaded = []
+    assert engine.upload(local_files, on_complete=uploaded.append) == []
+    assert sorted(i.key for i in uploaded) == sorted(i.key for i in local_files)
+    assert client.calls['upload_part'] == 2 + 3
+    assert len(engine.stats.report()) > 1
+
+    downloads = [TransferItem(str(tmp_path / 'download' / os.path.basename(i.local_path)), i.key, i.size)
+                 for i in local_files]
+    assert engine.download(downloads) == []
+    for upload, download in zip(local_files, downloads):
+        with open(upload.local_path, 'rb') as u, open(download.local_path, 'rb') as d:
+            assert u.read() == d.read()
+
+
+def test_resume_multipart_upload(client, local_files, tmp_path):
+    journal = UploadJournal(str(tmp_path / 'journal.db'))
+    config = TransferConfig(part_size=5 * MB, max_concurrency=1)
+    large = local_files[-1]
+    upload_part = client.upload_part
+
+    def crash_on_last_part(**kwargs):
+        if kwargs['PartNumber'] == 3:
+            raise FakeClientError('InternalError', 'upload_part')
+        return upload_part(**kwargs)
+
+    client.upload_part = crash_on_last_part
+    failures = TransferEngine(client, 'test', config, journal).upload([large])
+    assert [f[0].key for f in failures] == [large.key]
+    assert client.calls['upload_part'] == 2
+
+    client.upload_part = upload_part
+    assert TransferEngine(client, 'test', config, journal).upload([large]) == []
+    assert client.calls['upload_part'] == 3
+    assert client.calls['create_multipart_upload'] == 1
+    with open(large.local_path, 'rb') as f:
+        assert client.get_object(Bucket='test', Key=large.key)['Body'].read() == f.read()
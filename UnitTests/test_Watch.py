@@ -0,0 +1,170 @@
+from Util.Watch import ChangeQueue, InotifySource, PollingSource, SimulatedSource, SqsPoller, ListingPoller, RESCAN
+from Util.SyncState import SyncStateIndex
+from Util.Transfer import TransferEngine, TransferConfig
+from Util.FakeS3 import FakeClientError
+from CloudSync import OperationType, synchronize, watch
+import json
+import os
+import shutil
+import pytest
+
+
+@pytest.fixture
+def local_folder(tmp_path):
+    root = tmp_path / 'local'
+    (root / 'dir').mkdir(parents=True)
+    (root / 'a.txt').write_bytes(b'a' * 100)
+    (root / 'dir' / 'b.txt').write_bytes(b'b' * 200)
+    (root / 'dir' / 'c.txt').write_bytes(b'c' * 300)
+    return root
+
+
+def keys(client):
+    return sorted(e['Key'] for e in client.list_entries('test', 'sync/', None, versions=False))
+
+
+def test_change_queue():
+    now = [0.0]
+    queue = ChangeQueue(debounce=2.0, max_delay=5.0, clock=lambda: now[0])
+    assert queue.timeout(1.0) == 1.0
+    queue.add('a')
+    now[0] = 1.0
+    queue.add('a')
+    queue.add('b')
+    assert len(queue) == 2
+    assert queue.timeout() == 2.0
+    now[0] = 2.5
+    assert queue.pop_due() == []
+    now[0] = 3.0
+    assert queue.pop_due() == ['a', 'b']
+
+    # a key that keeps changing is due max_delay after its first event
+    for n in range(10):
+        now[0] = 10.0 + n
+        queue.add('c')
+        if queue.pop_due():
+            break
+    assert now[0] == 15.0
+
+
+def test_watch(client, local_folder, tmp_path):
+    engine = TransferEngine(client, 'test', TransferConfig())
+    events = SimulatedSource()
+    with SyncStateIndex(str(tmp_path / 'state.db')) as index:
+        assert synchronize(client, 'test', 'sync/', str(local_folder), index, engine, False) == []
+        calls = dict(client.calls)
+
+        (local_folder / 'a.txt').write_bytes(b'changed')
+        (local_folder / 'd.txt').write_bytes(b'new')
+        shutil.rmtree(local_folder / 'dir')
+        client.add_version('test', 'sync/e.txt', data=b'remote')
+        events.change('a.txt', 'a.txt', 'd.txt', 'dir/')
+        events.close()
+        remote = ListingPoller(client, 'test', 'sync/', index, interval=0)
+        assert watch(client, 'test', 'sync/', str(local_folder), index, engine, events, remote=remote,
+                     report=None) == []
+        assert keys(client) == ['sync/a.txt', 'sync/d.txt', 'sync/e.txt']
+        assert (local_folder / 'e.txt').read_bytes() == b'remote'
+        assert index.get('dir/b.txt') is None
+        # one HEAD request per changed file, and one listing
+        assert client.calls['head_object'] - calls.get('head_object', 0) == 5
+        assert remote.changes() == []
+
+
+def test_watch_update(client, local_folder, tmp_path):
+    '''
+    Update only applies local changes, and Replicate also deletes objects of deleted files
+    '''
+    engine = TransferEngine(client, 'test', TransferConfig())
+    with SyncStateIndex(str(tmp_path / 'state.db')) as index:
+        events = SimulatedSource()
+        events.change(RESCAN)
+        events.close()
+        client.add_version('test', 'sync/remote.txt', data=b'remote')
+        assert watch(client, 'test', 'sync/', str(local_folder), index, engine, events, OperationType.Update,
+                     report=None) == []
+        assert keys(client) == ['sync/a.txt', 'sync/dir/b.txt', 'sync/dir/c.txt', 'sync/remote.txt']
+
+        os.remove(local_folder / 'a.txt')
+        events = SimulatedSource()
+        events.change('a.txt', 'remote.txt')
+        events.close()
+        watch(client, 'test', 'sync/', str(local_folder), index, engine, events, OperationType.Update, report=None)
+        assert keys(client) == ['sync/a.txt', 'sync/dir/b.txt', 'sync/dir/c.txt', 'sync/remote.txt']
+        assert not (local_folder / 'remote.txt').exists()
+
+        events = SimulatedSource()
+        events.change('a.txt')
+        events.close()
+        watch(client, 'test', 'sync/', str(local_folder), index, engine, events, OperationType.Replicate, report=None)
+        assert keys(client) == ['sync/dir/b.txt', 'sync/dir/c.txt', 'sync/remote.txt']
+
+
+def test_watch_failure(client, local_folder, tmp_path, monkeypatch):
+    '''
+    A batch that fails with an S3 error is retried, and the watch goes on
+    '''
+    engine = TransferEngine(client, 'test', TransferConfig())
+    events = SimulatedSource()
+    head_object = client.head_object
+    errors = [FakeClientError('503', 'head_object')]
+
+    def failing_head_object(**kwargs):
+        if errors:
+            raise errors.pop()
+        return head_object(**kwargs)
+
+    lines = []
+
+    def report(line):
+        lines.append(line)
+        # stop watching once the batch was retried
+        if len(lines) == 2:
+            events.close()
+
+    monkeypatch.setattr(client, 'head_object', failing_head_object)
+    with SyncStateIndex(str(tmp_path / 'state.db')) as index:
+        events.change('a.txt', 'dir/b.txt')
+        assert watch(client, 'test', 'sync/', str(local_folder), index, engine, events, OperationType.Update,
+                     debounce=0.0, report=report) == []
+    assert 'failed: 503 in head_object' in lines[0]
+    assert 'Synchronized 2 changed keys, 0 failed' in lines[1]
+    assert keys(client) == ['sync/a.txt', 'sync/dir/b.txt']
+
+
+def test_polling_source(local_folder):
+    source = PollingSource(str(local_folder), interval=0)
+    assert source.events(0) == []
+    (local_folder / 'a.txt').write_bytes(b'changed')
+    os.remove(local_folder / 'dir' / 'b.txt')
+    (local_folder / 'new.txt').write_bytes(b'new')
+    assert sorted(source.events(0)) == ['a.txt', 'dir/b.txt', 'new.txt']
+
+
+def test_inotify_source(local_folder):
+    try:
+        source = InotifySource(str(local_folder))
+    except OSError:
+        pytest.skip('inotify is not available')
+    assert source.events(0) == []
+    (local_folder / 'a.txt').write_bytes(b'changed')
+    (local_folder / 'new').mkdir()
+    (local_folder / 'new' / 'f.txt').write_bytes(b'f')
+    shutil.rmtree(local_folder / 'dir')
+    changed = set()
+    for n in range(10):
+        changed.update(source.events(0.1))
+        if {'a.txt', 'new/f.txt', 'dir/'} <= changed:
+            break
+    assert {'a.txt', 'new/f.txt', 'dir/', 'dir/b.txt', 'dir/c.txt'} >= changed >= {'a.txt', 'new/f.txt', 'dir/'}
+    source.close()
+
+
+def test_sqs_message_keys():
+    poller = SqsPoller(None, 'queue', 'test', 'sync/')
+    body = json.dumps({'Records': [
+        {'eventName': 'ObjectCreated:Put', 's3': {'bucket': {'name': 'test'}, 'object': {'key': 'sync/a+b%21.txt'}}},
+        {'eventName': 'ObjectRemoved:Delete', 's3': {'bucket': {'name': 'other'}, 'object': {'key': 'sync/c.txt'}}},
+        {'eventName': 'ObjectCreated:Put', 's3': {'bucket': {'name': 'test'}, 'object': {'key': 'other/d.txt'}}}]})
+    assert poller.message_keys(body) == ['a b!.txt']
+    assert poller.message_keys(json.dumps({'Event': 's3:TestEvent'})) == []
@@ -0,0 +1,465 @@
+import errno
+import os
+import shutil
+from datetime import datetime, timezone
+
+from Util.Delete import BulkDeleter
+from Util.Diff import DiffEntry, e_tag_hash
+from Util.ListingCache import ListingCache, from_epoch_microseconds
+from Util.LocalScanner import LocalScanner
+from Util.Metrics import timer
+from Util.S3Client import get_client
+from Util.S3Listing import ShardedLister
+from Util.S3Repository import Repository
+from Util.Transfer import TransferEngine, TransferItem, CopyItem, MB, PART_SUFFIX
+
+# bytes asked of each copy_file_range or sendfile call
+COPY_CHUNK_SIZE = 1024 * MB
+COPY_BUFFER_SIZE = MB
+# errors of copy_file_range and sendfile meaning the files can't be copied that way, rather than that the
+# copy failed: across file systems before Linux 5.3, or by file systems and kernels without the call
+UNSUPPORTED_COPY_ERRORS = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP)
+NOT_FOUND_CODES = ('404', 'NoSuchKey', 'NotFound')
+
+
+def _copy_file_range(source_fd, target_fd, offset):
+    return os.copy_file_range(source_fd, target_fd, COPY_CHUNK_SIZE, offset, offset)
+
+
+def _sendfile(source_fd, target_fd, offset):
+    # sendfile writes at the position of the target, which copy_file_range with offsets doesn't move
+    os.lseek(target_fd, offset, os.SEEK_SET)
+    return os.sendfile(target_fd, source_fd, offset, COPY_CHUNK_SIZE)
+
+
+# copies made by the kernel, best first, where the system has them
+NATIVE_COPIES = tuple(copy for name, copy in (('copy_file_range', _copy_file_range), ('sendfile', _sendfile))
+                      if hasattr(os, name))
+
+
+def copy_file(source_path, target_path):
+    """
+    Copy the contents of a file without passing them through this process: with copy_file_range, which
+    NFS 4.2 and SMB shares turn into a copy on the server and some file systems into a shared extent, or
+    else with sendfile.  Where neither works the file is copied through a buffer.  A native copy that stops
+    short of the size of the file (some FUSE and NAS mounts, and procfs-style files, return 0 at once
+    instead of failing) is carried on by the next way, so a copy is never left empty.
+
+    :param source_path: (string) Full pathname of file to copy
+    :param target_path: (string) Full pathname of copy, replaced if it exists
+    :return: (int) Bytes copied
+    """
+    with open(source_path, 'rb') as source, open(target_path, 'wb') as target:
+        source_fd = source.fileno()
+        target_fd = target.fileno()
+        size = os.fstat(source_fd).st_size
+        offset = 0
+        for copy in NATIVE_COPIES:
+            try:
+                while offset < size:
+                    count = copy(source_fd, target_fd, offset)
+                    if count == 0:
+                        break
+                    offset += count
+            except OSError as e:
+                if e.errno not in UNSUPPORTED_COPY_ERRORS:
+                    raise
+            if offset >= size:
+                break
+        # carry on from whatever a native copy managed before it failed or stopped, to the end of the file
+        source.seek(offset)
+        target.seek(offset)
+        shutil.copyfileobj(source, target, COPY_BUFFER_SIZE)
+        return target.tell()
+
+
+class Backend:
+    """
+    Store of objects by key: the operations CloudSync needs of an S3 bucket, a local folder or a listing
+    cache.  Listings are streamed in key order as DiffEntries, so any two backends can be compared with
+    Util.Diff.diff.  Keys are relative to the root of the backend, with '/' delimiters.  A backend that
+    can't do an operation, such as writing to a listing cache, raises an exception.
+    """
+
+    @property
+    def name(self):
+        """
+        Get the name of the backend, as given on the command line.
+
+        :return: (string) Name, such as "s3:<bucketname>/<prefix>" or "dir:<directory>"
+        """
+        raise Exception(f'{type(self).__name__} has no name')
+
+    def list(self, prefix=''):
+        """
+        List the latest version of the objects under a prefix.
+
+        :param prefix: (string) Prefix of keys ('' for all objects)
+        :return: (iterator) DiffEntries, in key order
+        """
+        raise Exception(f'{type(self).__name__} does not support listing')
+
+    def stat(self, key, version_id=None):
+        """
+        Get an object.
+
+        :param key: (string) Key of object
+        :param version_id: (string) Version of object (default: latest), for backends that keep versions
+        :return: (DiffEntry) Entry of object, or None if there is no such object
+        """
+        raise Exception(f'{type(self).__name__} does not support stat')
+
+    def read(self, key, offset=0, length=None, version_id=None):
+        """
+        Read a range of the contents of an object.
+
+        :param key: (string) Key of object
+        :param offset: (int) Offset of first byte
+        :param length: (int) Number of bytes (default: to the end of the object)
+        :param version_id: (string) Version of object (default: latest)
+        :return: (bytes) Contents
+        """
+        raise Exception(f'{type(self).__name__} does not support reading')
+
+    def put(self, key, data):
+        """
+        Store an object, replacing any object with the key.
+
+        :param key: (string) Key of object
+        :param data: (bytes) Contents
+        :return: (DiffEntry) Entry of the object stored
+        """
+        raise Exception(f'{type(self).__name__} does not support writing')
+
+    def put_file(self, key, path):
+        """
+        Store the contents of a local file.  The default reads the whole file; backends override it to
+        transfer large files in parts or copy them natively.
+
+        :param key: (string) Key of object
+        :param path: (string) Full pathname of file
+        :return: (DiffEntry) Entry of the object stored
+        """
+        with open(path, 'rb') as f:
+            return self.put(key, f.read())
+
+    def put_from(self, source, entry):
+        """
+        Store an object of another backend under the same key.  Local files are stored from their path
+        (see put_file), so a local target copies them natively; other objects are read whole.
+
+        :param source: (Backend) Backend the entry was listed from
+        :param entry: (DiffEntry) Entry of object
+        :return: (DiffEntry) Entry of the object stored
+        """
+        if isinstance(source, LocalBackend):
+            return self.put_file(entry.key, entry.file_object)
+        return self.put(entry.key, source.read(entry.key, version_id=entry.version_id))
+
+    def copy(self, source_key, key):
+        """
+        Copy an object to another key of the backend, without passing its contents through this process
+        where the backend can.
+
+        :param source_key: (string) Key of object to copy
+        :param key: (string) Key of copy
+        :return: (DiffEntry) Entry of the copy
+        """
+        raise Exception(f'{type(self).__name__} does not support copying')
+
+    def delete(self, keys):
+        """
+        Delete objects.  Keys without an object are not an error.
+
+        :param keys: (iterable) Keys of objects
+        :return: (list) Tuples of key and exception for objects that could not be deleted
+        """
+        raise Exception(f'{type(self).__name__} does not support deleting')
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class S3Backend(Backend):
+    """
+    Objects under a prefix of an S3 bucket.  Works the same with a fake client (see FakeS3), so anything
+    built on backends can be run and benchmarked offline.
+    """
+
+    def __init__(self, bucket_name, prefix='', client=None, config=None):
+        """
+
+        :param bucket_name: (string) Name of bucket
+        :param prefix: (string) Prefix of the keys of the backend ('' or ending with '/')
+        :param client: (S3.Client) S3 client to use (default: shared client, see S3Client)
+        :param config: (TransferConfig) Settings of file transfers and copies (default: TransferConfig())
+        """
+        if client is None:
+            client = get_client()
+        self._bucket_name = bucket_name
+        self._prefix = prefix
+        self._client = client
+        self._engine = TransferEngine(client, bucket_name, config)
+        self._versioning = None
+
+    @property
+    def name(self):
+        return f's3:{self._bucket_name}/{self._prefix}'
+
+    @property
+    def client(self):
+        return self._client
+
+    @property
+    def versioning(self):
+        if self._versioning is None:
+            self._versioning = Repository.versioning_enabled(self._client, self._bucket_name)
+        return self._versioning
+
+    def list(self, prefix=''):
+        lister = ShardedLister(self._client, self._bucket_name, versions=self.versioning, max_workers=1)
+        for o in lister.list_serial(self._prefix + prefix):
+            if not o.is_latest or o.size is None:
+                continue
+            e_tag = o.e_tag.strip('"') if o.e_tag else None
+            yield DiffEntry(o.key[len(self._prefix):], o.size, o.last_modified, e_tag_hash(e_tag), o.id,
+                            file_object=o.key, e_tag=e_tag)
+
+    def stat(self, key, version_id=None):
+        kwargs = {'VersionId': version_id} if version_id else {}
+        try:
+            response = self._client.head_object(Bucket=self._bucket_name, Key=self._prefix + key, **kwargs)
+        except Exception as e:
+            if getattr(e, 'response', {}).get('Error', {}).get('Code') in NOT_FOUND_CODES:
+                return None
+            raise
+        e_tag = response['ETag'].strip('"')
+        return DiffEntry(key, response['ContentLength'], response['LastModified'], e_tag_hash(e_tag),
+                         response.get('VersionId'), file_object=self._prefix + key, e_tag=e_tag)
+
+    def read(self, key, offset=0, length=None, version_id=None):
+        if length == 0:
+            return b''
+        kwargs = {'VersionId': version_id} if version_id else {}
+        if offset or length is not None:
+            end = offset + length - 1 if length is not None else ''
+            kwargs['Range'] = f'bytes={offset}-{end}'
+        response = self._client.get_object(Bucket=self._bucket_name, Key=self._prefix + key, **kwargs)
+        return response['Body'].read()
+
+    def put(self, key, data):
+        response = self._client.put_object(Bucket=self._bucket_name, Key=self._prefix + key, Body=data)
+        e_tag = response['ETag'].strip('"')
+        return DiffEntry(key, len(data), datetime.now(timezone.utc), e_tag_hash(e_tag), response.get('VersionId'),
+                         file_object=self._prefix + key, e_tag=e_tag)
+
+    def _stored(self, key, item, failures):
+        if failures:
+            raise failures[0][1]
+        return DiffEntry(key, item.size, datetime.now(timezone.utc), e_tag_hash(item.e_tag), item.version_id,
+                         file_object=item.key, e_tag=item.e_tag)
+
+    def put_file(self, key, path):
+        # in parts, resumed and held to the byte budget, by the transfer engine
+        item = TransferItem(path, self._prefix + key, os.path.getsize(path))
+        return self._stored(key, item, self._engine.upload([item]))
+
+    def copy(self, source_key, key):
+        source = self.stat(source_key)
+        if source is None:
+            raise Exception(f'No object {self._prefix + source_key} to copy in {self._bucket_name}')
+        item = CopyItem(None, self._prefix + key, source.size, self._prefix + source_key, source.version_id)
+        return self._stored(key, item, self._engine.copy([item]))
+
+    def delete(self, keys):
+        deleter = BulkDeleter(self._client, self._bucket_name, prefix_depth=self._prefix.count('/') + 1)
+        return [(key[len(self._prefix):], e)
+                for key, version_id, e in deleter.delete((self._prefix + key, None) for key in keys)]
+
+
+class LocalBackend(Backend):
+    """
+    Files of a local folder, such as a NAS share mounted over NFS or SMB, as objects keyed by their paths
+    relative to the folder.  Files are written to a temporary file that replaces them when complete, and
+    copies are made by the kernel (see copy_file).  Files keep one version.
+    """
+
+    def __init__(self, root):
+        """
+
+        :param root: (string) Root of local folder
+        """
+        self._root = root
+
+    @property
+    def name(self):
+        return f'dir:{self._root}'
+
+    @property
+    def root(self):
+        return self._root
+
+    def path(self, key):
+        """
+        Get the path of the file of a key.
+
+        :param key: (string) Key of object
+        :return: (string) Full pathname of file
+        """
+        return os.path.join(self._root, *key.split('/'))
+
+    def _entry(self, key, path, stat_result):
+        return DiffEntry(key, stat_result.st_size, datetime.fromtimestamp(stat_result.st_mtime, timezone.utc),
+                         file_object=path)
+
+    def list(self, prefix=''):
+        # only the folder the prefix ends in is scanned
+        folder = prefix.rpartition('/')[0]
+        start = self.path(folder) if folder else self._root
+        if not os.path.isdir(start):
+            return
+        for path, stat_result in LocalScanner().scan_sorted(start):
+            key = os.path.relpath(path, self._root)
+            if os.sep != '/':
+                key = key.replace(os.sep, '/')
+            if key.startswith(prefix) and not key.endswith(PART_SUFFIX):
+                yield self._entry(key, path, stat_result)
+
+    def stat(self, key, version_id=None):
+        if version_id:
+            raise Exception(f'Files of {self.name} have no versions')
+        path = self.path(key)
+        try:
+            stat_result = os.stat(path)
+        except FileNotFoundError:
+            return None
+        if not os.path.isfile(path):
+            return None
+        return self._entry(key, path, stat_result)
+
+    def read(self, key, offset=0, length=None, version_id=None):
+        if version_id:
+            raise Exception(f'Files of {self.name} have no versions')
+        with open(self.path(key), 'rb') as f:
+            f.seek(offset)
+            return f.read(-1 if length is None else length)
+
+    def _write(self, key, write):
+        path = self.path(key)
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        temp_path = path + PART_SUFFIX
+        try:
+            write(temp_path)
+            os.replace(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        return self._entry(key, path, os.stat(path))
+
+    def put(self, key, data):
+        def write(temp_path):
+            with open(temp_path, 'wb') as f:
+                f.write(data)
+        return self._write(key, write)
+
+    def put_file(self, key, path):
+        """
+        Copy a local file into the folder, natively (see copy_file).  The copy keeps the modification time
+        of the file, so comparing the folders again finds it unchanged.
+        """
+        def write(temp_path):
+            with timer('transfer', files=1):
+                copy_file(path, temp_path)
+            shutil.copystat(path, temp_path)
+        return self._write(key, write)
+
+    def copy(self, source_key, key):
+        return self.put_file(key, self.path(source_key))
+
+    def delete(self, keys):
+        failures = []
+        for key in keys:
+            path = self.path(key)
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            except OSError as e:
+                failures.append((key, e))
+                continue
+            # folders exist only while they hold files, as in S3
+            folder = os.path.dirname(path)
+            while os.path.normpath(folder) != os.path.normpath(self._root):
+                try:
+                    os.rmdir(folder)
+                except OSError:
+                    break
+                folder = os.path.dirname(folder)
+        return failures
+
+
+class CacheBackend(Backend):
+    """
+    Objects of a bucket as recorded in its listing cache (see ListingCache), listed and found without a
+    request.  The cache holds no contents: they are read from the bucket's backend if one is given.
+    The cache can't be written through the backend.
+    """
+
+    def __init__(self, database_name, prefix='', backend=None):
+        """
+
+        :param database_name: (string) Name of cache database
+        :param prefix: (string) Prefix of the keys of the backend ('' or ending with '/')
+        :param backend: (Backend) Backend of the bucket, with the same prefix, to read contents from
+        """
+        self._database_name = database_name
+        self._prefix = prefix
+        self._backend = backend
+        self._cache = ListingCache(database_name)
+
+    @property
+    def name(self):
+        return f'cache:{self._database_name}'
+
+    @property
+    def cache(self):
+        return self._cache
+
+    def _entry(self, row):
+        key, version_id, size, mtime, e_tag, storage_class, is_latest, is_delete_marker, row_id = row
+        e_tag = e_tag.strip('"') if e_tag else None
+        return DiffEntry(key[len(self._prefix):], size, from_epoch_microseconds(mtime).replace(tzinfo=timezone.utc),
+                         e_tag_hash(e_tag), version_id or None, file_object=key, e_tag=e_tag)
+
+    def list(self, prefix=''):
+        condition, parameters = self._cache.prefix_condition(self._prefix + prefix)
+        condition = ' AND '.join(c for c in (condition, 'v.IsLatest AND NOT v.IsDeleteMarker') if c)
+        for row in self._cache.versions(condition, parameters, 'ORDER BY o.Key'):
+            yield self._entry(row)
+
+    def stat(self, key, version_id=None):
+        if version_id:
+            rows = self._cache.versions('o.Key = ? AND v.VersionId = ?', (self._prefix + key, version_id))
+        else:
+            rows = self._cache.versions('o.Key = ? AND v.IsLatest', (self._prefix + key,))
+        for row in rows:
+            if not row[7]:
+                return self._entry(row)
+        return None
+
+    def read(self, key, offset=0, length=None, version_id=None):
+        if self._backend is None:
+            raise Exception(f'Listing cache {self._database_name} holds no contents')
+        return self._backend.read(key, offset, length, version_id)
+
+    def close(self):
+        self._cache.close()
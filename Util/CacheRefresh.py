@@ -0,0 +1,174 @@
+import os
+import threading
+
+from Util.ListingCache import ListingCache
+from Util.Repository import CachedRepository, STREAM_BATCH_SIZE
+
+# suffix of the database a full refresh of an existing cache is built in, until it replaces the cache
+REFRESH_SUFFIX = '.refresh'
+DATABASE_SUFFIXES = ('', '-wal', '-shm')
+
+
+class RefreshCancelled(Exception):
+    pass
+
+
+class CacheRefresh:
+    """
+    Refresh of the local cache of a bucket on a worker thread, so a user interface stays responsive while
+    the bucket is listed.  The cache is written in place when the refresh can be shown as it goes: an
+    incremental refresh commits the changes of each top-level prefix, and a new cache is streamed from the
+    listing a batch at a time (see CachedRepository.stream_local_cached_database).  A full refresh of an
+    existing cache is built in a separate database, so the old cache can be shown until install replaces it.
+
+    on_progress and on_done are called on the worker thread; a user interface passes them on to its own
+    thread (with wx.CallAfter for wxPython).
+    """
+
+    def __init__(self, bucket_name, database_name=None, incremental=False, client=None, on_progress=None,
+                 on_done=None, batch_size=STREAM_BATCH_SIZE):
+        """
+
+        :param bucket_name: (string) Name of bucket
+        :param database_name: (string) Name of cache database (default: <bucket_name>.db)
+        :param incremental: (bool) Only re-read the prefixes that changed, if the cache has checkpoints
+        :param client: (S3.Client) S3 client to use (default: shared client, see S3Client)
+        :param on_progress: (function) Called with the amount done and the total (None if not known yet);
+                            versions for a full refresh, prefixes for an incremental one
+        :param on_done: (function) Called with the CacheRefresh once it finished, failed or was cancelled
+        :param batch_size: (int) Versions written between commits of a full refresh
+        """
+        if not database_name:
+            database_name = bucket_name + '.db'
+        self._bucket_name = bucket_name
+        self._database_name = database_name
+        self._client = client
+        self._on_progress = on_progress
+        self._on_done = on_done
+        self._batch_size = batch_size
+        self._incremental = incremental and CachedRepository.has_checkpoints(database_name)
+        if self._incremental or not os.path.exists(database_name):
+            self._building_name = database_name
+        else:
+            self._building_name = database_name + REFRESH_SUFFIX
+        self._estimate = None
+        self._done = 0
+        self._total = None
+        self._error = None
+        self._cancel = threading.Event()
+        self._thread = None
+
+    @property
+    def database_name(self):
+        return self._database_name
+
+    @property
+    def building_name(self):
+        """
+        Get the name of the database being written, which is the cache itself when it is refreshed in place.
+
+        :return: (string) Name of database
+        """
+        return self._building_name
+
+    @property
+    def in_place(self):
+        return self._building_name == self._database_name
+
+    @property
+    def incremental(self):
+        return self._incremental
+
+    @property
+    def done(self):
+        return self._done
+
+    @property
+    def total(self):
+        return self._total
+
+    @property
+    def error(self):
+        """
+        Get the exception that stopped the refresh.
+
+        :return: (Exception) Exception raised by the refresh (RefreshCancelled if cancelled), or None
+        """
+        return self._error
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        """
+        Start the refresh.  A cache being created is created empty before the worker starts, so it can be
+        opened at once.
+        """
+        if self._thread is not None:
+            raise Exception('Cache refresh already started')
+        if not os.path.exists(self._database_name):
+            ListingCache(self._database_name).close()
+        elif not self.in_place:
+            # the old cache's number of versions is the best guess of the new one's
+            with ListingCache(self._database_name) as cache:
+                self._estimate = cache.db.execute('SELECT COUNT(*) FROM Versions').fetchone()[0] or None
+        self._thread = threading.Thread(target=self._run, name='cache-refresh', daemon=True)
+        self._thread.start()
+
+    def cancel(self):
+        """
+        Ask the refresh to stop after its current batch.  Changes already committed to a cache written in
+        place are kept.
+        """
+        self._cancel.set()
+
+    def join(self, timeout=None):
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self):
+        try:
+            if self._incremental:
+                CachedRepository.refresh_local_cached_database(self._bucket_name, self._database_name,
+                                                               self._client, on_progress=self._progress)
+            else:
+                CachedRepository.stream_local_cached_database(self._bucket_name, self._building_name,
+                                                              self._client, on_progress=self._progress,
+                                                              batch_size=self._batch_size)
+        except Exception as e:
+            self._error = e
+        if self._on_done is not None:
+            self._on_done(self)
+
+    def _progress(self, done, total):
+        if self._cancel.is_set():
+            raise RefreshCancelled('Cache refresh cancelled')
+        self._done = done
+        self._total = total
+        if total is None and self._estimate is not None:
+            total = max(self._estimate, done)
+        if self._on_progress is not None:
+            self._on_progress(done, total)
+
+    def install(self):
+        """
+        Finish the refresh once it is done: replace the cache with the database built by a full refresh, or
+        remove that database if the refresh failed.  The cache must not be open, as its files are replaced.
+
+        :return: (bool) True if the cache was replaced
+        """
+        if self.running:
+            raise Exception('Cache refresh still running')
+        if self.in_place:
+            return False
+        if self._error is not None:
+            for suffix in DATABASE_SUFFIXES:
+                if os.path.exists(self._building_name + suffix):
+                    os.remove(self._building_name + suffix)
+            return False
+        for suffix in DATABASE_SUFFIXES[1:]:
+            if os.path.exists(self._database_name + suffix):
+                os.remove(self._database_name + suffix)
+        os.replace(self._building_name, self._database_name)
+        return True
@@ -0,0 +1,501 @@
+from datetime import datetime, timezone
+from enum import Enum
+
+import numpy as np
+
+from Util.ListingCache import ListingCache, epoch_microseconds
+from Util.Repository import S3StorageClass, MIN_BILLABLE_SIZE
+
+GIGABYTE = 2 ** 30
+DAYS_PER_MONTH = 30
+MICROSECONDS_PER_DAY = 86400 * 10 ** 6
+COLUMN_CHUNK_ROWS = 1000000
+
+# storage price of each class, in USD per GB-month (us-east-1)
+STORAGE_PRICES = {
+    S3StorageClass.STANDARD: 0.023,
+    S3StorageClass.REDUCED_REDUNDANCY: 0.024,
+    S3StorageClass.GLACIER: 0.0036,
+    S3StorageClass.STANDARD_IA: 0.0125,
+    S3StorageClass.ONEZONE_IA: 0.01,
+    S3StorageClass.INTELLIGENT_TIERING: 0.023,
+    S3StorageClass.DEEP_ARCHIVE: 0.00099,
+    S3StorageClass.GLACIER_IR: 0.004,
+}
+# price of lifecycle transitions into each class, in USD per 1000 objects
+TRANSITION_PRICES = {
+    S3StorageClass.STANDARD_IA: 0.01,
+    S3StorageClass.ONEZONE_IA: 0.01,
+    S3StorageClass.INTELLIGENT_TIERING: 0.01,
+    S3StorageClass.GLACIER_IR: 0.02,
+    S3StorageClass.GLACIER: 0.03,
+    S3StorageClass.DEEP_ARCHIVE: 0.05,
+}
+# monitoring fee of INTELLIGENT_TIERING objects at least MIN_BILLABLE_SIZE, in USD per 1000 objects a month
+MONITORING_PRICE = 0.0025
+# part of the archive overhead billed at the STANDARD rate instead of the rate of the class
+STANDARD_OVERHEAD_SIZE = 8 * 1024
+# order of classes in the lifecycle waterfall: objects can only be transitioned down it
+TRANSITION_ORDER = (
+    (S3StorageClass.STANDARD, S3StorageClass.REDUCED_REDUNDANCY),
+    (S3StorageClass.STANDARD_IA,),
+    (S3StorageClass.INTELLIGENT_TIERING,),
+    (S3StorageClass.ONEZONE_IA,),
+    (S3StorageClass.GLACIER_IR,),
+    (S3StorageClass.GLACIER,),
+    (S3StorageClass.DEEP_ARCHIVE,),
+)
+
+LISTING_DTYPE = np.dtype([('object_id', np.int64), ('size', np.int64), ('mtime', np.int64),
+                          ('storage_class', np.uint8), ('is_latest', np.bool_), ('is_delete_marker', np.bool_)])
+
+
+class VersionState(Enum):
+    """
+    Enumeration of the states of an object version, for billing.
+    """
+    Current = 0
+    Noncurrent = 1
+    DeleteMarker = 2
+
+    @property
+    def Description(self):
+        if self == VersionState.Current:
+            return 'Current versions'
+        elif self == VersionState.Noncurrent:
+            return 'Noncurrent versions'
+        elif self == VersionState.DeleteMarker:
+            return 'Delete markers'
+
+
+def class_table(values, default=0):
+    """
+    Get a per-class value as an array indexed by S3StorageClass value.
+
+    :param values: (dict or function) Value of each S3StorageClass
+    :param default: Value of classes missing from values
+    :return: (numpy.ndarray) Values, indexed by class value
+    """
+    size = max(c.value for c in S3StorageClass) + 1
+    table = np.full(size, default, dtype=np.float64)
+    for storage_class in S3StorageClass:
+        if callable(values):
+            table[storage_class.value] = values(storage_class)
+        elif storage_class in values:
+            table[storage_class.value] = values[storage_class]
+    return table
+
+
+def read_columns(db, table, columns, condition='', parameters=(), chunk_rows=COLUMN_CHUNK_ROWS):
+    """
+    Read integer columns of a table into arrays.  Each column of a range of rowids is read as one
+    comma-separated string made by SQLite (group_concat) and parsed by NumPy, instead of as one Python
+    tuple per row, which is several times faster for millions of rows.
+
+    :param db: (sqlite3.Connection) Database
+    :param table: (string) Name of table
+    :param columns: (tuple) SQL expressions of integer columns
+    :param condition: (string) SQL condition on rows of table, or '' for all rows
+    :param parameters: (tuple) Parameters of condition
+    :param chunk_rows: (int) Number of rowids read by one query, which bounds the size of the strings
+    :return: (list) numpy.ndarray of int64 for each column
+    """
+    last_row_id = db.execute(f'SELECT MAX(rowid) FROM {table}').fetchone()[0] or 0
+    select = ', '.join(f'group_concat({column})' for column in columns)
+    where = f'AND ({condition})' if condition else ''
+    chunks = [[] for _ in columns]
+    for first in range(0, last_row_id + 1, chunk_rows):
+        row = db.execute(f'SELECT {select} FROM {table} WHERE rowid >= ? AND rowid < ? {where}',
+                         (first, first + chunk_rows) + tuple(parameters)).fetchone()
+        if row[0] is None:
+            continue
+        for chunk, text in zip(chunks, row):
+            chunk.append(np.fromstring(text, dtype=np.int64, sep=','))
+    return [np.concatenate(chunk) if chunk else np.zeros(0, dtype=np.int64) for chunk in chunks]
+
+
+class CostSummary:
+    """
+    Totals of a group of object versions.
+    """
+    __slots__ = ('_count', '_size', '_billable_size', '_monthly_cost')
+
+    def __init__(self, count, size, billable_size, monthly_cost):
+        """
+
+        :param count: (int) Number of versions
+        :param size: (int) Total size, in bytes
+        :param billable_size: (int) Total billable size, in bytes
+        :param monthly_cost: (float) Estimated storage cost a month, in USD
+        """
+        self._count = int(count)
+        self._size = int(size)
+        self._billable_size = int(billable_size)
+        self._monthly_cost = float(monthly_cost)
+
+    @property
+    def count(self):
+        return self._count
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def billable_size(self):
+        return self._billable_size
+
+    @property
+    def monthly_cost(self):
+        return self._monthly_cost
+
+
+class TransitionEstimate:
+    """
+    Estimated effect of transitioning the objects under a prefix to another storage class.
+    """
+    __slots__ = ('_storage_class', '_count', '_size', '_monthly_cost_before', '_monthly_cost_after',
+                 '_transition_cost', '_early_deletion_cost')
+
+    def __init__(self, storage_class, count, size, monthly_cost_before, monthly_cost_after, transition_cost,
+                 early_deletion_cost):
+        """
+
+        :param storage_class: (S3StorageClass) Class objects are transitioned to
+        :param count: (int) Number of versions transitioned
+        :param size: (int) Total size of versions transitioned, in bytes
+        :param monthly_cost_before: (float) Monthly storage cost of versions before transition, in USD
+        :param monthly_cost_after: (float) Monthly storage cost of versions after transition, in USD
+        :param transition_cost: (float) One-time cost of transition requests, in USD
+        :param early_deletion_cost: (float) One-time charge for versions leaving their class before its
+                                    minimum storage duration, in USD
+        """
+        self._storage_class = storage_class
+        self._count = int(count)
+        self._size = int(size)
+        self._monthly_cost_before = float(monthly_cost_before)
+        self._monthly_cost_after = float(monthly_cost_after)
+        self._transition_cost = float(transition_cost)
+        self._early_deletion_cost = float(early_deletion_cost)
+
+    @property
+    def storage_class(self):
+        return self._storage_class
+
+    @property
+    def count(self):
+        return self._count
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def monthly_cost_before(self):
+        return self._monthly_cost_before
+
+    @property
+    def monthly_cost_after(self):
+        return self._monthly_cost_after
+
+    @property
+    def transition_cost(self):
+        return self._transition_cost
+
+    @property
+    def early_deletion_cost(self):
+        return self._early_deletion_cost
+
+    @property
+    def monthly_savings(self):
+        return self._monthly_cost_before - self._monthly_cost_after
+
+    @property
+    def break_even_months(self):
+        """
+        Get the number of months until the savings pay for the one-time costs of the transition.
+
+        :return: (float) Months to break even, or None if the transition doesn't save anything
+        """
+        if self.monthly_savings <= 0:
+            return None
+        return (self._transition_cost + self._early_deletion_cost) / self.monthly_savings
+
+
+class CostAnalysis:
+    """
+    Billable size and cost analytics of the versions in a listing cache.  The versions are read once
+    into NumPy columns (object id, folder, size, modification time, storage class, is latest and is
+    delete marker) and every report is computed with array operations over those columns, so rolling up
+    millions of versions takes one pass of vectorized arithmetic instead of a Python loop over objects.
+
+    Billable sizes follow the rules of each S3StorageClass: the minimum object size of the infrequent
+    access classes and the per-object overhead of the archive classes.  Delete markers are not billed
+    for storage.  The minimum storage duration of a class is charged when a version leaves the class
+    early; the age of a version is taken from its modification time, which is when it entered its class
+    unless it was transitioned since.
+    """
+
+    def __init__(self, cache, prefix='', now=None, prices=None, transition_prices=None):
+        """
+        Read the versions of a cache.
+
+        :param cache: (ListingCache) Cache to analyze, or (string) name of cache database
+        :param prefix: (string) Only analyze the objects whose keys start with prefix ('' for all)
+        :param now: (datetime) Time ages of versions are measured at (default: current time)
+        :param prices: (dict) Storage price of each S3StorageClass, in USD per GB-month (default: STORAGE_PRICES)
+        :param transition_prices: (dict) Transition price into each S3StorageClass, in USD per 1000 objects
+                                  (default: TRANSITION_PRICES)
+        """
+        if not isinstance(cache, ListingCache):
+            cache = ListingCache(cache)
+        self._cache = cache
+        self._prefix = prefix
+        self._now = epoch_microseconds(now if now is not None else datetime.now(timezone.utc))
+        self._prices = class_table(prices if prices is not None else STORAGE_PRICES)
+        self._transition_prices = class_table(transition_prices if transition_prices is not None
+                                              else TRANSITION_PRICES)
+        self._min_sizes = class_table(lambda c: c.min_billable_size).astype(np.int64)
+        self._overhead_sizes = class_table(lambda c: c.overhead_size).astype(np.int64)
+        self._min_days = class_table(lambda c: c.min_storage_days)
+        ranks = {c: rank for rank, classes in enumerate(TRANSITION_ORDER) for c in classes}
+        self._transition_ranks = class_table(ranks).astype(np.int64)
+        self._versions = self._read_versions()
+        self._read_folders()
+        self._billable_sizes = self.billable_sizes(self._versions['storage_class'])
+        self._monthly_costs = self.monthly_costs(self._versions['storage_class'])
+
+    @property
+    def prefix(self):
+        return self._prefix
+
+    @property
+    def count(self):
+        return len(self._versions)
+
+    @property
+    def versions(self):
+        """
+        Get the columns of the versions analyzed.
+
+        :return: (numpy.ndarray) Structured array with LISTING_DTYPE fields
+        """
+        return self._versions
+
+    def _read_versions(self):
+        """
+        Read the versions under the prefix into columns, without joining the Objects table unless the
+        versions have to be filtered by key.  The storage class and flags are packed in one column.
+        """
+        condition, parameters = self._cache.prefix_condition(self._prefix)
+        if condition:
+            condition = f'ObjectId IN (SELECT o.ObjectId FROM Objects o WHERE {condition})'
+        object_ids, sizes, mtimes, packed = read_columns(
+            self._cache.db, 'Versions', ('ObjectId', 'Size', 'MTime', 'StorageClass + 16*IsLatest + 32*IsDeleteMarker'),
+            condition, parameters)
+        versions = np.zeros(len(object_ids), dtype=LISTING_DTYPE)
+        versions['object_id'] = object_ids
+        versions['size'] = sizes
+        versions['mtime'] = mtimes
+        versions['storage_class'] = packed & 15
+        versions['is_latest'] = packed & 16
+        versions['is_delete_marker'] = packed & 32
+        return versions
+
+    def _read_folders(self):
+        """
+        Read the folder tree, and the index in it of the folder of each version.
+        """
+        folders = self._cache.db.execute('SELECT FolderId, Prefix, ParentId FROM Folders ORDER BY FolderId')
+        folders = folders.fetchall()
+        self._folder_prefixes = [row[1] for row in folders]
+        folder_ids = np.array([row[0] for row in folders], dtype=np.int64)
+        parent_ids = np.array([-1 if row[2] is None else row[2] for row in folders], dtype=np.int64)
+        self._parents = np.where(parent_ids < 0, -1, np.searchsorted(folder_ids, parent_ids))
+        self._depths = np.array([prefix.count('/') for prefix in self._folder_prefixes], dtype=np.int64)
+        # folder of each object, indexed by object id
+        object_ids, object_folders = read_columns(self._cache.db, 'Objects', ('ObjectId', 'FolderId'))
+        folder_of_object = np.zeros(object_ids.max() + 1 if len(object_ids) else 1, dtype=np.int64)
+        folder_of_object[object_ids] = np.searchsorted(folder_ids, object_folders)
+        self._folders = folder_of_object[self._versions['object_id']]
+
+    def billable_sizes(self, storage_classes):
+        """
+        Get the billable size of each version if it were stored in the given classes.
+
+        :param storage_classes: (numpy.ndarray) S3StorageClass value of each version
+        :return: (numpy.ndarray) Billable size of each version, in bytes
+        """
+        sizes = np.maximum(self._versions['size'], self._min_sizes[storage_classes])
+        sizes += self._overhead_sizes[storage_classes]
+        sizes[self._versions['is_delete_marker']] = 0
+        return sizes
+
+    def monthly_costs(self, storage_classes):
+        """
+        Get the storage cost a month of each version if it were stored in the given classes.
+
+        :param storage_classes: (numpy.ndarray) S3StorageClass value of each version
+        :return: (numpy.ndarray) Cost of each version, in USD
+        """
+        sizes = self.billable_sizes(storage_classes)
+        standard_overhead = np.where(self._overhead_sizes[storage_classes] > 0, STANDARD_OVERHEAD_SIZE, 0)
+        standard_overhead[self._versions['is_delete_marker']] = 0
+        costs = (sizes - standard_overhead) * self._prices[storage_classes]
+        costs += standard_overhead * self._prices[S3StorageClass.STANDARD.value]
+        costs /= GIGABYTE
+        monitored = (storage_classes == S3StorageClass.INTELLIGENT_TIERING.value) & \
+                    (self._versions['size'] >= MIN_BILLABLE_SIZE) & ~self._versions['is_delete_marker']
+        costs[monitored] += MONITORING_PRICE / 1000
+        return costs
+
+    def early_deletion_costs(self, storage_classes=None):
+        """
+        Get the charge for the rest of the minimum storage duration of each version, if it left its
+        class now.
+
+        :param storage_classes: (numpy.ndarray) S3StorageClass value of each version (default: current classes)
+        :return: (numpy.ndarray) Charge of each version, in USD
+        """
+        if storage_classes is None:
+            storage_classes = self._versions['storage_class']
+            monthly_costs = self._monthly_costs
+        else:
+            monthly_costs = self.monthly_costs(storage_classes)
+        age_days = (self._now - self._versions['mtime']) / MICROSECONDS_PER_DAY
+        remaining_days = np.maximum(self._min_days[storage_classes] - age_days, 0)
+        return monthly_costs * remaining_days / DAYS_PER_MONTH
+
+    def version_states(self):
+        """
+        Get the state of each version.
+
+        :return: (numpy.ndarray) VersionState value of each version
+        """
+        states = np.where(self._versions['is_latest'], VersionState.Current.value, VersionState.Noncurrent.value)
+        states[self._versions['is_delete_marker']] = VersionState.DeleteMarker.value
+        return states
+
+    def _summaries(self, groups, count, mask=None):
+        """
+        Total the versions of each group.
+
+        :param groups: (numpy.ndarray) Group number of each version
+        :param count: (int) Number of groups
+        :param mask: (numpy.ndarray) Versions to total (default: all)
+        :return: (numpy.ndarray) Count, size, billable size and monthly cost of each group, one row each
+        """
+        if mask is not None:
+            groups = groups[mask]
+        columns = (None, self._versions['size'], self._billable_sizes, self._monthly_costs)
+        return np.stack([np.bincount(groups, weights=None if c is None else (c if mask is None else c[mask]),
+                                     minlength=count) for c in columns], axis=1)
+
+    def total(self):
+        """
+        Get the totals of all versions.
+
+        :return: (CostSummary) Totals
+        """
+        return CostSummary(self.count, self._versions['size'].sum(), self._billable_sizes.sum(),
+                           self._monthly_costs.sum())
+
+    def monthly_cost(self):
+        """
+        Estimate the storage cost of the versions a month.
+
+        :return: (float) Cost, in USD
+        """
+        return float(self._monthly_costs.sum())
+
+    def early_deletion_cost(self):
+        """
+        Get the charge for the rest of the minimum storage durations, if all versions were deleted now.
+
+        :return: (float) Charge, in USD
+        """
+        return float(self.early_deletion_costs().sum())
+
+    def by_class(self):
+        """
+        Total the versions of each storage class.  Delete markers have no storage class and are left out.
+
+        :return: (dict) CostSummary of each S3StorageClass with versions
+        """
+        classes = self._versions['storage_class'].astype(np.int64)
+        totals = self._summaries(classes, len(self._prices), ~self._versions['is_delete_marker'])
+        return {S3StorageClass(value): CostSummary(*totals[value]) for value in np.flatnonzero(totals[:, 0])}
+
+    def by_version_state(self):
+        """
+        Total the current versions, noncurrent versions and delete markers.
+
+        :return: (dict) CostSummary of each VersionState
+        """
+        totals = self._summaries(self.version_states(), len(VersionState))
+        return {state: CostSummary(*totals[state.value]) for state in VersionState}
+
+    def by_folder(self, depth=None, recursive=True):
+        """
+        Total the versions of each folder.
+
+        :param depth: (int) Only report the folders this many levels below the root (default: all folders)
+        :param recursive: (bool) Include the versions of sub-folders in the totals of each folder
+        :return: (dict) CostSummary of each folder prefix with versions
+        """
+        totals = self._summaries(self._folders, len(self._folder_prefixes))
+        if recursive:
+            # add each level of the tree into its parents, deepest first
+            for level in range(int(self._depths.max()) if len(self._depths) else 0, 0, -1):
+                children = np.flatnonzero(self._depths == level)
+                np.add.at(totals, self._parents[children], totals[children])
+        selected = totals[:, 0] > 0
+        if depth is not None:
+            selected &= self._depths == depth
+        return {self._folder_prefixes[n]: CostSummary(*totals[n]) for n in np.flatnonzero(selected)}
+
+    def prefix_mask(self, prefix):
+        """
+        Find the versions of the objects whose keys start with a prefix, with one range query of the
+        object index.
+
+        :param prefix: (string) Prefix of keys
+        :return: (numpy.ndarray) True for each version under prefix
+        """
+        condition, parameters = self._cache.prefix_condition(prefix)
+        if not condition:
+            return np.ones(self.count, dtype=np.bool_)
+        cursor = self._cache.db.execute(f'SELECT o.ObjectId FROM Objects o WHERE {condition}', parameters)
+        object_ids = np.fromiter((row[0] for row in cursor), dtype=np.int64)
+        return np.isin(self._versions['object_id'], object_ids)
+
+    def simulate_transition(self, prefix, storage_class, include_noncurrent=False, min_age_days=0):
+        """
+        Estimate the effect of a lifecycle rule transitioning the objects under a prefix to another
+        storage class.  Like S3 lifecycle rules, only versions of at least MIN_BILLABLE_SIZE are
+        transitioned, delete markers are not, and classes are only transitioned down TRANSITION_ORDER.
+
+        :param prefix: (string) Prefix of keys transitioned ('' for the whole bucket)
+        :param storage_class: (S3StorageClass) Class transitioned to
+        :param include_noncurrent: (bool) Transition noncurrent versions as well as current ones
+        :param min_age_days: (float) Only transition versions at least this many days old
+        :return: (TransitionEstimate) Estimated costs and savings
+        """
+        versions = self._versions
+        classes = versions['storage_class']
+        age_days = (self._now - versions['mtime']) / MICROSECONDS_PER_DAY
+        mask = self.prefix_mask(prefix) & ~versions['is_delete_marker'] & (versions['size'] >= MIN_BILLABLE_SIZE)
+        mask &= age_days >= min_age_days
+        mask &= self._transition_ranks[classes] < self._transition_ranks[storage_class.value]
+        if not include_noncurrent:
+            mask &= versions['is_latest']
+        target_classes = np.where(mask, storage_class.value, classes).astype(np.uint8)
+        after = self.monthly_costs(target_classes)
+        count = np.count_nonzero(mask)
+        return TransitionEstimate(storage_class, count, versions['size'][mask].sum(),
+                                  self._monthly_costs[mask].sum(), after[mask].sum(),
+                                  count * self._transition_prices[storage_class.value] / 1000,
+                                  self.early_deletion_costs()[mask].sum())
+
+    def close(self):
+        self._cache.close()
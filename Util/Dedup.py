@@ -0,0 +1,119 @@
+from Util.Transfer import METADATA_MD5
+
+MAX_HEAD_CANDIDATES = 4
+
+
+def local_fingerprint(index, path, full_path, stat_result, part_size):
+    """
+    Get the fingerprint of a local file: the MD5 digest of its contents and the ETag S3 gives it when it
+    is uploaded in parts.  A file whose stat matches its own record in the sync-state index, or the
+    record of a file renamed or moved since the last sync, is not read again.
+
+    :param index: (SyncStateIndex) Index of last sync
+    :param path: (string) Relative path of file
+    :param full_path: (string) Full pathname of file
+    :param stat_result: (os.stat_result) Current stat of file
+    :param part_size: (int) Part size of multipart uploads of file
+    :return: (tuple) Hex MD5 digest, multipart ETag (None if file is uploaded in one request)
+    """
+    state = index.get(path)
+    if state is None or not state.matches(stat_result):
+        state = index.find_moved(stat_result)
+    if state is not None and state.content_hash and (state.e_tag or stat_result.st_size <= part_size):
+        return state.content_hash, state.e_tag
+    return index.file_hashes(full_path, part_size)
+
+
+class RemoteFingerprints:
+    """
+    Fingerprints of the objects under a prefix of a bucket, collected from the ETags of a listing as it
+    is read.  An object uploaded in one request has the MD5 digest of its contents as its ETag; one
+    uploaded in parts can be matched by its multipart ETag if it was uploaded with the same part size,
+    or else by the MD5 digest CloudSync stores in its metadata, which costs a HEAD request.
+    """
+
+    def __init__(self, client, bucket_name, prefix='', min_size=0):
+        """
+
+        :param client: (S3.Client) S3 client
+        :param bucket_name: (string) Name of bucket
+        :param prefix: (string) Prefix of keys, removed from the entry keys
+        :param min_size: (int) Objects smaller than this are not collected
+        """
+        self._client = client
+        self._bucket_name = bucket_name
+        self._prefix = prefix
+        self._min_size = min_size
+        self._by_e_tag = dict()
+        self._multipart = dict()
+        self._stored_hashes = dict()
+        self._excluded = set()
+
+    @property
+    def min_size(self):
+        return self._min_size
+
+    def collect(self, entries):
+        """
+        Collect the fingerprints of entries passing through a stream.
+
+        :param entries: (iterator) DiffEntries of bucket (from s3_entries)
+        :return: (iterator) Same DiffEntries
+        """
+        for entry in entries:
+            self.add(entry)
+            yield entry
+
+    def add(self, entry):
+        """
+        Add the fingerprint of an object.
+
+        :param entry: (DiffEntry) Entry of object, with its ETag
+        """
+        if entry.size < self._min_size or not entry.e_tag:
+            return
+        location = (self._prefix + entry.key, entry.version_id)
+        self._by_e_tag.setdefault((entry.size, entry.e_tag), location)
+        if '-' in entry.e_tag:
+            self._multipart.setdefault(entry.size, []).append(location)
+
+    def exclude(self, key):
+        """
+        Don't use an object as the source of a copy, because it changes during the run.
+
+        :param key: (string) Key of object, without prefix
+        """
+        self._excluded.add(self._prefix + key)
+
+    def find(self, size, content_hash, e_tag=None):
+        """
+        Find an object with the given contents.
+
+        :param size: (int) Size of contents, in bytes
+        :param content_hash: (string) Hex MD5 digest of contents
+        :param e_tag: (string) Multipart ETag of contents, if uploaded in parts
+        :return: (tuple) Key and version id of object, or None if not found
+        """
+        for tag in (content_hash, e_tag):
+            if tag:
+                location = self._by_e_tag.get((size, tag))
+                if location is not None and location[0] not in self._excluded:
+                    return location
+        candidates = [c for c in self._multipart.get(size, []) if c[0] not in self._excluded]
+        for location in candidates[0:MAX_HEAD_CANDIDATES]:
+            if self._stored_hash(location) == content_hash:
+                return location
+        return None
+
+    def _stored_hash(self, location):
+        if location not in self._stored_hashes:
+            key, version_id = location
+            kwargs = dict()
+            if version_id is not None:
+                kwargs['VersionId'] = version_id
+            try:
+                response = self._client.head_object(Bucket=self._bucket_name, Key=key, **kwargs)
+                self._stored_hashes[location] = response.get('Metadata', {}).get(METADATA_MD5)
+            except Exception:
+                self._stored_hashes[location] = None
+        return self._stored_hashes[location]
@@ -0,0 +1,287 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from Util.Metrics import timer
+from Util.Plan import DELETE_BATCH_SIZE
+from Util.S3Client import max_concurrency
+
+# S3 supports at least 3,500 PUT/COPY/POST/DELETE requests per second per partitioned prefix, and each key
+# of a DeleteObjects request counts as one
+DEFAULT_DELETE_RATE = 3500
+DEFAULT_MAX_ATTEMPTS = 5
+DEFAULT_BACKOFF = 0.1
+MAX_BACKOFF = 5.0
+# errors of single keys in a DeleteObjects response that can succeed when tried again
+RETRYABLE_CODES = frozenset(('SlowDown', 'InternalError', 'ServiceUnavailable', 'RequestTimeout',
+                             'OperationAborted'))
+
+
+class PrefixRateLimiter:
+    """
+    Token bucket per key prefix.  A prefix is the first prefix_depth delimiter-separated parts of a key,
+    and requests for keys under it are held back to rate per second, with bursts of up to one second of
+    requests.  Callers that take more tokens than the bucket has wait for the debt to be paid back, so
+    requests from many threads are spread out evenly.
+    """
+
+    def __init__(self, rate=DEFAULT_DELETE_RATE, prefix_depth=1, delimiter='/', clock=time.monotonic,
+                 sleep=time.sleep):
+        """
+
+        :param rate: (float) Requests per second per prefix (0 for no limit)
+        :param prefix_depth: (int) Number of parts of a key that make its prefix
+        :param delimiter: (string) Delimiter of the parts of a key
+        :param clock: (function) Returns the current time in seconds
+        :param sleep: (function) Waits a number of seconds
+        """
+        self._rate = rate
+        self._prefix_depth = prefix_depth
+        self._delimiter = delimiter
+        self._clock = clock
+        self._sleep = sleep
+        self._buckets = dict()
+        self._lock = threading.Lock()
+
+    @property
+    def rate(self):
+        return self._rate
+
+    def prefix(self, key):
+        """
+        Get the prefix a key is limited under.
+
+        :param key: (string) S3 key
+        :return: (string) Prefix ('' for keys with fewer parts than prefix_depth)
+        """
+        parts = key.split(self._delimiter, self._prefix_depth)
+        if len(parts) <= self._prefix_depth:
+            return self._delimiter.join(parts[0:-1])
+        return self._delimiter.join(parts[0:self._prefix_depth])
+
+    def acquire(self, keys):
+        """
+        Take one token per key from the bucket of its prefix, waiting until the slowest prefix allows it.
+
+        :param keys: (iterable) S3 keys of the requests about to be made
+        :return: (float) Seconds waited
+        """
+        if not self._rate:
+            return 0.0
+        counts = dict()
+        for key in keys:
+            prefix = self.prefix(key)
+            counts[prefix] = counts.get(prefix, 0) + 1
+        delay = 0.0
+        with self._lock:
+            now = self._clock()
+            for prefix, count in counts.items():
+                tokens, last = self._buckets.get(prefix, (self._rate, now))
+                tokens = min(self._rate, tokens + (now - last) * self._rate) - count
+                self._buckets[prefix] = (tokens, now)
+                if tokens < 0:
+                    delay = max(delay, -tokens / self._rate)
+        if delay > 0:
+            self._sleep(delay)
+        return delay
+
+
+class DeleteStats:
+    """
+    Counts of a bulk delete.
+    """
+    __slots__ = ('requests', 'deleted', 'retried', 'failed', 'throttled_seconds', '_lock')
+
+    def __init__(self):
+        self.requests = 0
+        self.deleted = 0
+        self.retried = 0
+        self.failed = 0
+        self.throttled_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, requests=0, deleted=0, retried=0, failed=0, throttled_seconds=0.0):
+        with self._lock:
+            self.requests += requests
+            self.deleted += deleted
+            self.retried += retried
+            self.failed += failed
+            self.throttled_seconds += throttled_seconds
+
+
+class BulkDeleter:
+    """
+    Deletes object versions of one bucket in DeleteObjects requests of up to DELETE_BATCH_SIZE keys, sent
+    in parallel on a pool of worker threads.  Targets are streamed in with add (or all at once with
+    delete), so any number of versions can be deleted in bounded memory.  Keys that fail in a response with
+    a retryable error are sent again, on their own, after a backoff; the rest of the batch is not.  Requests
+    are held back per prefix by a PrefixRateLimiter.
+    """
+
+    def __init__(self, client, bucket_name, max_concurrency=None, rate=DEFAULT_DELETE_RATE, prefix_depth=1,
+                 max_attempts=DEFAULT_MAX_ATTEMPTS, batch_size=DELETE_BATCH_SIZE, backoff=DEFAULT_BACKOFF):
+        """
+
+        :param client: (S3.Client) S3 client, shared by all worker threads
+        :param bucket_name: (string) Name of bucket
+        :param max_concurrency: (int) Number of requests at the same time (default: S3Client max_concurrency)
+        :param rate: (float) Keys deleted per second per prefix (0 for no limit)
+        :param prefix_depth: (int) Number of parts of a key that make the prefix it is limited under
+        :param max_attempts: (int) Number of attempts of a key, including the first, before it fails
+        :param batch_size: (int) Keys per request
+        :param backoff: (float) Seconds to wait before the first retry, doubled for each retry after
+        """
+        self._client = client
+        self._bucket_name = bucket_name
+        self._max_concurrency = max_concurrency
+        self._limiter = PrefixRateLimiter(rate, prefix_depth)
+        self._max_attempts = max_attempts
+        self._batch_size = batch_size
+        self._backoff = backoff
+        self._stats = DeleteStats()
+        self._executor = None
+        self._pending = set()
+        self._batch = []
+        self._failures = []
+        self._on_deleted = None
+
+    @property
+    def stats(self):
+        return self._stats
+
+    @property
+    def max_concurrency(self):
+        if self._max_concurrency is None:
+            return max_concurrency()
+        return self._max_concurrency
+
+    def start(self, on_deleted=None):
+        """
+        Start a bulk delete, before adding targets.
+
+        :param on_deleted: (function) Called on the thread that adds targets with each list of tuples of key
+                           and version id that were deleted
+        """
+        if self._executor is not None:
+            raise Exception('Bulk delete already started')
+        self._executor = ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix='delete')
+        self._pending = set()
+        self._batch = []
+        self._failures = []
+        self._on_deleted = on_deleted
+
+    def add(self, key, version_id=None):
+        """
+        Add a target.  It is sent when its batch is full, and waits there if too many batches are in flight.
+
+        :param key: (string) S3 key
+        :param version_id: (string) Version to delete, or None for the latest version, which on a versioned
+                           bucket leaves a delete marker
+        """
+        self._batch.append((key, version_id))
+        if len(self._batch) >= self._batch_size:
+            self._send()
+
+    def finish(self):
+        """
+        Send the last batch and wait for every request to finish.
+
+        :return: (list) Tuples of key, version id and exception for the targets that could not be deleted
+        """
+        if self._batch:
+            self._send()
+        self._collect(wait(self._pending).done)
+        self._executor.shutdown()
+        self._executor = None
+        return self._failures
+
+    def delete(self, targets, on_deleted=None):
+        """
+        Delete object versions.
+
+        :param targets: (iterator) Tuples of key and version id (None for the latest version)
+        :param on_deleted: (function) Called on the calling thread with each list of targets deleted
+        :return: (list) Tuples of key, version id and exception for the targets that could not be deleted
+        """
+        self.start(on_deleted)
+        try:
+            for key, version_id in targets:
+                self.add(key, version_id)
+        except BaseException:
+            self._executor.shutdown(cancel_futures=True)
+            self._executor = None
+            raise
+        return self.finish()
+
+    def _send(self):
+        # keep a batch queued per worker, so workers never wait for the caller
+        while len(self._pending) >= 2 * self.max_concurrency:
+            self._collect(wait(self._pending, return_when=FIRST_COMPLETED).done)
+        self._pending.add(self._executor.submit(self._delete_batch, self._batch))
+        self._batch = []
+        self._collect([future for future in self._pending if future.done()])
+
+    def _collect(self, futures):
+        for future in futures:
+            self._pending.discard(future)
+            deleted, failures = future.result()
+            self._failures.extend(failures)
+            if deleted and self._on_deleted is not None:
+                self._on_deleted(deleted)
+
+    def _delete_batch(self, batch):
+        """
+        Delete one batch, retrying the keys that fail with retryable errors.  A request that raises has
+        already been retried by the client (see S3ClientConfig), so all of its keys fail.
+
+        :param batch: (list) Tuples of key and version id
+        :return: (tuple) List of targets deleted, list of tuples of key, version id and exception
+        """
+        deleted = []
+        failures = []
+        attempt = 1
+        while batch:
+            waited = self._limiter.acquire(key for key, version_id in batch)
+            objects = [{'Key': key} if version_id is None else {'Key': key, 'VersionId': version_id}
+                       for key, version_id in batch]
+            try:
+                with timer('delete', keys=len(objects), attempt=attempt):
+                    response = self._client.delete_objects(Bucket=self._bucket_name,
+                                                           Delete={'Objects': objects, 'Quiet': True})
+            except Exception as e:
+                failures.extend((key, version_id, e) for key, version_id in batch)
+                self._stats.add(requests=1, failed=len(batch), throttled_seconds=waited)
+                break
+            errors = dict()
+            for error in response.get('Errors', []):
+                errors[(error['Key'], error.get('VersionId'))] = error
+                # errors of latest-version deletes may give the version of the delete marker made
+                errors.setdefault((error['Key'], None), error)
+            retry = []
+            failed = 0
+            for target in batch:
+                error = errors.get(target)
+                if error is None:
+                    deleted.append(target)
+                elif error.get('Code') in RETRYABLE_CODES and attempt < self._max_attempts:
+                    retry.append(target)
+                else:
+                    failures.append((*target, Exception(f'{error.get("Code")}: {error.get("Message", "")}')))
+                    failed += 1
+            self._stats.add(requests=1, deleted=len(batch) - len(retry) - failed, retried=len(retry), failed=failed,
+                            throttled_seconds=waited)
+            if retry:
+                time.sleep(min(self._backoff * 2 ** (attempt - 1), MAX_BACKOFF))
+                attempt += 1
+            batch = retry
+        return deleted, failures
+
+    def report(self):
+        """
+        Describe the counts of the bulk delete.
+
+        :return: (list) Lines of report
+        """
+        stats = self._stats
+        return [f'Deleted {stats.deleted:,} versions in {stats.requests:,} requests '
+                f'({stats.retried:,} retried, {stats.failed:,} failed, {stats.throttled_seconds:,.1f} s held back)']
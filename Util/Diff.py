@@ -0,0 +1,371 @@
+import os
+from datetime import datetime, timezone
+from enum import Enum
+from itertools import groupby
+from operator import attrgetter
+
+from Util.ListingCache import from_epoch_microseconds
+from Util.LocalScanner import LocalScanner
+from Util.S3Listing import ShardedLister
+import Util.Repository
+import Util.S3Repository
+
+
+class DiffActionType(Enum):
+    """
+    Enumeration of the actions that make a target match a source.
+    """
+    Copy = 1
+    Overwrite = 2
+    Delete = 3
+    Skip = 4
+
+    @property
+    def Description(self):
+        if self == DiffActionType.Copy:
+            return 'Copy new file to target'
+        elif self == DiffActionType.Overwrite:
+            return 'Overwrite changed file in target'
+        elif self == DiffActionType.Delete:
+            return 'Delete file missing from source'
+        elif self == DiffActionType.Skip:
+            return 'Skip identical file'
+
+
+class DiffEntry:
+    """
+    One file of a repository, as compared by the diff engine.
+    """
+    __slots__ = ('_key', '_size', '_timestamp', '_content_hash', '_version_id', '_file_object', '_e_tag',
+                 '_stat_result')
+
+    def __init__(self, key, size, timestamp, content_hash=None, version_id=None, file_object=None, e_tag=None,
+                 stat_result=None):
+        """
+
+        :param key: (string) Path of file relative to the root being compared, with '/' delimiters
+        :param size: (int) Size of file, in bytes
+        :param timestamp: (datetime) Timezone-aware date/time file was modified or stored
+        :param content_hash: (string) Hex MD5 digest of file contents, if known
+        :param version_id: (string) Version of file, for repositories that support versions
+        :param file_object: Object the entry was made from (FileObject, S3FileObject or local path)
+        :param e_tag: (string) ETag of S3 object, without quotes
+        :param stat_result: (os.stat_result) Result of stat of local file, if it was scanned
+        """
+        self._key = key
+        self._size = size
+        self._timestamp = timestamp
+        self._content_hash = content_hash
+        self._version_id = version_id
+        self._file_object = file_object
+        self._e_tag = e_tag
+        self._stat_result = stat_result
+
+    @property
+    def key(self):
+        return self._key
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def timestamp(self):
+        return self._timestamp
+
+    @property
+    def content_hash(self):
+        return self._content_hash
+
+    @property
+    def version_id(self):
+        return self._version_id
+
+    @property
+    def file_object(self):
+        return self._file_object
+
+    @property
+    def e_tag(self):
+        return self._e_tag
+
+    @property
+    def stat_result(self):
+        return self._stat_result
+
+
+class DiffAction:
+    """
+    Action for one key, with the source and target entries it was decided from.
+    """
+    __slots__ = ('_action', '_source', '_target')
+
+    def __init__(self, action, source, target):
+        """
+
+        :param action: (DiffActionType) Action to take
+        :param source: (DiffEntry) Source entry (None for Delete)
+        :param target: (DiffEntry) Target entry (None for Copy)
+        """
+        self._action = action
+        self._source = source
+        self._target = target
+
+    @property
+    def action(self):
+        return self._action
+
+    @property
+    def key(self):
+        if self._source is not None:
+            return self._source.key
+        return self._target.key
+
+    @property
+    def source(self):
+        return self._source
+
+    @property
+    def target(self):
+        return self._target
+
+
+def e_tag_hash(e_tag):
+    """
+    Get the content hash from an S3 ETag.  Only ETags of objects uploaded in one part are the MD5 of
+    their contents.
+
+    :param e_tag: (string) ETag, with or without quotes
+    :return: (string) Hex MD5 digest, or None if ETag is not an MD5 digest
+    """
+    if not e_tag:
+        return None
+    e_tag = e_tag.strip('"')
+    if '-' in e_tag:
+        return None
+    return e_tag
+
+
+def entries_identical(source, target):
+    """
+    Default comparison of a source and target entry with the same key.  Entries with different sizes
+    differ.  When both content hashes are known they decide; otherwise a target that is not older than
+    the source is taken to be a copy of it.
+
+    :param source: (DiffEntry) Source entry
+    :param target: (DiffEntry) Target entry
+    :return: (bool) True if target doesn't need to be overwritten
+    """
+    if source.size != target.size:
+        return False
+    if source.content_hash and target.content_hash:
+        return source.content_hash == target.content_hash
+    return source.timestamp <= target.timestamp
+
+
+def entries_identical_at_time(source, target):
+    """
+    Comparison for a restore to a point in time, where the source is an older version and a newer target
+    is not a copy of it.  When both content hashes are known they decide; otherwise the target must have
+    the time of the version, which files downloaded by a restore are given.
+
+    :param source: (DiffEntry) Source entry, a version of the snapshot
+    :param target: (DiffEntry) Target entry
+    :return: (bool) True if target doesn't need to be overwritten
+    """
+    if source.size != target.size:
+        return False
+    if source.content_hash and target.content_hash:
+        return source.content_hash == target.content_hash
+    return source.timestamp == target.timestamp
+
+
+def diff(source, target, compare=entries_identical):
+    """
+    Merge-join two streams of entries sorted by key.  Only one entry from each side is held at a
+    time, so memory does not depend on the number of keys.
+
+    :param source: (iterator) Source DiffEntries, sorted by key
+    :param target: (iterator) Target DiffEntries, sorted by key
+    :param compare: (function) Returns True if a target entry is identical to the source entry
+    :return: (iterator) DiffActions, in key order
+    """
+    source = _checked_order(source, 'source')
+    target = _checked_order(target, 'target')
+    s = next(source, None)
+    t = next(target, None)
+    while s is not None or t is not None:
+        if t is None or (s is not None and s.key < t.key):
+            yield DiffAction(DiffActionType.Copy, s, None)
+            s = next(source, None)
+        elif s is None or t.key < s.key:
+            yield DiffAction(DiffActionType.Delete, None, t)
+            t = next(target, None)
+        else:
+            if compare(s, t):
+                yield DiffAction(DiffActionType.Skip, s, t)
+            else:
+                yield DiffAction(DiffActionType.Overwrite, s, t)
+            s = next(source, None)
+            t = next(target, None)
+
+
+def _checked_order(entries, side):
+    previous = None
+    for entry in entries:
+        if previous is not None and entry.key <= previous:
+            raise Exception(f'Entries of {side} are not sorted by key: {entry.key!r} after {previous!r}')
+        previous = entry.key
+        yield entry
+
+
+def sort_entries(entries):
+    """
+    Sort entries by key, for sources that are not listed in key order.
+
+    :param entries: (iterator) DiffEntries
+    :return: (list) DiffEntries sorted by key
+    """
+    return sorted(entries, key=attrgetter('key'))
+
+
+def local_entries(root, index=None):
+    """
+    Get the entries of a local folder in key order, reading one directory at a time.
+
+    :param root: (string) Root of local folder
+    :param index: (SyncStateIndex) Index of last sync, used for the content hash of unchanged files
+    :return: (iterator) DiffEntries, file_object is the full path of each file and stat_result its stat
+    """
+    for full_path, stat_result in LocalScanner().scan_sorted(root):
+        key = os.path.relpath(full_path, root)
+        if os.sep != '/':
+            key = key.replace(os.sep, '/')
+        content_hash = None
+        if index is not None:
+            state = index.get(key)
+            if state is not None and state.matches(stat_result):
+                content_hash = state.content_hash
+        timestamp = datetime.fromtimestamp(stat_result.st_mtime, timezone.utc)
+        yield DiffEntry(key, stat_result.st_size, timestamp, content_hash, file_object=full_path,
+                        stat_result=stat_result)
+
+
+def s3_entries(client, bucket_name, prefix='', noncurrent=None):
+    """
+    Get the entries of the latest versions of the objects under a prefix, straight from a listing, which
+    is already in key order.  Keys whose latest version is a delete marker are left out.  The other versions
+    come in the same listing, and can be streamed to a callback as they go by, to delete them.
+
+    :param client: (S3.Client) S3 client
+    :param bucket_name: (string) Name of bucket
+    :param prefix: (string) Prefix of keys, removed from the entry keys
+    :param noncurrent: (function) Called with the S3 key and version id of each version that is not the
+                       latest version of an existing object: noncurrent versions and delete markers
+    :return: (iterator) DiffEntries, file_object is the S3 key
+    """
+    versioning = Util.S3Repository.Repository.versioning_enabled(client, bucket_name)
+    lister = ShardedLister(client, bucket_name, versions=versioning, max_workers=1)
+    for o in lister.list_serial(prefix):
+        if not o.is_latest or o.size is None:
+            if noncurrent is not None:
+                noncurrent(o.key, o.id)
+            continue
+        e_tag = o.e_tag.strip('"') if o.e_tag else None
+        yield DiffEntry(o.key[len(prefix):], o.size, o.last_modified, e_tag_hash(e_tag), o.id, file_object=o.key,
+                        e_tag=e_tag)
+
+
+def s3_snapshot_entries(client, bucket_name, prefix, timestamp):
+    """
+    Get the entries of the objects under a prefix as they were at a time, from a listing of all
+    versions.  The listing returns the versions of each key newest first, and the version current at
+    the time is found by binary search of the versions of the key.  Keys that did not exist at the
+    time, or were deleted, are left out.
+
+    :param client: (S3.Client) S3 client
+    :param bucket_name: (string) Name of bucket
+    :param prefix: (string) Prefix of keys, removed from the entry keys
+    :param timestamp: (datetime) Timezone-aware time of snapshot
+    :return: (iterator) DiffEntries, file_object is the S3 key
+    """
+    versioning = Util.S3Repository.Repository.versioning_enabled(client, bucket_name)
+    lister = ShardedLister(client, bucket_name, versions=versioning, max_workers=1)
+    for key, versions in groupby(lister.list_serial(prefix), key=attrgetter('key')):
+        versions = [Util.S3Repository.S3FileVersion(o) for o in versions]
+        position = Util.S3Repository.newest_first_position(versions, timestamp)
+        if position == len(versions) or versions[position].is_delete_marker:
+            continue
+        version = versions[position]
+        e_tag = version.e_tag.strip('"') if version.e_tag else None
+        yield DiffEntry(key[len(prefix):], version.size, version.time_stamp, e_tag_hash(e_tag), version.version_id,
+                        file_object=key, e_tag=e_tag)
+
+
+def cache_snapshot_entries(cache, prefix, timestamp):
+    """
+    Get the entries of the objects under a prefix as they were at a time, from a listing cache, with one
+    indexed query (see ListingCache.snapshot).
+
+    :param cache: (ListingCache) Cache of bucket
+    :param prefix: (string) Prefix of keys, removed from the entry keys
+    :param timestamp: (datetime) Timezone-aware time of snapshot
+    :return: (iterator) DiffEntries, file_object is the S3 key
+    """
+    for key, version_id, size, mtime, e_tag, storage_class, is_latest, is_delete_marker, row_id \
+            in cache.snapshot(timestamp, prefix):
+        e_tag = e_tag.strip('"') if e_tag else None
+        yield DiffEntry(key[len(prefix):], size, from_epoch_microseconds(mtime).replace(tzinfo=timezone.utc),
+                        e_tag_hash(e_tag), version_id or None, file_object=key, e_tag=e_tag)
+
+
+def repository_entries(repository):
+    """
+    Get the entries of a repository in key order.  Listings of Util.S3Repository.Repository are already
+    in key order and are not sorted again; the list-based repositories of Util.Repository are sorted.
+
+    :param repository: Repository (from Util.Repository or Util.S3Repository)
+    :return: (iterator) DiffEntries
+    """
+    if isinstance(repository, Util.S3Repository.Repository):
+        return _s3_repository_entries(repository)
+    if isinstance(repository, Util.Repository.LocalRepository):
+        return sort_entries(_local_repository_entries(repository))
+    return sort_entries(_versioned_repository_entries(repository))
+
+
+def _s3_repository_entries(repository):
+    for key, o in repository.file_objects.items():
+        if not o.is_deleted:
+            yield DiffEntry(key, o.size, o.time_stamp, e_tag_hash(o.e_tag), file_object=o)
+
+
+def _local_repository_entries(repository):
+    for o in repository.file_objects:
+        key = os.path.relpath(o.full_name, repository.root)
+        if os.sep != '/':
+            key = key.replace(os.sep, '/')
+        yield DiffEntry(key, o.size, o.timestamp.astimezone(timezone.utc), file_object=o)
+
+
+def _versioned_repository_entries(repository):
+    """
+    Get the entry of the latest version of each key of a repository whose file objects are named
+    <key>$<version id> (S3Repository and CachedRepository).
+    """
+    latest = dict()
+    for o in repository.file_objects:
+        key, delimiter, version_id = o.full_name.rpartition('$')
+        if getattr(o, 'is_latest', None) is False:
+            continue
+        current = latest.get(key)
+        if current is None or getattr(o, 'is_latest', False) or o.timestamp > current.timestamp:
+            latest[key] = o
+    for key, o in latest.items():
+        if getattr(o, 'is_delete_marker', False):
+            continue
+        timestamp = o.timestamp
+        if timestamp.tzinfo is None:
+            timestamp = timestamp.replace(tzinfo=timezone.utc)
+        yield DiffEntry(key, o.size, timestamp, e_tag_hash(getattr(o, 'e_tag', None)),
+                        o.full_name.rpartition('$')[2], file_object=o)
@@ -0,0 +1,368 @@
+'''
+In-memory stand-in for the parts of the boto3 S3 client used by CloudSync, with a configurable
+delay per request to simulate round-trip latency.  Buckets keep every version of their objects, unless
+created without versioning.  Used by the unit tests and benchmarks, and anywhere a bucket is needed
+offline: set_client (see S3Client) or the client parameter of an S3Backend.
+'''
+import bisect
+import hashlib
+import io
+import random
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+
+class FakePaginator:
+    def __init__(self, client, operation):
+        self._client = client
+        self._operation = operation
+
+    def paginate(self, Bucket, Prefix='', Delimiter=None, **kwargs):
+        entries = self._client.list_entries(Bucket, Prefix, Delimiter, versions=self._operation == 'list_object_versions')
+        page_size = self._client.page_size
+        for start in range(0, max(len(entries), 1), page_size):
+            self._client.request(self._operation)
+            yield self._make_page(entries[start:start + page_size])
+
+    def _make_page(self, entries):
+        page = {'CommonPrefixes': [{'Prefix': e} for e in entries if isinstance(e, str)]}
+        items = [e for e in entries if not isinstance(e, str)]
+        if self._operation == 'list_object_versions':
+            page['Versions'] = [dict(e) for e in items if 'Size' in e]
+            page['DeleteMarkers'] = [dict(e) for e in items if 'Size' not in e]
+        else:
+            page['Contents'] = [dict(e) for e in items]
+        return page
+
+
+class FakeEvents:
+    '''
+    Stand-in for the botocore event system of a client: handlers registered for an event such as
+    'after-call.s3' get the events below it, such as 'after-call.s3.GetObject'.
+    '''
+    def __init__(self):
+        self._handlers = dict()
+
+    def register(self, event_name, handler, unique_id=None):
+        self._handlers[unique_id or id(handler)] = (event_name, handler)
+
+    def emit(self, event_name, **kwargs):
+        for name, handler in list(self._handlers.values()):
+            if event_name == name or event_name.startswith(name + '.'):
+                handler(event_name=event_name, **kwargs)
+
+
+class FakeOperationModel:
+    def __init__(self, operation):
+        self.name = ''.join(part.capitalize() for part in operation.split('_'))
+
+
+class FakeMeta:
+    def __init__(self):
+        self.events = FakeEvents()
+
+
+class FakeClientError(Exception):
+    def __init__(self, code, operation):
+        super().__init__(f'{code} in {operation}')
+        self.response = {'Error': {'Code': code}}
+
+
+class FakeS3Client:
+    """
+    Fake S3 client.  Object versions are kept per bucket in key order, newest version first.
+    """
+
+    def __init__(self, latency=0.0, page_size=1000, bandwidth=None, jitter=0.0, seed=None):
+        """
+
+        :param latency: (float) Seconds each request takes
+        :param page_size: (int) Maximum entries returned by one listing request
+        :param bandwidth: (int) Bytes per second sent or received by one request (default: unlimited)
+        :param jitter: (float) Up to this many seconds are added at random to the latency of each request
+        :param seed: (int) Seed of the random jitter
+        """
+        self.latency = latency
+        self.page_size = page_size
+        self.bandwidth = bandwidth
+        self.jitter = jitter
+        self.calls = dict()
+        self.bytes_sent = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        # codes returned in turn for keys of delete_objects, as partial failures, before they are deleted
+        self.delete_errors = dict()
+        self._random = random.Random(seed)
+        self._buckets = dict()
+        self._data = dict()
+        self._uploads = dict()
+        self._lock = threading.RLock()
+        self.meta = FakeMeta()
+
+    def create_bucket(self, Bucket, versioning=True):
+        # keys are kept sorted for listings, and sorted again after keys are added or removed
+        self._buckets[Bucket] = {'versioning': versioning, 'objects': dict(), 'sorted_keys': []}
+
+    def add_version(self, bucket_name, key, size=0, last_modified=None, storage_class='STANDARD',
+                    is_delete_marker=False, data=None, e_tag=None, metadata=None):
+        """
+        Store a new version of an object, which becomes the latest version.
+
+        :return: (dict) Listing entry of the new version
+        """
+        with self._lock:
+            bucket = self._buckets[bucket_name]
+            versions = bucket['objects'].get(key)
+            if versions is None:
+                versions = bucket['objects'][key] = []
+                bucket['sorted_keys'] = None
+            if last_modified is None:
+                last_modified = datetime(2019, 1, 1, tzinfo=timezone.utc) + timedelta(seconds=len(versions))
+            if not bucket['versioning']:
+                versions.clear()
+            for v in versions:
+                v['IsLatest'] = False
+            bucket['next_version'] = bucket.get('next_version', 0) + 1
+            version = {'Key': key, 'VersionId': f'{key}-v{bucket["next_version"]}' if bucket['versioning'] else 'null',
+                       'LastModified': last_modified, 'IsLatest': True}
+            if not is_delete_marker:
+                if data is not None:
+                    size = len(data)
+                    if e_tag is None:
+                        e_tag = '"' + hashlib.md5(data).hexdigest() + '"'
+                if e_tag is None:
+                    e_tag = '"' + hashlib.md5(version['VersionId'].encode()).hexdigest() + '"'
+                version.update({'Size': size, 'ETag': e_tag, 'StorageClass': storage_class})
+                self._data[(bucket_name, key, version['VersionId'])] = (data, metadata or {})
+            versions.insert(0, version)
+            return version
+
+    def request(self, operation, size=0):
+        # the events a botocore client emits for each call, with the request's size as its ContentLength
+        model = FakeOperationModel(operation)
+        context = dict()
+        self.meta.events.emit(f'before-parameter-build.s3.{model.name}', params={'ContentLength': size or None},
+                              model=model, context=context)
+        with self._lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+            self.bytes_sent += size
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            delay = self.latency
+            if self.jitter:
+                delay += self._random.uniform(0, self.jitter)
+        if self.bandwidth and size:
+            delay += size / self.bandwidth
+        if delay:
+            time.sleep(delay)
+        with self._lock:
+            self.in_flight -= 1
+        self.meta.events.emit(f'after-call.s3.{model.name}', http_response=None,
+                              parsed={'ResponseMetadata': {'RetryAttempts': 0}}, model=model, context=context)
+
+    def _version(self, bucket_name, key, version_id=None, operation='get_object'):
+        with self._lock:
+            versions = self._buckets[bucket_name]['objects'].get(key, [])
+            for v in versions:
+                if version_id is None or v['VersionId'] == version_id:
+                    if 'Size' not in v:
+                        break
+                    return v
+        raise FakeClientError('NoSuchKey', operation)
+
+    def put_object(self, Bucket, Key, Body=b'', Metadata=None, **kwargs):
+        data = Body if isinstance(Body, bytes) else Body.read()
+        self.request('put_object', len(data))
+        version = self.add_version(Bucket, Key, data=data, last_modified=datetime.now(timezone.utc), metadata=Metadata)
+        return {'ETag': version['ETag'], 'VersionId': version['VersionId']}
+
+    def get_object(self, Bucket, Key, VersionId=None, Range=None, **kwargs):
+        version = self._version(Bucket, Key, VersionId)
+        data, metadata = self._data[(Bucket, Key, version['VersionId'])]
+        if data is None:
+            data = bytes(version['Size'])
+        if Range:
+            start, end = Range[len('bytes='):].split('-')
+            data = data[int(start):int(end) + 1 if end else None]
+        self.request('get_object', len(data))
+        return {'Body': io.BytesIO(data), 'ContentLength': len(data), 'ETag': version['ETag'],
+                'LastModified': version['LastModified'], 'VersionId': version['VersionId'], 'Metadata': metadata}
+
+    def head_object(self, Bucket, Key, VersionId=None, **kwargs):
+        self.request('head_object')
+        version = self._version(Bucket, Key, VersionId, 'head_object')
+        data, metadata = self._data[(Bucket, Key, version['VersionId'])]
+        return {'ContentLength': version['Size'], 'ETag': version['ETag'], 'LastModified': version['LastModified'],
+                'VersionId': version['VersionId'], 'Metadata': metadata}
+
+    def create_multipart_upload(self, Bucket, Key, Metadata=None, **kwargs):
+        self.request('create_multipart_upload')
+        with self._lock:
+            upload_id = f'upload-{len(self._uploads) + 1}'
+            self._uploads[upload_id] = {'Bucket': Bucket, 'Key': Key, 'Parts': dict(), 'Metadata': Metadata,
+                                        'Initiated': datetime.now(timezone.utc)}
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body, **kwargs):
+        data = Body if isinstance(Body, bytes) else Body.read()
+        self.request('upload_part', len(data))
+        e_tag = '"' + hashlib.md5(data).hexdigest() + '"'
+        with self._lock:
+            self._uploads[UploadId]['Parts'][PartNumber] = (data, e_tag)
+        return {'ETag': e_tag}
+
+    def list_multipart_uploads(self, Bucket, Prefix='', **kwargs):
+        self.request('list_multipart_uploads')
+        with self._lock:
+            uploads = [{'Key': u['Key'], 'UploadId': upload_id, 'Initiated': u['Initiated']}
+                       for upload_id, u in self._uploads.items()
+                       if u['Bucket'] == Bucket and u['Key'].startswith(Prefix)]
+        return {'Uploads': uploads}
+
+    def list_parts(self, Bucket, Key, UploadId, PartNumberMarker=0, **kwargs):
+        self.request('list_parts')
+        with self._lock:
+            parts = sorted(self._uploads[UploadId]['Parts'].items())
+        parts = [{'PartNumber': n, 'Size': len(data), 'ETag': e_tag}
+                 for n, (data, e_tag) in parts if n > PartNumberMarker]
+        truncated = len(parts) > self.page_size
+        parts = parts[0:self.page_size]
+        response = {'Parts': parts, 'IsTruncated': truncated}
+        if truncated:
+            response['NextPartNumberMarker'] = parts[-1]['PartNumber']
+        return response
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload, **kwargs):
+        self.request('complete_multipart_upload')
+        with self._lock:
+            upload = self._uploads.pop(UploadId)
+        numbers = [p['PartNumber'] for p in MultipartUpload['Parts']]
+        data = b''.join(upload['Parts'][n][0] for n in numbers)
+        digests = b''.join(hashlib.md5(upload['Parts'][n][0]).digest() for n in numbers)
+        e_tag = f'"{hashlib.md5(digests).hexdigest()}-{len(numbers)}"'
+        version = self.add_version(Bucket, Key, data=data, e_tag=e_tag, last_modified=datetime.now(timezone.utc),
+                                   metadata=upload['Metadata'])
+        return {'ETag': e_tag, 'VersionId': version['VersionId']}
+
+    def _copy_source_data(self, CopySource):
+        version = self._version(CopySource['Bucket'], CopySource['Key'], CopySource.get('VersionId'), 'copy_object')
+        data, metadata = self._data[(CopySource['Bucket'], CopySource['Key'], version['VersionId'])]
+        if data is None:
+            data = bytes(version['Size'])
+        return version, data, metadata
+
+    def copy_object(self, Bucket, Key, CopySource, **kwargs):
+        self.request('copy_object')
+        version, data, metadata = self._copy_source_data(CopySource)
+        copy = self.add_version(Bucket, Key, data=data, e_tag=version['ETag'], last_modified=datetime.now(timezone.utc),
+                                storage_class=version['StorageClass'], metadata=metadata)
+        return {'CopyObjectResult': {'ETag': copy['ETag']}, 'VersionId': copy['VersionId']}
+
+    def upload_part_copy(self, Bucket, Key, UploadId, PartNumber, CopySource, CopySourceRange=None, **kwargs):
+        self.request('upload_part_copy')
+        version, data, metadata = self._copy_source_data(CopySource)
+        if CopySourceRange:
+            start, end = CopySourceRange[len('bytes='):].split('-')
+            data = data[int(start):int(end) + 1 if end else None]
+        e_tag = '"' + hashlib.md5(data).hexdigest() + '"'
+        with self._lock:
+            self._uploads[UploadId]['Parts'][PartNumber] = (data, e_tag)
+        return {'CopyPartResult': {'ETag': e_tag}}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId, **kwargs):
+        self.request('abort_multipart_upload')
+        with self._lock:
+            self._uploads.pop(UploadId, None)
+
+    def delete_objects(self, Bucket, Delete, **kwargs):
+        self.request('delete_objects')
+        if len(Delete['Objects']) > 1000:
+            raise FakeClientError('MalformedXML', 'delete_objects')
+        deleted = []
+        errors = []
+        for o in Delete['Objects']:
+            with self._lock:
+                codes = self.delete_errors.get(o['Key'])
+                if codes:
+                    errors.append(dict(o, Code=codes.pop(0), Message='Injected error'))
+                    continue
+                versions = self._buckets[Bucket]['objects'].get(o['Key'], [])
+                if 'VersionId' in o:
+                    versions[:] = [v for v in versions if v['VersionId'] != o['VersionId']]
+                    if versions and not any(v['IsLatest'] for v in versions):
+                        versions[0]['IsLatest'] = True
+                    if not versions:
+                        self._remove_key(Bucket, o['Key'])
+                elif self._buckets[Bucket]['versioning']:
+                    self.add_version(Bucket, o['Key'], is_delete_marker=True,
+                                     last_modified=datetime.now(timezone.utc))
+                else:
+                    self._remove_key(Bucket, o['Key'])
+            deleted.append(dict(o))
+        response = {'Errors': errors} if errors else {}
+        if not Delete.get('Quiet'):
+            response['Deleted'] = deleted
+        return response
+
+    def get_bucket_versioning(self, Bucket):
+        self.request('get_bucket_versioning')
+        if self._buckets[Bucket]['versioning']:
+            return {'Status': 'Enabled'}
+        return {}
+
+    def get_paginator(self, operation):
+        return FakePaginator(self, operation)
+
+    def _remove_key(self, bucket_name, key):
+        bucket = self._buckets[bucket_name]
+        if bucket['objects'].pop(key, None) is not None:
+            bucket['sorted_keys'] = None
+
+    def add_listing(self, bucket_name, entries):
+        """
+        Store listing entries as they are, without contents, to fill a bucket with many objects quickly.
+
+        :param bucket_name: (string) Name of bucket
+        :param entries: (iterator) Version dicts with Key, VersionId, LastModified, IsLatest, and Size, ETag
+                        and StorageClass unless they are delete markers; the versions of a key newest first
+        """
+        with self._lock:
+            bucket = self._buckets[bucket_name]
+            objects = bucket['objects']
+            for entry in entries:
+                versions = objects.get(entry['Key'])
+                if versions is None:
+                    versions = objects[entry['Key']] = []
+                versions.append(entry)
+            bucket['sorted_keys'] = None
+
+    def list_entries(self, bucket_name, prefix, delimiter, versions=True):
+        """
+        Get the listing entries under a prefix in key order: version dicts, and common prefix strings
+        when a delimiter is given.
+        """
+        entries = []
+        with self._lock:
+            bucket = self._buckets[bucket_name]
+            keys = bucket['sorted_keys']
+            if keys is None:
+                keys = bucket['sorted_keys'] = sorted(bucket['objects'])
+            objects = bucket['objects']
+            position = bisect.bisect_left(keys, prefix)
+            while position < len(keys) and keys[position].startswith(prefix):
+                key = keys[position]
+                position += 1
+                if delimiter:
+                    end = key.find(delimiter, len(prefix))
+                    if end >= 0:
+                        common_prefix = key[0:end + len(delimiter)]
+                        entries.append(common_prefix)
+                        # skip the other keys under the common prefix
+                        position = bisect.bisect_left(keys, common_prefix + '\U0010ffff', position)
+                        continue
+                if versions:
+                    entries.extend(objects[key])
+                elif 'Size' in objects[key][0]:
+                    entries.append(objects[key][0])
+        return entries
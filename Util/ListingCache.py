@@ -0,0 +1,759 @@
+import os
+import sqlite3
+from datetime import datetime, timedelta, timezone
+
+from Util.Metrics import timer
+
+SCHEMA_VERSION = 5
+BULK_BATCH_SIZE = 50000
+FETCH_SIZE = 10000
+SEARCH_LIMIT = 1000
+VERSION_DELIMITER = '$'
+
+_EPOCH = datetime(1970, 1, 1)
+_UTC_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+_MICROSECOND = timedelta(microseconds=1)
+
+
+def epoch_microseconds(timestamp):
+    """
+    Convert a date/time to the integer stored in the cache.  Naive date/times are taken to be UTC, like
+    the timestamps S3 reports.
+
+    :param timestamp: (datetime) Date/time
+    :return: (int) Microseconds since the epoch
+    """
+    if timestamp.tzinfo is not None:
+        return (timestamp - _UTC_EPOCH) // _MICROSECOND
+    return (timestamp - _EPOCH) // _MICROSECOND
+
+
+def from_epoch_microseconds(microseconds):
+    """
+    Convert an integer stored in the cache to a date/time.
+
+    :param microseconds: (int) Microseconds since the epoch
+    :return: (datetime) Naive UTC date/time
+    """
+    return _EPOCH + timedelta(microseconds=microseconds)
+
+
+def split_version_name(full_name):
+    """
+    Split the full name of a cached file object into key and version id.
+
+    :param full_name: (string) <key>$<version id>, or a key without a version
+    :return: (tuple) Key, version id ('' if none)
+    """
+    key, delimiter, version_id = full_name.rpartition(VERSION_DELIMITER)
+    if not delimiter:
+        return full_name, ''
+    return key, version_id
+
+
+class FolderTotals:
+    """
+    Totals of the object versions stored under a folder, in the folder and all its sub-folders.
+    """
+    __slots__ = ('_prefix', '_objects', '_versions', '_size', '_billable_size', '_newest')
+
+    def __init__(self, prefix, objects=0, versions=0, size=0, billable_size=0, newest=None):
+        """
+
+        :param prefix: (string) Folder prefix, with trailing delimiter ('' for the root)
+        :param objects: (int) Number of keys
+        :param versions: (int) Number of versions, including noncurrent versions and delete markers
+        :param size: (int) Total size of versions, in bytes
+        :param billable_size: (int) Total size versions are billed for, in bytes (see S3StorageClass)
+        :param newest: (int) Newest modification time (microseconds since the epoch), None if no versions
+        """
+        self._prefix = prefix
+        self._objects = objects
+        self._versions = versions
+        self._size = size
+        self._billable_size = billable_size
+        self._newest = newest
+
+    @property
+    def prefix(self):
+        return self._prefix
+
+    @property
+    def objects(self):
+        return self._objects
+
+    @property
+    def versions(self):
+        return self._versions
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def billable_size(self):
+        return self._billable_size
+
+    @property
+    def newest(self):
+        """
+        Get the modification time of the newest version under the folder.
+
+        :return: (datetime) Naive UTC date/time, or None if the folder has no versions
+        """
+        if self._newest is None:
+            return None
+        return from_epoch_microseconds(self._newest)
+
+
+class ListingCache:
+    """
+    SQLite cache of the object versions of a bucket.  Folders, objects and versions are kept in
+    separate tables:
+
+    - Folders: one row per folder prefix (with trailing delimiter, '' for the root), with its parent and
+      the totals of the folder's sub-tree (objects, versions, size, billable size and newest modification
+      time), so the size of any prefix is read from one row (see folder_totals).  The totals are computed
+      when a cache is built and updated by every change to its rows
+    - Objects: one row per key, with its folder; the full key is kept so the cache can be read in key order
+    - Versions: one row per version, with size, modification time (microseconds since the epoch), ETag,
+      storage class and flags; the VersionsTimeline index keeps the versions of each object sorted by
+      time, so the version current at any time is found with one index seek per key (see snapshot)
+    - KeySearch: FTS5 trigram index of the keys of Objects, kept up to date by triggers, so keys containing
+      a text are found without reading every key (see key_search_condition)
+
+    The schema version is kept in PRAGMA user_version.  Caches written by earlier versions (a single
+    FileObjects table) are migrated when they are opened.
+    """
+    PRAGMAS = ('PRAGMA journal_mode=WAL', 'PRAGMA synchronous=NORMAL', 'PRAGMA temp_store=MEMORY',
+               'PRAGMA cache_size=-65536', 'PRAGMA mmap_size=268435456')
+    VERSION_COLUMNS = 'o.Key, v.VersionId, v.Size, v.MTime, v.ETag, v.StorageClass, v.IsLatest, v.IsDeleteMarker'
+    TOTAL_COLUMNS = ('ObjectCount', 'VersionCount', 'TotalSize', 'BillableSize', 'NewestMTime')
+    _billable_size_sql = None
+
+    def __init__(self, database_name, path_delimiter='/', indexes=True):
+        """
+        Open a cache, creating or migrating its schema if needed.
+
+        :param database_name: (string) Name of cache database
+        :param path_delimiter: (string) Delimiter between folders in keys
+        :param indexes: (bool) Create the indexes of a new cache (False when they're created after loading)
+        """
+        self._db = sqlite3.connect(database_name)
+        self._path_delimiter = path_delimiter
+        for pragma in self.PRAGMAS:
+            self._db.execute(pragma)
+        version = self._db.execute('PRAGMA user_version').fetchone()[0]
+        if version < SCHEMA_VERSION:
+            old_table = self._db.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='FileObjects'")
+            migrate = old_table.fetchone() is not None
+            self._create_schema()
+            if migrate:
+                self._migrate_file_objects()
+            if indexes or migrate:
+                self._create_indexes()
+                self.create_key_search()
+                self.build_folder_totals()
+            self._db.execute(f'PRAGMA user_version={SCHEMA_VERSION}')
+            self._db.commit()
+        elif version > SCHEMA_VERSION:
+            raise Exception(f'Cache {database_name} was written by a newer version (schema {version})')
+        self._folder_ids = dict()
+        self._object_ids = dict()
+        self._folder_parents = dict()
+        self._fresh = False
+        self._has_key_search = None
+
+    @classmethod
+    def build(cls, database_name, file_objects, path_delimiter='/'):
+        """
+        Write a new cache, replacing any existing one.  Rows are inserted with executemany in large
+        batches and the indexes are created after all rows are loaded, all in one transaction.
+
+        :param database_name: (string) Name of cache database
+        :param file_objects: (iterator) S3FileObjects (or FileObjects named <key>$<version id>)
+        :param path_delimiter: (string) Delimiter between folders in keys
+        :return: (ListingCache) Open cache
+        """
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(database_name + suffix):
+                os.remove(database_name + suffix)
+        cache = cls(database_name, path_delimiter, indexes=False)
+        # a cache being built from scratch is simply rebuilt if the build is interrupted
+        cache._db.execute('PRAGMA synchronous=OFF')
+        cache._fresh = True
+        cache.add_file_objects(file_objects)
+        cache._end_fresh()
+        with timer('cache_write', step='indexes'):
+            cache._create_indexes()
+            cache.create_key_search()
+            cache.build_folder_totals()
+            cache._db.commit()
+        cache._db.execute('PRAGMA synchronous=NORMAL')
+        return cache
+
+    @property
+    def db(self):
+        return self._db
+
+    def _create_schema(self):
+        self._db.execute('''CREATE TABLE IF NOT EXISTS "Folders" (
+                "FolderId"      INTEGER PRIMARY KEY,
+                "Prefix"        TEXT NOT NULL,
+                "ParentId"      INTEGER,
+                "ObjectCount"   INTEGER NOT NULL DEFAULT 0,
+                "VersionCount"  INTEGER NOT NULL DEFAULT 0,
+                "TotalSize"     INTEGER NOT NULL DEFAULT 0,
+                "BillableSize"  INTEGER NOT NULL DEFAULT 0,
+                "NewestMTime"   INTEGER
+                )''')
+        # totals added in schema 5
+        columns = set(row[1] for row in self._db.execute('PRAGMA table_info("Folders")'))
+        for column in self.TOTAL_COLUMNS:
+            if column not in columns:
+                default = '' if column == 'NewestMTime' else ' NOT NULL DEFAULT 0'
+                self._db.execute(f'ALTER TABLE "Folders" ADD COLUMN "{column}" INTEGER{default}')
+        self._db.execute('''CREATE TABLE IF NOT EXISTS "Objects" (
+                "ObjectId"  INTEGER PRIMARY KEY,
+                "FolderId"  INTEGER NOT NULL,
+                "Key"       TEXT NOT NULL
+                )''')
+        self._db.execute('''CREATE TABLE IF NOT EXISTS "Versions" (
+                "ObjectId"          INTEGER NOT NULL,
+                "VersionId"         TEXT NOT NULL,
+                "Size"              INTEGER NOT NULL,
+                "MTime"             INTEGER NOT NULL,
+                "ETag"              TEXT,
+                "StorageClass"      INTEGER NOT NULL DEFAULT 1,
+                "IsLatest"          INTEGER NOT NULL DEFAULT 1,
+                "IsDeleteMarker"    INTEGER NOT NULL DEFAULT 0
+                )''')
+        self._db.execute('''CREATE TABLE IF NOT EXISTS "PrefixCheckpoints" (
+                "Prefix"    TEXT PRIMARY KEY,
+                "Count"     INTEGER,
+                "Newest"    TEXT,
+                "Digest"    TEXT
+                )''')
+
+    def _create_indexes(self):
+        self._db.execute('CREATE UNIQUE INDEX IF NOT EXISTS "FoldersPrefix" ON "Folders" ("Prefix")')
+        self._db.execute('CREATE INDEX IF NOT EXISTS "FoldersParent" ON "Folders" ("ParentId")')
+        self._db.execute('CREATE UNIQUE INDEX IF NOT EXISTS "ObjectsKey" ON "Objects" ("Key")')
+        self._db.execute('CREATE INDEX IF NOT EXISTS "ObjectsFolder" ON "Objects" ("FolderId")')
+        # replaced by VersionsTimeline in schema 3
+        self._db.execute('DROP INDEX IF EXISTS "VersionsObject"')
+        self._db.execute('CREATE INDEX IF NOT EXISTS "VersionsTimeline" ON "Versions" ("ObjectId", "MTime")')
+        self._db.execute('CREATE INDEX IF NOT EXISTS "VersionsMTime" ON "Versions" ("MTime")')
+
+    def create_key_search(self):
+        """
+        Create the KeySearch index of the keys already in Objects, and the triggers that keep it up to date.
+        SQLite builds without FTS5 or its trigram tokenizer (before 3.34) get no index, and keys are
+        searched by reading every key instead.
+
+        :return: (bool) True if the cache has a KeySearch index
+        """
+        self._has_key_search = None
+        if self.has_key_search:
+            return True
+        try:
+            self._db.execute('''CREATE VIRTUAL TABLE "KeySearch" USING fts5("Key", content='Objects',
+                                    content_rowid='ObjectId', tokenize='trigram')''')
+        except sqlite3.OperationalError:
+            return False
+        self._db.execute("INSERT INTO KeySearch(KeySearch) VALUES('rebuild')")
+        self._db.execute('''CREATE TRIGGER IF NOT EXISTS "ObjectsSearchInsert" AFTER INSERT ON "Objects" BEGIN
+                                INSERT INTO KeySearch(rowid, Key) VALUES (new.ObjectId, new.Key); END''')
+        self._db.execute('''CREATE TRIGGER IF NOT EXISTS "ObjectsSearchDelete" AFTER DELETE ON "Objects" BEGIN
+                                INSERT INTO KeySearch(KeySearch, rowid, Key) VALUES ('delete', old.ObjectId, old.Key);
+                                END''')
+        self._has_key_search = True
+        return True
+
+    @property
+    def has_key_search(self):
+        if self._has_key_search is None:
+            row = self._db.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='KeySearch'").fetchone()
+            self._has_key_search = row is not None
+        return self._has_key_search
+
+    def key_search_condition(self, text):
+        """
+        Get the SQL condition selecting the objects whose keys contain every word of a search text, ignoring
+        case.  Words of three or more characters are looked up in the KeySearch index; shorter words, which
+        the trigram index can't find, are matched against the keys the index selects, or every key if no
+        word is long enough.
+
+        :param text: (string) Words to search for, separated by spaces
+        :return: (tuple) SQL condition on o (Objects) and its parameters, ('', ()) if text has no words
+        """
+        conditions = []
+        parameters = []
+        indexed = []
+        for word in text.split():
+            if len(word) >= 3 and self.has_key_search:
+                indexed.append('"' + word.replace('"', '""') + '"')
+            else:
+                conditions.append("o.Key LIKE ? ESCAPE '\\'")
+                escaped = word.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+                parameters.append('%' + escaped + '%')
+        if indexed:
+            conditions.insert(0, 'o.ObjectId IN (SELECT rowid FROM KeySearch WHERE KeySearch MATCH ?)')
+            parameters.insert(0, ' '.join(indexed))
+        return ' AND '.join(conditions), tuple(parameters)
+
+    def search_keys(self, text, limit=SEARCH_LIMIT):
+        """
+        Find the keys that contain every word of a search text (see key_search_condition).
+
+        :param text: (string) Words to search for, separated by spaces
+        :param limit: (int) Maximum number of keys returned
+        :return: (list) Keys, in the order they were added to the cache (key order for a cache built from
+                 a listing)
+        """
+        condition, parameters = self.key_search_condition(text)
+        if not condition:
+            return []
+        cursor = self._db.execute(f'SELECT o.Key FROM Objects o WHERE {condition} ORDER BY o.ObjectId LIMIT ?',
+                                  parameters + (limit,))
+        return [row[0] for row in cursor.fetchall()]
+
+    @classmethod
+    def billable_size_sql(cls):
+        """
+        Get the SQL expression of the billable size of a version v, with the minimum object size and archive
+        overhead of its storage class (see S3StorageClass.billable_size).  Delete markers are not billed.
+
+        :return: (string) SQL expression on v (Versions)
+        """
+        if cls._billable_size_sql is None:
+            # imported here, as Repository imports this module
+            from Util.Repository import S3StorageClass
+            minimums = ' '.join(f'WHEN {c.value} THEN {c.min_billable_size}' for c in S3StorageClass
+                                if c.min_billable_size)
+            overheads = ' '.join(f'WHEN {c.value} THEN {c.overhead_size}' for c in S3StorageClass if c.overhead_size)
+            cls._billable_size_sql = (f'(CASE WHEN v.IsDeleteMarker THEN 0 ELSE MAX(v.Size, CASE v.StorageClass '
+                                      f'{minimums} ELSE 0 END) + CASE v.StorageClass {overheads} ELSE 0 END END)')
+        return cls._billable_size_sql
+
+    def build_folder_totals(self):
+        """
+        Compute the totals of every folder from all versions: the totals of the versions of the objects in
+        each folder, with one aggregate query, then added up from the deepest folders to the root.  Changes
+        are not committed.
+        """
+        totals = dict()
+        parents = dict()
+        for folder_id, parent_id, prefix in self._db.execute('SELECT FolderId, ParentId, Prefix FROM Folders'):
+            totals[folder_id] = [0, 0, 0, 0, None]
+            parents[folder_id] = (len(prefix), parent_id)
+        for folder_id, objects in self._db.execute('SELECT FolderId, COUNT(*) FROM Objects GROUP BY FolderId'):
+            totals[folder_id][0] = objects
+        for folder_id, versions, size, billable_size, newest in self._db.execute(
+                f'''SELECT o.FolderId, COUNT(*), TOTAL(v.Size), TOTAL({self.billable_size_sql()}), MAX(v.MTime)
+                    FROM Versions v JOIN Objects o ON o.ObjectId = v.ObjectId GROUP BY o.FolderId'''):
+            totals[folder_id][1:] = [versions, int(size), int(billable_size), newest]
+        # a sub-folder's prefix is longer than its parent's
+        for folder_id in sorted(totals, key=lambda f: parents[f][0], reverse=True):
+            parent_id = parents[folder_id][1]
+            if parent_id is not None:
+                self._add_totals(totals[parent_id], totals[folder_id])
+        self._db.executemany('''UPDATE Folders SET ObjectCount=?, VersionCount=?, TotalSize=?, BillableSize=?,
+                                    NewestMTime=? WHERE FolderId=?''',
+                             (tuple(total) + (folder_id,) for folder_id, total in totals.items()))
+
+    @staticmethod
+    def _add_totals(total, other):
+        for n in range(4):
+            total[n] += other[n]
+        if other[4] is not None and (total[4] is None or other[4] > total[4]):
+            total[4] = other[4]
+
+    def folder_totals(self, prefix):
+        """
+        Get the totals of a folder's sub-tree, read from its row.
+
+        :param prefix: (string) Folder prefix, with trailing delimiter ('' for the root)
+        :return: (FolderTotals) Totals of folder, or None if folder not in cache
+        """
+        row = self._db.execute(f'SELECT Prefix, {", ".join(self.TOTAL_COLUMNS)} FROM Folders WHERE Prefix=?',
+                               (prefix,)).fetchone()
+        if row is None:
+            return None
+        return FolderTotals(*row)
+
+    def sub_folder_totals(self, prefix):
+        """
+        Get the totals of the sub-folders of a folder, for a folder tree.
+
+        :param prefix: (string) Folder prefix, with trailing delimiter ('' for the root)
+        :return: (list) FolderTotals of each sub-folder, in prefix order
+        """
+        folder_id = self.find_folder(prefix)
+        if folder_id is None:
+            return []
+        cursor = self._db.execute(f'SELECT Prefix, {", ".join(self.TOTAL_COLUMNS)} FROM Folders WHERE ParentId=? '
+                                  'ORDER BY Prefix', (folder_id,))
+        return [FolderTotals(*row) for row in cursor.fetchall()]
+
+    def _folder_parent(self, folder_id):
+        if folder_id not in self._folder_parents:
+            row = self._db.execute('SELECT ParentId FROM Folders WHERE FolderId=?', (folder_id,)).fetchone()
+            self._folder_parents[folder_id] = row[0] if row is not None else None
+        return self._folder_parents[folder_id]
+
+    def _update_folder_totals(self, changes, removed_newest=None):
+        """
+        Add the changes of some folders to their totals and the totals of their parent folders.  A folder
+        whose newest version may have been deleted gets its newest modification time read again, from the
+        versions of its objects and the totals of its sub-folders.
+
+        :param changes: (dict) Totals to add of each folder id: list of objects, versions, size, billable
+                        size (negative when removed) and newest modification time added (or None)
+        :param removed_newest: (dict) Newest modification time deleted from each folder id
+        """
+        totals = dict()
+        removed = dict()
+        for folder_id, change in changes.items():
+            newest = None if removed_newest is None else removed_newest.get(folder_id)
+            while folder_id is not None:
+                self._add_totals(totals.setdefault(folder_id, [0, 0, 0, 0, None]), change)
+                if newest is not None and (folder_id not in removed or newest > removed[folder_id]):
+                    removed[folder_id] = newest
+                folder_id = self._folder_parent(folder_id)
+        self._db.executemany('''UPDATE Folders SET ObjectCount=ObjectCount+?1, VersionCount=VersionCount+?2,
+                                    TotalSize=TotalSize+?3, BillableSize=BillableSize+?4,
+                                    NewestMTime=CASE WHEN NewestMTime IS NULL OR ?5 > NewestMTime THEN ?5
+                                                ELSE NewestMTime END
+                                    WHERE FolderId=?6''',
+                             (tuple(total) + (folder_id,) for folder_id, total in totals.items()))
+        stale = []
+        for folder_id, newest in removed.items():
+            row = self._db.execute('SELECT Prefix, NewestMTime FROM Folders WHERE FolderId=?', (folder_id,)).fetchone()
+            if row is not None and row[1] is not None and newest >= row[1]:
+                stale.append((len(row[0]), folder_id))
+        # sub-folders before their parents, whose newest time depends on theirs
+        for length, folder_id in sorted(stale, reverse=True):
+            times = [self._db.execute('''SELECT MAX(v.MTime) FROM Objects o JOIN Versions v ON v.ObjectId = o.ObjectId
+                                             WHERE o.FolderId = ?''', (folder_id,)).fetchone()[0],
+                     self._db.execute('SELECT MAX(NewestMTime) FROM Folders WHERE ParentId = ?',
+                                      (folder_id,)).fetchone()[0]]
+            times = [t for t in times if t is not None]
+            self._db.execute('UPDATE Folders SET NewestMTime=? WHERE FolderId=?',
+                             (max(times) if times else None, folder_id))
+
+    def _migrate_file_objects(self):
+        """
+        Move the rows of a FileObjects(Name, Size, Time) table written by an earlier version into the
+        normalized tables.  Only names, sizes and times were cached, so versions get the default
+        storage class and flags.
+        """
+        self._folder_ids = dict()
+        self._object_ids = dict()
+        self._fresh = True
+        cursor = self._db.execute('SELECT Name, Size, Time FROM FileObjects')
+        rows = cursor.fetchmany(FETCH_SIZE)
+        while rows:
+            self.add_rows((split_version_name(name) + (size, epoch_microseconds(datetime.fromisoformat(time)),
+                                                       None, 1, 1, 0))
+                          for name, size, time in rows)
+            rows = cursor.fetchmany(FETCH_SIZE)
+        self._end_fresh()
+        self._db.execute('DROP TABLE FileObjects')
+
+    def folder_prefix(self, key):
+        """
+        Get the folder prefix of a key.
+
+        :param key: (string) Object key
+        :return: (string) Folder prefix, with trailing delimiter ('' for the root)
+        """
+        position = key.rfind(self._path_delimiter)
+        if position < 0:
+            return ''
+        return key[0:position + len(self._path_delimiter)]
+
+    def find_folder(self, prefix):
+        """
+        Get the id of a folder.
+
+        :param prefix: (string) Folder prefix, with trailing delimiter ('' for the root)
+        :return: (int) Folder id, or None if folder not in cache
+        """
+        folder_id = self._folder_ids.get(prefix)
+        if folder_id is None and not self._fresh:
+            row = self._db.execute('SELECT FolderId FROM Folders WHERE Prefix=?', (prefix,)).fetchone()
+            if row is not None:
+                folder_id = self._folder_ids[prefix] = row[0]
+        return folder_id
+
+    def folder_id(self, prefix):
+        """
+        Get the id of a folder, adding it and its parent folders if needed.
+
+        :param prefix: (string) Folder prefix, with trailing delimiter ('' for the root)
+        :return: (int) Folder id
+        """
+        folder_id = self.find_folder(prefix)
+        if folder_id is None:
+            parent_id = None
+            if prefix:
+                parent_id = self.folder_id(self.folder_prefix(prefix[0:-len(self._path_delimiter)]))
+            cursor = self._db.execute('INSERT INTO Folders(Prefix, ParentId) VALUES(?,?)', (prefix, parent_id))
+            folder_id = self._folder_ids[prefix] = cursor.lastrowid
+        return folder_id
+
+    def list_folder(self, prefix):
+        """
+        Read the versions of the objects directly in a folder, and its sub-folders, through the folder
+        indexes.
+
+        :param prefix: (string) Folder prefix, with trailing delimiter ('' for the root)
+        :return: (tuple) list of versions (as returned by versions), in key order; list of sub-folder prefixes
+        """
+        folder_id = self.find_folder(prefix)
+        if folder_id is None:
+            return [], []
+        rows = list(self.versions('o.FolderId = ?', (folder_id,), 'ORDER BY o.Key'))
+        folders = [row[0] for row in self._db.execute('SELECT Prefix FROM Folders WHERE ParentId=? ORDER BY Prefix',
+                                                      (folder_id,))]
+        return rows, folders
+
+    def prefix_condition(self, prefix):
+        """
+        Get the SQL condition selecting the objects whose keys start with a prefix.
+
+        :param prefix: (string) Prefix, '' for all objects
+        :return: (tuple) SQL condition on o.Key and its parameters
+        """
+        if prefix == '':
+            return '', ()
+        # all keys under prefix sort between prefix and prefix with its last character incremented
+        upper = prefix[0:-1] + chr(ord(prefix[-1]) + 1)
+        return 'o.Key >= ? AND o.Key < ?', (prefix, upper)
+
+    def add_file_objects(self, file_objects):
+        """
+        Add the versions of file objects.
+
+        :param file_objects: (iterator) S3FileObjects (or FileObjects named <key>$<version id>)
+        :return: (int) Number of versions added
+        """
+        return self.add_rows(self._file_object_rows(file_objects))
+
+    @staticmethod
+    def _file_object_rows(file_objects):
+        for o in file_objects:
+            key, version_id = split_version_name(o.full_name)
+            is_delete_marker = getattr(o, 'is_delete_marker', False)
+            yield (key, version_id, None if is_delete_marker else o.size, epoch_microseconds(o.timestamp),
+                   getattr(o, 'e_tag', None), getattr(o, 'storage_class', None), getattr(o, 'is_latest', True),
+                   is_delete_marker)
+
+    def add_rows(self, rows):
+        """
+        Add versions, inserting them with executemany in batches of BULK_BATCH_SIZE.  Changes are not
+        committed.
+
+        :param rows: (iterator) Tuples of key, version id, size (None for delete markers), modification
+                     time (microseconds since the epoch), ETag, storage class (S3StorageClass or its
+                     value, None for STANDARD), is latest, is delete marker
+        :return: (int) Number of versions added
+        """
+        next_object_id = self._db.execute('SELECT IFNULL(MAX(ObjectId), 0) + 1 FROM Objects').fetchone()[0]
+        delimiter_length = len(self._path_delimiter)
+        object_ids = self._object_ids
+        folder_ids = self._folder_ids
+        count = 0
+        new_objects = []
+        versions = []
+        for key, version_id, size, mtime, e_tag, storage_class, is_latest, is_delete_marker in rows:
+            object_id = object_ids.get(key)
+            if object_id is None and not self._fresh:
+                row = self._db.execute('SELECT ObjectId FROM Objects WHERE Key=?', (key,)).fetchone()
+                if row is not None:
+                    object_id = object_ids[key] = row[0]
+            if object_id is None:
+                object_id = object_ids[key] = next_object_id
+                next_object_id += 1
+                position = key.rfind(self._path_delimiter)
+                prefix = key[0:position + delimiter_length] if position >= 0 else ''
+                folder_id = folder_ids.get(prefix)
+                if folder_id is None:
+                    folder_id = self.folder_id(prefix)
+                new_objects.append((object_id, folder_id, key))
+            if storage_class is None:
+                storage_class = 1
+            elif not isinstance(storage_class, int):
+                storage_class = storage_class.value
+            versions.append((object_id, version_id, size or 0, mtime, e_tag, storage_class,
+                             1 if is_latest else 0, 1 if is_delete_marker else 0))
+            if len(versions) >= BULK_BATCH_SIZE:
+                count += self._insert(new_objects, versions)
+                new_objects = []
+                versions = []
+        count += self._insert(new_objects, versions)
+        return count
+
+    def _end_fresh(self):
+        # the ids of all keys were only kept while the cache was being filled from scratch
+        self._fresh = False
+        self._object_ids.clear()
+
+    def _insert(self, new_objects, versions):
+        with timer('cache_write', rows=len(versions)):
+            return self._insert_rows(new_objects, versions)
+
+    def _insert_rows(self, new_objects, versions):
+        first_row_id = self._db.execute('SELECT IFNULL(MAX(rowid), 0) + 1 FROM Versions').fetchone()[0]
+        self._db.executemany('INSERT INTO Objects(ObjectId, FolderId, Key) VALUES(?,?,?)', new_objects)
+        self._db.executemany('''INSERT INTO Versions(ObjectId, VersionId, Size, MTime, ETag, StorageClass,
+                                    IsLatest, IsDeleteMarker) VALUES(?,?,?,?,?,?,?,?)''', versions)
+        # the totals of a cache being filled from scratch are computed once it is full
+        if not self._fresh and versions:
+            changes = dict()
+            for object_id, folder_id, key in new_objects:
+                changes.setdefault(folder_id, [0, 0, 0, 0, None])[0] += 1
+            # new versions get the highest rowids
+            for folder_id, count, size, billable_size, newest in self._db.execute(
+                    f'''SELECT o.FolderId, COUNT(*), TOTAL(v.Size), TOTAL({self.billable_size_sql()}), MAX(v.MTime)
+                        FROM Versions v JOIN Objects o ON o.ObjectId = v.ObjectId WHERE v.rowid >= ?
+                        GROUP BY o.FolderId''', (first_row_id,)):
+                changes.setdefault(folder_id, [0, 0, 0, 0, None])[1:] = [count, int(size), int(billable_size), newest]
+            self._update_folder_totals(changes)
+        return len(versions)
+
+    def clear(self):
+        """
+        Delete every folder, object, version and checkpoint, keeping the schema, so connections already
+        reading the cache see it empty instead of failing.  Changes are not committed.
+        """
+        for table in ('Versions', 'Objects', 'Folders', 'PrefixCheckpoints'):
+            self._db.execute(f'DELETE FROM "{table}"')
+        self._folder_ids.clear()
+        self._object_ids.clear()
+        self._folder_parents.clear()
+
+    def delete_versions(self, row_ids):
+        """
+        Delete versions, and the objects and folders left empty.  Changes are not committed.
+
+        :param row_ids: (iterator) rowid of each version to delete
+        """
+        object_ids = set()
+        changes = dict()
+        removed_newest = dict()
+        for row_id in row_ids:
+            row = self._db.execute(f'''SELECT v.ObjectId, o.FolderId, v.Size, {self.billable_size_sql()}, v.MTime
+                                           FROM Versions v JOIN Objects o ON o.ObjectId = v.ObjectId
+                                           WHERE v.rowid=?''', (row_id,)).fetchone()
+            if row is not None:
+                object_id, folder_id, size, billable_size, mtime = row
+                object_ids.add(object_id)
+                self._db.execute('DELETE FROM Versions WHERE rowid=?', (row_id,))
+                change = changes.setdefault(folder_id, [0, 0, 0, 0, None])
+                change[1] -= 1
+                change[2] -= size
+                change[3] -= billable_size
+                removed_newest[folder_id] = max(mtime, removed_newest.get(folder_id, mtime))
+        folder_ids = set()
+        for object_id in object_ids:
+            if self._db.execute('SELECT 1 FROM Versions WHERE ObjectId=? LIMIT 1', (object_id,)).fetchone() is None:
+                row = self._db.execute('SELECT FolderId FROM Objects WHERE ObjectId=?', (object_id,)).fetchone()
+                self._db.execute('DELETE FROM Objects WHERE ObjectId=?', (object_id,))
+                folder_ids.add(row[0])
+                changes[row[0]][0] -= 1
+        self._update_folder_totals(changes, removed_newest)
+        for folder_id in folder_ids:
+            self._remove_empty_folders(folder_id)
+        self._object_ids.clear()
+        self._folder_ids.clear()
+        self._folder_parents.clear()
+
+    def _remove_empty_folders(self, folder_id):
+        """
+        Remove a folder if it has no objects or sub-folders, and then its parent if it's left empty.
+        """
+        while folder_id is not None:
+            if self._db.execute('SELECT 1 FROM Objects WHERE FolderId=? LIMIT 1', (folder_id,)).fetchone() or \
+                    self._db.execute('SELECT 1 FROM Folders WHERE ParentId=? LIMIT 1', (folder_id,)).fetchone():
+                return
+            row = self._db.execute('SELECT ParentId FROM Folders WHERE FolderId=?', (folder_id,)).fetchone()
+            if row is None:
+                return
+            self._db.execute('DELETE FROM Folders WHERE FolderId=?', (folder_id,))
+            folder_id = row[0]
+
+    def versions(self, condition='', parameters=(), order=''):
+        """
+        Read versions in batches of FETCH_SIZE rows.
+
+        :param condition: (string) SQL condition on o (Objects) and v (Versions), or '' for all versions
+        :param parameters: (tuple) Parameters of condition
+        :param order: (string) SQL ORDER BY clause, or '' for storage order
+        :return: (iterator) Tuples of key, version id, size, modification time, ETag, storage class value,
+                 is latest, is delete marker and rowid of version
+        """
+        where = f'WHERE {condition}' if condition else ''
+        cursor = self._db.execute(f'SELECT {self.VERSION_COLUMNS}, v.rowid FROM Versions v '
+                                  f'JOIN Objects o ON o.ObjectId = v.ObjectId {where} {order}', parameters)
+        rows = cursor.fetchmany(FETCH_SIZE)
+        while rows:
+            yield from rows
+            rows = cursor.fetchmany(FETCH_SIZE)
+
+    def timeline(self, key):
+        """
+        Get the versions of one object in the order they were stored.
+
+        :param key: (string) Key of object
+        :return: (list) Versions (as returned by versions), oldest first
+        """
+        return list(self.versions('o.Key = ?', (key,), 'ORDER BY v.MTime, v.rowid DESC'))
+
+    def snapshot(self, timestamp, prefix=''):
+        """
+        Get the state of the objects under a prefix at a time: for each key, the newest version stored at
+        or before the time.  The version of each key is found with one seek of the VersionsTimeline index
+        (a binary search of the timeline of the key), in a single query that reads the keys in order.
+        Keys that did not exist at the time, or whose version at the time is a delete marker, are left out.
+        Versions stored in the same microsecond are taken in listing order, newest first.
+
+        :param timestamp: (datetime) Time of snapshot (naive date/times are taken to be UTC)
+        :param prefix: (string) Prefix of keys, '' for all objects
+        :return: (iterator) Versions (as returned by versions), in key order
+        """
+        condition, parameters = self.prefix_condition(prefix)
+        where = f'WHERE {condition}' if condition else ''
+        cursor = self._db.execute(f'SELECT {self.VERSION_COLUMNS}, v.rowid FROM Objects o '
+                                  'JOIN Versions v ON v.rowid = (SELECT t.rowid FROM Versions t '
+                                  'WHERE t.ObjectId = o.ObjectId AND t.MTime <= ? ORDER BY t.MTime DESC, t.rowid LIMIT 1) '
+                                  f'{where} ORDER BY o.Key', (epoch_microseconds(timestamp),) + parameters)
+        rows = cursor.fetchmany(FETCH_SIZE)
+        while rows:
+            for row in rows:
+                if not row[7]:
+                    yield row
+            rows = cursor.fetchmany(FETCH_SIZE)
+
+    def commit(self):
+        self._db.commit()
+
+    def close(self, commit=True):
+        """
+        Close the cache.
+
+        :param commit: (bool) Commit the changes since the last commit, instead of rolling them back
+        """
+        if commit:
+            self._db.commit()
+        else:
+            self._db.rollback()
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # a failure part-way through a change leaves the cache as it was at the last commit
+        self.close(commit=exc_type is None)
@@ -0,0 +1,253 @@
+from collections import OrderedDict
+
+from Util.ListingCache import ListingCache, FolderTotals, VERSION_DELIMITER, from_epoch_microseconds
+from Util.Metrics import timer
+from Util.Repository import S3StorageClass
+
+DEFAULT_PAGE_SIZE = 200
+DEFAULT_CACHE_ROWS = 2000
+
+
+class ListingView:
+    """
+    Sortable, read-only view of the rows of a listing cache database, for a virtual list control.  Rows
+    are read a page at a time in the order of an indexed column, and the most recently rendered rows are
+    kept in a small LRU cache, so showing a row costs the same however many rows the listing has.
+
+    Pages are read with keyset pagination (the rows after the last row of the previous page) when the
+    previous page has been read, which is the case while scrolling; a jump to a distant row reads its
+    page by offset.  Rows can be limited to the keys under a folder, and to the keys containing the words
+    of a search, found through the KeySearch index of the cache.  The count and total size of a folder
+    are read from its totals in the cache, so only those of a search are counted row by row.
+    """
+    COLUMNS = ('Key', 'Size', 'Timestamp', 'Class', 'BillableSize')
+    # indexed column of the cache each list column is sorted by (None: can't be sorted); the billable size
+    # depends on the storage class, so it isn't in the same order as any column
+    SORT_COLUMNS = ('o.Key', 'v.Size', 'v.MTime', None, None)
+
+    def __init__(self, cache, page_size=DEFAULT_PAGE_SIZE, cache_rows=DEFAULT_CACHE_ROWS):
+        """
+
+        :param cache: (ListingCache) Cache to show, or (string) name of cache database
+        :param page_size: (int) Number of rows read by one query
+        :param cache_rows: (int) Number of rendered rows kept
+        """
+        if not isinstance(cache, ListingCache):
+            cache = ListingCache(cache)
+        self._cache = cache
+        self._db = cache.db
+        self._page_size = page_size
+        self._cache_rows = max(cache_rows, page_size)
+        self._sort_column = 0
+        self._ascending = True
+        self._count = None
+        self._total_size = None
+        self._rows = OrderedDict()
+        self._page_ends = dict()
+        self._prefix = ''
+        self._search_text = ''
+        self._condition = ''
+        self._parameters = ()
+
+    @classmethod
+    def from_file_objects(cls, file_objects, page_size=DEFAULT_PAGE_SIZE, cache_rows=DEFAULT_CACHE_ROWS):
+        """
+        Get a view of file objects that are not cached in a database, such as those of a local folder,
+        through an in-memory cache.
+
+        :param file_objects: (iterator) FileObjects
+        :return: (ListingView) View of file objects
+        """
+        return cls(ListingCache.build(':memory:', file_objects), page_size, cache_rows)
+
+    @property
+    def cache(self):
+        return self._cache
+
+    @property
+    def count(self):
+        """
+        Get the number of rows.
+
+        :return: (int) Number of rows
+        """
+        if self._count is None:
+            if self._search_text:
+                self._count = self._db.execute(f'SELECT COUNT(*) FROM Versions v JOIN Objects o ON o.ObjectId = '
+                                               f'v.ObjectId WHERE {self._condition}', self._parameters).fetchone()[0]
+            else:
+                self._count = self.folder_totals.versions
+        return self._count
+
+    @property
+    def total_size(self):
+        """
+        Get the total size of all rows.
+
+        :return: (int) Total size, in bytes
+        """
+        if self._total_size is None:
+            if self._search_text:
+                self._total_size = int(self._db.execute(f'SELECT TOTAL(v.Size) FROM Versions v JOIN Objects o ON '
+                                                        f'o.ObjectId = v.ObjectId WHERE {self._condition}',
+                                                        self._parameters).fetchone()[0])
+            else:
+                self._total_size = self.folder_totals.size
+        return self._total_size
+
+    @property
+    def folder_totals(self):
+        """
+        Get the totals of the folder shown, from one row of the cache.
+
+        :return: (FolderTotals) Totals of folder (all zero if the folder is not in the cache)
+        """
+        totals = self._cache.folder_totals(self._prefix)
+        if totals is None:
+            return FolderTotals(self._prefix)
+        return totals
+
+    @property
+    def prefix(self):
+        return self._prefix
+
+    @property
+    def search_text(self):
+        return self._search_text
+
+    def show_folder(self, prefix):
+        """
+        Show only the rows of the keys under a folder, and its sub-folders.
+
+        :param prefix: (string) Folder prefix, with trailing delimiter ('' for all rows)
+        """
+        self._prefix = prefix
+        self._update_condition()
+
+    def search(self, text):
+        """
+        Show only the rows whose keys contain every word of a text, ignoring case.
+
+        :param text: (string) Words to search for, separated by spaces ('' to show all rows)
+        """
+        self._search_text = text
+        self._update_condition()
+
+    def _update_condition(self):
+        prefix_condition, prefix_parameters = self._cache.prefix_condition(self._prefix)
+        search_condition, search_parameters = self._cache.key_search_condition(self._search_text)
+        self._condition = ' AND '.join(c for c in (prefix_condition, search_condition) if c)
+        self._parameters = prefix_parameters + search_parameters
+        self.reload()
+
+    @property
+    def sort_column(self):
+        return self._sort_column
+
+    @property
+    def ascending(self):
+        return self._ascending
+
+    def sort(self, column, ascending=None):
+        """
+        Sort rows by a column.  The column is indexed the first time rows are sorted by it, so later
+        pages are read in index order.
+
+        :param column: (int) Index of column in COLUMNS
+        :param ascending: (bool) Sort order (default: reverse the order if already sorted by column,
+                          otherwise ascending)
+        :return: (bool) True if rows were sorted, False if column can't be sorted
+        """
+        sql_column = self.SORT_COLUMNS[column]
+        if sql_column is None:
+            return False
+        if ascending is None:
+            ascending = not self._ascending if column == self._sort_column else True
+        if sql_column == 'v.Size':
+            self._db.execute('CREATE INDEX IF NOT EXISTS "VersionsSize" ON "Versions" ("Size")')
+            self._db.commit()
+        self._sort_column = column
+        self._ascending = ascending
+        self._rows.clear()
+        self._page_ends.clear()
+        return True
+
+    def reload(self):
+        """
+        Forget the rows read so far, after the cache database changed.
+        """
+        self._count = None
+        self._total_size = None
+        self._rows.clear()
+        self._page_ends.clear()
+
+    def item_text(self, index, column):
+        """
+        Get the text of one cell.
+
+        :param index: (int) Row number, in sort order
+        :param column: (int) Index of column in COLUMNS
+        :return: (string) Text of cell
+        """
+        return self.row(index)[column]
+
+    def row(self, index):
+        """
+        Get the rendered text of a row.
+
+        :param index: (int) Row number, in sort order
+        :return: (tuple) Text of each column
+        """
+        row = self._rows.get(index)
+        if row is not None:
+            self._rows.move_to_end(index)
+            return row
+        page = index // self._page_size
+        first = page * self._page_size
+        with timer('render', page=page):
+            for n, values in enumerate(self._read_page(page)):
+                self._rows[first + n] = self._render(*values)
+        while len(self._rows) > self._cache_rows:
+            self._rows.popitem(last=False)
+        row = self._rows.get(index)
+        if row is None:
+            raise IndexError(f'Row {index} out of range')
+        self._rows.move_to_end(index)
+        return row
+
+    def _read_page(self, page):
+        """
+        Read the rows of one page.
+
+        :param page: (int) Page number
+        :return: (list) Key, version id, size, modification time and storage class of each row
+        """
+        sql_column = self.SORT_COLUMNS[self._sort_column]
+        direction = 'ASC' if self._ascending else 'DESC'
+        order = f'ORDER BY {sql_column} {direction}, v.rowid {direction}'
+        select = (f'SELECT v.rowid, {sql_column}, o.Key, v.VersionId, v.Size, v.MTime, v.StorageClass, '
+                  'v.IsDeleteMarker FROM Versions v JOIN Objects o ON o.ObjectId = v.ObjectId')
+        search = f'{self._condition} AND ' if self._condition else ''
+        previous = self._page_ends.get(page - 1)
+        if previous is not None:
+            comparison = '>' if self._ascending else '<'
+            rows = self._db.execute(f'{select} WHERE {search}({sql_column}, v.rowid) {comparison} (?, ?) {order} '
+                                    'LIMIT ?', self._parameters + previous + (self._page_size,)).fetchall()
+        else:
+            where = f'WHERE {self._condition}' if self._condition else ''
+            rows = self._db.execute(f'{select} {where} {order} LIMIT ? OFFSET ?',
+                                    self._parameters + (self._page_size, page * self._page_size)).fetchall()
+        if rows:
+            self._page_ends[page] = (rows[-1][1], rows[-1][0])
+        return [row[2:] for row in rows]
+
+    @staticmethod
+    def _render(key, version_id, size, mtime, storage_class, is_delete_marker):
+        name = key + VERSION_DELIMITER + version_id if version_id else key
+        storage_class = S3StorageClass(storage_class)
+        # delete markers are not billed for storage
+        billable_size = 0 if is_delete_marker else storage_class.billable_size(size)
+        return (name, str(size), from_epoch_microseconds(mtime).isoformat(), storage_class.name, str(billable_size))
+
+    def close(self):
+        self._cache.close()
@@ -0,0 +1,99 @@
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from operator import itemgetter
+
+DEFAULT_MAX_WORKERS = 8
+
+
+class LocalScanner:
+    """
+    Scans a local directory tree with os.scandir, reading the directories of different subtrees at
+    the same time on a thread pool.  Files are returned as each directory is read, together with the
+    stat result cached by its DirEntry, so no file is stat-ed more than once.
+    """
+
+    def __init__(self, max_workers=DEFAULT_MAX_WORKERS):
+        """
+
+        :param max_workers: (int) Number of directories read at the same time
+        """
+        if max_workers < 1:
+            raise Exception('max_workers must be at least 1')
+        self._max_workers = max_workers
+
+    def scan(self, root):
+        """
+        Get all files under a directory.  Like os.walk, symbolic links to directories are not
+        followed and directories that can't be read are skipped.
+
+        :param root: (string) Directory to scan
+        :return: (iterator) Tuples of full path and os.stat_result, in no particular order
+        """
+        if self._max_workers == 1:
+            yield from self._scan_serial(root)
+            return
+        # directories waiting to be read are kept in a queue so only a few futures are pending at once
+        waiting = deque([root])
+        pending = set()
+        with ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+            while waiting or pending:
+                while waiting and len(pending) < self._max_workers * 2:
+                    pending.add(executor.submit(self.scan_directory, waiting.popleft()))
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    files, directories = future.result()
+                    waiting.extend(directories)
+                    yield from files
+
+    def _scan_serial(self, root):
+        waiting = [root]
+        while waiting:
+            files, directories = self.scan_directory(waiting.pop())
+            waiting.extend(reversed(directories))
+            yield from files
+
+    def scan_sorted(self, root, delimiter='/'):
+        """
+        Get all files under a directory in the order of their relative paths, as an S3 listing of the
+        same tree would return them.  Only one directory is sorted at a time.
+
+        :param root: (string) Directory to scan
+        :param delimiter: (string) Delimiter between folders in relative paths
+        :return: (iterator) Tuples of full path and os.stat_result, in path order
+        """
+        files, directories = self.scan_directory(root)
+        # a folder sorts as its name followed by the delimiter, like the keys inside it
+        entries = [(os.path.basename(path), path, stat_result) for path, stat_result in files]
+        entries.extend((os.path.basename(path) + delimiter, path, None) for path in directories)
+        entries.sort(key=itemgetter(0))
+        for sort_name, path, stat_result in entries:
+            if stat_result is None:
+                yield from self.scan_sorted(path, delimiter)
+            else:
+                yield path, stat_result
+
+    @staticmethod
+    def scan_directory(path):
+        """
+        Read one directory.
+
+        :param path: (string) Directory to read
+        :return: (tuple) list of (full path, os.stat_result) of files, list of sub-directory paths
+        """
+        files = []
+        directories = []
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            directories.append(entry.path)
+                        elif not entry.is_dir():
+                            files.append((entry.path, entry.stat()))
+                    except OSError:
+                        # broken symbolic link, or file removed while scanning
+                        pass
+        except OSError:
+            pass
+        return files, directories
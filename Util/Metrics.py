@@ -0,0 +1,462 @@
+import atexit
+import json
+import os
+import sys
+import threading
+import time
+from bisect import bisect_left
+from contextlib import nullcontext
+from datetime import datetime, timezone
+
+KB = 1024
+MB = KB * KB
+GB = MB * KB
+# upper bounds of the buckets of the histograms, as in the Prometheus client defaults for seconds
+SECONDS_BOUNDS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+BYTES_BOUNDS = (KB, 4 * KB, 16 * KB, 64 * KB, 256 * KB, MB, 4 * MB, 16 * MB, 64 * MB, 256 * MB, GB, 5 * GB)
+PROMETHEUS_PREFIX = 'cloudsync'
+
+# phases timed by the modules of CloudSync; phases nest, so time spent listing pages pulled by a diff is
+# also part of the diff
+PHASES = ('list_page', 'object_build', 'cache_write', 'diff', 'transfer', 'delete', 'render')
+
+
+class Histogram:
+    """
+    Counts of observed values per bucket, with their sum, like a Prometheus histogram.
+    """
+    __slots__ = ('_bounds', '_counts', '_sum')
+
+    def __init__(self, bounds):
+        """
+
+        :param bounds: (tuple) Upper bound of each bucket, ascending; larger values go in a last +Inf bucket
+        """
+        self._bounds = bounds
+        self._counts = [0] * (len(bounds) + 1)
+        self._sum = 0
+
+    def observe(self, value):
+        self._counts[bisect_left(self._bounds, value)] += 1
+        self._sum += value
+
+    @property
+    def bounds(self):
+        return self._bounds
+
+    @property
+    def counts(self):
+        return list(self._counts)
+
+    @property
+    def count(self):
+        return sum(self._counts)
+
+    @property
+    def sum(self):
+        return self._sum
+
+    def cumulative_counts(self):
+        """
+        Get the number of values at or below each bound, as Prometheus reports them.
+
+        :return: (list) Tuples of bound (float('inf') for the last) and count
+        """
+        total = 0
+        counts = []
+        for bound, count in zip(self._bounds + (float('inf'),), self._counts):
+            total += count
+            counts.append((bound, total))
+        return counts
+
+
+class Metrics:
+    """
+    Measurements of one run: time spent in each phase, and count, latency and bytes of the S3 requests by
+    operation.  Each measurement is added to a histogram and, for phases, written as a JSON line to the log.
+    Thread-safe.
+    """
+
+    def __init__(self, log=None, prometheus_file=None, clock=time.perf_counter):
+        """
+
+        :param log: (file) Text file the JSON lines are written to (None for no log)
+        :param prometheus_file: (string) Name of file the totals are written to in the Prometheus text
+                                format by write_prometheus (None for no file)
+        :param clock: (function) Returns the current time in seconds
+        """
+        self._log = log
+        self._prometheus_file = prometheus_file
+        self._clock = clock
+        self._start = clock()
+        self._lock = threading.Lock()
+        self._phases = dict()
+        self._requests = dict()
+        self._errors = dict()
+        self._retries = dict()
+        self._latency = dict()
+        self._bytes = dict()
+
+    @property
+    def prometheus_file(self):
+        return self._prometheus_file
+
+    def log(self, event, **fields):
+        """
+        Write a JSON line to the log.
+
+        :param event: (string) Kind of line
+        :param fields: Values of line, which must be JSON serializable
+        """
+        if self._log is None:
+            return
+        line = json.dumps(dict(time=datetime.now(timezone.utc).isoformat(), event=event, **fields))
+        with self._lock:
+            self._log.write(line + '\n')
+
+    def record(self, phase, seconds, size=None, **fields):
+        """
+        Record the time spent in a phase.
+
+        :param phase: (string) Name of phase (see PHASES)
+        :param seconds: (float) Duration
+        :param size: (int) Bytes processed, also added to the bytes histogram of the phase
+        :param fields: Values logged with the duration, such as the number of rows
+        """
+        with self._lock:
+            self._histogram(self._phases, phase, SECONDS_BOUNDS).observe(seconds)
+            if size is not None:
+                self._histogram(self._bytes, phase, BYTES_BOUNDS).observe(size)
+        if size is not None:
+            fields['bytes'] = size
+        self.log('phase', phase=phase, seconds=round(seconds, 6), **fields)
+
+    def timer(self, phase, **fields):
+        """
+        Time a block of code as a phase.
+
+        :param phase: (string) Name of phase
+        :param fields: Values logged with the duration
+        :return: Context manager
+        """
+        return _PhaseTimer(self, phase, fields)
+
+    def timed(self, phase, iterable, each=False):
+        """
+        Time the work done to produce the items of an iterator, such as a generator that lists pages.
+
+        :param phase: (string) Name of phase
+        :param iterable: (iterable) Items
+        :param each: (bool) Record the time of each item (such as a page), instead of the total time
+        :return: (iterator) Same items
+        """
+        iterator = iter(iterable)
+        clock = self._clock
+        total = 0.0
+        items = 0
+        try:
+            while True:
+                start = clock()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    total += clock() - start
+                    break
+                seconds = clock() - start
+                total += seconds
+                items += 1
+                if each:
+                    self.record(phase, seconds)
+                yield item
+        finally:
+            if not each:
+                self.record(phase, total, items=items)
+
+    def request(self, operation, seconds, size=None, error=None, retries=0):
+        """
+        Record an S3 request.
+
+        :param operation: (string) API operation, such as ListObjectVersions
+        :param seconds: (float) Latency, including retries
+        :param size: (int) Bytes sent or received (None if none)
+        :param error: (string) Error code if the request failed
+        :param retries: (int) Number of times the request was retried
+        """
+        with self._lock:
+            self._requests[operation] = self._requests.get(operation, 0) + 1
+            if error is not None:
+                self._errors[(operation, error)] = self._errors.get((operation, error), 0) + 1
+            if retries:
+                self._retries[operation] = self._retries.get(operation, 0) + retries
+            self._histogram(self._latency, operation, SECONDS_BOUNDS).observe(seconds)
+            if size is not None:
+                self._histogram(self._bytes, operation, BYTES_BOUNDS).observe(size)
+
+    @staticmethod
+    def _histogram(histograms, name, bounds):
+        histogram = histograms.get(name)
+        if histogram is None:
+            histogram = histograms[name] = Histogram(bounds)
+        return histogram
+
+    def summary(self):
+        """
+        Get the totals of the run.
+
+        :return: (dict) Seconds and count of each phase, requests, errors and retries of each operation,
+                 bytes of each phase or operation, and seconds since the start
+        """
+        with self._lock:
+            return {
+                'elapsed': round(self._clock() - self._start, 6),
+                'phases': dict((phase, {'seconds': round(h.sum, 6), 'count': h.count})
+                               for phase, h in sorted(self._phases.items())),
+                'requests': dict(sorted(self._requests.items())),
+                'errors': dict((f'{operation}:{code}', count) for (operation, code), count
+                               in sorted(self._errors.items())),
+                'retries': dict(sorted(self._retries.items())),
+                'bytes': dict((name, h.sum) for name, h in sorted(self._bytes.items())),
+            }
+
+    def prometheus_text(self):
+        """
+        Get the totals in the Prometheus text exposition format, for the textfile collector of the node
+        exporter or a push gateway.
+
+        :return: (string) Metrics, one sample per line
+        """
+        lines = []
+        with self._lock:
+            self._histogram_lines(lines, 'phase_seconds', 'Time spent in each phase of the run', 'phase',
+                                  self._phases)
+            self._counter_lines(lines, 's3_requests_total', 'S3 requests by operation',
+                                [({'operation': o}, n) for o, n in sorted(self._requests.items())])
+            self._counter_lines(lines, 's3_errors_total', 'S3 requests that failed, by operation and error code',
+                                [({'operation': o, 'code': c}, n) for (o, c), n in sorted(self._errors.items())])
+            self._counter_lines(lines, 's3_retries_total', 'Retries of S3 requests by operation',
+                                [({'operation': o}, n) for o, n in sorted(self._retries.items())])
+            self._histogram_lines(lines, 's3_request_seconds', 'Latency of S3 requests, including retries',
+                                  'operation', self._latency)
+            self._histogram_lines(lines, 'bytes', 'Bytes of each request or phase that moves data', 'name',
+                                  self._bytes)
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def _labels(labels):
+        return ','.join(f'{name}="{str(value)}"' for name, value in labels.items())
+
+    def _counter_lines(self, lines, name, description, samples):
+        if not samples:
+            return
+        name = f'{PROMETHEUS_PREFIX}_{name}'
+        lines.append(f'# HELP {name} {description}')
+        lines.append(f'# TYPE {name} counter')
+        for labels, value in samples:
+            lines.append(f'{name}{{{self._labels(labels)}}} {value}')
+
+    def _histogram_lines(self, lines, name, description, label, histograms):
+        if not histograms:
+            return
+        name = f'{PROMETHEUS_PREFIX}_{name}'
+        lines.append(f'# HELP {name} {description}')
+        lines.append(f'# TYPE {name} histogram')
+        for key, histogram in sorted(histograms.items()):
+            for bound, count in histogram.cumulative_counts():
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f'{name}_bucket{{{label}="{key}",le="{le}"}} {count}')
+            lines.append(f'{name}_sum{{{label}="{key}"}} {histogram.sum}')
+            lines.append(f'{name}_count{{{label}="{key}"}} {histogram.count}')
+
+    def write_prometheus(self, file_name=None):
+        """
+        Write the totals in the Prometheus text format.  The file is replaced at once, so a collector never
+        reads half of it.
+
+        :param file_name: (string) Name of file (default: prometheus_file)
+        """
+        file_name = file_name or self._prometheus_file
+        if not file_name:
+            return
+        temp_name = file_name + '.tmp'
+        with open(temp_name, 'w') as f:
+            f.write(self.prometheus_text())
+        os.replace(temp_name, file_name)
+
+    def close(self):
+        """
+        Log the totals and write the Prometheus file.
+        """
+        self.log('summary', **self.summary())
+        self.write_prometheus()
+        if self._log is not None:
+            self._log.flush()
+
+
+class _PhaseTimer:
+    __slots__ = ('_metrics', '_phase', '_fields', '_start')
+
+    def __init__(self, metrics, phase, fields):
+        self._metrics = metrics
+        self._phase = phase
+        self._fields = fields
+
+    def __enter__(self):
+        self._start = self._metrics._clock()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._metrics.record(self._phase, self._metrics._clock() - self._start, **self._fields)
+
+
+# measurements of the process, None while instrumentation is off; every function below only checks it,
+# so instrumented code costs one call per page or batch when off
+_metrics = None
+_log_file = None
+_null_timer = nullcontext()
+
+
+def enable(log=None, prometheus_file=None):
+    """
+    Turn instrumentation on for the process.  The totals are logged and written when it is turned off,
+    or when the process exits.
+
+    :param log: (string) Name of JSON log file ('-' for standard error), or (file) text file
+    :param prometheus_file: (string) Name of Prometheus text file
+    :return: (Metrics) Measurements
+    """
+    global _metrics, _log_file
+    disable()
+    if log == '-':
+        log = sys.stderr
+    elif isinstance(log, str):
+        log = _log_file = open(log, 'a')
+    _metrics = Metrics(log, prometheus_file)
+    return _metrics
+
+
+def disable():
+    """
+    Turn instrumentation off, logging the totals and writing the Prometheus file.
+
+    :return: (Metrics) Measurements made, or None if instrumentation was off
+    """
+    global _metrics, _log_file
+    metrics = _metrics
+    _metrics = None
+    if metrics is not None:
+        metrics.close()
+    if _log_file is not None:
+        _log_file.close()
+        _log_file = None
+    return metrics
+
+
+atexit.register(disable)
+
+
+def get_metrics():
+    return _metrics
+
+
+def timer(phase, **fields):
+    """
+    Time a block of code as a phase, if instrumentation is on.
+
+    :param phase: (string) Name of phase (see PHASES)
+    :param fields: Values logged with the duration
+    :return: Context manager
+    """
+    if _metrics is None:
+        return _null_timer
+    return _metrics.timer(phase, **fields)
+
+
+def record(phase, seconds, size=None, **fields):
+    """
+    Record the time spent in a phase, if instrumentation is on (see Metrics.record).
+    """
+    if _metrics is not None:
+        _metrics.record(phase, seconds, size, **fields)
+
+
+def timed(phase, iterable, each=False):
+    """
+    Time the work done to produce the items of an iterator, if instrumentation is on (see Metrics.timed).
+
+    :return: (iterable) iterable itself if instrumentation is off
+    """
+    if _metrics is None:
+        return iterable
+    return _metrics.timed(phase, iterable, each)
+
+
+def instrument_client(client):
+    """
+    Count the requests of a client by operation, with their latency and bytes, through the botocore event
+    hooks.  The hooks do nothing while instrumentation is off, so clients can be instrumented when made.
+
+    :param client: (S3.Client) boto3 client, or a fake client with the same meta.events
+    """
+    events = getattr(getattr(client, 'meta', None), 'events', None)
+    if events is None:
+        return
+    events.register('before-parameter-build.s3', _before_parameter_build,
+                    unique_id='cloudsync-metrics-before-parameter-build')
+    events.register('after-call.s3', _after_call, unique_id='cloudsync-metrics-after-call')
+    events.register('after-call-error.s3', _after_call_error, unique_id='cloudsync-metrics-after-call-error')
+
+
+def _before_parameter_build(params=None, model=None, context=None, **kwargs):
+    # emitted with the parameters of the call, before they are serialized; the same context is passed to
+    # the after-call events
+    if _metrics is not None and context is not None:
+        context['metrics_operation'] = model.name
+        context['metrics_start'] = _metrics._clock()
+        size = params.get('ContentLength')
+        if size is None and isinstance(params.get('Body'), (bytes, bytearray)):
+            size = len(params['Body'])
+        context['metrics_size'] = size
+
+
+def _after_call(http_response=None, parsed=None, model=None, context=None, **kwargs):
+    metrics = _metrics
+    if metrics is None or context is None or 'metrics_start' not in context:
+        return
+    parsed = parsed or {}
+    size = context.get('metrics_size')
+    if size is None and model.name == 'GetObject':
+        size = parsed.get('ContentLength')
+    error = parsed.get('Error', {}).get('Code')
+    retries = parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+    metrics.request(model.name, metrics._clock() - context['metrics_start'], size, error, retries)
+
+
+def _after_call_error(exception=None, context=None, **kwargs):
+    metrics = _metrics
+    if metrics is None or context is None or 'metrics_start' not in context:
+        return
+    metrics.request(context['metrics_operation'], metrics._clock() - context['metrics_start'],
+                    error=type(exception).__name__)
+
+
+def add_arguments(parser):
+    """
+    Add the instrumentation options to the arguments of a command.
+
+    :param parser: (argparse.ArgumentParser) Parser of command
+    """
+    parser.add_argument('--metrics-log', help='Write the time of each phase and the totals of the run as JSON lines '
+                                              'to a file (- for standard error)')
+    parser.add_argument('--prometheus', help='Write the totals of the run to a file in the Prometheus text format')
+
+
+def enable_from_arguments(args):
+    """
+    Turn instrumentation on if the options of add_arguments ask for it.
+
+    :param args: (argparse.Namespace) Parsed arguments
+    :return: (Metrics) Measurements, or None if instrumentation is off
+    """
+    if args.metrics_log or args.prometheus:
+        return enable(args.metrics_log, args.prometheus)
+    return None
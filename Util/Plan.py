@@ -0,0 +1,430 @@
+import json
+import math
+import sqlite3
+import time
+from datetime import datetime, timezone
+from enum import Enum
+
+from Util.Transfer import MB, MAX_COPY_SIZE, COPY_PART_SIZE
+
+PLAN_FORMAT = 1
+DELETE_BATCH_SIZE = 1000
+# rates assumed until a run has been recorded in the throughput history
+DEFAULT_BYTES_PER_SECOND = 10 * MB
+DEFAULT_REQUESTS_PER_SECOND = 50
+HISTORY_RUNS = 10
+
+
+class PlanActionType(Enum):
+    """
+    Enumeration of the steps of a plan.
+    """
+    Upload = 1
+    Copy = 2
+    Download = 3
+    Delete = 4
+    DeleteLocal = 5
+    DeleteVersion = 6
+
+    @property
+    def Description(self):
+        if self == PlanActionType.Upload:
+            return 'Upload local file'
+        elif self == PlanActionType.Copy:
+            return 'Copy object on the server'
+        elif self == PlanActionType.Download:
+            return 'Download object version'
+        elif self == PlanActionType.Delete:
+            return 'Delete object'
+        elif self == PlanActionType.DeleteLocal:
+            return 'Delete local file'
+        elif self == PlanActionType.DeleteVersion:
+            return 'Delete noncurrent object version'
+
+    @property
+    def direction(self):
+        """
+        Get the direction of the throughput history the step is estimated with.
+
+        :return: (string) 'upload' or 'download'
+        """
+        if self in (PlanActionType.Download, PlanActionType.DeleteLocal):
+            return 'download'
+        return 'upload'
+
+
+class PlanStep:
+    """
+    One step of a plan, with everything needed to carry it out exactly as planned: the version of an
+    object to download, and the size and modification time of a local file to upload, which must not
+    have changed when the plan is executed.
+    """
+    __slots__ = ('_action', '_name', '_key', '_local_path', '_size', '_mtime', '_version_id', '_source_key',
+                 '_source_version_id', '_content_hash')
+
+    def __init__(self, action, name, key=None, local_path=None, size=0, mtime=None, version_id=None,
+                 source_key=None, source_version_id=None, content_hash=None):
+        """
+
+        :param action: (PlanActionType) Type of step
+        :param name: (string) Path of file relative to the root being synchronized, with '/' delimiters
+        :param key: (string) Key of S3 object
+        :param local_path: (string) Full pathname of local file
+        :param size: (int) Size of file, in bytes
+        :param mtime: (float) Modification time of the local file (Upload, DeleteLocal) or of the version
+                      (Download), in seconds since the epoch
+        :param version_id: (string) Version of object to download or delete
+        :param source_key: (string) Key of object to copy from
+        :param source_version_id: (string) Version of object to copy from
+        :param content_hash: (string) Hex MD5 digest of file, if known
+        """
+        self._action = action
+        self._name = name
+        self._key = key
+        self._local_path = local_path
+        self._size = size
+        self._mtime = mtime
+        self._version_id = version_id
+        self._source_key = source_key
+        self._source_version_id = source_version_id
+        self._content_hash = content_hash
+
+    @property
+    def action(self):
+        return self._action
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def key(self):
+        return self._key
+
+    @property
+    def local_path(self):
+        return self._local_path
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def mtime(self):
+        return self._mtime
+
+    @property
+    def timestamp(self):
+        """
+        Get the modification time as a date/time.
+
+        :return: (datetime) Timezone-aware date/time, or None if not known
+        """
+        if self._mtime is None:
+            return None
+        return datetime.fromtimestamp(self._mtime, timezone.utc)
+
+    @property
+    def version_id(self):
+        return self._version_id
+
+    @property
+    def source_key(self):
+        return self._source_key
+
+    @property
+    def source_version_id(self):
+        return self._source_version_id
+
+    @property
+    def content_hash(self):
+        return self._content_hash
+
+    def to_dict(self):
+        """
+        Get the step as a dictionary for the plan file, leaving out empty fields.
+
+        :return: (dict) Fields of step
+        """
+        values = {'action': self._action.name, 'name': self._name, 'key': self._key, 'path': self._local_path,
+                  'size': self._size, 'mtime': self._mtime, 'version': self._version_id,
+                  'source': self._source_key, 'source_version': self._source_version_id, 'hash': self._content_hash}
+        return {k: v for k, v in values.items() if v is not None}
+
+    @classmethod
+    def from_dict(cls, values):
+        """
+        Make a step from a dictionary of the plan file.
+
+        :param values: (dict) Fields of step, as written by to_dict
+        :return: (PlanStep) Step
+        """
+        return cls(PlanActionType[values['action']], values['name'], values.get('key'), values.get('path'),
+                   values.get('size', 0), values.get('mtime'), values.get('version'), values.get('source'),
+                   values.get('source_version'), values.get('hash'))
+
+    def description(self):
+        """
+        Describe the step on one line, as shown by --showonly.
+
+        :return: (string) Description
+        """
+        text = f'{self._action.name:<11} {self._name}'
+        if self._action == PlanActionType.Copy:
+            text += f' (server-side from {self._source_key})'
+        elif self._action in (PlanActionType.Download, PlanActionType.Delete, PlanActionType.DeleteVersion) and \
+                self._version_id:
+            text += f' (version {self._version_id})'
+        return text
+
+
+class ThroughputHistory:
+    """
+    Throughput of earlier runs, kept in the sync-state database, to estimate how long a plan will take.
+    Each run records the bytes transferred, the requests made and the wall-clock time of the whole
+    operation, including its listing.
+    """
+
+    def __init__(self, database_name):
+        """
+
+        :param database_name: (string) Name of sync-state database
+        """
+        self._db = sqlite3.connect(database_name)
+        self._db.execute('''CREATE TABLE IF NOT EXISTS "Throughput" (
+                "Direction" TEXT NOT NULL,
+                "Bytes"     INTEGER NOT NULL,
+                "Requests"  INTEGER NOT NULL,
+                "Seconds"   REAL NOT NULL,
+                "Time"      REAL NOT NULL
+                )''')
+        self._db.commit()
+
+    def record(self, direction, size, requests, seconds):
+        """
+        Record a run.
+
+        :param direction: (string) 'upload' or 'download'
+        :param size: (int) Bytes transferred
+        :param requests: (int) Requests made
+        :param seconds: (float) Wall-clock time of run
+        """
+        if seconds <= 0 or (size == 0 and requests == 0):
+            return
+        self._db.execute('INSERT INTO Throughput(Direction, Bytes, Requests, Seconds, Time) VALUES(?,?,?,?,?)',
+                         (direction, size, requests, seconds, time.time()))
+        self._db.commit()
+
+    def rates(self, direction, runs=HISTORY_RUNS):
+        """
+        Get the throughput of the latest runs in one direction.
+
+        :param direction: (string) 'upload' or 'download'
+        :param runs: (int) Number of latest runs averaged
+        :return: (tuple) Bytes per second, requests per second; None if no run was recorded
+        """
+        row = self._db.execute('SELECT SUM(Bytes), SUM(Requests), SUM(Seconds) FROM (SELECT Bytes, Requests, Seconds '
+                               'FROM Throughput WHERE Direction=? ORDER BY Time DESC LIMIT ?)',
+                               (direction, runs)).fetchone()
+        if row[2] is None:
+            return None
+        return row[0] / row[2], row[1] / row[2]
+
+    def close(self):
+        self._db.close()
+
+
+class PlanSummary:
+    """
+    Running totals of a plan: the number of steps, bytes and requests of each type of step, counted as
+    the steps are added so that the steps themselves need not be kept.
+    """
+
+    def __init__(self, config):
+        """
+
+        :param config: (TransferConfig) Settings the plan will be executed with, which decide the requests
+        """
+        self._config = config
+        self._counts = {action: 0 for action in PlanActionType}
+        self._bytes = {action: 0 for action in PlanActionType}
+        self._requests = {action: 0 for action in PlanActionType}
+
+    def add(self, step):
+        self._counts[step.action] += 1
+        if step.action != PlanActionType.DeleteLocal:
+            self._requests[step.action] += self.requests_for(step)
+        if step.action in (PlanActionType.Upload, PlanActionType.Download, PlanActionType.Copy,
+                           PlanActionType.DeleteLocal):
+            self._bytes[step.action] += step.size
+
+    def requests_for(self, step):
+        """
+        Count the requests a step takes, as the TransferEngine makes them.  Deletes are counted when the
+        batches are known (see requests).
+
+        :param step: (PlanStep) Step
+        :return: (int) Number of requests
+        """
+        config = self._config
+        if step.action == PlanActionType.Copy:
+            if step.size <= MAX_COPY_SIZE:
+                return 1
+            part_size = max(config.part_size_for(step.size), COPY_PART_SIZE)
+            return math.ceil(step.size / part_size) + 2
+        if step.action in (PlanActionType.Upload, PlanActionType.Download):
+            if step.size <= config.part_size:
+                return 1
+            parts = math.ceil(step.size / config.part_size_for(step.size))
+            # multipart uploads are started and completed; multipart downloads are ranged gets
+            return parts + 2 if step.action == PlanActionType.Upload else parts
+        return 0
+
+    def count(self, action):
+        return self._counts[action]
+
+    def bytes(self, action):
+        return self._bytes[action]
+
+    def requests(self, action):
+        if action in (PlanActionType.Delete, PlanActionType.DeleteVersion):
+            return math.ceil(self._counts[action] / DELETE_BATCH_SIZE)
+        return self._requests[action]
+
+    @property
+    def total_requests(self):
+        return sum(self.requests(action) for action in PlanActionType)
+
+    def estimate_seconds(self, history=None):
+        """
+        Estimate the wall-clock time of the plan from the throughput of earlier runs.  Each direction
+        takes as long as the slower of moving its bytes and making its requests at the recorded rates.
+
+        :param history: (ThroughputHistory) Earlier runs (default: assume DEFAULT_BYTES_PER_SECOND and
+                        DEFAULT_REQUESTS_PER_SECOND)
+        :return: (tuple) Estimated seconds, True if estimated from recorded runs
+        """
+        seconds = 0.0
+        measured = True
+        for direction in ('upload', 'download'):
+            actions = [a for a in PlanActionType if a.direction == direction]
+            size = sum(self._bytes[a] for a in actions if a in (PlanActionType.Upload, PlanActionType.Download))
+            requests = sum(self.requests(a) for a in actions)
+            if size == 0 and requests == 0:
+                continue
+            rates = history.rates(direction) if history is not None else None
+            if rates is None:
+                rates = (DEFAULT_BYTES_PER_SECOND, DEFAULT_REQUESTS_PER_SECOND)
+                measured = False
+            bytes_per_second, requests_per_second = rates
+            byte_seconds = size / bytes_per_second if bytes_per_second > 0 else 0.0
+            request_seconds = requests / requests_per_second if requests_per_second > 0 else 0.0
+            seconds += max(byte_seconds, request_seconds)
+        return seconds, measured
+
+    def to_dict(self):
+        return {action.name: {'count': self._counts[action], 'bytes': self._bytes[action],
+                              'requests': self.requests(action)}
+                for action in PlanActionType if self._counts[action]}
+
+    def report(self, history=None):
+        """
+        Describe the totals of the plan.
+
+        :param history: (ThroughputHistory) Earlier runs, for the time estimate
+        :return: (list) Lines of report
+        """
+        lines = []
+        for action in PlanActionType:
+            if self._counts[action]:
+                lines.append(f'{action.Description}: {self._counts[action]:,} files, '
+                             f'{self._bytes[action] / MB:,.1f} MB, {self.requests(action):,} requests')
+        if not lines:
+            return ['Nothing to do']
+        seconds, measured = self.estimate_seconds(history)
+        basis = 'from earlier runs' if measured else 'no earlier runs recorded'
+        lines.append(f'Total: {self.total_requests:,} requests, estimated {seconds:,.0f} s ({basis})')
+        return lines
+
+
+class Planner:
+    """
+    Receives the steps of a dry run: shows each step, adds it to the summary and writes it to the plan
+    file, one JSON object per line, as it arrives.  The plan file starts with a header naming the
+    operation, source and target, and ends with the summary.
+    """
+
+    def __init__(self, config, plan_file=None, header=None, show=print):
+        """
+
+        :param config: (TransferConfig) Settings the plan will be executed with
+        :param plan_file: (string) Name of plan file to write (default: none)
+        :param header: (dict) Operation, source and target of plan, written first in the plan file
+        :param show: (function) Called with the description of each step (None to not show steps)
+        """
+        self._summary = PlanSummary(config)
+        self._show = show
+        self._file = None
+        if plan_file is not None:
+            self._file = open(plan_file, 'w')
+            header = dict(header or {})
+            header.update({'plan': PLAN_FORMAT, 'created': datetime.now(timezone.utc).isoformat()})
+            self._write(header)
+
+    @property
+    def summary(self):
+        return self._summary
+
+    def _write(self, values):
+        self._file.write(json.dumps(values) + '\n')
+
+    def add(self, step):
+        """
+        Add a step to the plan.
+
+        :param step: (PlanStep) Step
+        """
+        self._summary.add(step)
+        if self._show is not None:
+            self._show(step.description())
+        if self._file is not None:
+            self._write(step.to_dict())
+
+    def close(self):
+        if self._file is not None:
+            self._write({'summary': self._summary.to_dict()})
+            self._file.close()
+            self._file = None
+
+
+def read_plan(plan_file):
+    """
+    Read the header of a plan file.
+
+    :param plan_file: (string) Name of plan file
+    :return: (dict) Header of plan
+    """
+    with open(plan_file) as f:
+        header = json.loads(f.readline() or '{}')
+    if header.get('plan') != PLAN_FORMAT:
+        raise Exception(f'{plan_file} is not a plan file written by --showonly')
+    return header
+
+
+def plan_steps(plan_file, actions=None):
+    """
+    Read the steps of a plan file one at a time.
+
+    :param plan_file: (string) Name of plan file
+    :param actions: (tuple) Only read steps of these PlanActionTypes (default: all)
+    :return: (iterator) PlanSteps, in the order they were planned
+    """
+    with open(plan_file) as f:
+        f.readline()
+        for line in f:
+            values = json.loads(line)
+            if 'action' not in values:
+                continue
+            step = PlanStep.from_dict(values)
+            if actions is None or step.action in actions:
+                yield step
@@ -1,9 +1,19 @@
+import hashlib
 import os
 import sqlite3
-from datetime import datetime
+from array import array
+from datetime import datetime, timedelta, timezone
 from enum import Enum
 
-import boto3
+from Util.ListingCache import ListingCache, VERSION_DELIMITER, epoch_microseconds, split_version_name
+from Util.LocalScanner import LocalScanner, DEFAULT_MAX_WORKERS as DEFAULT_SCAN_WORKERS
+from Util.S3Client import get_client
+from Util.S3Listing import ShardedLister
+
+# size objects of the infrequent access classes are billed for at least
+MIN_BILLABLE_SIZE = 128 * 1024
+# versions written to a cache being streamed from a listing between commits, so readers see them
+STREAM_BATCH_SIZE = 5000
 
 
 class S3StorageClass(Enum):
@@ -17,6 +27,71 @@ class S3StorageClass(Enum):
     ONEZONE_IA = 5
     INTELLIGENT_TIERING = 6
     DEEP_ARCHIVE = 7
+    GLACIER_IR = 8
+
+    @classmethod
+    def from_name(cls, name):
+        """
+        Get the storage class S3 reports by name.  Objects listed without a class (and classes this
+        enumeration doesn't know, such as those of S3 on Outposts) are taken as STANDARD.
+
+        :param name: (string) StorageClass of listing, or None
+        :return: (S3StorageClass) Storage class
+        """
+        if isinstance(name, cls):
+            return name
+        try:
+            return cls[name]
+        except KeyError:
+            return cls.STANDARD
+
+    @property
+    def min_billable_size(self):
+        """
+        Get the size each object of the class is billed for at least.
+
+        :return: (int) Minimum billable size, in bytes
+        """
+        if self in (S3StorageClass.STANDARD_IA, S3StorageClass.ONEZONE_IA, S3StorageClass.GLACIER_IR):
+            return MIN_BILLABLE_SIZE
+        return 0
+
+    @property
+    def overhead_size(self):
+        """
+        Get the size added to each object of the class for the index and metadata S3 keeps for archived
+        objects (32 KB billed at the archive rate plus 8 KB billed at the STANDARD rate).
+
+        :return: (int) Overhead, in bytes
+        """
+        if self in (S3StorageClass.GLACIER, S3StorageClass.DEEP_ARCHIVE):
+            return 40 * 1024
+        return 0
+
+    @property
+    def min_storage_days(self):
+        """
+        Get the number of days objects of the class are billed for at least, even if they are deleted,
+        overwritten or transitioned sooner.
+
+        :return: (int) Minimum storage duration, in days
+        """
+        if self in (S3StorageClass.STANDARD_IA, S3StorageClass.ONEZONE_IA):
+            return 30
+        elif self in (S3StorageClass.GLACIER, S3StorageClass.GLACIER_IR):
+            return 90
+        elif self == S3StorageClass.DEEP_ARCHIVE:
+            return 180
+        return 0
+
+    def billable_size(self, size):
+        """
+        Get the size an object of the class is billed for.
+
+        :param size: (int) Size of object, in bytes
+        :return: (int) Billable size, in bytes
+        """
+        return max(size, self.min_billable_size) + self.overhead_size
 
 
 class FileObject:
@@ -24,6 +99,7 @@ class FileObject:
     A FileObject contains information about a single object stored in the cloud.  This is an abstract class
     that is realized with an Amazon S3 file object or filesystem file object.
     """
+    __slots__ = ('_full_name', '_name', '_folder', '_size', '_timestamp')
 
     def __init__(self, size=0, timestamp=datetime.now(), path_delimiter='/', full_name=None, name=None, folder=None):
         """
@@ -97,6 +173,8 @@ class FileObject:
 
 
 class FileVersion:
+    __slots__ = ('_timestamp', '_size')
+
     def __init__(self, timestamp, size):
         """
         Initialize instance of FileVersion
@@ -128,24 +206,67 @@ class FileVersion:
 class Repository:
     """
     A repository for holding FileObjects.
+
+    A repository can be limited to the files under a prefix (a sub-folder, with trailing delimiter).
+    Folders are named by their prefix relative to the root of the repository, like S3 keys, whatever the
+    type of repository.  The immediate children of one folder can be listed with list_folder without
+    reading the rest of the repository, and walk lists a sub-tree one folder at a time.
     """
 
-    def __init__(self, file_objects, supports_versions=False):
+    def __init__(self, file_objects, supports_versions=False, prefix=''):
         """
 
-        :param file_objects:
+        :param file_objects: (list) FileObjects, or None to load them when first used
+        :param supports_versions: (bool) Does the repository support file versions?
+        :param prefix: (string) Prefix of the folder the repository is limited to ('' for the root)
         """
         self._file_objects = file_objects
         self._supports_versions = supports_versions
+        self._prefix = prefix
 
     @property
     def file_objects(self):
+        if self._file_objects is None:
+            self._file_objects = self._load()
         return self._file_objects
 
     @file_objects.setter
     def file_objects(self, file_objects):
         self._file_objects = file_objects
 
+    @property
+    def prefix(self):
+        return self._prefix
+
+    def _load(self):
+        """
+        Load all file objects under the prefix of the repository.
+
+        :return: (list) FileObjects
+        """
+        return list(self.walk())
+
+    def list_folder(self, prefix=None):
+        """
+        List the immediate children of a folder.
+
+        :param prefix: (string) Prefix of folder, with trailing delimiter (default: prefix of repository)
+        :return: (tuple) list of FileObjects in folder, list of prefixes of its sub-folders
+        """
+        raise Exception(f'{type(self).__name__} can\'t list folders')
+
+    def walk(self, prefix=None):
+        """
+        List the files under a folder one folder at a time, without listing the rest of the repository.
+
+        :param prefix: (string) Prefix of folder, with trailing delimiter (default: prefix of repository)
+        :return: (iterator) FileObjects
+        """
+        file_objects, folders = self.list_folder(prefix)
+        yield from file_objects
+        for folder in folders:
+            yield from self.walk(folder)
+
     @property
     def supports_versions(self):
         """
@@ -156,18 +277,37 @@ class Repository:
 
 
 class S3FileObject(FileObject):
-    MIN_BILLABLE_SIZE = 128 * 1024
+    MIN_BILLABLE_SIZE = MIN_BILLABLE_SIZE
+    __slots__ = ('_e_tag', '_storage_class', '_is_latest', '_is_delete_marker')
 
     def __init__(self, object_summary):
-        self._objectSummary = object_summary
         name = object_summary.object_key + '$' + object_summary.version_id
         size = object_summary.size
+        self._is_delete_marker = size is None
         if size is None:
             size = 0
+        self._is_latest = object_summary.is_latest
         timestamp = object_summary.last_modified
         super().__init__(full_name=name, size=size, timestamp=timestamp)
-        self._storage_class = S3StorageClass['STANDARD']
-        self._billable_size = size
+        self._e_tag = object_summary.e_tag
+        self._storage_class = S3StorageClass.from_name(object_summary.storage_class)
+
+    @property
+    def e_tag(self):
+        """
+        Get the entity tag S3 reported for this version (None for delete markers).
+
+        :return: (string) ETag of object version
+        """
+        return self._e_tag
+
+    @property
+    def is_latest(self):
+        return self._is_latest
+
+    @property
+    def is_delete_marker(self):
+        return self._is_delete_marker
 
     @property
     def storage_class(self):
@@ -175,86 +315,749 @@ class S3FileObject(FileObject):
 
     @property
     def billable_size(self):
-        return self._billable_size
+        """
+        Get the size the version is billed for, with the minimum object size and archive overhead of its
+        storage class.  Delete markers are not billed for storage.
+
+        :return: (int) Billable size, in bytes
+        """
+        if self._is_delete_marker:
+            return 0
+        return self._storage_class.billable_size(self.size)
 
 
 class LocalFileObject(FileObject):
     """
     File object for local hard drive or locally accessible file share
     """
+    __slots__ = ()
+
+    def __init__(self, full_name, path_delimiter='/', stat_result=None):
+        """
 
-    def __init__(self, full_name, path_delimiter='/'):
-        size = os.path.getsize(full_name)
-        timestamp = datetime.fromtimestamp(os.stat(full_name).st_mtime)
-        super().__init__(size, timestamp, path_delimiter, full_name)
+        :param full_name: (string) Full pathname of file
+        :param path_delimiter: (string) delimiter for components of file path (default: '/')
+        :param stat_result: (os.stat_result) Result of stat of file, if already known
+        """
+        if stat_result is None:
+            stat_result = os.stat(full_name)
+        timestamp = datetime.fromtimestamp(stat_result.st_mtime)
+        super().__init__(stat_result.st_size, timestamp, path_delimiter, full_name)
+
+
+class CompactFileObject:
+    """
+    Lightweight view of one file object stored in a CompactListing.  It has the same properties as
+    FileObject and S3FileObject, read from the columns of the listing when accessed.
+    """
+    __slots__ = ('_listing', '_index')
+
+    def __init__(self, listing, index):
+        self._listing = listing
+        self._index = index
+
+    @property
+    def name(self):
+        """
+        Get the name of the object, without the full path.
+
+        :returns: (string) Name of object (key)
+        """
+        return self._listing.name(self._index)
+
+    @property
+    def full_name(self):
+        """
+        Get the full pathname of the file object.
+
+        :return: (string) Full pathname of file object.
+        """
+        return self._listing.folder_prefix(self._index) + self.name
+
+    @property
+    def folder(self):
+        folder_prefix = self._listing.folder_prefix(self._index)
+        return folder_prefix[0:len(folder_prefix) - len(self._listing.path_delimiter)]
+
+    @property
+    def size(self):
+        """
+        Get the size of the object.
+
+        :return: (int) Size of object, in bytes
+        """
+        return self._listing.sizes[self._index]
+
+    @property
+    def timestamp(self):
+        """
+        Get the date & time object was stored.
+
+        :return: (datetime) Date/time when object stored.
+        """
+        return self._listing.timestamp(self._index)
+
+    @property
+    def storage_class(self):
+        return S3StorageClass(self._listing.storage_classes[self._index])
+
+    @property
+    def is_latest(self):
+        return bool(self._listing.latest[self._index])
+
+    @property
+    def is_delete_marker(self):
+        return bool(self._listing.delete_markers[self._index])
+
+    @property
+    def billable_size(self):
+        if self.is_delete_marker:
+            return 0
+        return self.storage_class.billable_size(self.size)
+
+
+class CompactListing:
+    """
+    Compact, column-oriented container of file objects for very large listings.  Instead of one Python
+    object per file, each attribute is kept in an array: an interned folder id, the offset of the name
+    in one UTF-8 buffer, the size, the timestamp (microseconds since the epoch), the storage class and
+    whether the version is the latest one or a delete marker.
+    Indexing or iterating hands out CompactFileObject views, so the listing can be used as the
+    file_objects of a Repository.
+    """
+    _EPOCH = datetime(1970, 1, 1)
+    _UTC_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+    def __init__(self, path_delimiter='/'):
+        """
+
+        :param path_delimiter: (string) delimiter for components of file path (default: '/')
+        """
+        self._path_delimiter = path_delimiter
+        self._folders = []
+        self._folder_ids = dict()
+        self._folder_column = array('I')
+        self._name_buffer = bytearray()
+        self._name_offsets = array('Q', [0])
+        self._sizes = array('q')
+        self._timestamps = array('q')
+        self._storage_classes = array('B')
+        self._latest = array('B')
+        self._delete_markers = array('B')
+        self._timezone_aware = None
+
+    def append(self, full_name, size, timestamp, storage_class=S3StorageClass.STANDARD, is_latest=True,
+               is_delete_marker=False):
+        """
+        Add a file object to the listing.
+
+        :param full_name: (string) Full name of file object, including path
+        :param size: (int) Size of file object in bytes
+        :param timestamp: (datetime) Timestamp of file object
+        :param storage_class: (S3StorageClass) Storage class of file object
+        :param is_latest: (bool) True if file object is the latest version of its key
+        :param is_delete_marker: (bool) True if file object is a delete marker
+        """
+        aware = timestamp.tzinfo is not None
+        epoch = self._UTC_EPOCH if aware else self._EPOCH
+        self.append_epoch(full_name, size, (timestamp - epoch) // timedelta(microseconds=1), storage_class.value,
+                          aware, is_latest, is_delete_marker)
+
+    def append_epoch(self, full_name, size, microseconds, storage_class=1, timezone_aware=False, is_latest=True,
+                     is_delete_marker=False):
+        """
+        Add a file object whose timestamp is already in microseconds since the epoch, as read from a
+        cache, without converting it to a datetime.
+
+        :param full_name: (string) Full name of file object, including path
+        :param size: (int) Size of file object in bytes
+        :param microseconds: (int) Timestamp of file object, in microseconds since the epoch
+        :param storage_class: (int) S3StorageClass value of file object
+        :param timezone_aware: (bool) True if timestamp is UTC and file object timestamps are timezone-aware
+        :param is_latest: (bool) True if file object is the latest version of its key
+        :param is_delete_marker: (bool) True if file object is a delete marker
+        """
+        if self._timezone_aware is None:
+            self._timezone_aware = timezone_aware
+        elif timezone_aware != self._timezone_aware:
+            raise Exception('Can\'t mix timezone-aware and naive timestamps in one listing')
+        # folders are interned with their trailing delimiter, so that '' is the root of the listing
+        position = full_name.rfind(self._path_delimiter)
+        if position < 0:
+            folder_prefix, name = '', full_name
+        else:
+            position += len(self._path_delimiter)
+            folder_prefix, name = full_name[0:position], full_name[position:]
+        folder_id = self._folder_ids.get(folder_prefix)
+        if folder_id is None:
+            folder_id = len(self._folders)
+            self._folder_ids[folder_prefix] = folder_id
+            self._folders.append(folder_prefix)
+        self._folder_column.append(folder_id)
+        self._name_buffer += name.encode('utf-8')
+        self._name_offsets.append(len(self._name_buffer))
+        self._sizes.append(size)
+        self._timestamps.append(microseconds)
+        self._storage_classes.append(storage_class)
+        self._latest.append(1 if is_latest else 0)
+        self._delete_markers.append(1 if is_delete_marker else 0)
+
+    def extend(self, file_objects):
+        """
+        Add file objects to the listing.
+
+        :param file_objects: (iterator) FileObjects (storage class and version flags are kept for S3FileObjects)
+        """
+        for o in file_objects:
+            storage_class = getattr(o, 'storage_class', S3StorageClass.STANDARD)
+            self.append(o.full_name, o.size, o.timestamp, storage_class, getattr(o, 'is_latest', True),
+                        getattr(o, 'is_delete_marker', False))
+
+    @property
+    def path_delimiter(self):
+        return self._path_delimiter
+
+    @property
+    def sizes(self):
+        """
+        Get the size column.
+
+        :return: (array) Size of each file object, in bytes
+        """
+        return self._sizes
+
+    @property
+    def timestamps(self):
+        """
+        Get the timestamp column.
+
+        :return: (array) Timestamp of each file object, in microseconds since the epoch
+        """
+        return self._timestamps
+
+    @property
+    def storage_classes(self):
+        """
+        Get the storage class column.
+
+        :return: (array) S3StorageClass value of each file object
+        """
+        return self._storage_classes
+
+    @property
+    def latest(self):
+        """
+        Get the latest version column.
+
+        :return: (array) 1 for each file object that is the latest version of its key, otherwise 0
+        """
+        return self._latest
+
+    @property
+    def delete_markers(self):
+        """
+        Get the delete marker column.
+
+        :return: (array) 1 for each file object that is a delete marker, otherwise 0
+        """
+        return self._delete_markers
+
+    def name(self, index):
+        start = self._name_offsets[index]
+        return self._name_buffer[start:self._name_offsets[index + 1]].decode('utf-8')
+
+    def folder_prefix(self, index):
+        return self._folders[self._folder_column[index]]
+
+    def timestamp(self, index):
+        epoch = self._UTC_EPOCH if self._timezone_aware else self._EPOCH
+        return epoch + timedelta(microseconds=self._timestamps[index])
+
+    @property
+    def nbytes(self):
+        """
+        Get the memory used by the columns, not counting the interned folder names.
+
+        :return: (int) Size of columns, in bytes
+        """
+        columns = (self._folder_column, self._name_offsets, self._sizes, self._timestamps, self._storage_classes,
+                   self._latest, self._delete_markers)
+        return len(self._name_buffer) + sum(c.itemsize * len(c) for c in columns)
+
+    def __len__(self):
+        return len(self._sizes)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError('CompactListing index out of range')
+        return CompactFileObject(self, index)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield CompactFileObject(self, index)
 
 
 class S3Repository(Repository):
-    def __init__(self, bucket_name):
-        s3 = boto3.resource('s3')
-        self._bucket = s3.Bucket(bucket_name)
-        # versions = self._bucket.object_versions
-        # for v in versions.all():
-        #    print(v)
-        # pull all objects from bucket and use to initialize base, versions supported
-        super().__init__([S3FileObject(o) for o in self._bucket.object_versions.all()], supports_versions=True)
+    CHECKPOINT_DELIMITER = '/'
+
+    def __init__(self, bucket_name, prefix='', lazy=False, client=None):
+        """
+
+        :param bucket_name: (string) Name of bucket
+        :param prefix: (string) Prefix of the folder the repository is limited to ('' for whole bucket)
+        :param lazy: (bool) Don't list objects until they are used; folders can be listed with list_folder
+        :param client: (S3.Client) S3 client to use (default: shared client, see S3Client)
+        """
+        self._client = client if client is not None else get_client()
+        self._bucket_name = bucket_name
+        super().__init__(None, supports_versions=True, prefix=prefix)
+        if not lazy:
+            # pull all objects under prefix from bucket
+            self.file_objects
+
+    def _load(self):
+        # one listing of the whole sub-tree takes fewer calls than listing it folder by folder
+        lister = ShardedLister(self._client, self._bucket_name)
+        return [S3FileObject(o) for o in lister.list(self._prefix)]
+
+    def list_folder(self, prefix=None):
+        """
+        List the immediate children of a folder with one delimiter-based listing.
+
+        :param prefix: (string) Prefix of folder, with trailing delimiter (default: prefix of repository)
+        :return: (tuple) list of S3FileObjects in folder, list of prefixes of its sub-folders
+        """
+        if prefix is None:
+            prefix = self._prefix
+        lister = ShardedLister(self._client, self._bucket_name, max_workers=1, delimiter=self.CHECKPOINT_DELIMITER)
+        objects, folders = lister.list_level(prefix)
+        return [S3FileObject(o) for o in objects], folders
+
+    @property
+    def bucket_name(self):
+        return self._bucket_name
+
+    @property
+    def client(self):
+        return self._client
+
+    @classmethod
+    def checkpoint_prefix(cls, key):
+        """
+        Get the top-level prefix a key is checkpointed under.
+
+        :param key: (string) Object key
+        :return: (string) Top-level prefix including delimiter, or '' for keys at the root of the bucket
+        """
+        position = key.find(cls.CHECKPOINT_DELIMITER)
+        if position < 0:
+            return ''
+        return key[0:position + 1]
+
+    @classmethod
+    def list_checkpoint_prefixes(cls, client, bucket_name):
+        """
+        Get the top-level prefixes of a bucket with delimiter-based listing calls, which only return
+        the objects at the root of the bucket and the common prefixes below it.
+
+        :param client: (S3.Client) S3 client
+        :param bucket_name: (string) Name of bucket
+        :return: (list) Sorted prefixes, starting with '' for the root of the bucket
+        """
+        prefixes = ['']
+        paginator = client.get_paginator('list_object_versions')
+        for page in paginator.paginate(Bucket=bucket_name, Delimiter=cls.CHECKPOINT_DELIMITER):
+            prefixes.extend(p['Prefix'] for p in page.get('CommonPrefixes', []))
+        return prefixes
+
+    @classmethod
+    def list_prefix_versions(cls, client, bucket_name, prefix):
+        """
+        Get all object versions stored under a top-level prefix.
+
+        :param client: (S3.Client) S3 client
+        :param bucket_name: (string) Name of bucket
+        :param prefix: (string) Prefix returned by list_checkpoint_prefixes
+        :return: (iterator) ListedObjects
+        """
+        lister = ShardedLister(client, bucket_name, max_workers=1, delimiter=cls.CHECKPOINT_DELIMITER)
+        if prefix == '':
+            return iter(lister.list_level('')[0])
+        return lister.list_serial(prefix)
 
 
 class LocalRepository(Repository):
-    def __init__(self, root):
-        files = self.get_files(root)
-        super().__init__([LocalFileObject(name) for name in files], supports_versions=False)
+    def __init__(self, root, max_workers=DEFAULT_SCAN_WORKERS, prefix='', lazy=False):
+        """
+
+        :param root: (string) Root folder of repository
+        :param max_workers: (int) Number of folders scanned at the same time
+        :param prefix: (string) Sub-folder the repository is limited to, relative to root with '/' delimiters
+        :param lazy: (bool) Don't scan files until they are used; folders can be listed with list_folder
+        """
+        self._root = root
+        self._max_workers = max_workers
+        super().__init__(None, supports_versions=False, prefix=prefix)
+        if not lazy:
+            self.file_objects
+
+    def _load(self):
+        return list(self.scan(self.folder_path(self._prefix), self._max_workers))
+
+    def folder_path(self, prefix):
+        """
+        Get the local path of a folder.
+
+        :param prefix: (string) Prefix of folder, relative to root with '/' delimiters
+        :return: (string) Full path of folder
+        """
+        return os.path.join(self._root, *[p for p in prefix.split('/') if p])
+
+    def list_folder(self, prefix=None):
+        """
+        List the immediate children of a folder with one scandir.
+
+        :param prefix: (string) Prefix of folder, with trailing '/' (default: prefix of repository)
+        :return: (tuple) list of LocalFileObjects in folder, list of prefixes of its sub-folders
+        """
+        if prefix is None:
+            prefix = self._prefix
+        files, directories = LocalScanner.scan_directory(self.folder_path(prefix))
+        file_objects = [LocalFileObject(full_path, stat_result=stat_result) for full_path, stat_result in files]
+        folders = sorted(prefix + os.path.basename(path) + '/' for path in directories)
+        return file_objects, folders
+
+    @property
+    def root(self):
+        return self._root
+
+    @staticmethod
+    def scan(root, max_workers=DEFAULT_SCAN_WORKERS):
+        """
+        Get the files under a folder as they are found, without collecting the whole tree first.
+
+        :param root: (string) Root folder
+        :param max_workers: (int) Number of folders scanned at the same time
+        :return: (iterator) LocalFileObjects
+        """
+        for full_path, stat_result in LocalScanner(max_workers).scan(root):
+            yield LocalFileObject(full_path, stat_result=stat_result)
 
     @staticmethod
     def get_files(root_folder):
-        all_files = []
-        for dir_path, dir_names, file_names in os.walk(root_folder):
-            for filename in file_names:
-                full_path = dir_path + os.sep + filename
-                all_files.append(full_path)
-        return all_files
+        return [full_path for full_path, stat_result in LocalScanner().scan(root_folder)]
+
+
+class PrefixCheckpoint:
+    """
+    Summary of the object versions listed under one top-level prefix of a bucket.  Object versions
+    are immutable, so a prefix whose checkpoint is unchanged since the last refresh has no
+    changed rows in the cache.
+    """
+
+    def __init__(self, prefix, count=0, newest=None, digest=None):
+        """
+
+        :param prefix: (string) Top-level prefix ('' for the root of the bucket)
+        :param count: (int) Number of object versions under prefix
+        :param newest: (string) Newest LastModified of the versions, as stored in the cache
+        :param digest: (string) Hex digest of the (name, ETag, LastModified) of every version
+        """
+        self._prefix = prefix
+        self._count = count
+        self._newest = newest
+        self._digest = digest
+
+    @classmethod
+    def from_file_objects(cls, prefix, file_objects):
+        """
+        Build the checkpoint for the S3FileObjects listed under a prefix.  The digest does not depend
+        on listing order, so a full listing and a per-prefix listing give the same checkpoint.
+
+        :param prefix: (string) Top-level prefix
+        :param file_objects: (list) S3FileObjects under prefix
+        :return: (PrefixCheckpoint) Checkpoint of prefix
+        """
+        digest = hashlib.sha1()
+        newest = None
+        rows = sorted((o.full_name, o.e_tag or '', CachedRepository.format_time(o.timestamp)) for o in file_objects)
+        for row in rows:
+            digest.update('\0'.join(row).encode('utf-8'))
+            digest.update(b'\n')
+            if newest is None or row[2] > newest:
+                newest = row[2]
+        return cls(prefix, len(rows), newest, digest.hexdigest())
+
+    @property
+    def prefix(self):
+        return self._prefix
+
+    @property
+    def row(self):
+        """
+        Get the checkpoint as stored in the PrefixCheckpoints table.
+
+        :return: (tuple) Prefix, Count, Newest, Digest
+        """
+        return self._prefix, self._count, self._newest, self._digest
+
+    def __eq__(self, other):
+        return isinstance(other, PrefixCheckpoint) and self.row == other.row
 
 
 class CachedRepository(Repository):
-    def __init__(self, database_name):
-        with sqlite3.connect(database_name) as db:
-            cursor = db.cursor()
-            cursor.execute('SELECT Name, Size, Time FROM FileObjects')
-            done = False
-            objects = []
-            while not done:
-                row = cursor.fetchone()
-                if row is not None:
-                    timestamp = datetime.strptime(row[2], '%Y-%m-%d %H:%M:%S.%f')
-                    file_object = FileObject(full_name=row[0], size=row[1], timestamp=timestamp)
-                    objects.append(file_object)
-                else:
-                    done = True
-        super().__init__(objects)
+    """
+    Repository of the object versions of a bucket, read from a local cache database (see ListingCache).
+    """
+    TIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+    def __init__(self, database_name, prefix='', lazy=False):
+        """
+
+        :param database_name: (string) Name of cache database (migrated if written by an earlier version)
+        :param prefix: (string) Prefix of the folder the repository is limited to ('' for whole bucket)
+        :param lazy: (bool) Don't read objects until they are used; folders can be listed with list_folder
+        """
+        self._database_name = database_name
+        self._cache = ListingCache(database_name)
+        super().__init__(None, supports_versions=True, prefix=prefix)
+        if not lazy:
+            self.file_objects
+            self.close()
+
+    @property
+    def cache(self):
+        """
+        Get the cache the repository is read from, opened again if it was closed.
+
+        :return: (ListingCache) Cache of bucket
+        """
+        if self._cache is None:
+            self._cache = ListingCache(self._database_name)
+        return self._cache
+
+    def close(self):
+        if self._cache is not None:
+            self._cache.close()
+            self._cache = None
+
+    def _load(self):
+        objects = CompactListing()
+        condition, parameters = self.cache.prefix_condition(self._prefix)
+        for key, version_id, size, mtime, e_tag, storage_class, is_latest, is_delete_marker, row_id \
+                in self.cache.versions(condition, parameters):
+            objects.append_epoch(key + VERSION_DELIMITER + version_id, size, mtime, storage_class, False, is_latest,
+                                 is_delete_marker)
+        return objects
+
+    def list_folder(self, prefix=None):
+        """
+        List the immediate children of a folder with one query of the cache.
+
+        :param prefix: (string) Prefix of folder, with trailing delimiter (default: prefix of repository)
+        :return: (tuple) CompactListing of file objects in folder, list of prefixes of its sub-folders
+        """
+        if prefix is None:
+            prefix = self._prefix
+        rows, folders = self.cache.list_folder(prefix)
+        objects = CompactListing()
+        for key, version_id, size, mtime, e_tag, storage_class, is_latest, is_delete_marker, row_id in rows:
+            objects.append_epoch(key + VERSION_DELIMITER + version_id, size, mtime, storage_class, False, is_latest,
+                                 is_delete_marker)
+        return objects, folders
 
     @classmethod
-    def create_local_cached_database(cls, bucket_name, database_name=None):
+    def format_time(cls, timestamp):
+        return timestamp.strftime(cls.TIME_FORMAT)
+
+    @classmethod
+    def create_local_cached_database(cls, bucket_name, database_name=None, client=None):
         if not database_name:
             database_name = bucket_name + '.db'
-        if os.path.exists(database_name):
-            os.remove(database_name)
-        bucket = S3Repository(bucket_name)
-        with sqlite3.connect(database_name) as db:
-            cursor = db.cursor()
-            cursor.execute('''CREATE TABLE "FileObjects" ( 
-                    "Name"	TEXT,
-                    "Size"	INTEGER,
-                    "Time"  TEXT
-                    )''')
-            for obj in bucket.file_objects:
-                cursor.execute('''INSERT INTO FileObjects(Name,Size,Time)
-                                      VALUES(?,?,?)''', (
-                    obj.full_name, obj.size, obj.timestamp.strftime('%Y-%m-%d %H:%M:%S.%f')))
+        bucket = S3Repository(bucket_name, client=client)
+        prefixes = dict()
+        for obj in bucket.file_objects:
+            prefixes.setdefault(S3Repository.checkpoint_prefix(obj.full_name), []).append(obj)
+        with ListingCache.build(database_name, bucket.file_objects) as cache:
+            cursor = cache.db.cursor()
+            for prefix, file_objects in prefixes.items():
+                cls._write_checkpoint(cursor, PrefixCheckpoint.from_file_objects(prefix, file_objects))
         return bucket
 
+    @classmethod
+    def stream_local_cached_database(cls, bucket_name, database_name=None, client=None, on_progress=None,
+                                     batch_size=STREAM_BATCH_SIZE):
+        """
+        Create the local cache of a bucket while the bucket is listed.  Unlike create_local_cached_database,
+        the cache keeps its indexes while it is filled and the versions listed are committed every
+        batch_size versions, so another connection can show and search the cache as it grows.  Rows already
+        in the cache are deleted first.  The checkpoint of each top-level prefix is written once its last
+        version is listed, so an interrupted build can be completed by refresh_local_cached_database.
+
+        :param bucket_name: (string) Name of bucket
+        :param database_name: (string) Name of cache database (default: <bucket_name>.db)
+        :param client: (S3.Client) S3 client to use (default: shared client, see S3Client)
+        :param on_progress: (function) Called with the number of versions written after each commit, and None
+                            for the total, which is not known until the listing ends; it may raise to stop
+        :param batch_size: (int) Versions written between commits
+        :return: (int) Number of versions in cache
+        """
+        if not database_name:
+            database_name = bucket_name + '.db'
+        if client is None:
+            client = get_client()
+        lister = ShardedLister(client, bucket_name, max_workers=1)
+        with ListingCache(database_name) as cache:
+            cache.clear()
+            cache.commit()
+            cursor = cache.db.cursor()
+            count = 0
+            batch = []
+            # keys are listed in order, so the versions of each top-level prefix are listed together; those
+            # at the root of the bucket are not, as their keys sort between prefixes
+            prefix = None
+            prefix_objects = []
+            root_objects = []
+            for obj in (S3FileObject(o) for o in lister.list_serial('')):
+                obj_prefix = S3Repository.checkpoint_prefix(obj.full_name)
+                if obj_prefix == '':
+                    root_objects.append(obj)
+                else:
+                    if obj_prefix != prefix:
+                        if prefix_objects:
+                            cls._write_checkpoint(cursor, PrefixCheckpoint.from_file_objects(prefix, prefix_objects))
+                        prefix = obj_prefix
+                        prefix_objects = []
+                    prefix_objects.append(obj)
+                batch.append(obj)
+                if len(batch) >= batch_size:
+                    count += cache.add_file_objects(batch)
+                    batch = []
+                    cache.commit()
+                    if on_progress is not None:
+                        on_progress(count, None)
+            count += cache.add_file_objects(batch)
+            if prefix_objects:
+                cls._write_checkpoint(cursor, PrefixCheckpoint.from_file_objects(prefix, prefix_objects))
+            if root_objects:
+                cls._write_checkpoint(cursor, PrefixCheckpoint.from_file_objects('', root_objects))
+            cache.commit()
+            if on_progress is not None:
+                on_progress(count, count)
+        return count
+
+    @classmethod
+    def refresh_local_cached_database(cls, bucket_name, database_name=None, client=None, on_progress=None):
+        """
+        Incrementally refresh the local cache of a bucket.  Each top-level prefix is listed and compared
+        with its stored checkpoint; only the rows of prefixes whose checkpoint changed are upserted or
+        deleted, all in a single transaction.  If the cache does not exist or was built without
+        checkpoints, a full cache is created instead.
+
+        With on_progress, the changes of each prefix are committed as soon as the prefix is compared
+        instead, so another connection can show the cache as it is refreshed.
+
+        :param bucket_name: (string) Name of bucket
+        :param database_name: (string) Name of cache database (default: <bucket_name>.db)
+        :param client: (S3.Client) S3 client to use (default: shared client, see S3Client)
+        :param on_progress: (function) Called with the number of prefixes compared and the number of prefixes
+                            after each prefix; it may raise to stop, keeping the prefixes already refreshed
+        :return: (CachedRepository) Repository loaded from the refreshed cache
+        """
+        if not database_name:
+            database_name = bucket_name + '.db'
+        if not cls.has_checkpoints(database_name):
+            cls.create_local_cached_database(bucket_name, database_name, client)
+            return CachedRepository(database_name)
+        if client is None:
+            client = get_client()
+        with ListingCache(database_name) as cache:
+            cursor = cache.db.cursor()
+            cursor.execute('SELECT Prefix, Count, Newest, Digest FROM PrefixCheckpoints')
+            checkpoints = dict((row[0], PrefixCheckpoint(*row)) for row in cursor.fetchall())
+            prefixes = S3Repository.list_checkpoint_prefixes(client, bucket_name)
+            for done, prefix in enumerate(prefixes, 1):
+                versions = S3Repository.list_prefix_versions(client, bucket_name, prefix)
+                file_objects = [S3FileObject(o) for o in versions]
+                checkpoint = PrefixCheckpoint.from_file_objects(prefix, file_objects)
+                if checkpoints.pop(prefix, None) != checkpoint:
+                    cls._update_prefix_rows(cache, prefix, file_objects)
+                    cls._write_checkpoint(cursor, checkpoint)
+                if on_progress is not None:
+                    cache.commit()
+                    on_progress(done, len(prefixes))
+            # prefixes that no longer exist in bucket
+            for prefix in checkpoints:
+                cls._update_prefix_rows(cache, prefix, [])
+                cursor.execute('DELETE FROM PrefixCheckpoints WHERE Prefix=?', (prefix,))
+        return CachedRepository(database_name)
+
     @classmethod
     def load_from_cache(cls, bucket_name, database_name=None):
         if not database_name:
             database_name = bucket_name + '.db'
-            bucket = CachedRepository(database_name)
-            return bucket
+        bucket = CachedRepository(database_name)
+        return bucket
+
+    @staticmethod
+    def has_checkpoints(database_name):
+        """
+        Check whether a cache was built with prefix checkpoints, so it can be refreshed incrementally.
+
+        :param database_name: (string) Name of cache database
+        :return: (bool) True if cache exists and has checkpoints
+        """
+        if not os.path.exists(database_name):
+            return False
+        with sqlite3.connect(database_name) as db:
+            cursor = db.cursor()
+            cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='PrefixCheckpoints'")
+            return cursor.fetchone() is not None
+
+    @staticmethod
+    def _write_checkpoint(cursor, checkpoint):
+        cursor.execute('''INSERT OR REPLACE INTO PrefixCheckpoints(Prefix,Count,Newest,Digest)
+                              VALUES(?,?,?,?)''', checkpoint.row)
+
+    @staticmethod
+    def _prefix_condition(prefix):
+        """
+        Get the SQL condition selecting the cached versions stored under a top-level prefix.
+
+        :param prefix: (string) Top-level prefix
+        :return: (tuple) SQL condition on o.Key and its parameters
+        """
+        if prefix == '':
+            return 'instr(o.Key, ?) = 0', (S3Repository.CHECKPOINT_DELIMITER,)
+        # all keys under prefix sort between prefix and prefix with its trailing delimiter incremented
+        upper = prefix[0:-1] + chr(ord(prefix[-1]) + 1)
+        return 'o.Key >= ? AND o.Key < ?', (prefix, upper)
+
+    @classmethod
+    def _update_prefix_rows(cls, cache, prefix, file_objects):
+        """
+        Make the cached versions under a prefix match the listed file objects, writing only rows that changed.
+
+        :param cache: (ListingCache) Cache of bucket
+        :param prefix: (string) Top-level prefix
+        :param file_objects: (list) S3FileObjects now listed under prefix
+        """
+        condition, parameters = cls._prefix_condition(prefix)
+        cached = dict()
+        for row in cache.versions(condition, parameters):
+            cached[row[0:2]] = row
+        listed = []
+        for obj in file_objects:
+            key, version_id = split_version_name(obj.full_name)
+            cached_row = cached.pop((key, version_id), None)
+            row = (key, version_id, 0 if obj.is_delete_marker else obj.size, epoch_microseconds(obj.timestamp),
+                   obj.e_tag, obj.storage_class.value, int(bool(obj.is_latest)), int(obj.is_delete_marker))
+            if cached_row is None or cached_row[0:8] != row:
+                if cached_row is not None:
+                    cached[(key, version_id)] = cached_row
+                listed.append(row)
+        # changed versions are replaced; versions no longer listed are removed
+        cache.delete_versions(row[8] for row in cached.values())
+        cache.add_rows(listed)
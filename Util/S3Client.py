@@ -0,0 +1,216 @@
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from Util.Metrics import instrument_client
+
+DEFAULT_MAX_CONCURRENCY = 10
+DEFAULT_MAX_ATTEMPTS = 10
+DEFAULT_RETRY_MODE = 'adaptive'
+
+
+class S3ClientConfig:
+    """
+    Settings of the clients shared by the whole process.  max_concurrency is the one knob for
+    concurrency: it is the size of the connection pool of every client, the number of threads of the
+    shared thread pool, and the default number of listing and transfer requests made at the same time.
+    """
+    __slots__ = ('_max_concurrency', '_max_attempts', '_retry_mode', '_region_name', '_endpoint_url')
+
+    def __init__(self, max_concurrency=DEFAULT_MAX_CONCURRENCY, max_attempts=DEFAULT_MAX_ATTEMPTS,
+                 retry_mode=DEFAULT_RETRY_MODE, region_name=None, endpoint_url=None):
+        """
+
+        :param max_concurrency: (int) Number of requests made at the same time
+        :param max_attempts: (int) Number of attempts of a request, including the first, before it fails
+        :param retry_mode: (string) botocore retry mode: 'adaptive' also slows requests down on throttling,
+                           'standard' only backs off exponentially between attempts
+        :param region_name: (string) AWS region (default: from the AWS configuration)
+        :param endpoint_url: (string) URL of an S3-compatible service (default: AWS)
+        """
+        if max_concurrency < 1:
+            raise Exception('max_concurrency must be at least 1')
+        if max_attempts < 1:
+            raise Exception('max_attempts must be at least 1')
+        self._max_concurrency = max_concurrency
+        self._max_attempts = max_attempts
+        self._retry_mode = retry_mode
+        self._region_name = region_name
+        self._endpoint_url = endpoint_url
+
+    @property
+    def max_concurrency(self):
+        return self._max_concurrency
+
+    @property
+    def max_attempts(self):
+        return self._max_attempts
+
+    @property
+    def retry_mode(self):
+        return self._retry_mode
+
+    @property
+    def region_name(self):
+        return self._region_name
+
+    @property
+    def endpoint_url(self):
+        return self._endpoint_url
+
+    def botocore_config(self):
+        """
+        Get the botocore configuration of the shared clients.
+
+        :return: (botocore.config.Config) Configuration with the pool size and retry settings
+        """
+        from botocore.config import Config
+        return Config(max_pool_connections=self._max_concurrency,
+                      retries={'max_attempts': self._max_attempts, 'mode': self._retry_mode})
+
+
+_lock = threading.Lock()
+_config = S3ClientConfig()
+_clients = dict()
+_executor = None
+
+
+def configure(config):
+    """
+    Set the settings of the shared clients.  Clients made with the earlier settings are dropped, so the
+    next get_client makes a new one.
+
+    :param config: (S3ClientConfig) Settings
+    """
+    global _config, _executor
+    with _lock:
+        _config = config
+        _clients.clear()
+        if _executor is not None:
+            _executor.shutdown(wait=False)
+            _executor = None
+
+
+def get_config():
+    return _config
+
+
+def max_concurrency():
+    """
+    Get the number of requests made at the same time, for callers that don't set their own.
+
+    :return: (int) Concurrency of the shared clients
+    """
+    return _config.max_concurrency
+
+
+def get_client(service_name='s3'):
+    """
+    Get the client of a service shared by the whole process.  boto3 clients are thread-safe, so every
+    thread uses the same client and connection pool.
+
+    :param service_name: (string) Name of AWS service
+    :return: Client (boto3 client, unless another was set with set_client)
+    """
+    with _lock:
+        client = _clients.get(service_name)
+        if client is None:
+            import boto3
+            session = boto3.session.Session()
+            client = session.client(service_name, region_name=_config.region_name,
+                                    endpoint_url=_config.endpoint_url if service_name == 's3' else None,
+                                    config=_config.botocore_config())
+            instrument_client(client)
+            _clients[service_name] = client
+        return client
+
+
+def set_client(client, service_name='s3'):
+    """
+    Share a client made elsewhere, such as a fake client in tests, instead of a boto3 client.
+
+    :param client: Client, or None to go back to a boto3 client
+    :param service_name: (string) Name of AWS service
+    """
+    with _lock:
+        if client is None:
+            _clients.pop(service_name, None)
+        else:
+            instrument_client(client)
+            _clients[service_name] = client
+
+
+def get_executor():
+    """
+    Get the thread pool the asyncio interface runs requests on, with max_concurrency threads.
+
+    :return: (ThreadPoolExecutor) Shared thread pool
+    """
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=_config.max_concurrency, thread_name_prefix='s3')
+        return _executor
+
+
+class AsyncS3Client:
+    """
+    asyncio interface to a client.  Each method of the client is a coroutine here, run on the shared
+    thread pool, so at most max_concurrency requests of the process are in flight however many
+    coroutines are waiting for them.
+    """
+
+    def __init__(self, client=None):
+        """
+
+        :param client: Client (default: shared S3 client)
+        """
+        self._client = client if client is not None else get_client()
+
+    @property
+    def client(self):
+        return self._client
+
+    def __getattr__(self, name):
+        method = getattr(self._client, name)
+
+        async def call(**kwargs):
+            import asyncio
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(get_executor(), functools.partial(method, **kwargs))
+
+        call.__name__ = name
+        return call
+
+    async def paginate(self, operation, **kwargs):
+        """
+        Get the pages of a listing, each page requested on the shared thread pool.
+
+        :param operation: (string) Name of listing operation, such as 'list_object_versions'
+        :param kwargs: Parameters of operation
+        :return: (async iterator) Response pages
+        """
+        import asyncio
+        loop = asyncio.get_running_loop()
+        pages = iter(self._client.get_paginator(operation).paginate(**kwargs))
+        while True:
+            page = await loop.run_in_executor(get_executor(), next, pages, None)
+            if page is None:
+                return
+            yield page
+
+
+def run_all(calls):
+    """
+    Make calls of the asyncio interface at the same time from synchronous code, and wait for all of them.
+
+    :param calls: (list) Coroutines, such as AsyncS3Client(client).head_object(Bucket=..., Key=...)
+    :return: (list) Results in the order of calls; a call that raised gives its exception
+    """
+    # asyncio is only imported when the asyncio interface is used, so the command line tools start without it
+    import asyncio
+
+    async def gather():
+        return await asyncio.gather(*calls, return_exceptions=True)
+
+    return asyncio.run(gather())
@@ -0,0 +1,149 @@
+from concurrent.futures import ThreadPoolExecutor
+from operator import attrgetter
+
+from Util.Metrics import timed, timer
+from Util.S3Client import max_concurrency
+
+DEFAULT_SHARD_DEPTH = 2
+
+
+class ListedObject:
+    """
+    An object (or object version) returned by a listing call.  It has the same attributes as the boto3
+    ObjectSummary and ObjectVersion resources, so it can be used wherever those are used.
+    """
+    __slots__ = ('key', 'id', 'last_modified', 'size', 'is_latest', 'storage_class', 'e_tag')
+
+    def __init__(self, item, is_delete_marker=False):
+        """
+
+        :param item: (dict) Entry of Versions, DeleteMarkers or Contents in a listing response
+        :param is_delete_marker: (bool) True if item is from DeleteMarkers
+        """
+        self.key = item['Key']
+        self.id = item.get('VersionId')
+        self.last_modified = item['LastModified']
+        self.size = None if is_delete_marker else item.get('Size', 0)
+        self.is_latest = item.get('IsLatest', True)
+        self.storage_class = item.get('StorageClass')
+        self.e_tag = item.get('ETag')
+
+    @property
+    def object_key(self):
+        return self.key
+
+    @property
+    def version_id(self):
+        return self.id
+
+
+class ShardedLister:
+    """
+    Lists a bucket by first finding its prefix tree with delimiter-based listing calls, then listing
+    each prefix below the tree (a shard) at the same time on a thread pool.  Objects are returned in
+    the same order as a single serial listing: by key, and newest version first within a key.
+    """
+
+    def __init__(self, client, bucket_name, versions=True, max_workers=None, shard_depth=DEFAULT_SHARD_DEPTH,
+                 delimiter='/'):
+        """
+
+        :param client: (S3.Client) S3 client, shared by all worker threads
+        :param bucket_name: (string) Name of bucket
+        :param versions: (bool) List all object versions (ListObjectVersions) instead of objects (ListObjectsV2)
+        :param max_workers: (int) Number of listing calls made at the same time (default: concurrency of the
+                            shared clients, see S3Client)
+        :param shard_depth: (int) Number of prefix levels discovered before the shards are listed
+        :param delimiter: (string) Delimiter between folders in keys
+        """
+        if max_workers is None:
+            max_workers = max_concurrency()
+        if max_workers < 1:
+            raise Exception('max_workers must be at least 1')
+        self._client = client
+        self._bucket_name = bucket_name
+        self._versions = versions
+        self._max_workers = max_workers
+        self._shard_depth = shard_depth
+        self._delimiter = delimiter
+
+    @property
+    def max_workers(self):
+        return self._max_workers
+
+    def list(self, prefix=''):
+        """
+        List all objects under a prefix, listing shards in parallel.
+
+        :param prefix: (string) Prefix to list (default: whole bucket)
+        :return: (iterator) ListedObjects, in key order
+        """
+        with ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+            # a segment is either the objects directly under a discovered prefix (sorted by their key)
+            # or a pending shard (sorted by its prefix, which sorts the same as every key under it)
+            segments = []
+            level = [prefix]
+            for depth in range(self._shard_depth):
+                next_level = []
+                for objects, common_prefixes in executor.map(self.list_level, level):
+                    segments.extend((o.key, o) for o in objects)
+                    next_level.extend(common_prefixes)
+                level = next_level
+            segments.extend((p, executor.submit(self._list_shard, p)) for p in level)
+            # stable sort keeps the versions of a key in listing order
+            segments.sort(key=lambda segment: segment[0])
+            for sort_key, segment in segments:
+                if isinstance(segment, ListedObject):
+                    yield segment
+                else:
+                    yield from segment.result()
+
+    def list_serial(self, prefix=''):
+        """
+        List all objects under a prefix one page at a time on the calling thread.
+
+        :param prefix: (string) Prefix to list (default: whole bucket)
+        :return: (iterator) ListedObjects, in key order
+        """
+        for page in self._paginate(Prefix=prefix):
+            yield from self._page_objects(page)
+
+    def list_level(self, prefix):
+        """
+        List the objects directly under a prefix and the common prefixes below it.
+
+        :param prefix: (string) Prefix to list
+        :return: (tuple) list of ListedObjects, list of common prefixes
+        """
+        objects = []
+        common_prefixes = []
+        for page in self._paginate(Prefix=prefix, Delimiter=self._delimiter):
+            objects.extend(self._page_objects(page))
+            common_prefixes.extend(p['Prefix'] for p in page.get('CommonPrefixes', []))
+        return objects, common_prefixes
+
+    def _list_shard(self, prefix):
+        return list(self.list_serial(prefix))
+
+    def _paginate(self, **kwargs):
+        operation = 'list_object_versions' if self._versions else 'list_objects_v2'
+        paginator = self._client.get_paginator(operation)
+        # each page is timed from its request until its response is parsed
+        return timed('list_page', paginator.paginate(Bucket=self._bucket_name, **kwargs), each=True)
+
+    def _page_objects(self, page):
+        """
+        Get the objects of one listing page in key order, with the versions and delete markers of
+        each key merged newest first.
+
+        :param page: (dict) Listing response
+        :return: (list) ListedObjects
+        """
+        with timer('object_build'):
+            if not self._versions:
+                return [ListedObject(item) for item in page.get('Contents', [])]
+            objects = [ListedObject(item) for item in page.get('Versions', [])]
+            objects.extend(ListedObject(item, is_delete_marker=True) for item in page.get('DeleteMarkers', []))
+            objects.sort(key=attrgetter('last_modified'), reverse=True)
+            objects.sort(key=attrgetter('key'))
+            return objects
@@ -1,6 +1,7 @@
 
-import boto3
 from enum import Enum
+from Util.S3Client import get_client
+from Util.S3Listing import ShardedLister, DEFAULT_SHARD_DEPTH
 
 
 class S3StorageClass(Enum):
@@ -15,6 +16,7 @@ class S3StorageClass(Enum):
     ONEZONE_IA = 5
     INTELLIGENT_TIERING = 6
     DEEP_ARCHIVE = 7
+    GLACIER_IR = 8
 
     @classmethod
     def FromObject(cls, o):
@@ -25,7 +27,29 @@ class S3StorageClass(Enum):
 
 
 
+def newest_first_position(versions, time_stamp):
+    """
+    Binary search versions sorted newest first for the first version not newer than a time.
+
+    :param versions: (list) Versions with a time_stamp, newest first
+    :param time_stamp: (datetime) Date/time
+    :return: (int) Index of first version stored at or before time_stamp (len(versions) if none)
+    """
+    low = 0
+    high = len(versions)
+    while low < high:
+        middle = (low + high) // 2
+        if versions[middle].time_stamp > time_stamp:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+
 class S3FileObject:
+    __slots__ = ('_key', '_versions', '_num_versions', '_time_stamp', '_size', '_storage_class', '_is_deleted',
+                 '_e_tag')
+
     def __init__(self, key, bucket_object=None, bucket_object_version=None):
         if not bucket_object and not bucket_object_version:
             raise Exception('Must supply either bucket_object or bucket_object_version')
@@ -42,15 +66,26 @@ class S3FileObject:
             self._size = bucket_object.size
             self._storage_class = S3StorageClass.FromObject(bucket_object)
             self._is_deleted = False
+            self._e_tag = bucket_object.e_tag
             self._num_versions = 1
 
     def add_version(self, file_version):
-        self._versions.append(file_version)
+        """
+        Add a version, keeping the versions sorted newest first.  Listings return the versions of a key
+        newest first, so a version is normally appended; an out of order one is inserted in place.
+
+        :param file_version: (S3FileVersion) Version of object
+        """
+        if not self._versions or file_version.time_stamp <= self._versions[-1].time_stamp:
+            self._versions.append(file_version)
+        else:
+            self._versions.insert(newest_first_position(self._versions, file_version.time_stamp), file_version)
         if file_version.is_latest:
             self._time_stamp = file_version.time_stamp
             self._size = file_version.size
             self._is_deleted = file_version.is_delete_marker
             self._storage_class = file_version.storage_class
+            self._e_tag = file_version.e_tag
         self._num_versions += 1
 
     @property
@@ -59,8 +94,28 @@ class S3FileObject:
 
     @property
     def versions(self):
+        """
+        Get the versions of the object, newest first.
+
+        :return: (list) S3FileVersions
+        """
         return self._versions
 
+    def version_at(self, time_stamp):
+        """
+        Get the version that was current at a time: the newest version stored at or before the time,
+        found by binary search of the versions.
+
+        :param time_stamp: (datetime) Timezone-aware date/time
+        :return: (S3FileVersion) Version (possibly a delete marker), or None if object did not exist yet
+        """
+        if not self._versions:
+            return None
+        position = newest_first_position(self._versions, time_stamp)
+        if position == len(self._versions):
+            return None
+        return self._versions[position]
+
     @property
     def time_stamp(self):
         return self._time_stamp
@@ -77,18 +132,25 @@ class S3FileObject:
     def is_deleted(self):
         return self._is_deleted
 
+    @property
+    def e_tag(self):
+        return self._e_tag
+
     @property
     def num_versions(self):
         return self._num_versions
 
 
 class S3FileVersion:
+    __slots__ = ('_version_id', '_time_stamp', '_size', '_is_latest', '_storage_class', '_e_tag')
+
     def __init__(self, o):
         self._version_id = o.id
         self._time_stamp = o.last_modified
         self._size = o.size
         self._is_latest = o.is_latest
         self._storage_class = S3StorageClass.FromObject(o)
+        self._e_tag = o.e_tag
 
     @property
     def version_id(self):
@@ -120,6 +182,10 @@ class S3FileVersion:
     def storage_class(self):
         return self._storage_class
 
+    @property
+    def e_tag(self):
+        return self._e_tag
+
     def __cmp__(self, other):
         if self._time_stamp < other.time_stamp:
             return -1
@@ -141,25 +207,83 @@ class S3FileVersion:
 
 
 class Repository:
-    def __init__(self, bucket_name):
-        client = boto3.client('s3')
-        response = client.get_bucket_versioning(Bucket=bucket_name)
-        if 'Status' in response and response['Status'] == 'Enabled':
-            self._versioning = True
-        else:
-            self._versioning = False
-        s3 = boto3.resource('s3')
-        self._bucket = s3.Bucket(bucket_name)
+    def __init__(self, bucket_name, max_workers=None, shard_depth=DEFAULT_SHARD_DEPTH, client=None, prefix=''):
+        """
+
+        :param bucket_name: (string) Name of bucket
+        :param max_workers: (int) Number of prefix shards listed at the same time (1 lists serially; default:
+                            concurrency of the shared clients)
+        :param shard_depth: (int) Number of prefix levels discovered before shards are listed
+        :param client: (S3.Client) S3 client to use (default: shared client, see S3Client)
+        :param prefix: (string) Only list the objects under this prefix (default: whole bucket)
+        """
+        if client is None:
+            client = get_client()
+        self._prefix = prefix
+        self._versioning = self.versioning_enabled(client, bucket_name)
         self._objects = dict()
+        lister = ShardedLister(client, bucket_name, versions=self._versioning, max_workers=max_workers,
+                               shard_depth=shard_depth)
+        if lister.max_workers > 1:
+            self._add_objects(lister.list(prefix))
+        else:
+            self._add_objects(lister.list_serial(prefix))
+
+    @staticmethod
+    def versioning_enabled(client, bucket_name):
+        """
+        Is versioning enabled on a bucket?
+
+        :param client: (S3.Client) S3 client
+        :param bucket_name: (string) Name of bucket
+        :return: (bool) True if versioning enabled, False if not.
+        """
+        response = client.get_bucket_versioning(Bucket=bucket_name)
+        return 'Status' in response and response['Status'] == 'Enabled'
+
+    @classmethod
+    def stream(cls, bucket_name, client=None, prefix=''):
+        """
+        Get the objects of a bucket as each listing page arrives, without keeping the whole bucket in memory.
+
+        :param bucket_name: (string) Name of bucket
+        :param client: (S3.Client) S3 client to use (default: shared client, see S3Client)
+        :param prefix: (string) Only list the objects under this prefix (default: whole bucket)
+        :return: (iterator) S3FileObjects, in key order
+        """
+        if client is None:
+            client = get_client()
+        versioning = cls.versioning_enabled(client, bucket_name)
+        lister = ShardedLister(client, bucket_name, versions=versioning, max_workers=1)
+        if not versioning:
+            for o in lister.list_serial(prefix):
+                yield S3FileObject(o.key, bucket_object=o)
+            return
+        # listings are in key order, so the versions of a key are consecutive
+        file_object = None
+        for o in lister.list_serial(prefix):
+            if file_object is not None and file_object.key == o.key:
+                file_object.add_version(S3FileVersion(o))
+                continue
+            if file_object is not None:
+                yield file_object
+            file_object = S3FileObject(o.key, bucket_object_version=o)
+        if file_object is not None:
+            yield file_object
+
+    def _add_objects(self, objects):
+        """
+        Add listed objects to the repository, merging the versions of each key into one S3FileObject.
+
+        :param objects: (iterator) ListedObjects
+        """
         if self._versioning:
-            objects = self._bucket.object_versions.all()
             for o in objects:
                 if o.key in self._objects:
                     self._objects[o.key].add_version(S3FileVersion(o))
                 else:
                     self._objects[o.key] = S3FileObject(o.key, bucket_object_version=o)
         else:
-            objects = self._bucket.objects.all()
             for o in objects:
                 self._objects[o.key] = S3FileObject(o.key, bucket_object=o)
 
@@ -170,3 +294,7 @@ class Repository:
     @property
     def versioning(self):
         return self._versioning
+
+    @property
+    def prefix(self):
+        return self._prefix
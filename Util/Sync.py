@@ -0,0 +1,257 @@
+import os
+from enum import Enum
+
+
+class SyncActionType(Enum):
+    """
+    Enumeration of the actions of a three-way sync of a local folder and a bucket.
+    """
+    Upload = 1
+    Download = 2
+    DeleteRemote = 3
+    DeleteLocal = 4
+    Conflict = 5
+    Record = 6
+    Forget = 7
+    Skip = 8
+
+    @property
+    def Description(self):
+        if self == SyncActionType.Upload:
+            return 'Upload file created or changed locally'
+        elif self == SyncActionType.Download:
+            return 'Download object created or changed in bucket'
+        elif self == SyncActionType.DeleteRemote:
+            return 'Delete object of file deleted locally'
+        elif self == SyncActionType.DeleteLocal:
+            return 'Delete file of object deleted in bucket'
+        elif self == SyncActionType.Conflict:
+            return 'File and object both changed since last sync'
+        elif self == SyncActionType.Record:
+            return 'Record file and object already identical'
+        elif self == SyncActionType.Forget:
+            return 'Forget file deleted on both sides'
+        elif self == SyncActionType.Skip:
+            return 'Skip unchanged file'
+
+
+class ConflictPolicy(Enum):
+    """
+    Enumeration of the ways a conflict (a file and its object both changed since the last sync) is resolved.
+    """
+    Newer = 1
+    Local = 2
+    Remote = 3
+    Skip = 4
+
+    @property
+    def Description(self):
+        if self == ConflictPolicy.Newer:
+            return 'Keep whichever side was modified last'
+        elif self == ConflictPolicy.Local:
+            return 'Keep the local file'
+        elif self == ConflictPolicy.Remote:
+            return 'Keep the object in the bucket'
+        elif self == ConflictPolicy.Skip:
+            return 'Leave both sides as they are'
+
+
+class SyncAction:
+    """
+    Action for one key of a three-way sync, with the local, remote and last-sync states it was decided from.
+    """
+    __slots__ = ('_action', '_key', '_local', '_remote', '_base', '_hashes', '_resolution')
+
+    def __init__(self, action, key, local, remote, base, hashes=None, resolution=None):
+        """
+
+        :param action: (SyncActionType) Action to take
+        :param key: (string) Path of file relative to the local folder and the prefix, with '/' delimiters
+        :param local: (DiffEntry) Entry of local file, or None if there is no local file
+        :param remote: (DiffEntry) Entry of latest version of object, or None if there is no object
+        :param base: (FileState) State of file at the last sync, or None if it wasn't synchronized
+        :param hashes: (tuple) Content hash and multipart ETag of local file, if they are known
+        :param resolution: (SyncActionType) For a Conflict, the action that resolves it (Upload, Download
+                           or Skip)
+        """
+        self._action = action
+        self._key = key
+        self._local = local
+        self._remote = remote
+        self._base = base
+        self._hashes = hashes
+        self._resolution = resolution
+
+    @property
+    def action(self):
+        return self._action
+
+    @property
+    def key(self):
+        return self._key
+
+    @property
+    def local(self):
+        return self._local
+
+    @property
+    def remote(self):
+        return self._remote
+
+    @property
+    def base(self):
+        return self._base
+
+    @property
+    def hashes(self):
+        return self._hashes
+
+    @property
+    def resolution(self):
+        return self._resolution
+
+    @property
+    def effective_action(self):
+        """
+        Get the action that is carried out: the resolution of a conflict, otherwise the action.
+
+        :return: (SyncActionType) Action
+        """
+        if self._action == SyncActionType.Conflict:
+            return self._resolution
+        return self._action
+
+
+def sync_diff(local, remote, base, local_hashes, policy=ConflictPolicy.Newer):
+    """
+    Merge-join the local folder, the bucket and the state of the last sync, three streams sorted by key, in
+    one pass.  A side changed if it differs from the last sync: a local file is only hashed when its stat
+    differs from the recorded one, and an object changed if its version (or, in an unversioned bucket, its
+    ETag) differs from the recorded one.  Changes on one side are copied to the other; a file modified on
+    one side and deleted on the other is kept; files changed on both sides to the same contents are
+    recorded, and files changed differently are conflicts, resolved by the policy.
+
+    :param local: (iterator) DiffEntries of local folder, sorted by key, file_object is the full path
+    :param remote: (iterator) DiffEntries of latest versions of objects, sorted by key
+    :param base: (iterator) FileStates of last sync, sorted by path
+    :param local_hashes: (function) Returns the content hash and multipart ETag of a local entry
+    :param policy: (ConflictPolicy) How conflicts are resolved
+    :return: (iterator) SyncActions, in key order
+    """
+    l = next(local, None)
+    r = next(remote, None)
+    b = next(base, None)
+    while l is not None or r is not None or b is not None:
+        key = min(k for k in (l and l.key, r and r.key, b and b.path) if k is not None)
+        local_entry = l if l is not None and l.key == key else None
+        remote_entry = r if r is not None and r.key == key else None
+        state = b if b is not None and b.path == key else None
+        yield _sync_action(key, local_entry, remote_entry, state, local_hashes, policy)
+        if local_entry is not None:
+            l = next(local, None)
+        if remote_entry is not None:
+            r = next(remote, None)
+        if state is not None:
+            b = next(base, None)
+
+
+def _sync_action(key, local, remote, state, local_hashes, policy):
+    hashes = None
+    if local is None or state is None or local.size != state.size:
+        local_changed = local is not None or state is not None
+    else:
+        # the stat of the scan, so a file isn't stat'ed again for every sync
+        stat_result = local.stat_result
+        if stat_result is None:
+            try:
+                stat_result = os.stat(local.file_object)
+            except FileNotFoundError:
+                # deleted since the folder was scanned
+                stat_result = None
+        if stat_result is None:
+            local = None
+            local_changed = True
+        elif state.matches(stat_result):
+            local_changed = False
+            hashes = (state.content_hash, state.e_tag)
+        else:
+            hashes = local_hashes(local)
+            local_changed = hashes[0] != state.content_hash
+    remote_changed = object_changed(remote, state)
+
+    def action(action_type, resolution=None):
+        return SyncAction(action_type, key, local, remote, state, hashes, resolution)
+
+    if not local_changed and not remote_changed:
+        if local is not None and remote is not None and state.remote_e_tag is None:
+            # recorded by Update or Restore, which don't keep the version of the object
+            return action(SyncActionType.Record)
+        return action(SyncActionType.Skip)
+    if local is not None and remote is not None and local.size == remote.size:
+        if hashes is None:
+            hashes = local_hashes(local)
+        if remote.content_hash == hashes[0] or (hashes[1] is not None and remote.e_tag == hashes[1]):
+            return action(SyncActionType.Record)
+    if not remote_changed:
+        return action(SyncActionType.Upload if local is not None else SyncActionType.DeleteRemote)
+    if not local_changed:
+        return action(SyncActionType.Download if remote is not None else SyncActionType.DeleteLocal)
+    if local is None and remote is None:
+        return action(SyncActionType.Forget)
+    # a modification wins over a delete
+    if local is None:
+        return action(SyncActionType.Download)
+    if remote is None:
+        return action(SyncActionType.Upload)
+    return action(SyncActionType.Conflict, resolve_conflict(local, remote, policy))
+
+
+def object_changed(remote, state):
+    """
+    Has an object changed since the last sync?  Objects are compared by version id in versioned buckets,
+    and by ETag otherwise.  States recorded without the version of the object are compared with the
+    content hash or multipart ETag of the file, which is the ETag of an object uploaded from it.
+
+    :param remote: (DiffEntry) Entry of latest version of object, or None if there is no object
+    :param state: (FileState) State of file at the last sync, or None if it wasn't synchronized
+    :return: (bool) True if object was created, changed or deleted since the last sync
+    """
+    if remote is None or state is None:
+        return remote is not None or state is not None
+    if state.version_id and state.version_id != 'null' and remote.version_id:
+        return remote.version_id != state.version_id
+    if state.remote_e_tag:
+        return remote.e_tag != state.remote_e_tag
+    return remote.e_tag is None or remote.e_tag not in (state.content_hash, state.e_tag)
+
+
+def resolve_conflict(local, remote, policy):
+    """
+    Decide how a conflict is resolved.
+
+    :param local: (DiffEntry) Entry of local file
+    :param remote: (DiffEntry) Entry of latest version of object
+    :param policy: (ConflictPolicy) How conflicts are resolved
+    :return: (SyncActionType) Upload, Download or Skip
+    """
+    if policy == ConflictPolicy.Local:
+        return SyncActionType.Upload
+    elif policy == ConflictPolicy.Remote:
+        return SyncActionType.Download
+    elif policy == ConflictPolicy.Skip:
+        return SyncActionType.Skip
+    if local.timestamp > remote.timestamp:
+        return SyncActionType.Upload
+    return SyncActionType.Download
+
+
+def conflict_path(full_path, timestamp):
+    """
+    Get the name a local file is kept under when a conflict is resolved by downloading over it.
+
+    :param full_path: (string) Full pathname of file
+    :param timestamp: (datetime) Time of conflict
+    :return: (string) Full pathname of conflict copy, <name>.conflict-<time><extension>
+    """
+    name, extension = os.path.splitext(full_path)
+    return f'{name}.conflict-{timestamp.strftime("%Y%m%dT%H%M%S")}{extension}'
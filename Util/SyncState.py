@@ -0,0 +1,330 @@
+import hashlib
+import os
+import sqlite3
+
+from Util.LocalScanner import LocalScanner, DEFAULT_MAX_WORKERS
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+class FileState:
+    """
+    State of a local file at the time it was last synchronized.
+    """
+    __slots__ = ('_path', '_size', '_mtime_ns', '_inode', '_content_hash', '_e_tag', '_remote_e_tag', '_version_id')
+
+    def __init__(self, path, size, mtime_ns, inode, content_hash, e_tag=None, remote_e_tag=None, version_id=None):
+        """
+
+        :param path: (string) Path of file relative to root of local folder, with '/' delimiters
+        :param size: (int) Size of file, in bytes
+        :param mtime_ns: (int) Modification time of file, in nanoseconds since the epoch
+        :param inode: (int) Inode number of file
+        :param content_hash: (string) Hex MD5 digest of file contents
+        :param e_tag: (string) ETag of the file uploaded in parts, or None if uploaded in one request
+        :param remote_e_tag: (string) ETag of the object in the bucket when the file was synchronized
+        :param version_id: (string) Version of the object in the bucket when the file was synchronized
+        """
+        self._path = path
+        self._size = size
+        self._mtime_ns = mtime_ns
+        self._inode = inode
+        self._content_hash = content_hash
+        self._e_tag = e_tag
+        self._remote_e_tag = remote_e_tag
+        self._version_id = version_id
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def mtime_ns(self):
+        return self._mtime_ns
+
+    @property
+    def inode(self):
+        return self._inode
+
+    @property
+    def content_hash(self):
+        return self._content_hash
+
+    @property
+    def e_tag(self):
+        return self._e_tag
+
+    @property
+    def remote_e_tag(self):
+        return self._remote_e_tag
+
+    @property
+    def version_id(self):
+        return self._version_id
+
+    def matches(self, stat_result):
+        """
+        Does a stat result show the file is unchanged since this state was recorded?
+
+        :param stat_result: (os.stat_result) Current stat of file
+        :return: (bool) True if size, modification time and inode are unchanged
+        """
+        return (self._size == stat_result.st_size and self._mtime_ns == stat_result.st_mtime_ns
+                and self._inode == stat_result.st_ino)
+
+
+class SyncStateIndex:
+    """
+    SQLite index of the state of every local file after the last successful sync, keyed by path
+    relative to the root of the local folder.  A later run can tell which files changed from their
+    stat results alone, and only hashes files whose size, modification time or inode changed.
+
+    Records are committed in batches, so after an interrupted run the files recorded so far are
+    skipped when the run is repeated.  Record a file only after it has been synchronized.
+    """
+    BATCH_SIZE = 1000
+    STATE_COLUMNS = 'Path, Size, MTime, Inode, Hash, ETag, RemoteETag, VersionId'
+
+    def __init__(self, database_name, batch_size=BATCH_SIZE):
+        """
+
+        :param database_name: (string) Name of index database (created if it doesn't exist)
+        :param batch_size: (int) Number of records per commit
+        """
+        self._db = sqlite3.connect(database_name)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('''CREATE TABLE IF NOT EXISTS "SyncState" (
+                "Path"      TEXT PRIMARY KEY,
+                "Size"      INTEGER,
+                "MTime"     INTEGER,
+                "Inode"     INTEGER,
+                "Hash"      TEXT,
+                "ETag"      TEXT,
+                "RemoteETag" TEXT,
+                "VersionId" TEXT
+                )''')
+        columns = [row[1] for row in self._db.execute('PRAGMA table_info("SyncState")')]
+        for column in ('ETag', 'RemoteETag', 'VersionId'):
+            if column not in columns:
+                self._db.execute(f'ALTER TABLE "SyncState" ADD COLUMN "{column}" TEXT')
+        self._db.execute('CREATE INDEX IF NOT EXISTS "SyncStateInode" ON "SyncState" ("Inode")')
+        self._db.commit()
+        self._database_name = database_name
+        self._batch_size = batch_size
+        self._pending = 0
+
+    @staticmethod
+    def default_database_name(source, target):
+        """
+        Get the default index database for a source folder and target, kept outside the source folder.
+
+        :param source: (string) Source folder
+        :param target: (string) Target, as given to CloudSync
+        :return: (string) Full pathname of index database
+        """
+        name = hashlib.sha1(f'{os.path.abspath(source)}|{target}'.encode('utf-8')).hexdigest()[0:16]
+        folder = os.path.join(os.path.expanduser('~'), '.cloudsync')
+        os.makedirs(folder, exist_ok=True)
+        return os.path.join(folder, f'state-{name}.db')
+
+    @staticmethod
+    def relative_path(root, full_path):
+        """
+        Get the key of a file in the index.
+
+        :param root: (string) Root of local folder
+        :param full_path: (string) Full pathname of file
+        :return: (string) Path relative to root, with '/' delimiters
+        """
+        path = os.path.relpath(full_path, root)
+        if os.sep != '/':
+            path = path.replace(os.sep, '/')
+        return path
+
+    @staticmethod
+    def content_hash(full_path, chunk_size=HASH_CHUNK_SIZE):
+        """
+        Hash the contents of a file, reading it in chunks.
+
+        :param full_path: (string) Full pathname of file
+        :param chunk_size: (int) Bytes read at a time
+        :return: (string) Hex MD5 digest of file contents
+        """
+        digest = hashlib.md5()
+        with open(full_path, 'rb') as f:
+            chunk = f.read(chunk_size)
+            while chunk:
+                digest.update(chunk)
+                chunk = f.read(chunk_size)
+        return digest.hexdigest()
+
+    @staticmethod
+    def file_hashes(full_path, part_size=None, chunk_size=HASH_CHUNK_SIZE):
+        """
+        Hash the contents of a file and, in the same pass, compute the ETag S3 gives the file when it is
+        uploaded in parts of part_size: the MD5 of the MD5 digests of the parts, followed by the number
+        of parts.
+
+        :param full_path: (string) Full pathname of file
+        :param part_size: (int) Part size of multipart uploads, or None if file is uploaded in one request
+        :param chunk_size: (int) Bytes read at a time
+        :return: (tuple) Hex MD5 digest of file contents, multipart ETag (None if uploaded in one request)
+        """
+        digest = hashlib.md5()
+        part_digests = []
+        part = hashlib.md5()
+        part_length = 0
+        with open(full_path, 'rb') as f:
+            while True:
+                if part_size:
+                    chunk = f.read(min(chunk_size, part_size - part_length))
+                else:
+                    chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                if part_size:
+                    part.update(chunk)
+                    part_length += len(chunk)
+                    if part_length == part_size:
+                        part_digests.append(part.digest())
+                        part = hashlib.md5()
+                        part_length = 0
+        if part_length:
+            part_digests.append(part.digest())
+        # files no larger than one part are uploaded in one request
+        if len(part_digests) < 2:
+            return digest.hexdigest(), None
+        return digest.hexdigest(), f'{hashlib.md5(b"".join(part_digests)).hexdigest()}-{len(part_digests)}'
+
+    def get(self, path):
+        """
+        Get the recorded state of a file.
+
+        :param path: (string) Relative path of file
+        :return: (FileState) Recorded state, or None if file not in index
+        """
+        row = self._db.execute(f'SELECT {self.STATE_COLUMNS} FROM SyncState WHERE Path=?',
+                               (path,)).fetchone()
+        if row is None:
+            return None
+        return FileState(*row)
+
+    def find_moved(self, stat_result):
+        """
+        Find the recorded state of a file that was renamed or moved since it was synchronized.  A rename
+        keeps the inode, size and modification time of a file.
+
+        :param stat_result: (os.stat_result) Current stat of file
+        :return: (FileState) Recorded state under the old path, or None
+        """
+        for row in self._db.execute(f'SELECT {self.STATE_COLUMNS} FROM SyncState WHERE Inode=?',
+                                    (stat_result.st_ino,)):
+            state = FileState(*row)
+            if state.matches(stat_result):
+                return state
+        return None
+
+    def changed_files(self, root, max_workers=DEFAULT_MAX_WORKERS):
+        """
+        Scan a local folder for files that are new or whose contents changed since they were recorded.
+        Files whose stat matches the index are skipped without being read.  Files whose stat changed
+        but whose contents hash the same are skipped, and their new stat is recorded.
+
+        :param root: (string) Root of local folder
+        :param max_workers: (int) Number of folders scanned at the same time
+        :return: (iterator) Tuples of relative path, full path, os.stat_result and content hash
+        """
+        for full_path, stat_result in LocalScanner(max_workers).scan(root):
+            path = self.relative_path(root, full_path)
+            state = self.get(path)
+            if state is not None and state.matches(stat_result):
+                continue
+            try:
+                content_hash = self.content_hash(full_path)
+            except OSError:
+                # removed or unreadable since it was scanned
+                continue
+            if state is not None and state.content_hash == content_hash:
+                self.record(path, stat_result, content_hash)
+                continue
+            yield path, full_path, stat_result, content_hash
+
+    def record(self, path, stat_result, content_hash, e_tag=None, remote_e_tag=None, version_id=None):
+        """
+        Record the state of a file after it has been synchronized.
+
+        :param path: (string) Relative path of file
+        :param stat_result: (os.stat_result) Stat of file when it was synchronized
+        :param content_hash: (string) Hex MD5 digest of file contents
+        :param e_tag: (string) Multipart ETag of file (see file_hashes), if uploaded in parts
+        :param remote_e_tag: (string) ETag of the object in the bucket, without quotes, if known
+        :param version_id: (string) Version of the object in the bucket, if known
+        """
+        self._db.execute('INSERT OR REPLACE INTO SyncState(Path,Size,MTime,Inode,Hash,ETag,RemoteETag,VersionId) '
+                         'VALUES(?,?,?,?,?,?,?,?)',
+                         (path, stat_result.st_size, stat_result.st_mtime_ns, stat_result.st_ino, content_hash,
+                          e_tag, remote_e_tag, version_id))
+        self._count_change()
+
+    def states(self, prefix='', batch_size=BATCH_SIZE):
+        """
+        Get the recorded state of every file, in path order, as of the time the first state is read.
+        The states are read on a separate connection in one read transaction, which sees a snapshot of
+        the index, so files recorded or removed while the states are read don't change what is read.
+
+        :param prefix: (string) Only get the files whose path starts with this prefix
+        :param batch_size: (int) Number of states fetched at a time
+        :return: (iterator) FileStates, sorted by path
+        """
+        self.commit()
+        condition = ''
+        parameters = ()
+        if prefix:
+            # a range of the primary key: paths from prefix up to the prefix with its last character incremented
+            condition = 'WHERE Path >= ? AND Path < ? '
+            parameters = (prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1))
+        db = sqlite3.connect(self._database_name)
+        try:
+            db.execute('BEGIN')
+            cursor = db.execute(f'SELECT {self.STATE_COLUMNS} FROM SyncState {condition}ORDER BY Path', parameters)
+            rows = cursor.fetchmany(batch_size)
+            while rows:
+                for row in rows:
+                    yield FileState(*row)
+                rows = cursor.fetchmany(batch_size)
+        finally:
+            db.close()
+
+    def remove(self, path):
+        """
+        Remove a file that no longer exists on either side from the index.
+
+        :param path: (string) Relative path of file
+        """
+        self._db.execute('DELETE FROM SyncState WHERE Path=?', (path,))
+        self._count_change()
+
+    def _count_change(self):
+        self._pending += 1
+        if self._pending >= self._batch_size:
+            self.commit()
+
+    def commit(self):
+        self._db.commit()
+        self._pending = 0
+
+    def close(self):
+        self.commit()
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,823 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from Util.Metrics import record
+from Util.S3Client import max_concurrency as default_concurrency
+
+MB = 1024 * 1024
+MIN_PART_SIZE = 5 * MB
+MAX_PARTS = 10000
+MAX_COPY_SIZE = 5 * 1024 * MB
+COPY_PART_SIZE = 512 * MB
+METADATA_MD5 = 'cloudsync-md5'
+# suffix of the temporary file a download is written to, renamed to the file when complete
+PART_SUFFIX = '.cloudsync-part'
+
+
+class TransferConfig:
+    """
+    Settings of a TransferEngine.
+    """
+
+    def __init__(self, part_size=8 * MB, max_concurrency=None, max_bytes_in_flight=256 * MB,
+                 small_file_size=1 * MB, batch_files=32, batch_bytes=8 * MB):
+        """
+
+        :param part_size: (int) Size of each part of a multipart transfer; larger files are transferred in parts
+        :param max_concurrency: (int) Number of requests made at the same time (default: concurrency of the
+                                shared clients, see S3Client)
+        :param max_bytes_in_flight: (int) Maximum bytes of all scheduled requests that haven't finished
+        :param small_file_size: (int) Files smaller than this are transferred in batches
+        :param batch_files: (int) Maximum number of files in a batch
+        :param batch_bytes: (int) Maximum total size of a batch
+        """
+        if part_size < MIN_PART_SIZE:
+            raise Exception(f'Part size must be at least {MIN_PART_SIZE} bytes')
+        if max_concurrency is None:
+            max_concurrency = default_concurrency()
+        if max_concurrency < 1:
+            raise Exception('max_concurrency must be at least 1')
+        self._part_size = part_size
+        self._max_concurrency = max_concurrency
+        self._max_bytes_in_flight = max_bytes_in_flight
+        self._small_file_size = small_file_size
+        self._batch_files = batch_files
+        self._batch_bytes = batch_bytes
+
+    @property
+    def part_size(self):
+        return self._part_size
+
+    @property
+    def max_concurrency(self):
+        return self._max_concurrency
+
+    @property
+    def max_bytes_in_flight(self):
+        return self._max_bytes_in_flight
+
+    @property
+    def small_file_size(self):
+        return self._small_file_size
+
+    @property
+    def batch_files(self):
+        return self._batch_files
+
+    @property
+    def batch_bytes(self):
+        return self._batch_bytes
+
+    def part_size_for(self, size):
+        """
+        Get the part size for a file, raised if needed to stay within the S3 limit on number of parts.
+
+        :param size: (int) Size of file, in bytes
+        :return: (int) Part size, in bytes
+        """
+        part_size = self._part_size
+        while part_size * MAX_PARTS < size:
+            part_size *= 2
+        return part_size
+
+
+class TransferItem:
+    """
+    A file to transfer between a local path and an S3 key.
+    """
+    __slots__ = ('_local_path', '_key', '_size', '_version_id', '_timestamp', '_content_hash', '_e_tag')
+
+    def __init__(self, local_path, key, size, version_id=None, timestamp=None, content_hash=None):
+        """
+
+        :param local_path: (string) Full pathname of local file
+        :param key: (string) Key of S3 object
+        :param size: (int) Size of file, in bytes
+        :param version_id: (string) Version of object to download (default: latest)
+        :param timestamp: (datetime) Modification time to give a downloaded file
+        :param content_hash: (string) Hex MD5 digest of file, stored in the metadata of an uploaded object
+        """
+        self._local_path = local_path
+        self._key = key
+        self._size = size
+        self._version_id = version_id
+        self._timestamp = timestamp
+        self._content_hash = content_hash
+        self._e_tag = None
+
+    @property
+    def local_path(self):
+        return self._local_path
+
+    @property
+    def key(self):
+        return self._key
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def version_id(self):
+        return self._version_id
+
+    @property
+    def e_tag(self):
+        """
+        Get the ETag (without quotes) S3 gave the object when it was uploaded or copied.
+
+        :return: (string) ETag, or None if not uploaded yet
+        """
+        return self._e_tag
+
+    def stored(self, e_tag, version_id=None):
+        """
+        Keep the ETag and version S3 gave an uploaded or copied object.
+
+        :param e_tag: (string) ETag, with or without quotes
+        :param version_id: (string) Version id of object, if the bucket is versioned
+        """
+        self._e_tag = e_tag.strip('"') if e_tag else None
+        self._version_id = version_id
+
+    @property
+    def timestamp(self):
+        return self._timestamp
+
+    @property
+    def content_hash(self):
+        return self._content_hash
+
+    @property
+    def metadata(self):
+        """
+        Get the metadata to store with an uploaded object.  The MD5 digest identifies the contents of
+        objects uploaded in parts, whose ETag is not a digest of the contents.
+        """
+        if self._content_hash is None:
+            return dict()
+        return {METADATA_MD5: self._content_hash}
+
+
+class CopyItem(TransferItem):
+    """
+    A local file whose contents already exist in the bucket under another key, copied on the server
+    instead of being uploaded.
+    """
+    __slots__ = ('_source_key', '_source_version_id')
+
+    def __init__(self, local_path, key, size, source_key, source_version_id=None, content_hash=None):
+        """
+
+        :param local_path: (string) Full pathname of local file
+        :param key: (string) Key of S3 object to create
+        :param size: (int) Size of file, in bytes
+        :param source_key: (string) Key of S3 object with the same contents
+        :param source_version_id: (string) Version of source object (default: latest)
+        :param content_hash: (string) Hex MD5 digest of file
+        """
+        super().__init__(local_path, key, size, content_hash=content_hash)
+        self._source_key = source_key
+        self._source_version_id = source_version_id
+
+    @property
+    def source_key(self):
+        return self._source_key
+
+    @property
+    def source_version_id(self):
+        return self._source_version_id
+
+
+class ByteBudget:
+    """
+    Global cap on the bytes of requests in flight.  A request larger than the cap is allowed when nothing
+    else is in flight.
+    """
+
+    def __init__(self, limit):
+        self._limit = limit
+        self._in_flight = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, size):
+        with self._condition:
+            while self._in_flight > 0 and self._in_flight + size > self._limit:
+                self._condition.wait()
+            self._in_flight += size
+
+    def release(self, size):
+        with self._condition:
+            self._in_flight -= size
+            self._condition.notify_all()
+
+    @property
+    def in_flight(self):
+        return self._in_flight
+
+
+class WorkerStats:
+    """
+    Bytes and time spent transferring by one worker thread.
+    """
+    __slots__ = ('_files', '_bytes', '_seconds', '_requests')
+
+    def __init__(self):
+        self._files = 0
+        self._bytes = 0
+        self._seconds = 0.0
+        self._requests = 0
+
+    def add(self, size, seconds, files):
+        self._files += files
+        self._bytes += size
+        self._seconds += seconds
+        self._requests += 1
+
+    @property
+    def files(self):
+        return self._files
+
+    @property
+    def bytes(self):
+        return self._bytes
+
+    @property
+    def seconds(self):
+        return self._seconds
+
+    @property
+    def requests(self):
+        return self._requests
+
+    @property
+    def throughput(self):
+        """
+        Get the throughput of the worker while it was transferring.
+
+        :return: (float) Bytes per second
+        """
+        if self._seconds == 0:
+            return 0.0
+        return self._bytes / self._seconds
+
+
+class TransferStats:
+    """
+    Throughput of a TransferEngine, per worker thread and in total.
+    """
+
+    def __init__(self):
+        self._workers = dict()
+        self._lock = threading.Lock()
+        self._start = None
+        self._end = None
+
+    def start(self):
+        self._start = time.perf_counter()
+        self._end = None
+
+    def stop(self):
+        self._end = time.perf_counter()
+
+    def record(self, size, seconds, files=0):
+        """
+        Record a request made by the calling worker thread.
+
+        :param size: (int) Bytes transferred
+        :param seconds: (float) Duration of request
+        :param files: (int) Files completed by request
+        """
+        name = threading.current_thread().name
+        with self._lock:
+            stats = self._workers.get(name)
+            if stats is None:
+                stats = self._workers[name] = WorkerStats()
+            stats.add(size, seconds, files)
+
+    @property
+    def workers(self):
+        return dict(self._workers)
+
+    @property
+    def bytes(self):
+        return sum(w.bytes for w in self._workers.values())
+
+    @property
+    def requests(self):
+        return sum(w.requests for w in self._workers.values())
+
+    @property
+    def elapsed(self):
+        if self._start is None:
+            return 0.0
+        return (self._end or time.perf_counter()) - self._start
+
+    @property
+    def throughput(self):
+        """
+        Get the overall throughput since the transfer started.
+
+        :return: (float) Bytes per second
+        """
+        if self.elapsed == 0:
+            return 0.0
+        return self.bytes / self.elapsed
+
+    def report(self):
+        """
+        Describe the throughput of each worker and the total.
+
+        :return: (list) Lines of report
+        """
+        lines = []
+        for name in sorted(self._workers):
+            w = self._workers[name]
+            lines.append(f'{name}: {w.files} files, {w.bytes / MB:.1f} MB in {w.seconds:.1f} s '
+                         f'({w.throughput / MB:.1f} MB/s)')
+        lines.append(f'Total: {self.bytes / MB:.1f} MB in {self.elapsed:.1f} s ({self.throughput / MB:.1f} MB/s)')
+        return lines
+
+
+class UploadJournal:
+    """
+    SQLite record of the multipart uploads in progress, so that an upload interrupted by a crash can be
+    resumed.  An upload is only resumed if the local file has the same size and modification time.
+    """
+
+    def __init__(self, database_name):
+        self._db = sqlite3.connect(database_name)
+        self._db.execute('''CREATE TABLE IF NOT EXISTS "MultipartUploads" (
+                "Key"       TEXT PRIMARY KEY,
+                "UploadId"  TEXT,
+                "Size"      INTEGER,
+                "MTime"     INTEGER,
+                "PartSize"  INTEGER
+                )''')
+        self._db.commit()
+
+    def get(self, key, stat_result, part_size):
+        """
+        Get the upload in progress for a key, if it was started for the same file.
+
+        :param key: (string) Key of S3 object
+        :param stat_result: (os.stat_result) Current stat of local file
+        :param part_size: (int) Part size of upload
+        :return: (string) Upload id, or None
+        """
+        row = self._db.execute('SELECT UploadId, Size, MTime, PartSize FROM MultipartUploads WHERE Key=?',
+                               (key,)).fetchone()
+        if row is None or row[1:] != (stat_result.st_size, stat_result.st_mtime_ns, part_size):
+            return None
+        return row[0]
+
+    def add(self, key, upload_id, stat_result, part_size):
+        self._db.execute('INSERT OR REPLACE INTO MultipartUploads(Key,UploadId,Size,MTime,PartSize) VALUES(?,?,?,?,?)',
+                         (key, upload_id, stat_result.st_size, stat_result.st_mtime_ns, part_size))
+        self._db.commit()
+
+    def remove(self, key):
+        self._db.execute('DELETE FROM MultipartUploads WHERE Key=?', (key,))
+        self._db.commit()
+
+    def close(self):
+        self._db.close()
+
+
+class MultipartTransfer:
+    """
+    State of a file being transferred in parts.
+    """
+
+    def __init__(self, item, part_size, upload_id=None, existing_parts=None):
+        self.item = item
+        self.part_size = part_size
+        self.upload_id = upload_id
+        self.existing_parts = existing_parts or dict()
+        self.part_count = max(1, (item.size + part_size - 1) // part_size)
+        self.parts = dict()
+        self.failed = False
+
+    def part_range(self, part_number):
+        """
+        Get the byte range of a part.
+
+        :param part_number: (int) Part number, starting at 1
+        :return: (tuple) Offset and length of part
+        """
+        offset = (part_number - 1) * self.part_size
+        return offset, min(self.part_size, self.item.size - offset)
+
+    @property
+    def is_upload(self):
+        return self.upload_id is not None
+
+    @property
+    def temp_path(self):
+        return self.item.local_path + PART_SUFFIX
+
+
+class TransferEngine:
+    """
+    Schedules uploads, downloads and server-side copies for one S3 bucket on a pool of worker threads.
+    Small files are sent in batches, one request after another on the same worker; large files are
+    split into parts sent in parallel.  The total size of scheduled requests is capped, so memory use
+    stays bounded however many files are given.
+    """
+
+    def __init__(self, client, bucket_name, config=None, journal=None):
+        """
+
+        :param client: (S3.Client) S3 client, shared by all worker threads
+        :param bucket_name: (string) Name of bucket
+        :param config: (TransferConfig) Settings (default: TransferConfig())
+        :param journal: (UploadJournal) Journal for resuming multipart uploads (default: no resume)
+        """
+        self._client = client
+        self._bucket_name = bucket_name
+        self._config = config or TransferConfig()
+        self._journal = journal
+        self._budget = ByteBudget(self._config.max_bytes_in_flight)
+        self._stats = TransferStats()
+        self._condition = threading.Condition()
+        self._events = deque()
+        self._outstanding = 0
+        self._failures = []
+        self._on_complete = None
+
+    @property
+    def config(self):
+        return self._config
+
+    @property
+    def stats(self):
+        return self._stats
+
+    def upload(self, items, on_complete=None):
+        """
+        Upload local files.
+
+        :param items: (iterator) TransferItems
+        :param on_complete: (function) Called on the calling thread with each TransferItem uploaded
+        :return: (list) Tuples of TransferItem and exception for files that failed
+        """
+        return self._run(items, on_complete, self._upload_batch, self._upload_file, self._start_upload)
+
+    def download(self, items, on_complete=None):
+        """
+        Download S3 objects to local files.  Each file is written to a temporary file first and renamed
+        when complete.
+
+        :param items: (iterator) TransferItems
+        :param on_complete: (function) Called on the calling thread with each TransferItem downloaded
+        :return: (list) Tuples of TransferItem and exception for files that failed
+        """
+        return self._run(items, on_complete, self._download_batch, self._download_file, self._start_download)
+
+    def copy(self, items, on_complete=None):
+        """
+        Copy S3 objects to new keys on the server, without transferring their contents.  Objects larger
+        than the limit of one copy request are copied in parts.
+
+        :param items: (iterator) CopyItems
+        :param on_complete: (function) Called on the calling thread with each CopyItem copied
+        :return: (list) Tuples of CopyItem and exception for objects that failed
+        """
+        self._failures = []
+        self._on_complete = on_complete
+        self._stats.start()
+        with ThreadPoolExecutor(max_workers=self._config.max_concurrency, thread_name_prefix='transfer') as executor:
+            for item in items:
+                if item.size <= MAX_COPY_SIZE:
+                    # no data passes through this process, so copies don't count against the byte budget
+                    self._submit(executor, 0, self._copy_object, item)
+                else:
+                    self._start_copy(executor, item)
+                self._drain()
+            self._wait_all()
+        self._stats.stop()
+        return self._failures
+
+    def _run(self, items, on_complete, batch_function, file_function, start_multipart):
+        self._failures = []
+        self._on_complete = on_complete
+        self._stats.start()
+        config = self._config
+        with ThreadPoolExecutor(max_workers=config.max_concurrency, thread_name_prefix='transfer') as executor:
+            batch = []
+            batch_bytes = 0
+            for item in items:
+                if item.size < config.small_file_size:
+                    batch.append(item)
+                    batch_bytes += item.size
+                    if len(batch) >= config.batch_files or batch_bytes >= config.batch_bytes:
+                        self._submit(executor, batch_bytes, batch_function, batch)
+                        batch = []
+                        batch_bytes = 0
+                elif item.size <= config.part_size:
+                    self._submit(executor, item.size, file_function, item)
+                else:
+                    start_multipart(executor, item)
+                self._drain()
+            if batch:
+                self._submit(executor, batch_bytes, batch_function, batch)
+            self._wait_all()
+        self._stats.stop()
+        return self._failures
+
+    def _wait_all(self):
+        """
+        Wait for all scheduled requests to finish, handling their events as they arrive.
+        """
+        while True:
+            with self._condition:
+                while self._outstanding > 0 and not self._events:
+                    self._condition.wait()
+                if self._outstanding == 0 and not self._events:
+                    break
+            self._drain()
+
+    def _submit(self, executor, size, function, *args):
+        self._budget.acquire(size)
+        with self._condition:
+            self._outstanding += 1
+        executor.submit(self._task, size, function, *args)
+
+    def _task(self, size, function, *args):
+        try:
+            function(*args)
+        finally:
+            self._budget.release(size)
+            with self._condition:
+                self._outstanding -= 1
+                self._condition.notify_all()
+
+    def _post(self, *event):
+        with self._condition:
+            self._events.append(event)
+            self._condition.notify_all()
+
+    def _drain(self):
+        """
+        Handle the events posted by workers, on the calling thread.
+        """
+        while self._events:
+            with self._condition:
+                event = self._events.popleft()
+            kind = event[0]
+            if kind == 'done':
+                if self._on_complete is not None:
+                    self._on_complete(event[1])
+            elif kind == 'failed':
+                self._failures.append((event[1], event[2]))
+            elif kind == 'part':
+                transfer, part_number, e_tag = event[1:]
+                transfer.parts[part_number] = e_tag
+                if len(transfer.parts) == transfer.part_count and not transfer.failed:
+                    self._finish_multipart(transfer)
+            elif kind == 'part-failed':
+                transfer = event[1]
+                if not transfer.failed:
+                    transfer.failed = True
+                    self._failures.append((transfer.item, event[2]))
+                    self._abandon_multipart(transfer)
+
+    def _abandon_multipart(self, transfer):
+        """
+        Clean up after a failed multipart transfer.  An upload recorded in the journal is kept so that it
+        can be resumed by the next run; otherwise it is aborted.  Multipart copies are always aborted.
+        """
+        try:
+            if not transfer.is_upload:
+                if os.path.exists(transfer.temp_path):
+                    os.remove(transfer.temp_path)
+            elif self._journal is None or isinstance(transfer.item, CopyItem):
+                self._client.abort_multipart_upload(Bucket=self._bucket_name, Key=transfer.item.key,
+                                                    UploadId=transfer.upload_id)
+        except Exception:
+            pass
+
+    def _timed(self, size, files, function, *args, **kwargs):
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        seconds = time.perf_counter() - start
+        self._stats.record(size, seconds, files)
+        record('transfer', seconds, size, files=files)
+        return result
+
+    # uploads
+
+    def _upload_file(self, item):
+        try:
+            with open(item.local_path, 'rb') as f:
+                data = f.read()
+            response = self._timed(len(data), 1, self._client.put_object, Bucket=self._bucket_name, Key=item.key,
+                                   Body=data, Metadata=item.metadata)
+            item.stored(response.get('ETag'), response.get('VersionId'))
+        except Exception as e:
+            self._post('failed', item, e)
+        else:
+            self._post('done', item)
+
+    def _upload_batch(self, items):
+        for item in items:
+            self._upload_file(item)
+
+    def _start_upload(self, executor, item):
+        try:
+            stat_result = os.stat(item.local_path)
+            part_size = self._config.part_size_for(item.size)
+            upload_id = None
+            existing_parts = dict()
+            if self._journal is not None:
+                upload_id = self._journal.get(item.key, stat_result, part_size)
+                if upload_id is not None:
+                    existing_parts = self._list_parts(item.key, upload_id)
+                    if existing_parts is None:
+                        upload_id = None
+            if upload_id is None:
+                response = self._client.create_multipart_upload(Bucket=self._bucket_name, Key=item.key,
+                                                                Metadata=item.metadata)
+                upload_id = response['UploadId']
+                existing_parts = dict()
+                if self._journal is not None:
+                    self._journal.add(item.key, upload_id, stat_result, part_size)
+        except Exception as e:
+            self._failures.append((item, e))
+            return
+        transfer = MultipartTransfer(item, part_size, upload_id, existing_parts)
+        for part_number in range(1, transfer.part_count + 1):
+            self._submit(executor, transfer.part_range(part_number)[1], self._upload_part, transfer, part_number)
+
+    def _list_parts(self, key, upload_id):
+        """
+        Get the parts already uploaded for a multipart upload.
+
+        :return: (dict) ETag of each uploaded part, by part number, or None if the upload no longer exists
+        """
+        parts = dict()
+        marker = 0
+        try:
+            while True:
+                response = self._client.list_parts(Bucket=self._bucket_name, Key=key, UploadId=upload_id,
+                                                   PartNumberMarker=marker)
+                for part in response.get('Parts', []):
+                    parts[part['PartNumber']] = (part['Size'], part['ETag'])
+                if not response.get('IsTruncated'):
+                    return parts
+                marker = response['NextPartNumberMarker']
+        except Exception:
+            return None
+
+    def _upload_part(self, transfer, part_number):
+        if transfer.failed:
+            return
+        try:
+            offset, length = transfer.part_range(part_number)
+            with open(transfer.item.local_path, 'rb') as f:
+                f.seek(offset)
+                data = f.read(length)
+            existing = transfer.existing_parts.get(part_number)
+            e_tag = '"' + hashlib.md5(data).hexdigest() + '"'
+            if existing is not None and existing == (length, e_tag):
+                # uploaded before the crash and unchanged since
+                self._post('part', transfer, part_number, e_tag)
+                return
+            response = self._timed(length, 0, self._client.upload_part, Bucket=self._bucket_name,
+                                   Key=transfer.item.key, UploadId=transfer.upload_id, PartNumber=part_number,
+                                   Body=data)
+        except Exception as e:
+            self._post('part-failed', transfer, e)
+        else:
+            self._post('part', transfer, part_number, response['ETag'])
+
+    def _finish_multipart(self, transfer):
+        item = transfer.item
+        try:
+            if transfer.is_upload:
+                parts = [{'ETag': transfer.parts[n], 'PartNumber': n} for n in range(1, transfer.part_count + 1)]
+                response = self._timed(0, 1, self._client.complete_multipart_upload, Bucket=self._bucket_name,
+                                       Key=item.key, UploadId=transfer.upload_id, MultipartUpload={'Parts': parts})
+                item.stored(response.get('ETag'), response.get('VersionId'))
+                if self._journal is not None and not isinstance(item, CopyItem):
+                    self._journal.remove(item.key)
+            else:
+                self._complete_download(item, transfer.temp_path)
+        except Exception as e:
+            self._failures.append((item, e))
+        else:
+            if self._on_complete is not None:
+                self._on_complete(item)
+
+    # downloads
+
+    def _get_object(self, item, **kwargs):
+        if item.version_id is not None:
+            kwargs['VersionId'] = item.version_id
+        response = self._client.get_object(Bucket=self._bucket_name, Key=item.key, **kwargs)
+        return response['Body'].read()
+
+    def _complete_download(self, item, temp_path):
+        os.replace(temp_path, item.local_path)
+        if item.timestamp is not None:
+            mtime = item.timestamp.timestamp()
+            os.utime(item.local_path, (mtime, mtime))
+
+    def _download_file(self, item):
+        temp_path = item.local_path + PART_SUFFIX
+        try:
+            folder = os.path.dirname(item.local_path)
+            if folder:
+                os.makedirs(folder, exist_ok=True)
+            data = self._timed(item.size, 1, self._get_object, item)
+            with open(temp_path, 'wb') as f:
+                f.write(data)
+            self._complete_download(item, temp_path)
+        except Exception as e:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            self._post('failed', item, e)
+        else:
+            self._post('done', item)
+
+    def _download_batch(self, items):
+        for item in items:
+            self._download_file(item)
+
+    def _start_download(self, executor, item):
+        transfer = MultipartTransfer(item, self._config.part_size_for(item.size))
+        try:
+            folder = os.path.dirname(item.local_path)
+            if folder:
+                os.makedirs(folder, exist_ok=True)
+            with open(transfer.temp_path, 'wb') as f:
+                f.truncate(item.size)
+        except Exception as e:
+            self._failures.append((item, e))
+            return
+        for part_number in range(1, transfer.part_count + 1):
+            self._submit(executor, transfer.part_range(part_number)[1], self._download_part, transfer, part_number)
+
+    def _download_part(self, transfer, part_number):
+        if transfer.failed:
+            return
+        try:
+            offset, length = transfer.part_range(part_number)
+            data = self._timed(length, 0, self._get_object, transfer.item,
+                               Range=f'bytes={offset}-{offset + length - 1}')
+            with open(transfer.temp_path, 'r+b') as f:
+                f.seek(offset)
+                f.write(data)
+        except Exception as e:
+            self._post('part-failed', transfer, e)
+        else:
+            self._post('part', transfer, part_number, None)
+
+    # server-side copies
+
+    def _copy_source(self, item):
+        source = {'Bucket': self._bucket_name, 'Key': item.source_key}
+        if item.source_version_id is not None:
+            source['VersionId'] = item.source_version_id
+        return source
+
+    def _copy_object(self, item):
+        try:
+            response = self._timed(0, 1, self._client.copy_object, Bucket=self._bucket_name, Key=item.key,
+                                   CopySource=self._copy_source(item))
+            item.stored(response.get('CopyObjectResult', {}).get('ETag'), response.get('VersionId'))
+        except Exception as e:
+            self._post('failed', item, e)
+        else:
+            self._post('done', item)
+
+    def _start_copy(self, executor, item):
+        try:
+            part_size = max(self._config.part_size_for(item.size), COPY_PART_SIZE)
+            response = self._client.create_multipart_upload(Bucket=self._bucket_name, Key=item.key,
+                                                            Metadata=item.metadata)
+        except Exception as e:
+            self._failures.append((item, e))
+            return
+        transfer = MultipartTransfer(item, part_size, response['UploadId'])
+        for part_number in range(1, transfer.part_count + 1):
+            self._submit(executor, 0, self._copy_part, transfer, part_number)
+
+    def _copy_part(self, transfer, part_number):
+        if transfer.failed:
+            return
+        try:
+            offset, length = transfer.part_range(part_number)
+            response = self._timed(0, 0, self._client.upload_part_copy, Bucket=self._bucket_name,
+                                   Key=transfer.item.key, UploadId=transfer.upload_id, PartNumber=part_number,
+                                   CopySource=self._copy_source(transfer.item),
+                                   CopySourceRange=f'bytes={offset}-{offset + length - 1}')
+        except Exception as e:
+            self._post('part-failed', transfer, e)
+        else:
+            self._post('part', transfer, part_number, response['CopyPartResult']['ETag'])
@@ -0,0 +1,532 @@
+import ctypes
+import errno
+import json
+import os
+import select
+import stat
+import struct
+import threading
+import time
+from datetime import datetime, timezone
+from urllib.parse import unquote_plus
+
+from Util.Diff import DiffEntry, e_tag_hash, s3_entries
+from Util.LocalScanner import LocalScanner, DEFAULT_MAX_WORKERS
+from Util.S3Client import AsyncS3Client, run_all
+from Util.Sync import object_changed
+from Util.SyncState import SyncStateIndex
+from Util.Transfer import METADATA_MD5
+
+DEFAULT_DEBOUNCE = 2.0
+DEFAULT_MAX_DELAY = 30.0
+DEFAULT_POLL_INTERVAL = 10.0
+DEFAULT_REMOTE_POLL_INTERVAL = 60.0
+HEAD_BATCH_SIZE = 100
+
+# key that stands for the whole tree, when events were lost and everything has to be compared again
+RESCAN = ''
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+INOTIFY_EVENT = struct.Struct('iIII')
+INOTIFY_READ_SIZE = 64 * 1024
+
+
+class ChangeQueue:
+    """
+    Debounced queue of changed keys.  Events for a key that is already waiting are coalesced into one
+    entry, and a key is only due once no event arrived for it for the debounce time, so a file that is
+    being written is synchronized once, after the writer is done.  A key that keeps changing is due
+    max_delay after its first event.
+    """
+
+    def __init__(self, debounce=DEFAULT_DEBOUNCE, max_delay=DEFAULT_MAX_DELAY, clock=time.monotonic):
+        """
+
+        :param debounce: (float) Seconds without events before a key is due
+        :param max_delay: (float) Seconds after its first event a key is due, even if events keep arriving
+        :param clock: (function) Returns the current time in seconds
+        """
+        self._debounce = debounce
+        self._max_delay = max_delay
+        self._clock = clock
+        self._waiting = dict()
+
+    def add(self, key):
+        """
+        Add an event for a key.
+
+        :param key: (string) Key of changed file, a folder key ending with '/' or RESCAN
+        """
+        now = self._clock()
+        first, last = self._waiting.get(key, (now, now))
+        self._waiting[key] = (first, now)
+
+    def _due_time(self, key):
+        first, last = self._waiting[key]
+        return min(last + self._debounce, first + self._max_delay)
+
+    def timeout(self, default=None):
+        """
+        Get the time until the next key is due, to wait for events for.
+
+        :param default: (float) Seconds to wait if no key is waiting (None waits indefinitely)
+        :return: (float) Seconds, 0 if a key is due
+        """
+        if not self._waiting:
+            return default
+        return max(min(self._due_time(key) for key in self._waiting) - self._clock(), 0.0)
+
+    def pop_due(self):
+        """
+        Remove the keys that are due from the queue.
+
+        :return: (list) Due keys, sorted
+        """
+        now = self._clock()
+        due = sorted(key for key in self._waiting if self._due_time(key) <= now)
+        for key in due:
+            del self._waiting[key]
+        return due
+
+    def pop_all(self):
+        """
+        Remove every key from the queue, due or not.
+
+        :return: (list) Keys, sorted
+        """
+        keys = sorted(self._waiting)
+        self._waiting.clear()
+        return keys
+
+    def __len__(self):
+        return len(self._waiting)
+
+
+def _libc():
+    # ctypes.util imports subprocess and tempfile, so it is only imported when inotify is used
+    import ctypes.util
+    path = ctypes.util.find_library('c')
+    if path is None:
+        raise OSError(errno.ENOSYS, 'C library not found')
+    libc = ctypes.CDLL(path, use_errno=True)
+    if not hasattr(libc, 'inotify_init1'):
+        raise OSError(errno.ENOSYS, 'inotify is not available')
+    return libc
+
+
+class InotifySource:
+    """
+    Local change events from Linux inotify, called through ctypes.  Every directory of the tree is
+    watched, so the cost of waiting for changes doesn't depend on the number of files.  Directories
+    created or moved into the tree are watched as they appear, and the files already in them are
+    reported.  A folder deleted or moved out of the tree is reported as a folder key ending with '/';
+    if the kernel queue overflowed, RESCAN is reported.
+    """
+    MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+    def __init__(self, root):
+        """
+
+        :param root: (string) Root of local folder
+        """
+        self._libc = _libc()
+        self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        self._root = root
+        self._watches = dict()
+        self._found = []
+        self._closed = False
+        self._poll = select.poll()
+        self._poll.register(self._fd, select.POLLIN)
+        try:
+            self._add_tree(RESCAN)
+        except Exception:
+            os.close(self._fd)
+            raise
+        self._found.clear()
+
+    def _add_tree(self, folder):
+        """
+        Watch a folder and the folders under it, adding the files in them to the found keys.  Each
+        folder is watched before it is read, so no file created in between is missed.
+        """
+        waiting = [folder]
+        while waiting:
+            folder = waiting.pop()
+            path = os.path.join(self._root, *folder.split('/')) if folder else self._root
+            wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path), self.MASK | IN_ONLYDIR)
+            if wd < 0:
+                error = ctypes.get_errno()
+                if error in (errno.ENOENT, errno.ENOTDIR):
+                    # removed since it was found
+                    continue
+                raise OSError(error, os.strerror(error), path)
+            self._watches[wd] = folder
+            files, directories = LocalScanner.scan_directory(path)
+            self._found.extend(SyncStateIndex.relative_path(self._root, full_path) for full_path, s in files)
+            waiting.extend(SyncStateIndex.relative_path(self._root, full_path) for full_path in directories)
+
+    def events(self, timeout=None):
+        """
+        Wait for changes.
+
+        :param timeout: (float) Seconds to wait for the first change (None waits indefinitely)
+        :return: (list) Keys of changed files (or folder keys or RESCAN), empty if there were none
+        """
+        keys = self._found
+        self._found = []
+        if keys:
+            timeout = 0
+        if not self._poll.poll(None if timeout is None else int(timeout * 1000)):
+            return keys
+        while True:
+            try:
+                data = os.read(self._fd, INOTIFY_READ_SIZE)
+            except BlockingIOError:
+                break
+            keys.extend(self._parse(data))
+        keys.extend(self._found)
+        self._found = []
+        return keys
+
+    def _parse(self, data):
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = INOTIFY_EVENT.unpack_from(data, offset)
+            name = os.fsdecode(data[offset + INOTIFY_EVENT.size:offset + INOTIFY_EVENT.size + length].rstrip(b'\0'))
+            offset += INOTIFY_EVENT.size + length
+            if mask & IN_Q_OVERFLOW:
+                yield RESCAN
+                continue
+            folder = self._watches.get(wd)
+            if folder is None:
+                continue
+            if mask & IN_IGNORED:
+                del self._watches[wd]
+                continue
+            key = f'{folder}/{name}' if folder else name
+            if not mask & IN_ISDIR:
+                yield key
+            elif mask & (IN_CREATE | IN_MOVED_TO):
+                self._add_tree(key)
+            else:
+                yield key + '/'
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            os.close(self._fd)
+
+
+class PollingSource:
+    """
+    Local change events found by scanning the whole tree every interval and comparing the stat of every
+    file with the previous scan, for systems without inotify.  Scans cost time proportional to the
+    number of files, so the interval should grow with the tree.
+    """
+
+    def __init__(self, root, interval=DEFAULT_POLL_INTERVAL, max_workers=DEFAULT_MAX_WORKERS, clock=time.monotonic):
+        """
+
+        :param root: (string) Root of local folder
+        :param interval: (float) Seconds between scans
+        :param max_workers: (int) Number of folders scanned at the same time
+        :param clock: (function) Returns the current time in seconds
+        """
+        self._root = root
+        self._interval = interval
+        self._scanner = LocalScanner(max_workers)
+        self._clock = clock
+        self._closed = False
+        self._files = self._scan()
+        self._next_scan = clock() + interval
+
+    def _scan(self):
+        return dict((SyncStateIndex.relative_path(self._root, full_path),
+                     (stat_result.st_size, stat_result.st_mtime_ns, stat_result.st_ino))
+                    for full_path, stat_result in self._scanner.scan(self._root))
+
+    def events(self, timeout=None):
+        """
+        Wait for the next scan, and get the files that changed since the last one.
+
+        :param timeout: (float) Seconds to wait at most (None waits for the next scan)
+        :return: (list) Keys of changed files, empty if there were none or the next scan isn't due
+        """
+        wait = self._next_scan - self._clock()
+        if wait > 0:
+            if timeout is not None and timeout < wait:
+                time.sleep(timeout)
+                return []
+            time.sleep(wait)
+        files = self._scan()
+        self._next_scan = self._clock() + self._interval
+        keys = [key for key, signature in files.items() if self._files.get(key) != signature]
+        keys.extend(key for key in self._files if key not in files)
+        self._files = files
+        return keys
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def close(self):
+        self._closed = True
+
+
+class SimulatedSource:
+    """
+    Local change events supplied by the caller, for tests.
+    """
+
+    def __init__(self):
+        self._keys = []
+        self._closed = False
+        self._condition = threading.Condition()
+
+    def change(self, *keys):
+        """
+        Report changed files.
+
+        :param keys: (string) Keys of changed files (or folder keys or RESCAN)
+        """
+        with self._condition:
+            self._keys.extend(keys)
+            self._condition.notify_all()
+
+    def events(self, timeout=None):
+        """
+        Wait for changes.
+
+        :param timeout: (float) Seconds to wait for the first change (None waits indefinitely)
+        :return: (list) Keys reported since the last call
+        """
+        with self._condition:
+            if not self._keys and not self._closed:
+                self._condition.wait(timeout)
+            keys = self._keys
+            self._keys = []
+        return keys
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+
+def local_event_source(root, poll_interval=DEFAULT_POLL_INTERVAL):
+    """
+    Get the best source of local change events: inotify if the system has it, otherwise polling.
+
+    :param root: (string) Root of local folder
+    :param poll_interval: (float) Seconds between scans, if polling
+    :return: InotifySource or PollingSource
+    """
+    try:
+        return InotifySource(root)
+    except OSError:
+        # no inotify, or too many folders for the inotify watch limit
+        return PollingSource(root, poll_interval)
+
+
+class SqsPoller:
+    """
+    Remote changes from the S3 event notifications of a bucket, delivered to an SQS queue.  The queue is
+    read without waiting, and messages are deleted once their keys were taken.
+    """
+
+    def __init__(self, sqs_client, queue_url, bucket_name, prefix=''):
+        """
+
+        :param sqs_client: (SQS.Client) SQS client
+        :param queue_url: (string) URL of queue the bucket sends ObjectCreated and ObjectRemoved events to
+        :param bucket_name: (string) Name of bucket
+        :param prefix: (string) Prefix of keys, removed from the keys returned
+        """
+        self._sqs = sqs_client
+        self._queue_url = queue_url
+        self._bucket_name = bucket_name
+        self._prefix = prefix
+
+    def changes(self):
+        """
+        Get the keys changed since the last call.
+
+        :return: (list) Keys relative to prefix
+        """
+        keys = []
+        while True:
+            response = self._sqs.receive_message(QueueUrl=self._queue_url, MaxNumberOfMessages=10,
+                                                 WaitTimeSeconds=0)
+            messages = response.get('Messages', [])
+            if not messages:
+                return keys
+            for message in messages:
+                keys.extend(self.message_keys(message['Body']))
+            self._sqs.delete_message_batch(QueueUrl=self._queue_url, Entries=[
+                {'Id': str(n), 'ReceiptHandle': message['ReceiptHandle']} for n, message in enumerate(messages)])
+
+    def message_keys(self, body):
+        """
+        Get the keys of an S3 event notification.  Test events have no records.
+
+        :param body: (string) JSON body of message
+        :return: (list) Keys relative to prefix, of the records for this bucket and prefix
+        """
+        keys = []
+        for record in json.loads(body).get('Records', []):
+            s3 = record.get('s3', {})
+            if s3.get('bucket', {}).get('name') != self._bucket_name:
+                continue
+            # keys are URL-encoded in notifications
+            key = unquote_plus(s3.get('object', {}).get('key', ''))
+            if key.startswith(self._prefix) and len(key) > len(self._prefix):
+                keys.append(key[len(self._prefix):])
+        return keys
+
+
+class ListingPoller:
+    """
+    Remote changes found by listing the prefix every interval and comparing it with the sync-state index
+    in one merge: objects whose version or ETag differs from the one recorded at the last sync, new
+    objects and deleted objects are changes.  Nothing is kept between polls.
+    """
+
+    def __init__(self, client, bucket_name, prefix, index, interval=DEFAULT_REMOTE_POLL_INTERVAL,
+                 clock=time.monotonic):
+        """
+
+        :param client: (S3.Client) S3 client
+        :param bucket_name: (string) Name of bucket
+        :param prefix: (string) Prefix of keys, removed from the keys returned
+        :param index: (SyncStateIndex) Index of last sync
+        :param interval: (float) Seconds between listings
+        :param clock: (function) Returns the current time in seconds
+        """
+        self._client = client
+        self._bucket_name = bucket_name
+        self._prefix = prefix
+        self._index = index
+        self._interval = interval
+        self._clock = clock
+        self._next_poll = clock() + interval
+
+    def changes(self):
+        """
+        Get the keys changed since the last sync, if a listing is due.
+
+        :return: (list) Keys relative to prefix
+        """
+        if self._clock() < self._next_poll:
+            return []
+        self._next_poll = self._clock() + self._interval
+        keys = []
+        remote = s3_entries(self._client, self._bucket_name, self._prefix)
+        base = self._index.states()
+        r = next(remote, None)
+        b = next(base, None)
+        while r is not None or b is not None:
+            if b is None or (r is not None and r.key < b.path):
+                keys.append(r.key)
+                r = next(remote, None)
+            elif r is None or b.path < r.key:
+                keys.append(b.path)
+                b = next(base, None)
+            else:
+                if object_changed(r, b):
+                    keys.append(r.key)
+                r = next(remote, None)
+                b = next(base, None)
+        return keys
+
+
+def expand_keys(root, index, keys):
+    """
+    Get the keys of the files a list of changed keys stands for: folder keys ending with '/' stand for
+    the files under the folder now and the files recorded under it at the last sync.
+
+    :param root: (string) Root of local folder
+    :param index: (SyncStateIndex) Index of last sync
+    :param keys: (list) Keys of changed files and folders (not RESCAN)
+    :return: (list) Keys of files, sorted
+    """
+    files = set()
+    for key in keys:
+        if not key.endswith('/'):
+            files.add(key)
+            continue
+        folder = os.path.join(root, *key.rstrip('/').split('/'))
+        if os.path.isdir(folder):
+            files.update(SyncStateIndex.relative_path(root, full_path)
+                         for full_path, stat_result in LocalScanner(1).scan(folder))
+        files.update(state.path for state in index.states(key))
+    return sorted(files)
+
+
+def local_key_entries(root, keys):
+    """
+    Get the entries of the local files of some keys, in key order.  Keys of files that don't exist (or
+    are not regular files) are left out.
+
+    :param root: (string) Root of local folder
+    :param keys: (list) Keys, sorted
+    :return: (iterator) DiffEntries, file_object is the full path of each file and stat_result its stat
+    """
+    for key in keys:
+        full_path = os.path.join(root, *key.split('/'))
+        try:
+            stat_result = os.stat(full_path)
+        except OSError:
+            continue
+        if stat.S_ISREG(stat_result.st_mode):
+            yield DiffEntry(key, stat_result.st_size, datetime.fromtimestamp(stat_result.st_mtime, timezone.utc),
+                            file_object=full_path, stat_result=stat_result)
+
+
+def remote_key_entries(client, bucket_name, prefix, keys):
+    """
+    Get the entries of the latest versions of the objects of some keys, in key order, with one HEAD
+    request per key.  The requests of up to HEAD_BATCH_SIZE keys are made at the same time, through the
+    asyncio interface of the shared clients.  Keys without an object, or whose latest version is a
+    delete marker, are left out.
+
+    :param client: (S3.Client) S3 client
+    :param bucket_name: (string) Name of bucket
+    :param prefix: (string) Prefix of keys
+    :param keys: (list) Keys relative to prefix, sorted
+    :return: (iterator) DiffEntries, file_object is the S3 key
+    """
+    s3 = AsyncS3Client(client)
+    for start in range(0, len(keys), HEAD_BATCH_SIZE):
+        batch = keys[start:start + HEAD_BATCH_SIZE]
+        responses = run_all([s3.head_object(Bucket=bucket_name, Key=prefix + key) for key in batch])
+        for key, response in zip(batch, responses):
+            if isinstance(response, Exception):
+                if getattr(response, 'response', {}).get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                    continue
+                raise response
+            e_tag = response['ETag'].strip('"') if response.get('ETag') else None
+            # objects uploaded in parts keep the MD5 of their contents in their metadata
+            content_hash = e_tag_hash(e_tag) or response.get('Metadata', {}).get(METADATA_MD5)
+            yield DiffEntry(key, response['ContentLength'], response['LastModified'], content_hash,
+                            response.get('VersionId'), file_object=prefix + key, e_tag=e_tag)